@@ -14,32 +14,113 @@ import time
 import tqdm
 
 import argparse
+import functools
+import threading
 import subprocess
-import multiprocessing
 
 #import logging
 #import logging.config
 
 import yaml
+import json
 import pprint
 
 pp = pprint.PrettyPrinter(indent=2)
 
 import utils
 
+from common import tracing
+from common import docker_api
+
 max_cores = os.cpu_count()
 
+default_build_index = os.path.join(os.path.expanduser("~"), ".cache", "mhubai", "build_index.json")
+
+# the build index is shared by all the build threads
+build_index_lock = threading.Lock()
+
 ## --------------------------------
 
 # for now, build only
-def run_core(image_dict):
+def run_core(image_dict, build_index=None, path_to_index=None, commit_hash=None, force_rebuild=False, use_api=False,
+             buildkit=None):
     try:
-        image_tag = utils.build_docker_image(image_dict)    
+        image_tag = utils.get_image_tag(image_dict)
+
+        # no index: always build from scratch (with BuildKit, the layer cache knows the version of the models)
+        if build_index is None:
+            no_cache = force_rebuild or buildkit is None or not is_layer_cache_safe(image_dict)
+
+            with tracing.span(image_tag, "build", no_cache = no_cache):
+                return utils.build_docker_image(image_dict, no_cache = no_cache, use_api = use_api,
+                                                buildkit = buildkit)
+
+        build_key = utils.get_build_key(image_dict, use_api = use_api)
+
+        with build_index_lock:
+            last_build = build_index["images"].get(image_tag)
+
+        # skip the build if nothing the image is built from changed (and the image is still there)
+        if not force_rebuild and last_build is not None and last_build["build_key"] == build_key:
+            if docker_api.get_image_id(image_tag, use_api = use_api) == last_build["image_id"]:
+                print("Image %s is up to date (build key %s...) - skipping build"%(image_tag, build_key[:12]))
+                return image_tag
+
+        # something changed: the layers that did not change are still taken from the cache (the layers fetching
+        # the models repository are built again if the image folder changed, see `utils.add_models_tree_arg`)
+        no_cache = force_rebuild or not is_layer_cache_safe(image_dict)
+
+        with tracing.span(image_tag, "build", no_cache = no_cache):
+            image_tag = utils.build_docker_image(image_dict, no_cache = no_cache, use_api = use_api,
+                                                 buildkit = buildkit)
+
+        with build_index_lock:
+            build_index["images"][image_tag] = {"build_key": build_key,
+                                      "commit_hash": commit_hash,
+                                      "image_id": docker_api.get_image_id(image_tag, use_api = use_api),
+                                      "timestamp": time.time()}
+            utils.save_build_index(build_index, path_to_index)
+
     except Exception as e:
         print("Error building image %s"%image_dict["name"])
         print(e)
         return None
 
+    return image_tag
+
+## --------------------------------
+
+def is_layer_cache_safe(image_dict):
+
+    """
+    Returns True if the layer cache of an image can be used: its Dockerfile fetches the models repository with the
+    command the version of the image folder is tied to (see `utils.add_models_tree_arg`). Otherwise, the cache
+    could hold the models of another commit, and the image is built without it.
+    """
+
+    if utils.fetches_models_repository(utils.read_dockerfile(image_dict)):
+        return True
+
+    print("The Dockerfile of %s does not fetch the models repository with `%s`: building it without the layer "
+          "cache"%(utils.get_image_tag(image_dict), utils.models_fetch_command))
+
+    return False
+
+## --------------------------------
+
+def get_buildkit_options(args):
+
+    """
+    Returns the BuildKit options passed to `utils.build_docker_image` (None if not building with BuildKit).
+    """
+
+    if not args.buildkit:
+        return None
+
+    return {"builder": args.buildkit_builder,
+            "cache_dir": args.buildkit_cache_dir,
+            "cache_registry": args.buildkit_cache_registry}
+
 ## --------------------------------
 
 def dryrun_core(image_dict):
@@ -47,9 +128,171 @@ def dryrun_core(image_dict):
     pp.pprint(image_dict)
     print("")
 
+    return utils.get_image_tag(image_dict)
+
 ## --------------------------------
 
-def main():
+def load_config(config_paths):
+
+    """
+    Loads the build config file(s).
+
+    The images of all the config files are merged, while the rest is taken from the first file.
+    """
+
+    config_dict = None
+    for config_path in config_paths:
+        with open(config_path, 'r') as f:
+            tmp = yaml.safe_load(f)
+
+        if config_dict is None:
+            config_dict = tmp
+        else:
+            config_dict["images"].update(tmp["images"])
+
+    return config_dict
+
+## --------------------------------
+
+def sync_repository(config_dict, branch="main", dryrun=False, verbose=False, ttl=utils.git_sync.DEFAULT_CACHE_TTL):
+
+    """
+    Brings the models repository (and the branch to build, if not main) up to date with the remote,
+    and returns the hash of the commit checked out in the repository (see `common/git_sync.py`).
+
+    If git fails (e.g., the remote can not be reached, or the branch is not found), the error is printed
+    and the script exits.
+    """
+
+    try:
+        with tracing.span("git sync", "git", branch = branch) as span_args:
+            result = utils.git_sync.sync_repository(path_to_repo = config_dict["github"]["repository_folder"],
+                                                    repo_url = config_dict["github"]["repository_url"],
+                                                    branches = [branch],
+                                                    dryrun = dryrun,
+                                                    ttl = ttl)
+
+            span_args["fetched"] = ",".join(result.fetched)
+            span_args["from_cache"] = result.from_cache
+
+    except utils.git_sync.GitSyncError as e:
+        print("ERROR: could not sync the models repository with %s"%config_dict["github"]["repository_url"])
+        print(e)
+        sys.exit(1)
+
+    if verbose:
+        for state in result.branches.values():
+            print("Branch %s: local %s, remote %s%s"%(state.branch, state.local_hash, state.remote_hash,
+                                                      " (cached)" if result.from_cache else ""))
+        print("")
+
+    if result.updated:
+        print("Updated the models repository to %s\n"%result.commit_hash)
+
+    # the commit the images are built from (i.e., after the pull)
+    return result.commit_hash
+
+## --------------------------------
+
+def checkout_branch(config_dict, branch, worktree_dir=utils.default_worktree_dir, dryrun=False, verbose=False):
+
+    """
+    Points the config to the worktree of a branch of the models repository (see `utils.get_branch_worktree`),
+    and returns the hash of the commit checked out there.
+
+    The checkout of the repository itself is left on main: builds of different branches can run at the same time.
+    The branch is expected to be fetched already (see `sync_repository`).
+    """
+
+    path_to_worktree = utils.get_branch_worktree(path_to_repo = config_dict["github"]["repository_folder"],
+                                                 branch = branch,
+                                                 worktree_dir = worktree_dir,
+                                                 update = not dryrun)
+
+    # in dry run mode, the worktree is only used if it is already there
+    if dryrun:
+        print("git worktree %s (%s)\n"%(path_to_worktree, branch))
+
+        if not os.path.isdir(path_to_worktree):
+            return None
+
+    config_dict["github"]["repository_folder"] = path_to_worktree
+    commit_hash = utils.get_git_hash(path_to_repo = path_to_worktree)
+
+    if verbose:
+        print("Building branch %s from %s (commit %s)\n"%(branch, path_to_worktree, commit_hash))
+
+    return commit_hash
+
+## --------------------------------
+
+def get_image_list(config_dict, branch="main"):
+
+    """
+    Returns the list of images to build (formatted in dictionaries, as passed to `utils.build_docker_image`).
+    """
+
+    image_list = list()
+
+    # populate a list of images to build (formatted in dictionaries)
+    for image in config_dict["images"]:
+        
+        # get the image dictionary
+        image_dict = config_dict["images"][image]
+
+        # quick workaround to avoid passing the config dictionary to the `build_docker_image` function
+        image_dict["repository_folder"] = config_dict["github"]["repository_folder"]
+        image_dict["dockerhub_username"] = config_dict["dockerhub"]["username"]
+
+        # if a branch different from main is specified, append it to the image tag
+        # furthermore, build the Dockerfiles pulling the correct branch (see `utils.read_dockerfile`)
+        if branch != "main":
+            image_dict["version"] = branch
+            image_dict["branch"] = branch
+
+        image_list.append(image_dict)
+
+    return image_list
+
+## --------------------------------
+
+def get_affected_image_list(image_list, build_graph, build_index, config_dict, branch, commit_hash):
+
+    """
+    Returns the images (and the build graph) affected by the changes since the last commit built successfully.
+
+    If the affected images can not be found (e.g., no commit was built successfully yet), every image is returned.
+    """
+
+    last_built_hash = build_index["commits"].get(branch)
+
+    try:
+        if last_built_hash is None:
+            raise ValueError("no successful build found for branch %s"%branch)
+
+        updated_folders = utils.get_list_of_updated_folders(
+            path_to_repo = config_dict["github"]["repository_folder"],
+            from_hash = last_built_hash,
+            to_hash = commit_hash)
+
+        affected_tags = utils.get_affected_images(image_list, build_graph, updated_folders)
+
+        print("Found %g image(s) affected by the changes between %s and %s\n"%(len(affected_tags),
+                                                                             last_built_hash[:7], commit_hash[:7]))
+
+        image_list = [d for d in image_list if utils.get_image_tag(d) in affected_tags]
+        build_graph = {t: [p for p in parents if p in affected_tags]
+                       for t, parents in build_graph.items() if t in affected_tags}
+
+    except Exception as e:
+        print("WARNING: could not find the images affected by the last changes - building all of the images")
+        print(e, "\n")
+
+    return image_list, build_graph
+
+## --------------------------------
+
+def main(argv=None):
 
     # TO-DO: implement ands set up logging
     # https://stackoverflow.com/questions/7507825/where-is-a-complete-example-of-logging-config-dictconfig
@@ -61,88 +304,144 @@ def main():
     #parser.add_argument('-l', '--logging', action='store_true', help='enable logging')
     parser.add_argument('--verbose', action='store_true', help='enable verbose mode')
     parser.add_argument('--dryrun', action='store_true', help='execute in dry run mode')
-    parser.add_argument('--ncores', action='store', help='number of cores to execute on (max is %g)'%max_cores, 
+    parser.add_argument('--ncores', action='store', help='maximum number of images to build at the same time (max is %g)'%max_cores, 
                         type=int, default=4)
     parser.add_argument('--branch', action='store', help='name of the branch to build the images from',
                         type=str, default="main")
-    parser.add_argument('--config', action='store', help='path to config file', required=True)
+    parser.add_argument('--git_cache_ttl', action='store', type=float, default=utils.git_sync.DEFAULT_CACHE_TTL,
+                        help='seconds the commits of the remote branches are cached for (0 to check the remote every time)')
+    parser.add_argument('--worktree_dir', action='store', type=str, default=utils.default_worktree_dir,
+                        help='folder storing the worktrees the branches other than main are built from')
+    parser.add_argument('--incremental', action='store_true',
+                        help='skip the images whose Dockerfile, build context, parent images and image folder did not change')
+    parser.add_argument('--force_rebuild', action='store_true',
+                        help='rebuild every image from scratch, without the layer cache (and regardless of the build index)')
+    parser.add_argument('--changed_only', action='store_true',
+                        help='only build the images affected by the changes since the last successful build')
+    parser.add_argument('--affected_list', action='store', type=str, default=None,
+                        help='path to a JSON file to store the list of images to build (e.g., to test and push only those)')
+    parser.add_argument('--build_index', action='store', help='path to the build index (incremental/changed-only mode)',
+                        type=str, default=default_build_index)
+    parser.add_argument('--docker_api', action='store_true',
+                        help='talk to the Docker Engine API (/var/run/docker.sock) instead of running the docker CLI')
+    parser.add_argument('--buildkit', action='store_true',
+                        help='build the images with BuildKit (docker buildx), importing and exporting their layer cache')
+    parser.add_argument('--buildkit_builder', action='store', type=str, default=None,
+                        help='name of the buildx builder to use (default: the current one)')
+    parser.add_argument('--buildkit_cache_dir', action='store', type=str, default=utils.default_buildkit_cache_dir,
+                        help='folder storing the BuildKit layer cache of every image')
+    parser.add_argument('--buildkit_cache_registry', action='store', type=str, default=None,
+                        help='registry storing the BuildKit layer cache instead of --buildkit_cache_dir (e.g., localhost:5000/mhubai)')
+    parser.add_argument('--build_memory', action='store', type=str, default="4G",
+                        help='memory needed by the builds of the images without resource hints in the config (e.g., 8G)')
+    parser.add_argument('--build_disk', action='store', type=str, default="10G",
+                        help='disk space needed by the builds of the images without resource hints in the config')
+    parser.add_argument('--docker_root', action='store', type=str, default=utils.resources.DEFAULT_DOCKER_ROOT,
+                        help='folder storing the Docker images, whose free disk space is checked before every build')
+    parser.add_argument('--no_admission', action='store_true',
+                        help='start the builds regardless of the memory, CPUs and disk space available')
+    parser.add_argument('--trace_dir', action='store', type=str, default=None,
+                        help='folder to export the timing of every step to (as <run_id>.trace.json)')
+    parser.add_argument('--run_id', action='store', type=str, default=None,
+                        help='ID of the run, shared by the stages writing to the same trace (default: a new one)')
+    parser.add_argument('--config', action='store', nargs='+', required=True,
+                        help='path to config file(s) - images from multiple files are built together')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
-    # parse yaml config file
-    with open(args.config, 'r') as f:
-        config_dict = yaml.safe_load(f)
-    
-    use_multiprocessing = True if args.ncores > 1 else False
-    
-    # get hash for the current commit using git
-    commit_hash = utils.get_git_hash(path_to_repo = config_dict["github"]["repository_folder"])
-    remote_hash = utils.get_git_hash_remote(repo_url = config_dict["github"]["repository_url"])
+    if args.trace_dir is not None:
+        tracing.start_trace(run_id = args.run_id)
 
-    if args.verbose:
-        print("Commit hash:", commit_hash)
-        print("Remote hash:", remote_hash, "\n")
+    # parse yaml config file(s)
+    config_dict = load_config(args.config)
 
-    # if the two hashes are different, pull the latest changes
-    if commit_hash != remote_hash:
-        if args.dryrun:
-            print("git pull %s \n"%config_dict["github"]["repository_folder"])
-        else:
-            print(utils.git_pull(path_to_repo = config_dict["github"]["repository_folder"]))
+    # pull the latest changes, and get the hash of the commit the images are built from
+    commit_hash = sync_repository(config_dict, branch = args.branch, dryrun = args.dryrun, verbose = args.verbose,
+                                  ttl = args.git_cache_ttl)
 
-    image_list = list()
+    # the branches other than main are built from their own worktree
+    if args.branch != "main":
+        with tracing.span("git worktree", "git", branch = args.branch):
+            commit_hash = checkout_branch(config_dict, branch = args.branch, worktree_dir = args.worktree_dir,
+                                          dryrun = args.dryrun, verbose = args.verbose) or commit_hash
 
-    # populate a list of images to build (formatted in dictionaries)
-    for image in config_dict["images"]:
-        
-        # get the image dictionary
-        image_dict = config_dict["images"][image]
+    image_list = get_image_list(config_dict, branch = args.branch)
 
-        # quick workaround to avoid passing the config dictionary to the `build_docker_image` function
-        image_dict["repository_folder"] = config_dict["github"]["repository_folder"]
-        image_dict["dockerhub_username"] = config_dict["dockerhub"]["username"]
+    # images built from other images in the list (FROM lines) are only built once their parent is done
+    build_graph = utils.get_build_graph(image_list)
 
-        # if a branch different from main is specified, append it to the image tag
-        # furthermore, modify the Dockerfiles to pull the correct branch
-        if args.branch != "main":
-            image_dict["version"] = args.branch
+    if args.verbose:
+        print("Build graph (image: images it is built from):")
+        pp.pprint(build_graph)
+        print("")
 
-            # modify the Dockerfile
-            utils.modify_dockerfile(image_dict, branch = args.branch)
+    if args.incremental or args.changed_only:
+        build_index = utils.load_build_index(args.build_index)
 
-        image_list.append(image_dict)
+        if args.verbose:
+            print("Using the build index at %s (%g images)\n"%(args.build_index, len(build_index["images"])))
+
+    # only keep the images affected by the changes since the last commit built successfully (and their children)
+    if args.changed_only:
+        image_list, build_graph = get_affected_image_list(image_list, build_graph, build_index, config_dict,
+                                                          branch = args.branch, commit_hash = commit_hash)
+
+    if args.affected_list is not None:
+        with open(args.affected_list, "w") as f:
+            json.dump([utils.get_image_tag(d) for d in image_list], f, indent=2)
+
+    if args.dryrun:
+        core_fn = dryrun_core
+    elif args.incremental:
+        core_fn = functools.partial(run_core, build_index = build_index, path_to_index = args.build_index,
+                                    commit_hash = commit_hash, force_rebuild = args.force_rebuild,
+                                    use_api = args.docker_api, buildkit = get_buildkit_options(args))
+    else:
+        core_fn = functools.partial(run_core, force_rebuild = args.force_rebuild, use_api = args.docker_api,
+                                    buildkit = get_buildkit_options(args))
 
-    # for every image in the config file, build the docker image and push it to the registry
-    if use_multiprocessing:
-        pool = multiprocessing.Pool(processes = args.ncores)
+    # the builds only start if the node has the memory, CPUs and disk space they need
+    admission = None
+    if not args.no_admission and not args.dryrun:
+        default_request = {"memory": utils.resources.parse_size(args.build_memory),
+                           "cpus": 1,
+                           "disk": utils.resources.parse_size(args.build_disk)}
 
+        admission = utils.resources.BuildAdmission(default_request = default_request,
+                                                   path_to_docker_root = args.docker_root)
+
+    if args.ncores > 1:
         if args.dryrun:
             print("This will run in parallel, on %g cores.\n"%(args.ncores))
-            for _ in tqdm.tqdm(pool.imap_unordered(dryrun_core, image_list), total = len(image_list)):
-                pass
         else:
             print("\nRunning in parallel on %g cores.\n"%(args.ncores))
-            for _ in tqdm.tqdm(pool.imap_unordered(run_core, image_list), total = len(image_list)):
-                pass
-
     else:
         if args.dryrun:
             print("This will run on a single core.\n")
-            for image_dict in image_list:
-                dryrun_core(image_dict)
         else:
             print("Running on a single core.\n")
-            for image_dict in image_list:
-                run_core(image_dict)
 
-    
-    # if a branch different from main is specified, revert the Dockerfiles to the original state
-    # by running a git restore command
-    if args.branch != "main":
-        if args.verbose:
-            print("git restore %s \n"%config_dict["github"]["repository_folder"])
+    # for every image in the config file, build the docker image
+    failed_list = list()
+    for image_tag, result in tqdm.tqdm(utils.run_build_graph(image_list, build_graph, core_fn, ncores = args.ncores,
+                                                             admission = admission),
+                                       total = len(image_list)):
+        if result is None:
+            failed_list.append(image_tag)
+
+    if len(failed_list) > 0:
+        print("\nThe following images were not built: %s\n"%", ".join(failed_list))
+
+    # if everything was built, the changes up to this commit do not need to be built again
+    elif (args.incremental or args.changed_only) and not args.dryrun:
+        build_index["commits"][args.branch] = commit_hash
+        utils.save_build_index(build_index, args.build_index)
+
+    if args.trace_dir is not None:
+        path_to_trace = tracing.get_trace_path(args.trace_dir)
+        nspans = tracing.write_trace(path_to_trace, stage = "build")
 
-        utils.git_restore(path_to_repo = config_dict["github"]["repository_folder"])
+        print("Timing of %g steps exported to %s"%(nspans, path_to_trace))
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
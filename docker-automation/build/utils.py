@@ -8,14 +8,24 @@ Email:  dbontempi@bwh.harvard.edu
 -------------------------------------------------
 """
 
+import io
 import os
+import re
 import sys
 import time
-
-import fileinput
-
+import glob
+import json
+import shutil
+import fnmatch
+import hashlib
+import tarfile
+import tempfile
+
+import fcntl
 import argparse
+import contextlib
 import subprocess
+import concurrent.futures
 
 # TO-DO: add logging
 #import logging
@@ -26,7 +36,40 @@ import pprint
 
 pp = pprint.PrettyPrinter(indent=2)
 
-def build_docker_image(image_dict, verbose=False):
+# modules shared by the build, test and push stages
+base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if base_dir not in sys.path:
+    sys.path.append(base_dir)
+
+from common import docker_api
+from common import resources
+from common import git_sync
+from common import tracing
+
+def get_image_tag(image_dict):
+
+    """
+    Returns the tag of the Docker image described by the provided image dictionary.
+
+    Args:
+        image_dict (dict): A dictionary containing the image details.
+
+    Returns:
+        str: The tag of the image, in the usual format (username/name:version).
+
+    Example:
+        >>> image_dict = {"dockerhub_username": "mhubai", "name": "base", "version": "latest"}
+        >>> get_image_tag(image_dict)
+        'mhubai/base:latest'
+    """
+
+    return "%s/%s:%s"%(image_dict["dockerhub_username"],
+                       image_dict["name"],
+                       image_dict["version"])
+
+## --------------------------------
+
+def build_docker_image(image_dict, verbose=False, no_cache=True, use_api=False, buildkit=None):
     
     """
     Builds a Docker image based on the provided image dictionary.
@@ -34,6 +77,13 @@ def build_docker_image(image_dict, verbose=False):
     Args:
         image_dict (dict): A dictionary containing the image details.
         verbose (bool, optional): Controls the verbosity of the output. Defaults to False.
+        no_cache (bool, optional): Whether to build the image without using the Docker layer cache.
+                                   Defaults to True.
+        use_api (bool, optional): Whether to build the image through the Docker Engine API (instead of
+                                  the docker CLI). Defaults to False.
+        buildkit (dict, optional): If provided, the image is built with BuildKit (`docker buildx build`), with the
+                                   builder and the layer cache it stores (see `build_docker_image_buildkit`).
+                                   Defaults to None.
 
     Returns:
         str: The tag of the built Docker image.
@@ -61,38 +111,761 @@ def build_docker_image(image_dict, verbose=False):
         raise FileNotFoundError("File %s not found"%path_to_dockerfile)
 
     # generate image tag based on the dictionary keys
-    image_tag = "%s/%s:%s"%(image_dict["dockerhub_username"],
-                            image_dict["name"],
-                            image_dict["version"])
+    image_tag = get_image_tag(image_dict)
+
+    print("Building dockerfile at %s as: '%s'\n"%(path_to_dockerfile, image_tag))
+
+    if buildkit is not None:
+        return build_docker_image_buildkit(image_dict, verbose=verbose, no_cache=no_cache, **buildkit)
 
-    print("Building dockerfile at %s as: '%s'\n"%(path_to_dockerfile, image_tag))            
-    time.sleep(1)
+    if use_api:
+        return build_docker_image_api(image_dict, verbose=verbose, no_cache=no_cache)
 
-    # build the docker image
+    dockerfile, build_args = get_models_tree_arg(image_dict)
+
+    # build the docker image - the build context (only the files the Dockerfile needs, and the Dockerfile with
+    # the branch substitutions, if any) is read from stdin as a tar archive
     # TO-DO: add checks on the docker build
     bash_command = ["docker", "build",
-                    "--file", "%s"%path_to_dockerfile,
-                    "--tag", "%s"%image_tag,
-                    "--no-cache"]
+                    "--file", context_dockerfile_name,
+                    "--tag", "%s"%image_tag]
+
+    for key, value in build_args.items():
+        bash_command += ["--build-arg", "%s=%s"%(key, value)]
+
+    if no_cache:
+        bash_command += ["--no-cache"]
 
     if not verbose:
-        bash_command += ["--quiet", "."]
+        bash_command += ["--quiet"]
+
+    bash_command += ["-"]
+
+    with use_context_tar(image_dict, dockerfile) as path_to_tar:
+
+        if verbose:
+            print("Running the shell command:\n", " ".join(bash_command), "< %s\n"%path_to_tar)
+
+        # TO-DO: add logging
+        with open(path_to_tar, "rb") as f:
+            output = subprocess.run(bash_command, check=True, stdin=f,
+                                    stdout=None if verbose else subprocess.DEVNULL,
+                                    stderr=None if verbose else subprocess.DEVNULL)
+
+    return image_tag
+
+## --------------------------------
+
+def build_docker_image_api(image_dict, verbose=False, no_cache=True):
+
+    """
+    Builds a Docker image through the Docker Engine API (see `build_docker_image`).
+
+    The build context (see `create_context_tar`) is streamed to the daemon as a tar archive, and the progress
+    of the build is printed (in verbose mode) as it is received.
+
+    Returns:
+        str: The tag of the built Docker image.
+
+    Raises:
+        DockerAPIError: If the build fails.
+    """
+
+    image_tag = get_image_tag(image_dict)
+
+    def print_event(event):
+        if "stream" in event:
+            print(event["stream"], end="")
+        elif "status" in event:
+            print(event["status"])
+
+    dockerfile, build_args = get_models_tree_arg(image_dict)
+
+    with use_context_tar(image_dict, dockerfile) as path_to_tar:
+        client = docker_api.get_client()
+        build_events = client.build(path_to_tar, tag=image_tag, dockerfile=context_dockerfile_name, nocache=no_cache,
+                                    buildargs=build_args)
+
+        docker_api.run_sync(docker_api.collect_events(build_events, callback=print_event if verbose else None))
+
+    return image_tag
+
+## --------------------------------
+
+# the folder storing the BuildKit layer cache of every image (one subfolder per image)
+default_buildkit_cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "mhubai", "buildkit_cache")
+
+# the build argument set to the hash of the image folder in the models repository (see `add_models_tree_arg`)
+models_tree_arg = "MHUB_MODELS_TREE"
+
+# the command the Dockerfiles fetch the models repository with
+models_fetch_command = "git fetch https://github.com/MHubAI/models.git"
+
+def build_docker_image_buildkit(image_dict, verbose=False, no_cache=False, builder=None,
+                                cache_dir=default_buildkit_cache_dir, cache_registry=None):
+
+    """
+    Builds a Docker image with BuildKit (`docker buildx build`), importing and exporting its layer cache.
+
+    The layer cache of every image is exported (all the layers, including those of the intermediate stages) to
+    its own subfolder of `cache_dir` - or, if `cache_registry` is provided, to `<cache_registry>/<name>:buildcache-
+    <version>` - and imported by its next build, so that it survives `docker image prune`. As the Dockerfiles fetch
+    the models repository (which the cache knows nothing about), the instruction fetching it is made to depend on
+    the content of the image folder in the repository (see `get_models_tree_arg`): the layers before it (e.g., the
+    dependencies of the model) are taken from the cache, and the ones from it onwards are built again whenever the
+    image folder changes.
+
+    BuildKit builds the independent stages of a Dockerfile at the same time. The time spent in every step is
+    recorded in the trace (and, in verbose mode, the slowest steps are printed).
+
+    Args:
+        image_dict (dict): A dictionary containing the image details.
+        verbose (bool, optional): Controls the verbosity of the output. Defaults to False.
+        no_cache (bool, optional): Whether to build the image without importing the cache (it is still exported).
+                                   Defaults to False.
+        builder (str, optional): The name of the buildx builder to use. Defaults to None (the current one).
+        cache_dir (str, optional): The folder storing the layer cache of every image. Defaults to
+                                   default_buildkit_cache_dir.
+        cache_registry (str, optional): The registry (and namespace) storing the layer cache, instead of `cache_dir`
+                                        (e.g., "localhost:5000/mhubai"). Defaults to None.
+
+    Returns:
+        str: The tag of the built Docker image.
+
+    Raises:
+        subprocess.CalledProcessError: If the build fails.
+    """
+
+    image_tag = get_image_tag(image_dict)
+
+    dockerfile, build_args = get_models_tree_arg(image_dict)
+
+    bash_command = ["docker", "buildx", "build"]
+
+    if builder is not None:
+        bash_command += ["--builder", builder]
+
+    bash_command += ["--file", context_dockerfile_name,
+                     "--tag", "%s"%image_tag,
+                     "--load",
+                     "--progress", "plain"]
+
+    for key, value in build_args.items():
+        bash_command += ["--build-arg", "%s=%s"%(key, value)]
+
+    if cache_registry is not None:
+        cache_ref = "%s/%s:buildcache-%s"%(cache_registry, image_dict["name"], image_dict["version"])
+
+        bash_command += ["--cache-from", "type=registry,ref=%s"%cache_ref]
+        bash_command += ["--cache-to", "type=registry,ref=%s,mode=max"%cache_ref]
     else:
-        bash_command += ["."]
+        # the cache is exported to a new folder, replacing the previous one once done (otherwise, it keeps growing)
+        path_to_cache = os.path.join(cache_dir, re.sub(r"[^A-Za-z0-9_.-]", "_", image_tag))
+
+        if os.path.isdir(path_to_cache):
+            bash_command += ["--cache-from", "type=local,src=%s"%path_to_cache]
+        bash_command += ["--cache-to", "type=local,dest=%s.new,mode=max"%path_to_cache]
+
+    if no_cache:
+        bash_command += ["--no-cache"]
+
+    bash_command += ["-"]
+
+    with use_context_tar(image_dict, dockerfile) as path_to_tar:
+
+        if verbose:
+            print("Running the shell command:\n", " ".join(bash_command), "< %s\n"%path_to_tar)
+
+        steps = dict()
+        output_lines = list()
+
+        with open(path_to_tar, "rb") as f:
+            process = subprocess.Popen(bash_command, stdin=f, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                       text=True, errors="replace")
+
+            for line in process.stdout:
+                line = line.rstrip("\n")
+
+                if verbose:
+                    print(line)
+
+                # keep the end of the output, to report the errors
+                output_lines = output_lines[-49:] + [line]
+
+                step = parse_buildkit_progress(line, steps)
+
+                if step is not None and step["duration"] is not None:
+                    tracing.add_span(step["name"], "build step", step["end_time"] - step["duration"], step["duration"],
+                                     image = image_tag, status = step["status"])
+
+            returncode = process.wait()
+
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, bash_command, output="\n".join(output_lines))
+
+    if cache_registry is None:
+        if os.path.isdir(path_to_cache):
+            shutil.rmtree(path_to_cache)
+        os.replace(path_to_cache + ".new", path_to_cache)
 
     if verbose:
-        print("Running the shell command:\n", " ".join(bash_command), "\n")
-        time.sleep(2)
+        done_steps = sorted([step for step in steps.values() if step["duration"] is not None],
+                            key=lambda step: step["duration"], reverse=True)
 
-    # TO-DO: add logging
-    output = subprocess.run(bash_command, check=True, text=True,
-                            stdout=None if verbose else subprocess.DEVNULL,
-                            stderr=None if verbose else subprocess.DEVNULL)
+        print("\nSlowest steps of the build of %s (%g step(s) cached):"%(
+            image_tag, len([step for step in done_steps if step["status"] == "cached"])))
+        for step in done_steps[:5]:
+            print("- %.1fs %s"%(step["duration"], step["name"]))
 
     return image_tag
 
 ## --------------------------------
 
+def add_models_tree_arg(dockerfile):
+
+    """
+    Declares the `models_tree_arg` build argument right before the instruction fetching the models repository.
+
+    Since the build arguments are part of the environment of the RUN instructions, the layer cache of the
+    instruction (and of the following ones) is only used if the value of the argument (i.e., the hash of the
+    image folder in the models repository) did not change. Dockerfiles not fetching the repository (see
+    `fetches_models_repository`) are returned as they are.
+
+    Args:
+        dockerfile (str): The content of the Dockerfile (see `read_dockerfile`).
+
+    Returns:
+        str: The content of the Dockerfile, with the build argument.
+
+    Example:
+        >>> print(add_models_tree_arg("FROM mhubai/base:latest\\nRUN git fetch https://github.com/MHubAI/models.git main"))
+        FROM mhubai/base:latest
+        ARG MHUB_MODELS_TREE
+        RUN git fetch https://github.com/MHubAI/models.git main
+    """
+
+    lines = dockerfile.splitlines()
+
+    instruction_start = 0
+    continued = False
+
+    for idx, line in enumerate(lines):
+        # the instruction may span multiple lines (e.g., RUN git init && \ ... git fetch ...)
+        if not continued:
+            instruction_start = idx
+
+        if models_fetch_command in line:
+            lines.insert(instruction_start, "ARG %s"%models_tree_arg)
+            return "\n".join(lines) + "\n"
+
+        continued = line.rstrip().endswith("\\") or (continued and line.strip().startswith("#"))
+
+    return dockerfile
+
+def fetches_models_repository(dockerfile):
+
+    """
+    Returns True if the Dockerfile fetches the models repository with `models_fetch_command`, i.e., if the layer
+    cache can tell the versions of the image folder apart (see `add_models_tree_arg`).
+    """
+
+    return models_fetch_command in dockerfile
+
+def get_models_tree_arg(image_dict):
+
+    """
+    Returns the Dockerfile of an image as it is built (see `read_dockerfile`), with the `models_tree_arg` build
+    argument (see `add_models_tree_arg`), and the value of the build arguments.
+
+    Example:
+        >>> dockerfile, build_args = get_models_tree_arg(image_dict)
+        >>> build_args
+        {'MHUB_MODELS_TREE': '5b7e0c2f3d0a4c6e8f1a2b3c4d5e6f708192a3b4'}
+    """
+
+    dockerfile = read_dockerfile(image_dict)
+
+    if not fetches_models_repository(dockerfile):
+        return dockerfile, dict()
+
+    return add_models_tree_arg(dockerfile), {models_tree_arg: get_image_tree_hash(image_dict)}
+
+def get_image_tree_hash(image_dict):
+
+    """
+    Returns the git tree hash of the image folder (see `get_image_folder`) at the commit checked out in the models
+    repository, which only changes if a file of the folder changed (unlike the hash of the commit, which changes
+    with every commit to the repository).
+
+    If the folder is not tracked by git, the hash of the commit is returned instead.
+    """
+
+    bash_command = ["git", "-C", image_dict["repository_folder"],
+                    "rev-parse", "--verify", "--quiet", "HEAD:%s"%get_image_folder(image_dict)]
+
+    output = subprocess.run(bash_command, text=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    if output.returncode != 0:
+        return get_git_hash(image_dict["repository_folder"])
+
+    return output.stdout.strip()
+
+## --------------------------------
+
+def parse_buildkit_progress(line, steps):
+
+    """
+    Updates the state of the steps of a BuildKit build with a line of its plain progress output
+    (`--progress plain`), where every line starts with the number of the step (e.g., "#7 DONE 12.3s").
+
+    Args:
+        line (str): The line of the output.
+        steps (dict): The state of the steps seen so far (updated in place), mapping the number of every step to
+                      its "name" (the first line of the step), "status" ("running", "done", "cached" or "error"),
+                      "duration" (seconds, None until done) and "end_time".
+
+    Returns:
+        dict: The state of the step, if the line marks the end of a step (None otherwise).
+
+    Example:
+        >>> steps = dict()
+        >>> parse_buildkit_progress("#7 [base 3/5] RUN pip install torch", steps)
+        >>> parse_buildkit_progress("#7 DONE 93.2s", steps)["duration"]
+        93.2
+    """
+
+    match = re.match(r"^#(\d+) (.*)$", line)
+
+    if match is None:
+        return None
+
+    step_id, text = match.groups()
+    text = text.strip()
+
+    if step_id not in steps:
+        steps[step_id] = {"name": text, "status": "running", "duration": None, "end_time": None}
+        return None
+
+    step = steps[step_id]
+
+    done_match = re.fullmatch(r"DONE ([0-9.]+)s", text)
+
+    if done_match is not None:
+        step.update(status="done", duration=float(done_match.group(1)), end_time=time.time())
+    elif text == "CACHED":
+        step.update(status="cached", duration=0.0, end_time=time.time())
+    elif text.startswith("ERROR"):
+        step.update(status="error", end_time=time.time())
+    else:
+        return None
+
+    return step
+
+## --------------------------------
+
+# name of the Dockerfile in the tar archives of the build contexts (to avoid clashing with the context files)
+context_dockerfile_name = ".mhub.Dockerfile"
+
+# the folder caching the tar archives of the build contexts, and how many of them are kept
+default_context_cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "mhubai", "build_contexts")
+max_cached_contexts = 64
+
+def get_context_files(image_dict, dockerfile):
+
+    """
+    Returns the files of the build context an image needs: the files the Dockerfile copies (COPY/ADD, see
+    `get_context_sources`) and, if found in the build context, the files of the folder storing the Dockerfile.
+
+    Args:
+        image_dict (dict): A dictionary containing the image details.
+        dockerfile (str): The content of the Dockerfile (see `read_dockerfile`).
+
+    Returns:
+        list: The sorted list of the paths to the files, relative to the build context.
+
+    Example:
+        >>> get_context_files(image_dict, read_dockerfile(image_dict))
+        ['models/lungmask/config/default.yml']
+    """
+
+    path_to_context = get_build_context_dir(image_dict)
+
+    paths = list()
+    for source in get_context_sources(dockerfile):
+        paths += glob_context(path_to_context, source)
+
+    dockerfile_folder = os.path.dirname(os.path.abspath(os.path.join(image_dict["repository_folder"],
+                                                                     image_dict["dockerfile"])))
+
+    if os.path.commonpath([dockerfile_folder, path_to_context]) == path_to_context:
+        paths.append(dockerfile_folder)
+
+    context_files = list()
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                context_files += [os.path.join(root, f) for f in files]
+        elif os.path.isfile(path):
+            context_files.append(path)
+
+    return sorted(set([os.path.relpath(path, path_to_context) for path in context_files]))
+
+## --------------------------------
+
+def create_context_tar(image_dict, dockerfile, cache_dir=default_context_cache_dir):
+
+    """
+    Returns a tar archive with the build context of an image: only the files it needs (see `get_context_files`)
+    and the Dockerfile (as `context_dockerfile_name`).
+
+    The archives are cached under the hash of their content (the Dockerfile, and the path, mode and content of
+    every file), so that the archive is only created again if one of them changed. Use `use_context_tar` to build
+    from the archive, so that it is not deleted while the build reads it.
+
+    Args:
+        image_dict (dict): A dictionary containing the image details.
+        dockerfile (str): The content of the Dockerfile (see `read_dockerfile`).
+        cache_dir (str, optional): The folder caching the archives. Defaults to default_context_cache_dir.
+
+    Returns:
+        str: The path to the (cached) tar archive.
+    """
+
+    path_to_context = get_build_context_dir(image_dict)
+    context_files = get_context_files(image_dict, dockerfile)
+
+    sha = hashlib.sha256()
+    sha.update(b"dockerfile:")
+    sha.update(dockerfile.encode("utf-8"))
+
+    for rel_path in context_files:
+        path = os.path.join(path_to_context, rel_path)
+        sha.update(("\nfile:%s:%o\n"%(rel_path, os.stat(path).st_mode)).encode("utf-8"))
+
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha.update(chunk)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    path_to_tar = os.path.join(cache_dir, sha.hexdigest() + ".tar")
+
+    if os.path.isfile(path_to_tar):
+        os.utime(path_to_tar)
+        return path_to_tar
+
+    # written under a temporary name first, as builds running at the same time can create the same archive
+    fd, path_to_tmp = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+
+    with os.fdopen(fd, "wb") as f, tarfile.open(fileobj=f, mode="w") as tar:
+        for rel_path in context_files:
+            tarinfo = tar.gettarinfo(os.path.join(path_to_context, rel_path), arcname=rel_path)
+            tarinfo.uid, tarinfo.gid, tarinfo.uname, tarinfo.gname = 0, 0, "", ""
+
+            with open(os.path.join(path_to_context, rel_path), "rb") as file_obj:
+                tar.addfile(tarinfo, file_obj)
+
+        dockerfile_bytes = dockerfile.encode("utf-8")
+
+        tarinfo = tarfile.TarInfo(name=context_dockerfile_name)
+        tarinfo.size = len(dockerfile_bytes)
+        tar.addfile(tarinfo, io.BytesIO(dockerfile_bytes))
+
+    os.replace(path_to_tmp, path_to_tar)
+
+    return path_to_tar
+
+## --------------------------------
+
+@contextlib.contextmanager
+def use_context_tar(image_dict, dockerfile, cache_dir=default_context_cache_dir):
+
+    """
+    Returns the tar archive with the build context of an image (see `create_context_tar`), which is not deleted
+    until the end of the block - then deletes the least recently used archives, if more than `max_cached_contexts`
+    are cached and no build (of any run on the node) is using an archive.
+
+    Example:
+        >>> with use_context_tar(image_dict, read_dockerfile(image_dict)) as path_to_tar:
+        ...     client.build(path_to_tar, tag=image_tag, dockerfile=context_dockerfile_name)
+    """
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # every build using an archive holds a shared lock on the cache, the archives are deleted under an exclusive one
+    with open(os.path.join(cache_dir, ".lock"), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_SH)
+
+        try:
+            yield create_context_tar(image_dict, dockerfile, cache_dir=cache_dir)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    evict_context_tars(cache_dir)
+
+def evict_context_tars(cache_dir=default_context_cache_dir):
+
+    """
+    Deletes the least recently used tar archives of the build contexts, if more than `max_cached_contexts` are
+    cached - unless a build is using one of them (see `use_context_tar`), in which case the next build done does.
+    """
+
+    with open(os.path.join(cache_dir, ".lock"), "a") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+
+        cached_list = sorted(glob.glob(os.path.join(cache_dir, "*.tar")), key=os.path.getmtime, reverse=True)
+        for path in cached_list[max_cached_contexts:]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+## --------------------------------
+
+def glob_context(path_to_context, source):
+
+    """
+    Returns the paths in the build context matching the source of a COPY or ADD instruction.
+
+    Unlike `glob.glob`, the wildcards also match the hidden files and folders (starting with a dot), as Docker does.
+
+    Example:
+        >>> glob_context("/path/to/models", "models/lungmask/*")
+        ['/path/to/models/models/lungmask/.env', '/path/to/models/models/lungmask/config']
+    """
+
+    paths = [path_to_context]
+
+    for component in source.split("/"):
+        if component in ["", "."]:
+            continue
+
+        matches = list()
+
+        for path in paths:
+            if not any([char in component for char in "*?["]):
+                if os.path.lexists(os.path.join(path, component)):
+                    matches.append(os.path.join(path, component))
+            elif os.path.isdir(path):
+                with os.scandir(path) as it:
+                    matches += [entry.path for entry in it if fnmatch.fnmatchcase(entry.name, component)]
+
+        paths = matches
+
+    return sorted(paths)
+
+## --------------------------------
+
+def prune_docker_images(use_api=False, verbose=False):
+
+    """
+    Deletes all of the dangling Docker images (as `docker image prune -f`).
+
+    Args:
+        use_api (bool, optional): Whether to use the Docker Engine API (instead of the docker CLI). Defaults to False.
+        verbose (bool, optional): Controls the verbosity of the output. Defaults to False.
+    """
+
+    if use_api:
+        output = docker_api.run_sync(docker_api.get_client().prune_images(dangling=True))
+
+        if verbose:
+            print("Deleted %g image(s), reclaimed %g bytes"%(len(output.get("ImagesDeleted") or list()),
+                                                           output.get("SpaceReclaimed", 0)))
+        return
+
+    bash_command = ["docker", "image", "prune", "-f"]
+
+    subprocess.run(bash_command, check=True, text=True,
+                   stdout=None if verbose else subprocess.DEVNULL,
+                   stderr=None if verbose else subprocess.DEVNULL)
+
+## --------------------------------
+
+def get_build_context_dir(image_dict):
+
+    """
+    Returns the path to the build context used for the provided image.
+
+    Args:
+        image_dict (dict): A dictionary containing the image details.
+
+    Returns:
+        str: The absolute path to the build context (for now, the directory the script is run from). Only the
+             files an image needs are sent to the builder (see `create_context_tar`).
+    """
+
+    return os.path.abspath(".")
+
+## --------------------------------
+
+def get_context_sources(dockerfile):
+
+    """
+    Returns the sources of the COPY and ADD instructions of a Dockerfile (i.e., the build context files it uses).
+
+    Sources copied from other stages or images (--from) and remote URLs are not part of the build context
+    and are therefore not included.
+
+    Args:
+        dockerfile (str): The content of the Dockerfile (see `read_dockerfile`).
+
+    Returns:
+        list: A list of source paths (or patterns), relative to the build context.
+
+    Example:
+        >>> get_context_sources(read_dockerfile(image_dict))
+        ['models/lungmask/config/default.yml']
+    """
+
+    context_sources = list()
+
+    for line in dockerfile.splitlines():
+        line = line.strip()
+        tokens = line.split()
+
+        if len(tokens) < 3 or tokens[0].upper() not in ["COPY", "ADD"]:
+            continue
+
+        # skip COPY --from=<stage|image>, which does not use the build context
+        if any(t.startswith("--from") for t in tokens[1:]):
+            continue
+
+        # both the exec form (["src", "dest"]) and the shell form (src dest) are supported
+        arguments = line[len(tokens[0]):].strip()
+        arguments = " ".join([t for t in arguments.split() if not t.startswith("--")])
+
+        if arguments.startswith("["):
+            try:
+                paths = json.loads(arguments)
+            except json.JSONDecodeError:
+                continue
+        else:
+            paths = arguments.split()
+
+        # the last path is the destination
+        for source in paths[:-1]:
+            if "://" not in source:
+                context_sources.append(source)
+
+    return context_sources
+
+## --------------------------------
+
+def get_build_key(image_dict, use_api=False):
+
+    """
+    Returns a key identifying the content an image is built from.
+
+    The key is the hash of the Dockerfile, of the build context files it references (COPY/ADD), of the IDs of
+    the images it is built from, and of the image folder in the models repository (see `get_image_tree_hash`) -
+    so that a commit to the folder of another model does not change it. Two builds with the same key are expected
+    to produce the same image.
+
+    Args:
+        image_dict (dict): A dictionary containing the image details.
+        use_api (bool, optional): Whether to use the Docker Engine API to inspect the images. Defaults to False.
+
+    Returns:
+        str: The build key (a hex digest).
+
+    Example:
+        >>> build_key = get_build_key(image_dict)
+        >>> print(build_key)
+        '4f1c0d5d6a0b8f3f2a6b0e3c1b2a9d8e7f6c5b4a3928171615141312111009ff'
+    """
+
+    dockerfile = read_dockerfile(image_dict)
+    path_to_context = get_build_context_dir(image_dict)
+
+    sha = hashlib.sha256()
+    sha.update(("tree:%s\n"%get_image_tree_hash(image_dict)).encode("utf-8"))
+
+    # the Dockerfile as it is built (i.e., with the branch substitutions, if any)
+    sha.update(b"dockerfile:")
+    sha.update(dockerfile.encode("utf-8"))
+
+    # the images the Dockerfile is built from (changes if e.g., the base image was rebuilt)
+    for parent_image in get_parent_images(dockerfile):
+        parent_id = docker_api.get_image_id(parent_image, use_api=use_api)
+        sha.update(("parent:%s@%s\n"%(parent_image, parent_id)).encode("utf-8"))
+
+    # the files from the build context the Dockerfile copies into the image
+    context_files = list()
+    for source in get_context_sources(dockerfile):
+        for path in glob_context(path_to_context, source):
+            if os.path.isdir(path):
+                for root, dirs, files in os.walk(path):
+                    context_files += [os.path.join(root, f) for f in files]
+            else:
+                context_files.append(path)
+
+    for path in sorted(set(context_files)):
+        sha.update(("file:%s\n"%os.path.relpath(path, path_to_context)).encode("utf-8"))
+
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha.update(chunk)
+
+    return sha.hexdigest()
+
+## --------------------------------
+
+def load_build_index(path_to_index):
+
+    """
+    Loads the index storing the details of the images built so far.
+
+    Args:
+        path_to_index (str): The path to the JSON file storing the index.
+
+    Returns:
+        dict: A dictionary with two entries:
+              - "images": maps image tags to the details of their last build (build key, commit hash,
+                image ID and time of the build);
+              - "commits": maps branch names to the last commit all the images were successfully built from.
+              Both are empty if the file does not exist.
+    """
+
+    build_index = {"images": dict(), "commits": dict()}
+
+    if not os.path.isfile(path_to_index):
+        return build_index
+
+    with open(path_to_index, "r") as f:
+        try:
+            build_index.update(json.load(f))
+        except json.JSONDecodeError:
+            print("WARNING: build index %s is corrupted - starting from an empty index"%path_to_index)
+
+    return build_index
+
+## --------------------------------
+
+def save_build_index(build_index, path_to_index):
+
+    """
+    Saves the index storing the build key of the images built so far.
+
+    The file is replaced atomically, so that a crash while saving does not corrupt the index.
+
+    Args:
+        build_index (dict): The index, as returned by `load_build_index`.
+        path_to_index (str): The path to the JSON file storing the index.
+    """
+
+    os.makedirs(os.path.dirname(os.path.abspath(path_to_index)), exist_ok=True)
+
+    tmp_path = path_to_index + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(build_index, f, indent=2, sort_keys=True)
+
+    os.replace(tmp_path, path_to_index)
+
+## --------------------------------
+
 def push_docker_image(image_tag, verbose=False):
 
     """
@@ -158,169 +931,431 @@ def get_git_hash(path_to_repo):
 
 ## --------------------------------
 
-def get_git_hash_remote(repo_url):
-        
+def get_list_of_updated_folders(path_to_repo, from_hash, to_hash="HEAD"):
+
     """
-    Returns the current commit hash of a remote Git repository.
+    Returns a list of updated folders in the repository between two commits.
 
     Args:
-        repo_url (str): The URL of the remote Git repository.
+        path_to_repo (str): The path to the repository.
+        from_hash (str): The hash of the first commit (e.g., the last commit the images were built from).
+        to_hash (str, optional): The hash of the second commit. Defaults to "HEAD".
 
     Returns:
-        str: The current commit hash.
+        list: A list of updated folders (relative to the root of the repository).
+
+    Raises:
+        CalledProcessError: If the git diff command fails (e.g., if one of the commits is not found).
 
     Example:
-        >>> repository_url = "https://github.com/username/repository.git"
-        >>> commit_hash = get_git_hash_remote(repository_url)
-        >>> print(commit_hash)
-        'b45e63a71c08e8c3ef1b9a4fb5ebf1bebc58a52d'
-    
-    Pointers/References:
-        - using python: https://stackoverflow.com/questions/14989858/get-the-current-git-hash-in-a-python-script
-        - using subprocess: https://stackoverflow.com/questions/949314/how-do-i-get-the-hash-for-the-current-commit-in-git
+        >>> repo_path = "/path/to/repository"
+        >>> updated_folders = get_list_of_updated_folders(repo_path, "b45e63a71c", "a1b2c3d4e5")
+        >>> print(updated_folders)
+        ['models/lungmask/config', 'models/lungmask/dockerfiles']
     """
 
-    # bash command to get the current commit hash
+    # bash command to get the list of files changed between the two commits
     bash_command =  ["git",
-                    "ls-remote", "--heads",
-                    "%s"%repo_url, "refs/heads/main"]
-
+                     "-C", "%s"%path_to_repo,
+                     "diff", "--name-only", "%s"%from_hash, "%s"%to_hash]
+    
     # run git in subprocess
-    process = subprocess.Popen(bash_command, stdout=subprocess.PIPE)
-    # get the output of the git command
-    output, error = process.communicate()
+    output = subprocess.run(bash_command, check=True, text=True,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
     # decode the output
-    commit_hash = output.decode('utf-8').strip()
-    commit_hash = commit_hash.split("\t")[0]
+    updated_files = [f for f in output.stdout.strip().split("\n") if f != ""]
 
-    return commit_hash
+    # for each entry in the list, separate the file name from the path
+    updated_folders = sorted(set([os.path.dirname(f) for f in updated_files]))
+
+    return updated_folders
 
 ## --------------------------------
 
-def get_list_of_updated_folders(path_to_repo):
+def get_image_folder(image_dict):
 
     """
-    Returns a list of updated folders in the repository based on the last commit.
+    Returns the folder of the repository storing everything related to the provided image.
+
+    By convention, Dockerfiles are stored in a `dockerfiles` subfolder of the image folder
+    (e.g., `models/lungmask/dockerfiles/Dockerfile` for the `models/lungmask` folder).
 
     Args:
-        path_to_repo (str): The path to the repository.
+        image_dict (dict): A dictionary containing the image details.
 
     Returns:
-        list: A list of updated folders.
+        str: The path to the image folder, relative to the root of the repository.
+    """
+
+    dockerfile_folder = os.path.dirname(os.path.normpath(image_dict["dockerfile"]))
+
+    if os.path.basename(dockerfile_folder) == "dockerfiles":
+        return os.path.dirname(dockerfile_folder)
+
+    return dockerfile_folder
+
+## --------------------------------
+
+def get_affected_images(image_list, build_graph, updated_folders):
+
+    """
+    Returns the images affected by a change in the provided folders.
+
+    An image is affected if one of the updated folders is (or is found under) its image folder,
+    or if it is built from an affected image.
+
+    Args:
+        image_list (list): A list of image dictionaries (as passed to `build_docker_image`).
+        build_graph (dict): The dependency graph returned by `get_build_graph`.
+        updated_folders (list): The folders updated, as returned by `get_list_of_updated_folders`.
+
+    Returns:
+        list: The tags of the affected images, in the same order as `image_list`.
+    """
+
+    changed_tags = list()
+
+    for image_dict in image_list:
+        image_folder = get_image_folder(image_dict)
+
+        for folder in updated_folders:
+            if folder == image_folder or folder.startswith(image_folder + "/"):
+                changed_tags.append(get_image_tag(image_dict))
+                break
+
+    affected_tags = set(changed_tags + get_downstream_images(build_graph, changed_tags))
+
+    return [get_image_tag(image_dict) for image_dict in image_list if get_image_tag(image_dict) in affected_tags]
+
+## --------------------------------
+
+def read_dockerfile(image_dict):
+
+    """
+    Returns the content of the Dockerfile of an image, as it is built.
+
+    If the image is built from a branch of the models repository other than main (`branch` key of the image
+    dictionary), the line fetching the models repository is changed to fetch the branch and, for the model images,
+    the image is built from the base image of the same branch. The Dockerfile on disk is never modified (the
+    content is fed to `docker build` instead), so that builds of different branches can run at the same time.
+
+    Args:
+        image_dict (dict): A dictionary containing the image details.
+
+    Returns:
+        str: The content of the Dockerfile.
+
+    Raises:
+        FileNotFoundError: If the Dockerfile specified in the image dictionary is not found.
 
     Example:
-        >>> repo_path = "/path/to/repository"
-        >>> updated_folders = get_list_of_updated_folders(repo_path)
-        >>> print(updated_folders)
-        ['/path/to/folder1', '/path/to/folder2', '/path/to/folder3']
+        >>> image_dict = {"name": "lungmask", "dockerfile": "models/lungmask/dockerfiles/Dockerfile",
+        ...               "repository_folder": "/path/to/repository", "branch": "patch-models"}
+        >>> [l for l in read_dockerfile(image_dict).splitlines() if l.startswith("FROM")]
+        ['FROM mhubai/base:patch-models']
     """
 
+    path_to_dockerfile = os.path.join(image_dict["repository_folder"], image_dict["dockerfile"])
 
-    # bash command to get the list of folders changed in the last commit
-    bash_command =  ["git",
-                     "-C", "%s"%path_to_repo,
-                     "diff", "--name-only", "HEAD~2...HEAD"]
-    
-    # run git in subprocess
-    process = subprocess.Popen(bash_command, stdout=subprocess.PIPE)
-    # get the output of the git command
-    output, error = process.communicate()
-    # decode the output
-    updated_folders = output.decode('utf-8').strip().split("\n")
+    with open(path_to_dockerfile, "r") as f:
+        dockerfile = f.read()
 
-    # for each entry in the list, separate the file name from the path
-    updated_folders = [os.path.dirname(f) for f in updated_folders]
+    branch = image_dict.get("branch", "main")
 
-    return updated_folders
+    if branch == "main":
+        return dockerfile
+
+    # for both model and base images, replace the line that pulls the models repository
+    dockerfile = dockerfile.replace("git fetch https://github.com/MHubAI/models.git main",
+                                    "git fetch https://github.com/MHubAI/models.git %s"%branch)
+
+    # for model images only, build the image starting from the "branch" base image
+    if image_dict["name"] != "base":
+        dockerfile = dockerfile.replace("FROM mhubai/base:latest", "FROM mhubai/base:%s"%branch)
+
+    return dockerfile
 
 ## --------------------------------
 
-def git_pull(path_to_repo):
+# the folder storing the worktrees of the branches of the models repository (one per branch)
+default_worktree_dir = os.path.join(os.path.expanduser("~"), ".cache", "mhubai", "worktrees")
+
+def get_branch_worktree(path_to_repo, branch, worktree_dir=default_worktree_dir, update=True):
 
     """
-    Performs a git pull operation on a local Git repository.
+    Returns the path to a worktree of the models repository with the latest commit of a branch checked out.
+
+    The worktrees are kept across runs (one per repository and branch, sharing the objects of the repository),
+    and moved to the commit the branch was last fetched at (under `refs/mhub/branches/<branch>`, see
+    `common/git_sync.py`). The worktree is locked for the rest of the run, so that two runs building the same
+    branch do not update it at the same time (runs building different branches do not wait for each other).
 
     Args:
         path_to_repo (str): The path to the local Git repository.
+        branch (str): The name of the branch (already fetched, see `git_sync.sync_repository`).
+        worktree_dir (str, optional): The folder storing the worktrees. Defaults to `default_worktree_dir`.
+        update (bool, optional): Whether to update the worktree (e.g., not in dry run mode). Defaults to True.
 
     Returns:
-        bytes: The output of the git pull command.
+        str: The path to the worktree.
+
+    Raises:
+        GitSyncError: If a git command fails (e.g., if the branch was never fetched).
 
     Example:
-        >>> repo_path = "/path/to/repository"
-        >>> output = git_pull(repo_path)
-        >>> print(output.decode('utf-8'))
-        'Updating b45e63a71c..a1b2c3d4e5f'
+        >>> get_branch_worktree("/path/to/repository", "patch-models")
+        '/home/mhubai/.cache/mhubai/worktrees/models/patch-models'
     """
 
-    # bash command to git pull
-    bash_command =  ["git",
-                     "-C", "%s"%path_to_repo,
-                     "pull"]
+    path_to_repo = os.path.abspath(path_to_repo)
+    path_to_worktree = os.path.join(worktree_dir, os.path.basename(path_to_repo), branch)
+    branch_ref = git_sync.branch_ref_prefix + branch
 
-    # run git in subprocess
-    process = subprocess.Popen(bash_command, stdout=subprocess.PIPE)
-    # get the output of the git command
-    output, error = process.communicate()
+    if not update:
+        return path_to_worktree
+
+    os.makedirs(os.path.dirname(path_to_worktree), exist_ok=True)
+    lock_worktree(path_to_worktree)
 
-    return output
+    if not os.path.exists(os.path.join(path_to_worktree, ".git")):
+        # forget the worktrees whose folder was deleted
+        git_sync.run_git(path_to_repo, ["worktree", "prune"])
+        git_sync.run_git(path_to_repo, ["worktree", "add", "--quiet", "--detach", "--force", path_to_worktree,
+                                        branch_ref])
+    else:
+        # only the files changed between the two commits are written
+        git_sync.run_git(path_to_worktree, ["checkout", "--quiet", "--detach", "--force", branch_ref])
+        git_sync.run_git(path_to_worktree, ["clean", "--quiet", "-d", "--force"])
+
+    return path_to_worktree
 
 ## --------------------------------
 
-def modify_dockerfile(image_dict, branch):
+# the lock files of the worktrees used by this run (released when the process exits)
+worktree_locks = dict()
 
-    # update the Dockerfile to pull the correct branch
-    rel_path_to_dockerfile = image_dict["dockerfile"]
-    path_to_dockerfile = os.path.join(image_dict["repository_folder"], rel_path_to_dockerfile)
+def lock_worktree(path_to_worktree):
 
-    # for both model and base images, replace the line that pulls the models repository
-    to_replace = "git fetch https://github.com/MHubAI/models.git main"
-    replace_with = "git fetch https://github.com/MHubAI/models.git %s"%branch
+    """
+    Locks a worktree until the end of the run, waiting for the run using it (if any) to be done.
+    """
 
-    for line in fileinput.input(path_to_dockerfile, inplace=True): 
-        print(line.replace(to_replace, replace_with), end = "")
-    
-    fileinput.close()
+    if path_to_worktree in worktree_locks:
+        return
 
-    # for model images only, replace the first line to build the image starting from the "branch" base image
-    if image_dict["name"] != "base":
-        to_replace = "FROM mhubai/base:latest"
-        replace_with = "FROM mhubai/base:%s"%branch
+    lock_file = open(path_to_worktree + ".lock", "w")
+
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        print("Waiting for another run to be done with the worktree at %s..."%path_to_worktree)
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
 
-        for line in fileinput.input(path_to_dockerfile, inplace=True): 
-            print(line.replace(to_replace, replace_with), end = "")
-        
-        fileinput.close()
+    worktree_locks[path_to_worktree] = lock_file
 
 ## --------------------------------
 
-def git_restore(path_to_repo):
-    
+def get_parent_images(dockerfile):
+
     """
-    Performs a git restore operation on a local Git repository.
+    Returns the list of images a Dockerfile is built from (i.e., the images in its FROM lines).
 
     Args:
-        path_to_repo (str): The path to the local Git repository.
+        dockerfile (str): The content of the Dockerfile (see `read_dockerfile`).
 
     Returns:
-        bytes: The output of the git restore command.
+        list: A list of image references, in the order they are found in the Dockerfile.
+              References to previous stages of multi-stage builds (FROM ... AS stage) are not included.
 
     Example:
-        >>> repo_path = "/path/to/repository"
-        >>> output = git_restore(repo_path)
-        >>> print(output.decode('utf-8'))
-        ' '
+        >>> get_parent_images(read_dockerfile(image_dict))
+        ['mhubai/base:latest']
     """
 
-    # bash command to git restore
-    bash_command =  ["git",
-                     "-C", "%s"%path_to_repo,
-                     "restore", "%s"%path_to_repo]
+    parent_images = list()
+    stage_names = list()
 
-    # run git in subprocess
-    process = subprocess.Popen(bash_command, stdout=subprocess.PIPE)
-    # get the output of the git command
-    output, error = process.communicate()
+    for line in dockerfile.splitlines():
+        tokens = line.strip().split()
+
+        if len(tokens) < 2 or tokens[0].upper() != "FROM":
+            continue
+
+        # skip flags such as --platform=linux/amd64
+        tokens = [t for t in tokens[1:] if not t.startswith("--")]
+
+        if len(tokens) == 0:
+            continue
+
+        if tokens[0] not in stage_names and tokens[0] not in parent_images:
+            parent_images.append(tokens[0])
+
+        # FROM <image> AS <stage>
+        if len(tokens) >= 3 and tokens[1].upper() == "AS":
+            stage_names.append(tokens[2])
+
+    return parent_images
+
+## --------------------------------
+
+def get_build_graph(image_list):
+
+    """
+    Returns the dependency graph of the images to build, based on the FROM lines of their Dockerfiles.
+
+    Only the dependencies between images found in `image_list` are part of the graph; every other image
+    (e.g., ubuntu, or an mhubai/base image that is not being rebuilt) is assumed to be available already.
+
+    Args:
+        image_list (list): A list of image dictionaries (as passed to `build_docker_image`).
+
+    Returns:
+        dict: A dictionary mapping the tag of every image to the list of tags of the images it is built from.
+
+    Raises:
+        ValueError: If the dependencies between the images contain a cycle.
+
+    Example:
+        >>> build_graph = get_build_graph(image_list)
+        >>> print(build_graph)
+        {'mhubai/base:latest': [], 'mhubai/lungmask:latest': ['mhubai/base:latest']}
+    """
+
+    image_tags = [get_image_tag(image_dict) for image_dict in image_list]
+
+    build_graph = dict()
+
+    for image_tag, image_dict in zip(image_tags, image_list):
+        path_to_dockerfile = os.path.join(image_dict["repository_folder"], image_dict["dockerfile"])
+
+        # images whose Dockerfile is missing will fail to build anyway - treat them as independent
+        if not os.path.exists(path_to_dockerfile):
+            build_graph[image_tag] = list()
+            continue
+
+        parent_images = get_parent_images(read_dockerfile(image_dict))
+        build_graph[image_tag] = [p for p in parent_images if p in image_tags and p != image_tag]
+
+    # check the graph can be built at all (Kahn's algorithm)
+    pending = {image_tag: set(parents) for image_tag, parents in build_graph.items()}
+    sorted_tags = [image_tag for image_tag, parents in pending.items() if len(parents) == 0]
+
+    for image_tag in sorted_tags:
+        for child_tag, parents in pending.items():
+            if image_tag in parents:
+                parents.discard(image_tag)
+                if len(parents) == 0:
+                    sorted_tags.append(child_tag)
+
+    if len(sorted_tags) != len(build_graph):
+        unsorted_tags = [image_tag for image_tag in build_graph if image_tag not in sorted_tags]
+        raise ValueError("Circular FROM dependency between images: %s"%", ".join(unsorted_tags))
+
+    return build_graph
+
+## --------------------------------
+
+def get_downstream_images(build_graph, image_tags):
+
+    """
+    Returns every image built (directly or not) from the provided images.
+
+    Args:
+        build_graph (dict): The dependency graph returned by `get_build_graph`.
+        image_tags (list): A list of image tags.
+
+    Returns:
+        list: The tags of all the images that depend on the images in `image_tags` (these excluded),
+              in the same order they are found in `build_graph`.
+    """
+
+    downstream = set()
+    to_visit = list(image_tags)
+
+    while len(to_visit) > 0:
+        image_tag = to_visit.pop()
+
+        for child_tag, parents in build_graph.items():
+            if image_tag in parents and child_tag not in downstream:
+                downstream.add(child_tag)
+                to_visit.append(child_tag)
+
+    return [image_tag for image_tag in build_graph if image_tag in downstream and image_tag not in image_tags]
+
+## --------------------------------
+
+def run_build_graph(image_list, build_graph, core_fn, ncores=1, admission=None):
+
+    """
+    Runs `core_fn` on every image of the list, following the dependency graph of the images.
+
+    Every image is submitted to a pool of `ncores` workers as soon as all of the images it is built from
+    are done (i.e., without waiting for the rest of the images at the same "level" of the graph).
+    If `core_fn` fails on an image (i.e., returns None), every image depending on it is skipped.
+    If `admission` is provided, every image also waits for the resources it needs to be available
+    (see `common/resources.py`) before `core_fn` runs on it.
+
+    Args:
+        image_list (list): A list of image dictionaries (as passed to `build_docker_image`).
+        build_graph (dict): The dependency graph returned by `get_build_graph`.
+        core_fn (callable): The function to run on each image dictionary. Should return None on failure.
+        ncores (int, optional): The maximum number of images to process at the same time. Defaults to 1.
+        admission (resources.BuildAdmission, optional): The admission control of the builds. Defaults to None
+                                                        (the images only wait for a free worker).
+
+    Yields:
+        tuple: A (image_tag, result) tuple for every image, as soon as the image is done (or skipped).
+               `result` is the value returned by `core_fn`, or None if the image was skipped.
+
+    Example:
+        >>> build_graph = get_build_graph(image_list)
+        >>> for image_tag, result in run_build_graph(image_list, build_graph, build_docker_image, ncores=4):
+        ...     print(image_tag, result)
+    """
+
+    image_dicts = {get_image_tag(image_dict): image_dict for image_dict in image_list}
+
+    pending = {image_tag: set(parents) for image_tag, parents in build_graph.items()}
+    skipped = set()
+
+    # preserve the order of the config file for the images that can be built right away
+    ready = [image_tag for image_tag in image_dicts if len(pending[image_tag]) == 0]
+    futures = dict()
+
+    def run_admitted(image_tag):
+        if admission is None:
+            return core_fn(image_dicts[image_tag])
+
+        with admission.admit(image_tag, admission.get_request(image_dicts[image_tag])):
+            return core_fn(image_dicts[image_tag])
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=ncores) as executor:
+        while len(ready) > 0 or len(futures) > 0:
+
+            for image_tag in ready:
+                futures[executor.submit(run_admitted, image_tag)] = image_tag
+            ready = list()
+
+            done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+
+            for future in done:
+                image_tag = futures.pop(future)
+                result = future.result()
+
+                yield image_tag, result
 
-    return output
+                # if the image could not be processed, skip everything depending on it
+                if result is None:
+                    for child_tag in get_downstream_images(build_graph, [image_tag]):
+                        if child_tag not in skipped:
+                            skipped.add(child_tag)
+                            print("Skipping image %s (depends on %s, which failed)"%(child_tag, image_tag))
+                            yield child_tag, None
+                    continue
 
+                for child_tag, parents in pending.items():
+                    if image_tag in parents:
+                        parents.discard(image_tag)
+                        if len(parents) == 0 and child_tag not in skipped:
+                            ready.append(child_tag)
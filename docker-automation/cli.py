@@ -0,0 +1,141 @@
+"""
+-------------------------------------------------
+MHub - command line interface for the build, test and push automation
+-------------------------------------------------
+"""
+
+import os
+import sys
+import time
+
+import argparse
+import statistics
+import subprocess
+
+# the folder storing the build, test and push stages (and this script)
+base_dir = os.path.dirname(os.path.abspath(__file__))
+
+stage_list = ["build", "test", "push", "pipeline"]
+
+## --------------------------------
+
+def run_stage(stage, argv):
+
+    """
+    Runs the `main` function of one of the stages, with the provided command line arguments.
+
+    The stage (and the modules it needs) is only loaded once the command is known: e.g., running the push stage
+    does not import anything the test stage needs.
+    """
+
+    # the pipeline utils know how to load a stage (along with its own `utils` module)
+    from pipeline.utils import load_stage
+
+    stage_run = load_stage(stage)
+    stage_run.main(argv)
+
+## --------------------------------
+
+def get_import_times(command):
+
+    """
+    Runs a command with `python -X importtime`, and returns the cumulative import time of every top-level import.
+
+    Returns:
+        list: The (module, cumulative import time in ms) tuples, slowest first.
+    """
+
+    output = subprocess.run([sys.executable, "-X", "importtime"] + command, text=True,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    import_times = list()
+
+    # e.g., "import time:       523 |      12345 |   numpy" (nested imports are indented further)
+    for line in output.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+
+        _, cumulative, module = line.split("|")
+
+        if not module.startswith("  "):
+            import_times.append((module.strip(), int(cumulative)/1000.0))
+
+    return sorted(import_times, key=lambda item: item[1], reverse=True)
+
+## --------------------------------
+
+def run_bench(stages, nruns=5, importtime=False, ntop=10):
+
+    """
+    Measures the cold-start time of the subcommands (a new interpreter, up to the parsing of the arguments).
+
+    Every subcommand is run `nruns` times with `--help`, which loads the stage (and its imports) and exits.
+    The start-up time of the interpreter alone is reported as a baseline.
+
+    Args:
+        stages (list): The subcommands to benchmark.
+        nruns (int, optional): The number of runs for each subcommand. Defaults to 5.
+        importtime (bool, optional): Whether to print the slowest top-level imports of each subcommand.
+                                     Defaults to False.
+        ntop (int, optional): The number of imports to print for each subcommand. Defaults to 10.
+    """
+
+    command_dict = {"(python)": ["-c", "pass"]}
+    for stage in stages:
+        command_dict[stage] = [os.path.abspath(__file__), stage, "--help"]
+
+    print("Cold-start time over %g runs (min/median):\n"%nruns)
+
+    for name, command in command_dict.items():
+        time_list = list()
+
+        for _ in range(nruns):
+            start_time = time.perf_counter()
+            output = subprocess.run([sys.executable] + command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                    text=True)
+            time_list.append((time.perf_counter() - start_time)*1000.0)
+
+            if output.returncode != 0:
+                break
+
+        if output.returncode != 0:
+            print("- %-10s FAILED (%s)"%(name, output.stderr.strip().splitlines()[-1]))
+            continue
+
+        print("- %-10s %7.1f ms / %7.1f ms"%(name, min(time_list), statistics.median(time_list)))
+
+        if importtime and name in stages:
+            for module, cumulative in get_import_times(command)[:ntop]:
+                print("    %-30s %7.1f ms"%(module, cumulative))
+
+## --------------------------------
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='MHub - local automation for the build, test and push of MHub images',
+                                     usage='cli.py [-h] {%s,bench} ...'%",".join(stage_list))
+    parser.add_argument('command', choices=stage_list + ["bench"],
+                        help='the stage to run (see `cli.py <stage> --help`), or bench to measure the start-up time')
+    parser.add_argument('args', nargs=argparse.REMAINDER, help='the arguments of the stage')
+
+    args = parser.parse_args(argv)
+
+    if args.command == "bench":
+        bench_parser = argparse.ArgumentParser(prog='cli.py bench',
+                                               description='measure the cold-start time of the subcommands')
+        bench_parser.add_argument('--stages', action='store', nargs='+', choices=stage_list, default=stage_list,
+                                  help='the subcommands to measure (default: all)')
+        bench_parser.add_argument('--nruns', action='store', type=int, default=5,
+                                  help='number of runs for each subcommand')
+        bench_parser.add_argument('--importtime', action='store_true',
+                                  help='print the slowest top-level imports of each subcommand')
+
+        bench_args = bench_parser.parse_args(args.args)
+        run_bench(bench_args.stages, nruns = bench_args.nruns, importtime = bench_args.importtime)
+
+        return
+
+    run_stage(args.command, args.args)
+
+if __name__ == '__main__':
+    main()
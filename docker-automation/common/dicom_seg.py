@@ -0,0 +1,274 @@
+"""
+-------------------------------------------------
+MHub - decoding of DICOM SEG files
+-------------------------------------------------
+"""
+
+import struct
+
+# NOTE: numpy and pydicom are only imported by the functions using them (see `python cli.py bench`)
+
+## --------------------------------
+
+def get_functional_group(dcm, frame_idx, sequence_name):
+
+    """
+    Returns the first item of a functional group of a frame, either per-frame or shared (None if not found).
+    """
+
+    for groups_name in ["PerFrameFunctionalGroupsSequence", "SharedFunctionalGroupsSequence"]:
+        groups = dcm.get(groups_name)
+
+        if groups is None or len(groups) == 0:
+            continue
+
+        group = groups[frame_idx] if groups_name == "PerFrameFunctionalGroupsSequence" else groups[0]
+
+        if sequence_name in group and len(group.get(sequence_name)) > 0:
+            return group.get(sequence_name)[0]
+
+    return None
+
+## --------------------------------
+
+def read_frame_info(dcm):
+
+    """
+    Maps every frame of a DICOM SEG to its segment and slice, from the functional groups of the frames.
+
+    The slices are placed as `pydicom_seg` would: along the normal of the image plane, from the first to the last
+    position of the frames, one slice every `SpacingBetweenSlices` (or `SliceThickness`).
+
+    Args:
+        dcm (pydicom.Dataset): The DICOM SEG (its pixel data does not need to be loaded).
+
+    Returns:
+        dict: The segment numbers defined in the DICOM SEG under "segments", the segment number of every frame under
+              "frame_segments", the slice index of every frame under "frame_slices", and the (z, y, x) "shape"
+              and "spacing" of the volume the frames belong to.
+    """
+
+    import numpy as np
+
+    nframes = int(dcm.get("NumberOfFrames", 1))
+
+    segments = np.array(sorted([int(segment.SegmentNumber) for segment in dcm.SegmentSequence]), dtype=np.uint16)
+
+    frame_segments = np.zeros(nframes, dtype=np.uint16)
+    positions = np.zeros((nframes, 3))
+
+    for frame_idx in range(nframes):
+        frame_segments[frame_idx] = int(get_functional_group(dcm, frame_idx, "SegmentIdentificationSequence")
+                                        .ReferencedSegmentNumber)
+
+        plane_position = get_functional_group(dcm, frame_idx, "PlanePositionSequence")
+        if plane_position is not None:
+            positions[frame_idx] = [float(v) for v in plane_position.ImagePositionPatient]
+
+    plane_orientation = get_functional_group(dcm, 0, "PlaneOrientationSequence")
+    orientation = [1.0, 0.0, 0.0, 0.0, 1.0, 0.0] if plane_orientation is None \
+                  else [float(v) for v in plane_orientation.ImageOrientationPatient]
+
+    # the distance of every frame along the normal of the image plane
+    distances = positions @ np.cross(orientation[:3], orientation[3:])
+    distances -= distances.min() if nframes > 0 else 0.0
+
+    spacing = None
+    pixel_spacing = [1.0, 1.0]
+    pixel_measures = get_functional_group(dcm, 0, "PixelMeasuresSequence")
+    if pixel_measures is not None:
+        spacing = pixel_measures.get("SpacingBetweenSlices", pixel_measures.get("SliceThickness"))
+        pixel_spacing = [float(v) for v in pixel_measures.get("PixelSpacing", pixel_spacing)]
+
+    if spacing is None or float(spacing) <= 0:
+        steps = np.diff(np.unique(np.round(distances, 3)))
+        spacing = steps.min() if len(steps) > 0 else 1.0
+
+    frame_slices = np.rint(distances/float(spacing)).astype(np.intp)
+    nslices = int(frame_slices.max()) + 1 if nframes > 0 else 0
+
+    # the pixel spacing is given as (between rows, between columns), i.e. (y, x)
+    return {"segments": segments, "frame_segments": frame_segments, "frame_slices": frame_slices,
+            "shape": (nslices, int(dcm.Rows), int(dcm.Columns)),
+            "spacing": np.array([float(spacing)] + pixel_spacing)}
+
+## --------------------------------
+
+def get_pixel_buffer(path_to_file, dcm, pixel_offset=None):
+
+    """
+    Returns the (bit-packed, if binary) pixel data of a DICOM SEG as a flat array of bytes.
+
+    Args:
+        path_to_file (str): The path to the DICOM SEG.
+        dcm (pydicom.Dataset): The DICOM SEG (read with `stop_before_pixels` if `pixel_offset` is provided).
+        pixel_offset (int, optional): The offset of the PixelData element in the file, to memory map the pixel data
+                                      instead of loading it (see `read_labels`). Defaults to None.
+
+    Returns:
+        np.ndarray: The pixel data (a `np.memmap` if `pixel_offset` is provided), or None if the pixel data
+                    is compressed (or can not be memory mapped).
+    """
+
+    import numpy as np
+
+    transfer_syntax = getattr(dcm, "file_meta", dict()).get("TransferSyntaxUID")
+
+    if transfer_syntax is not None and (transfer_syntax.is_compressed or transfer_syntax.is_deflated):
+        return None
+
+    if pixel_offset is None:
+        return np.frombuffer(dcm.PixelData, dtype=np.uint8)
+
+    if transfer_syntax is None or not transfer_syntax.is_little_endian:
+        return None
+
+    with open(path_to_file, "rb") as f:
+        f.seek(pixel_offset)
+        header = f.read(12)
+
+    if len(header) < 12 or struct.unpack("<HH", header[:4]) != (0x7FE0, 0x0010):
+        return None
+
+    # the value follows the tag and length (and the VR, if explicit) of the element
+    if transfer_syntax.is_implicit_VR:
+        length, value_offset = struct.unpack("<I", header[4:8])[0], pixel_offset + 8
+    else:
+        length, value_offset = struct.unpack("<I", header[8:12])[0], pixel_offset + 12
+
+    # undefined length (encapsulated pixel data)
+    if length == 0xFFFFFFFF:
+        return None
+
+    return np.memmap(path_to_file, dtype=np.uint8, mode="r", offset=value_offset, shape=(length,))
+
+## --------------------------------
+
+def unpack_frames(buffer, start, stop, rows, columns, bits_allocated):
+
+    """
+    Unpacks the frames `start` to `stop` (excluded) of a DICOM SEG into an array of binary masks.
+
+    The frames of binary DICOM SEGs are packed one bit per pixel (little endian), one frame right after the other
+    (frames may not start on a byte boundary), so any range of frames is unpacked in a single `np.unpackbits`.
+
+    Args:
+        buffer (np.ndarray): The pixel data (see `get_pixel_buffer`).
+        start (int): The index of the first frame.
+        stop (int): The index past the last frame.
+        rows (int): The number of rows of every frame.
+        columns (int): The number of columns of every frame.
+        bits_allocated (int): The number of bits per pixel (1 for binary, 8 for fractional DICOM SEGs).
+
+    Returns:
+        np.ndarray: The (stop - start, rows, columns) array of binary masks.
+    """
+
+    import numpy as np
+
+    frame_size = rows*columns
+
+    if bits_allocated == 8:
+        frames = np.asarray(buffer[start*frame_size:stop*frame_size])
+        return frames.reshape(stop - start, rows, columns) > 0
+
+    start_bit, stop_bit = start*frame_size, stop*frame_size
+    packed = np.asarray(buffer[start_bit // 8:(stop_bit + 7) // 8])
+
+    bits = np.unpackbits(packed, bitorder="little")[start_bit % 8:start_bit % 8 + stop_bit - start_bit]
+
+    return bits.view(bool).reshape(stop - start, rows, columns)
+
+## --------------------------------
+
+def read_labels(path_to_file, memory_budget=None):
+
+    """
+    Reads a DICOM SEG, returning its segment numbers and the voxel data of its segments.
+
+    The pixel data of all of the frames is unpacked at once (or in chunks of frames fitting in `memory_budget`,
+    memory mapping the pixel data), and only the positions of the foreground pixels of the frames are kept: they are
+    scattered to a single label array (voxels store the segment number) or, if some of the segments overlap,
+    to an array of binary masks (one per segment).
+
+    Args:
+        path_to_file (str): The path to the DICOM SEG.
+        memory_budget (int, optional): The memory (in bytes) the unpacked frames can take. Defaults to None
+                                       (all of the frames are unpacked at once).
+
+    Returns:
+        dict: The segment numbers under "segments", the (z, y, x) spacing of the voxels under "spacing", and either
+              the label array under "array" (and None under "masks"), or the stacked binary masks under "masks"
+              (and None under "array").
+
+    Example:
+        >>> seg_data = read_labels("/path/to/seg.seg.dcm")
+        >>> seg_data["segments"], seg_data["array"].shape
+        (array([1, 2, 3], dtype=uint16), (120, 512, 512))
+    """
+
+    import numpy as np
+    import pydicom
+
+    lazy = memory_budget is not None
+
+    # the file is left right before the pixel data, so that the latter can be memory mapped
+    if lazy:
+        with open(path_to_file, "rb") as f:
+            dcm = pydicom.dcmread(f, stop_before_pixels=True)
+            pixel_offset = f.tell()
+    else:
+        dcm = pydicom.dcmread(path_to_file)
+        pixel_offset = None
+
+    frame_info = read_frame_info(dcm)
+    nslices, rows, columns = frame_info["shape"]
+    frame_size = rows*columns
+    nframes = len(frame_info["frame_segments"])
+
+    buffer = get_pixel_buffer(path_to_file, dcm, pixel_offset=pixel_offset)
+
+    # compressed pixel data is decoded by pydicom, all of the frames at once
+    if buffer is None:
+        if lazy:
+            dcm = pydicom.dcmread(path_to_file)
+
+        buffer = (dcm.pixel_array.reshape(nframes, rows, columns) > 0).view(np.uint8).ravel()
+        bits_allocated = 8
+    else:
+        bits_allocated = int(dcm.BitsAllocated)
+
+    chunk_size = nframes
+    if lazy:
+        chunk_size = int(min(max(memory_budget // max(frame_size*2, 1), 1), max(nframes, 1)))
+
+    # the (flat) index in the volume and the segment number of every foreground pixel
+    voxel_list, segment_list = list(), list()
+
+    for start in range(0, nframes, chunk_size):
+        stop = min(start + chunk_size, nframes)
+        frame_idx, pixel_idx = np.divmod(np.flatnonzero(unpack_frames(buffer, start, stop, rows, columns,
+                                                                      bits_allocated)), frame_size)
+        frame_idx += start
+
+        voxel_list.append(frame_info["frame_slices"][frame_idx]*frame_size + pixel_idx)
+        segment_list.append(frame_info["frame_segments"][frame_idx])
+
+    voxels = np.concatenate(voxel_list) if len(voxel_list) > 0 else np.zeros(0, dtype=np.intp)
+    segments = np.concatenate(segment_list) if len(segment_list) > 0 else np.zeros(0, dtype=np.uint16)
+
+    shape = (nslices, rows, columns)
+
+    # the segments overlap if (at least) one voxel belongs to more than one segment
+    if len(np.unique(voxels)) == len(voxels):
+        label_array = np.zeros(nslices*frame_size, dtype=np.uint16)
+        label_array[voxels] = segments
+
+        return {"segments": frame_info["segments"], "spacing": frame_info["spacing"],
+                "array": label_array.reshape(shape), "masks": None}
+
+    masks = np.zeros((len(frame_info["segments"]), nslices*frame_size), dtype=bool)
+    masks[np.searchsorted(frame_info["segments"], segments), voxels] = True
+
+    return {"segments": frame_info["segments"], "spacing": frame_info["spacing"],
+            "array": None, "masks": masks.reshape((-1,) + shape)}
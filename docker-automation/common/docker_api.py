@@ -0,0 +1,605 @@
+"""
+-------------------------------------------------
+MHub - asyncio client for the Docker Engine API
+-------------------------------------------------
+"""
+
+import os
+import json
+import codecs
+import base64
+import asyncio
+import threading
+import contextlib
+import subprocess
+import urllib.parse
+
+DEFAULT_SOCKET_PATH = "/var/run/docker.sock"
+DEFAULT_API_VERSION = "v1.41"
+
+DOCKERHUB_REGISTRY = "https://index.docker.io/v1/"
+
+## --------------------------------
+
+class DockerAPIError(Exception):
+
+    """
+    Raised when the Docker Engine returns an error (either as an HTTP error status or in a stream of events).
+    """
+
+    def __init__(self, status, message):
+        super().__init__("Docker Engine API error (%s): %s"%(status, message))
+        self.status = status
+        self.message = message
+
+## --------------------------------
+
+class Response:
+
+    """
+    The response to a request to the Docker Engine API, whose body is read from the connection on demand.
+    """
+
+    def __init__(self, reader, status, headers):
+        self.reader = reader
+        self.status = status
+        self.headers = headers
+        self.done = False
+
+        self.keep_alive = headers.get("connection", "").lower() != "close"
+
+    async def iter_chunks(self):
+
+        """
+        Yields the body of the response, as chunks of bytes (handles both chunked and fixed length bodies).
+        """
+
+        if self.done:
+            return
+
+        if self.headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                size_line = await self.reader.readline()
+                size = int(size_line.split(b";")[0].strip() or b"0", 16)
+
+                if size == 0:
+                    # skip the (optional) trailers, up to the final empty line
+                    while (await self.reader.readline()) not in [b"\r\n", b"\n", b""]:
+                        pass
+                    break
+
+                chunk = await self.reader.readexactly(size)
+                await self.reader.readexactly(2)
+                yield chunk
+
+        elif "content-length" in self.headers:
+            remaining = int(self.headers["content-length"])
+
+            while remaining > 0:
+                chunk = await self.reader.read(min(remaining, 1 << 16))
+                if not chunk:
+                    raise ConnectionError("Connection closed by the Docker Engine before the end of the response")
+                remaining -= len(chunk)
+                yield chunk
+
+        elif self.status not in [204, 304]:
+            # no length information: the body ends with the connection
+            self.keep_alive = False
+            while True:
+                chunk = await self.reader.read(1 << 16)
+                if not chunk:
+                    break
+                yield chunk
+
+        self.done = True
+
+    async def read(self):
+        return b"".join([chunk async for chunk in self.iter_chunks()])
+
+    async def json(self):
+        body = await self.read()
+        return json.loads(body) if len(body) > 0 else None
+
+    async def iter_json(self):
+
+        """
+        Yields the objects of a stream of JSON objects (e.g., the progress of a build or push), one at a time.
+        """
+
+        text = ""
+        decoder = json.JSONDecoder()
+
+        # multi-byte characters can be split across chunks: the decoder holds their first bytes until complete
+        utf8_decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+        async for chunk in self.iter_chunks():
+            text = (text + utf8_decoder.decode(chunk)).lstrip()
+
+            # objects can be split across chunks, and multiple objects can be found in the same chunk
+            while len(text) > 0:
+                try:
+                    obj, end = decoder.raw_decode(text)
+                except json.JSONDecodeError:
+                    break
+                yield obj
+                text = text[end:].lstrip()
+
+    async def raise_for_status(self):
+        if self.status >= 400:
+            body = await self.read()
+            try:
+                message = json.loads(body).get("message", body.decode("utf-8", errors="replace"))
+            except ValueError:
+                message = body.decode("utf-8", errors="replace")
+            raise DockerAPIError(self.status, message)
+
+## --------------------------------
+
+class DockerClient:
+
+    """
+    An asyncio client for the Docker Engine API, talking to the daemon over its Unix socket.
+
+    Connections are kept alive and reused between requests, and at most `max_connections` requests are sent
+    to the daemon at the same time. Long-running operations (build and push) return the stream of progress
+    events sent by the daemon, as dictionaries.
+
+    Args:
+        socket_path (str, optional): The path to the socket of the Docker daemon. Defaults to "/var/run/docker.sock".
+        api_version (str, optional): The version of the API to use. Defaults to "v1.41".
+        max_connections (int, optional): The maximum number of connections open at the same time. Defaults to 8.
+
+    Example:
+        >>> client = DockerClient()
+        >>> async for event in client.build("/path/to/context.tar", tag="mhubai/base:latest"):
+        ...     print(event.get("stream", ""), end="")
+        >>> await client.close()
+    """
+
+    def __init__(self, socket_path=DEFAULT_SOCKET_PATH, api_version=DEFAULT_API_VERSION, max_connections=8):
+        self.socket_path = socket_path
+        self.api_version = api_version
+        self.max_connections = max_connections
+
+        self._idle_connections = list()
+        self._semaphore = None
+
+    ## --------------------------------
+
+    async def _open_connection(self):
+
+        """
+        Returns a (connection, reused) tuple, where `reused` is True if the connection was taken from the pool.
+        """
+
+        while len(self._idle_connections) > 0:
+            reader, writer = self._idle_connections.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return (reader, writer), True
+            writer.close()
+
+        return await asyncio.open_unix_connection(self.socket_path), False
+
+    async def _release_connection(self, connection, reusable):
+
+        reader, writer = connection
+
+        if reusable and not writer.is_closing():
+            self._idle_connections.append(connection)
+        else:
+            writer.close()
+
+    async def _send(self, writer, method, url, body, headers):
+
+        headers = dict(headers or dict())
+        headers["Host"] = "docker"
+
+        # the body can be empty, bytes, or the path to a file to stream (e.g., the tar of the build context)
+        if body is None:
+            if method in ["POST", "PUT"]:
+                headers["Content-Length"] = "0"
+        elif isinstance(body, (bytes, bytearray)):
+            headers["Content-Length"] = str(len(body))
+        else:
+            headers["Content-Length"] = str(os.path.getsize(body))
+
+        head = "%s %s HTTP/1.1\r\n"%(method, url)
+        head += "".join(["%s: %s\r\n"%(k, v) for k, v in headers.items()])
+        writer.write((head + "\r\n").encode("latin-1"))
+
+        if isinstance(body, (bytes, bytearray)):
+            writer.write(body)
+        elif body is not None:
+            with open(body, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    writer.write(chunk)
+                    await writer.drain()
+
+        await writer.drain()
+
+    async def _read_head(self, reader):
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionError("Connection closed by the Docker Engine")
+
+        status = int(status_line.split()[1])
+
+        headers = dict()
+        while True:
+            line = await reader.readline()
+            if line in [b"\r\n", b"\n", b""]:
+                break
+            key, _, value = line.decode("latin-1").partition(":")
+            headers[key.strip().lower()] = value.strip()
+
+        return Response(reader, status, headers)
+
+    def _url(self, path, params=None):
+
+        url = "/%s%s"%(self.api_version, path)
+
+        if params:
+            query = dict()
+            for key, value in params.items():
+                if value is None:
+                    continue
+                elif isinstance(value, bool):
+                    query[key] = "1" if value else "0"
+                elif isinstance(value, (dict, list)):
+                    query[key] = json.dumps(value)
+                else:
+                    query[key] = str(value)
+            url += "?" + urllib.parse.urlencode(query)
+
+        return url
+
+    @contextlib.asynccontextmanager
+    async def request(self, method, path, params=None, body=None, headers=None):
+
+        """
+        Sends a request to the Docker Engine API, and yields the response (whose body is read on demand).
+
+        The connection is put back in the pool once the response is fully read (unread bodies are drained).
+        """
+
+        # created here, as the semaphore needs to be bound to the loop the client runs on
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_connections)
+
+        async with self._semaphore:
+            connection, reused = await self._open_connection()
+            reusable = False
+
+            try:
+                try:
+                    await self._send(connection[1], method, self._url(path, params), body, headers)
+                    response = await self._read_head(connection[0])
+
+                except (ConnectionError, EOFError):
+                    # the daemon may have closed a pooled connection since it was last used (before any response
+                    # was sent): the request is sent again, once, on a new connection
+                    if not reused:
+                        raise
+
+                    connection[1].close()
+                    connection = await asyncio.open_unix_connection(self.socket_path)
+
+                    await self._send(connection[1], method, self._url(path, params), body, headers)
+                    response = await self._read_head(connection[0])
+
+                yield response
+
+                async for _ in response.iter_chunks():
+                    pass
+                reusable = response.keep_alive
+
+            finally:
+                await self._release_connection(connection, reusable)
+
+    async def close(self):
+        while len(self._idle_connections) > 0:
+            reader, writer = self._idle_connections.pop()
+            writer.close()
+
+    ## --------------------------------
+
+    async def _stream_events(self, method, path, params=None, body=None, headers=None):
+
+        async with self.request(method, path, params=params, body=body, headers=headers) as response:
+            await response.raise_for_status()
+
+            async for event in response.iter_json():
+                yield event
+
+                # errors happening during a build/push are only reported in the stream
+                if "error" in event:
+                    raise DockerAPIError(response.status, event["error"])
+
+    async def ping(self):
+        async with self.request("GET", "/_ping") as response:
+            return response.status == 200
+
+    async def build(self, context, tag, dockerfile="Dockerfile", nocache=False, buildargs=None, pull=False):
+
+        """
+        Builds an image from a build context, yielding the progress events sent by the daemon.
+
+        Args:
+            context (str or bytes): The tar archive of the build context (or the path to it).
+            tag (str): The tag of the image to build.
+            dockerfile (str, optional): The path to the Dockerfile, within the build context. Defaults to "Dockerfile".
+            nocache (bool, optional): Whether to build the image without using the layer cache. Defaults to False.
+            buildargs (dict, optional): The build-time variables. Defaults to None.
+            pull (bool, optional): Whether to pull the images the Dockerfile is built from. Defaults to False.
+        """
+
+        params = {"t": tag, "dockerfile": dockerfile, "nocache": nocache, "pull": pull,
+                  "rm": True, "forcerm": True, "buildargs": buildargs}
+
+        async for event in self._stream_events("POST", "/build", params=params, body=context,
+                                               headers={"Content-Type": "application/x-tar"}):
+            yield event
+
+    async def inspect_image(self, name):
+
+        """
+        Returns the details of a local image (as `docker image inspect`), or None if the image is not found.
+        """
+
+        async with self.request("GET", "/images/%s/json"%urllib.parse.quote(name, safe="")) as response:
+            if response.status == 404:
+                return None
+            await response.raise_for_status()
+            return await response.json()
+
+    async def push_image(self, image_tag, auth=None):
+
+        """
+        Pushes an image to its registry, yielding the progress events sent by the daemon.
+
+        Args:
+            image_tag (str): The tag of the image to push (repo/image:tag).
+            auth (str, optional): The encoded registry credentials (see `get_registry_auth`). Defaults to None.
+        """
+
+        repository, tag = split_image_tag(image_tag)
+        headers = {"X-Registry-Auth": auth if auth is not None else "e30="}
+
+        async for event in self._stream_events("POST", "/images/%s/push"%repository,
+                                               params={"tag": tag}, headers=headers):
+            yield event
+
+    async def prune_images(self, dangling=True):
+
+        """
+        Deletes the unused images (only the dangling ones by default), as `docker image prune -f`.
+        """
+
+        params = {"filters": {"dangling": ["true" if dangling else "false"]}}
+
+        async with self.request("POST", "/images/prune", params=params) as response:
+            await response.raise_for_status()
+            return await response.json()
+
+    async def create_container(self, config, name=None):
+        async with self.request("POST", "/containers/create", params={"name": name}, body=json.dumps(config).encode(),
+                                headers={"Content-Type": "application/json"}) as response:
+            await response.raise_for_status()
+            return (await response.json())["Id"]
+
+    async def start_container(self, container_id):
+        async with self.request("POST", "/containers/%s/start"%container_id) as response:
+            await response.raise_for_status()
+
+    async def wait_container(self, container_id):
+        async with self.request("POST", "/containers/%s/wait"%container_id) as response:
+            await response.raise_for_status()
+            return (await response.json())["StatusCode"]
+
+    async def remove_container(self, container_id, force=False):
+        async with self.request("DELETE", "/containers/%s"%container_id, params={"force": force}) as response:
+            if response.status != 404:
+                await response.raise_for_status()
+
+    async def run_container(self, config, name=None):
+
+        """
+        Runs a container until it exits (as `docker run --rm`), and returns its exit code.
+
+        Args:
+            config (dict): The configuration of the container, as expected by the `/containers/create` endpoint
+                           (e.g., {"Image": ..., "Cmd": [...], "HostConfig": {"Binds": [...]}}).
+            name (str, optional): The name of the container. Defaults to None.
+        """
+
+        container_id = await self.create_container(config, name=name)
+
+        try:
+            await self.start_container(container_id)
+            return await self.wait_container(container_id)
+        finally:
+            await self.remove_container(container_id, force=True)
+
+## --------------------------------
+
+def split_image_tag(image_tag):
+
+    """
+    Splits an image tag (repo/image:tag) in its repository and tag (which defaults to "latest").
+    """
+
+    repository, _, tag = image_tag.rpartition(":")
+
+    # the colon belongs to the registry host (e.g., localhost:5000/image), not to the tag
+    if repository == "" or "/" in tag:
+        return image_tag, "latest"
+
+    return repository, tag
+
+## --------------------------------
+
+def get_registry(image_tag):
+
+    """
+    Returns the registry an image is pushed to (the DockerHub registry, unless the tag starts with a registry host).
+    """
+
+    first_component = image_tag.split("/")[0]
+
+    if "/" in image_tag and ("." in first_component or ":" in first_component or first_component == "localhost"):
+        return first_component
+
+    return DOCKERHUB_REGISTRY
+
+## --------------------------------
+
+def get_registry_auth(registry=DOCKERHUB_REGISTRY, path_to_config=None):
+
+    """
+    Returns the credentials for a registry stored by `docker login`, encoded as expected by the Docker Engine API.
+
+    Args:
+        registry (str, optional): The registry. Defaults to the DockerHub registry.
+        path_to_config (str, optional): The path to the Docker CLI config. Defaults to "~/.docker/config.json".
+
+    Returns:
+        str: The credentials (base64-encoded JSON), or None if no credentials are found.
+    """
+
+    if path_to_config is None:
+        path_to_config = os.path.join(os.path.expanduser("~"), ".docker", "config.json")
+
+    if not os.path.isfile(path_to_config):
+        return None
+
+    with open(path_to_config, "r") as f:
+        docker_config = json.load(f)
+
+    username, password = None, None
+
+    entry = docker_config.get("auths", dict()).get(registry, dict())
+    helper = docker_config.get("credHelpers", dict()).get(registry, docker_config.get("credsStore"))
+
+    if "auth" in entry:
+        username, _, password = base64.b64decode(entry["auth"]).decode("utf-8").partition(":")
+
+    elif helper is not None:
+        # credentials stored by a helper (e.g., docker-credential-pass)
+        try:
+            output = subprocess.run(["docker-credential-%s"%helper, "get"], input=registry, check=True,
+                                    text=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            credentials = json.loads(output.stdout)
+            username, password = credentials["Username"], credentials["Secret"]
+        except (subprocess.CalledProcessError, FileNotFoundError, ValueError, KeyError):
+            return None
+
+    if username is None:
+        return None
+
+    auth = {"username": username, "password": password, "serveraddress": registry}
+
+    return base64.urlsafe_b64encode(json.dumps(auth).encode("utf-8")).decode("ascii")
+
+## --------------------------------
+
+# a single event loop, running in a background thread, drives the requests of all the (synchronous) callers
+_loop = None
+_loop_lock = threading.Lock()
+_clients = dict()
+
+def get_event_loop():
+
+    """
+    Returns the event loop the clients returned by `get_client` run on (started in a background thread if needed).
+    """
+
+    global _loop
+
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="docker-api", daemon=True).start()
+
+    return _loop
+
+def get_client(socket_path=DEFAULT_SOCKET_PATH):
+
+    """
+    Returns the client shared by all the callers (one per socket), running on the loop returned by `get_event_loop`.
+    """
+
+    with _loop_lock:
+        if socket_path not in _clients:
+            _clients[socket_path] = DockerClient(socket_path=socket_path)
+
+        return _clients[socket_path]
+
+def run_sync(coroutine):
+
+    """
+    Runs a coroutine on the loop returned by `get_event_loop`, waiting for its result (thread-safe).
+
+    Example:
+        >>> client = get_client()
+        >>> image_details = run_sync(client.inspect_image("mhubai/base:latest"))
+    """
+
+    return asyncio.run_coroutine_threadsafe(coroutine, get_event_loop()).result()
+
+async def collect_events(events, callback=None):
+
+    """
+    Consumes a stream of events (e.g., from `DockerClient.build`), calling `callback` on each of them.
+
+    Returns:
+        list: The events.
+    """
+
+    event_list = list()
+
+    async for event in events:
+        if callback is not None:
+            callback(event)
+        event_list.append(event)
+
+    return event_list
+
+def is_available(socket_path=DEFAULT_SOCKET_PATH):
+
+    """
+    Returns True if the Docker daemon socket is found (and can be written to).
+    """
+
+    return os.path.exists(socket_path) and os.access(socket_path, os.W_OK)
+
+## --------------------------------
+
+def get_image_id(image_tag, use_api=False):
+
+    """
+    Returns the ID (i.e., the digest of the config) of a local Docker image.
+
+    Args:
+        image_tag (str): The tag of the Docker image.
+        use_api (bool, optional): Whether to use the Docker Engine API (instead of the docker CLI). Defaults to False.
+
+    Returns:
+        str: The ID of the image (e.g., 'sha256:0a1b...'), or None if the image is not found locally.
+    """
+
+    if use_api:
+        image_details = run_sync(get_client().inspect_image(image_tag))
+        return image_details["Id"] if image_details is not None else None
+
+    bash_command = ["docker", "image", "inspect",
+                    "--format", "{{.Id}}",
+                    "%s"%image_tag]
+
+    try:
+        output = subprocess.run(bash_command, check=True, text=True,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return None
+
+    return output.stdout.strip()
@@ -0,0 +1,274 @@
+"""
+-------------------------------------------------
+MHub - sync of the local models repository with the remote
+-------------------------------------------------
+"""
+
+import os
+import json
+import time
+import tempfile
+import subprocess
+import dataclasses
+
+from typing import Optional
+
+# the commits the remote branches pointed to the last time they were listed (see `get_remote_refs`)
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "mhubai", "remote_refs.json")
+
+# how long (in seconds) the cached remote commits are used before listing the remote branches again
+DEFAULT_CACHE_TTL = 300
+
+# the local refs storing the fetched branches (the branches checked out in the repository are left untouched)
+branch_ref_prefix = "refs/mhub/branches/"
+
+## --------------------------------
+
+class GitSyncError(Exception):
+
+    """
+    Raised when a git command fails, with the command and the error printed by git.
+    """
+
+    def __init__(self, git_args, stderr):
+        self.git_args = git_args
+        self.stderr = stderr.strip()
+
+        super().__init__("git %s failed: %s"%(" ".join(git_args), self.stderr))
+
+## --------------------------------
+
+@dataclasses.dataclass
+class BranchState:
+
+    """
+    The state of a branch of the models repository, before and after the sync.
+    """
+
+    branch: str
+    # the commit of the branch on the remote (None if the branch is not found there)
+    remote_hash: Optional[str]
+    # the commit of the branch in the local repository before the sync (None if never fetched)
+    local_hash: Optional[str]
+    # whether the branch was fetched (i.e., the local commit is now the remote one)
+    fetched: bool = False
+
+    @property
+    def ref(self):
+        return branch_ref_prefix + self.branch
+
+    @property
+    def up_to_date(self):
+        return self.remote_hash is not None and self.local_hash == self.remote_hash
+
+## --------------------------------
+
+@dataclasses.dataclass
+class SyncResult:
+
+    """
+    The outcome of `sync_repository`.
+    """
+
+    # the commit checked out in the repository after the sync
+    commit_hash: str
+    # the state of every branch synced (main included)
+    branches: dict
+    # whether the remote commits were taken from the cache (i.e., the remote was not contacted at all)
+    from_cache: bool
+    # whether the checkout of the repository moved to a new commit
+    updated: bool = False
+
+    @property
+    def fetched(self):
+        return [state.branch for state in self.branches.values() if state.fetched]
+
+## --------------------------------
+
+def run_git(path_to_repo, git_args):
+
+    """
+    Runs a git command (in a repository or worktree, if `path_to_repo` is not None), returning its output.
+
+    Raises:
+        GitSyncError: If the command fails (with the error printed by git).
+    """
+
+    bash_command = ["git"] + (["-C", "%s"%path_to_repo] if path_to_repo is not None else list()) + git_args
+
+    output = subprocess.run(bash_command, text=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    if output.returncode != 0:
+        raise GitSyncError(git_args, output.stderr)
+
+    return output.stdout
+
+## --------------------------------
+
+def load_cache(cache_path=DEFAULT_CACHE_PATH):
+
+    """
+    Loads the cache of the remote commits ({repo_url: {"timestamp": ..., "refs": {branch: commit}}}).
+    """
+
+    try:
+        with open(cache_path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+def save_cache(cache, cache_path=DEFAULT_CACHE_PATH):
+
+    """
+    Saves the cache of the remote commits (atomically, as several runs can share it).
+    """
+
+    os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(cache_path)), suffix=".tmp")
+
+    with os.fdopen(fd, "w") as f:
+        json.dump(cache, f, indent=2)
+
+    os.replace(tmp_path, cache_path)
+
+## --------------------------------
+
+def get_remote_refs(repo_url, branches, cache_path=DEFAULT_CACHE_PATH, ttl=DEFAULT_CACHE_TTL):
+
+    """
+    Returns the commits the branches of a remote repository point to, listing all of them in a single call.
+
+    The commits are cached for `ttl` seconds: within that time, the remote is not contacted at all
+    (e.g., when the build runs every few minutes, and nothing changed).
+
+    Args:
+        repo_url (str): The URL of the remote Git repository (or the path to a local one).
+        branches (list): The names of the branches.
+        cache_path (str, optional): The path to the cache. Defaults to DEFAULT_CACHE_PATH.
+        ttl (float, optional): How long (in seconds) the cached commits are used. Defaults to DEFAULT_CACHE_TTL
+                               (0 to always contact the remote).
+
+    Returns:
+        tuple: The (refs, from_cache) tuple, where `refs` maps every branch to its commit (None if the branch
+               is not found on the remote), and `from_cache` is True if the commits were taken from the cache.
+
+    Raises:
+        GitSyncError: If the remote can not be listed.
+
+    Example:
+        >>> get_remote_refs("https://github.com/MHubAI/models", ["main", "patch-models"])
+        ({'main': 'b45e63a71c08e8c3ef1b9a4fb5ebf1bebc58a52d', 'patch-models': None}, False)
+    """
+
+    cache = load_cache(cache_path) if ttl > 0 else dict()
+    cache_entry = cache.get(repo_url)
+
+    if cache_entry is not None and time.time() - cache_entry["timestamp"] < ttl \
+       and all([branch in cache_entry["refs"] for branch in branches]):
+        return {branch: cache_entry["refs"][branch] for branch in branches}, True
+
+    output = run_git(None, ["ls-remote", "--heads", repo_url] + ["refs/heads/%s"%branch for branch in branches])
+
+    remote_refs = dict()
+    for line in output.splitlines():
+        commit_hash, ref = line.split("\t")
+        remote_refs[ref[len("refs/heads/"):]] = commit_hash
+
+    refs = {branch: remote_refs.get(branch) for branch in branches}
+
+    if ttl > 0:
+        cache[repo_url] = {"timestamp": time.time(), "refs": refs}
+        save_cache(cache, cache_path)
+
+    return refs, False
+
+## --------------------------------
+
+def get_local_refs(path_to_repo, branches):
+
+    """
+    Returns the commits the branches were last fetched at in the local repository (None if never fetched).
+    """
+
+    output = run_git(path_to_repo, ["for-each-ref", "--format=%(refname) %(objectname)", branch_ref_prefix])
+
+    local_refs = dict()
+    for line in output.splitlines():
+        ref, commit_hash = line.split(" ")
+        local_refs[ref[len(branch_ref_prefix):]] = commit_hash
+
+    return {branch: local_refs.get(branch) for branch in branches}
+
+## --------------------------------
+
+def sync_repository(path_to_repo, repo_url, branches=("main",), dryrun=False, cache_path=DEFAULT_CACHE_PATH,
+                    ttl=DEFAULT_CACHE_TTL):
+
+    """
+    Brings the local models repository up to date with the remote.
+
+    The commits of all the branches are listed with a single `git ls-remote` (or taken from the cache, see
+    `get_remote_refs`), and the branches whose commit changed are fetched with a single `git fetch` (under
+    `refs/mhub/branches/<branch>`). If main changed, the checkout of the repository is fast-forwarded to it.
+    When nothing changed, no objects are fetched and the checkout is not touched.
+
+    Args:
+        path_to_repo (str): The path to the local Git repository (with main checked out).
+        repo_url (str): The URL of the remote Git repository.
+        branches (list, optional): The names of the branches to sync - main is always synced. Defaults to ("main",).
+        dryrun (bool, optional): Whether to only print the fetch (the remote commits are still listed).
+                                 Defaults to False.
+        cache_path (str, optional): The path to the cache of the remote commits. Defaults to DEFAULT_CACHE_PATH.
+        ttl (float, optional): How long (in seconds) the cached remote commits are used. Defaults to DEFAULT_CACHE_TTL.
+
+    Returns:
+        SyncResult: The commit checked out after the sync and the state of every branch.
+
+    Raises:
+        GitSyncError: If a git command fails, or if one of the branches is not found on the remote.
+
+    Example:
+        >>> result = sync_repository("/path/to/repository", "https://github.com/MHubAI/models", ["patch-models"])
+        >>> result.commit_hash, result.fetched, result.from_cache
+        ('b45e63a71c08e8c3ef1b9a4fb5ebf1bebc58a52d', ['patch-models'], False)
+    """
+
+    branches = list(dict.fromkeys(["main"] + list(branches)))
+
+    remote_refs, from_cache = get_remote_refs(repo_url, branches, cache_path=cache_path, ttl=ttl)
+    local_refs = get_local_refs(path_to_repo, branches)
+
+    states = {branch: BranchState(branch=branch, remote_hash=remote_refs[branch], local_hash=local_refs[branch])
+              for branch in branches}
+
+    missing_branches = [branch for branch, state in states.items() if state.remote_hash is None]
+    if len(missing_branches) > 0:
+        raise GitSyncError(["ls-remote", repo_url], "branch(es) not found: %s"%", ".join(missing_branches))
+
+    commit_hash = run_git(path_to_repo, ["rev-parse", "--verify", "HEAD"]).strip()
+
+    to_fetch = [state for state in states.values() if not state.up_to_date]
+    refspecs = ["+refs/heads/%s:%s"%(state.branch, state.ref) for state in to_fetch]
+
+    if dryrun:
+        if len(refspecs) > 0:
+            print("git fetch %s %s\n"%(repo_url, " ".join(refspecs)))
+
+        return SyncResult(commit_hash=commit_hash, branches=states, from_cache=from_cache)
+
+    if len(refspecs) > 0:
+        run_git(path_to_repo, ["fetch", "--quiet", "--no-tags", repo_url] + refspecs)
+
+        for state in to_fetch:
+            state.fetched = True
+
+    # fast-forward the checkout of the repository to the latest commit of main
+    updated = False
+    if commit_hash != states["main"].remote_hash:
+        run_git(path_to_repo, ["merge", "--quiet", "--ff-only", states["main"].ref])
+
+        commit_hash = run_git(path_to_repo, ["rev-parse", "--verify", "HEAD"]).strip()
+        updated = True
+
+    return SyncResult(commit_hash=commit_hash, branches=states, from_cache=from_cache, updated=updated)
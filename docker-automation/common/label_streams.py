@@ -0,0 +1,432 @@
+"""
+-------------------------------------------------
+MHub - bounded-memory reading of large label volumes
+-------------------------------------------------
+"""
+
+import os
+import re
+import gzip
+import zlib
+import struct
+
+# NOTE: numpy is only imported by the functions using it (see `python cli.py bench`)
+
+nrrd_types = {
+    "u1": ["uchar", "unsigned char", "uint8", "uint8_t"],
+    "i1": ["signed char", "int8", "int8_t"],
+    "u2": ["ushort", "unsigned short", "unsigned short int", "uint16", "uint16_t"],
+    "i2": ["short", "short int", "signed short", "signed short int", "int16", "int16_t"],
+    "u4": ["uint", "unsigned int", "uint32", "uint32_t"],
+    "i4": ["int", "signed int", "int32", "int32_t"],
+    "u8": ["ulonglong", "unsigned long long", "unsigned long long int", "uint64", "uint64_t"],
+    "i8": ["longlong", "long long", "long long int", "signed long long", "signed long long int", "int64", "int64_t"],
+    "f4": ["float"],
+    "f8": ["double"],
+}
+
+mha_types = {"MET_UCHAR": "u1", "MET_CHAR": "i1", "MET_USHORT": "u2", "MET_SHORT": "i2", "MET_UINT": "u4",
+             "MET_INT": "i4", "MET_ULONG_LONG": "u8", "MET_LONG_LONG": "i8", "MET_FLOAT": "f4", "MET_DOUBLE": "f8"}
+
+nifti_types = {2: "u1", 4: "i2", 8: "i4", 16: "f4", 64: "f8", 256: "i1", 512: "u2", 768: "u4", 1024: "i8", 1280: "u8"}
+
+## --------------------------------
+
+def read_header(path_to_file):
+
+    """
+    Reads the header of a label volume, to read its voxel data one slab at a time (see `iter_slabs`).
+
+    The raw and compressed (gzip or zlib) NRRD, MHA/MHD and NIfTI-1 files storing a single-channel 2D or 3D volume
+    are supported - without reading the voxel data.
+
+    Args:
+        path_to_file (str): The path to the file.
+
+    Returns:
+        dict: The header, with the "shape" (z, y, x) and "spacing" (same order) of the volume, the "dtype" of the
+              voxels, the "data_file" storing the voxel data, the "offset" of the voxel data in the file,
+              the "compression" of the voxel data (None, "gzip" or "zlib") and the "scaling" (slope, intercept)
+              of the values (None if the values are not scaled). None if the file is not supported.
+
+    Example:
+        >>> read_header("/path/to/seg.nrrd")
+        {'shape': (512, 512, 512), 'spacing': (1.0, 0.8, 0.8), 'dtype': dtype('uint8'), ...}
+    """
+
+    try:
+        if path_to_file.endswith(".nrrd"):
+            return read_nrrd_header(path_to_file)
+        elif path_to_file.endswith((".mha", ".mhd")):
+            return read_mha_header(path_to_file)
+        elif path_to_file.endswith((".nii", ".nii.gz")):
+            return read_nifti_header(path_to_file)
+    except (OSError, ValueError, KeyError, struct.error):
+        return None
+
+    return None
+
+## --------------------------------
+
+def get_header(shape, spacing, dtype, data_file, offset, compression=None, scaling=None):
+
+    import numpy as np
+
+    # 2D images are read as volumes with a single slice
+    if len(shape) == 2:
+        shape, spacing = (1,) + tuple(shape), (1.0,) + tuple(spacing)
+
+    if len(shape) != 3:
+        return None
+
+    return {"shape": tuple([int(v) for v in shape]), "spacing": tuple([float(v) for v in spacing]),
+            "dtype": np.dtype(dtype), "data_file": data_file, "offset": int(offset),
+            "compression": compression, "scaling": scaling}
+
+## --------------------------------
+
+def read_nrrd_header(path_to_file):
+
+    """
+    Reads the header of a NRRD file with attached voxel data (see `read_header`).
+    """
+
+    import numpy as np
+
+    fields = dict()
+
+    with open(path_to_file, "rb") as f:
+        if not f.readline().startswith(b"NRRD"):
+            return None
+
+        while True:
+            line = f.readline()
+
+            # the header ends with an empty line (or with the end of the file, if the data is detached)
+            if line.strip() == b"":
+                break
+
+            line = line.decode("latin-1").strip()
+
+            if line.startswith("#") or ":" not in line:
+                continue
+
+            key, value = line.split(":", 1)
+            fields[key.strip().lower()] = value.lstrip("=").strip()
+
+        offset = f.tell()
+
+    if "data file" in fields or "datafile" in fields or int(fields.get("byte skip", 0)) != 0 \
+       or int(fields.get("line skip", 0)) != 0:
+        return None
+
+    dtype = [t for t, names in nrrd_types.items() if fields["type"].lower() in names]
+    if len(dtype) != 1:
+        return None
+
+    dtype = np.dtype(dtype[0])
+    if dtype.itemsize > 1:
+        dtype = dtype.newbyteorder(">" if fields.get("endian", "little").lower() == "big" else "<")
+
+    encoding = fields.get("encoding", "raw").lower()
+    if encoding not in ["raw", "gzip", "gz"]:
+        return None
+
+    sizes = [int(v) for v in fields["sizes"].split()]
+
+    # the spacing is either given as is, or as the norm of the space directions
+    if "spacings" in fields:
+        spacing = [float(v) for v in fields["spacings"].split()]
+    elif "space directions" in fields:
+        spacing = [float(np.linalg.norm([float(c) for c in d.split(",")]))
+                   for d in re.findall(r"\(([^)]*)\)", fields["space directions"])]
+    else:
+        spacing = [1.0]*len(sizes)
+
+    if len(spacing) != len(sizes):
+        return None
+
+    return get_header(sizes[::-1], spacing[::-1], dtype, path_to_file, offset,
+                      compression = None if encoding == "raw" else "gzip")
+
+## --------------------------------
+
+def read_mha_header(path_to_file):
+
+    """
+    Reads the header of a MHA (or MHD, with the voxel data in a separate file) file (see `read_header`).
+    """
+
+    import numpy as np
+
+    fields = dict()
+
+    with open(path_to_file, "rb") as f:
+        while True:
+            line = f.readline()
+
+            if line == b"":
+                return None
+
+            line = line.decode("latin-1").strip()
+
+            if "=" not in line:
+                continue
+
+            key, value = line.split("=", 1)
+            fields[key.strip()] = value.strip()
+
+            # the voxel data follows the last field of the header
+            if key.strip() == "ElementDataFile":
+                break
+
+        offset = f.tell()
+
+    if int(fields.get("ElementNumberOfChannels", 1)) != 1 or fields["ElementType"] not in mha_types:
+        return None
+
+    dtype = np.dtype(mha_types[fields["ElementType"]])
+    msb = fields.get("BinaryDataByteOrderMSB", fields.get("ElementByteOrderMSB", "False")).lower() == "true"
+    if dtype.itemsize > 1:
+        dtype = dtype.newbyteorder(">" if msb else "<")
+
+    data_file = path_to_file
+    if fields["ElementDataFile"] != "LOCAL":
+        # a single file storing the voxel data (and not a list or a pattern of files)
+        if " " in fields["ElementDataFile"] or fields["ElementDataFile"] == "LIST":
+            return None
+
+        data_file = os.path.join(os.path.dirname(path_to_file), fields["ElementDataFile"])
+        offset = int(fields.get("HeaderSize", 0))
+
+        if offset < 0:
+            return None
+
+    sizes = [int(v) for v in fields["DimSize"].split()]
+    spacing = [float(v) for v in fields.get("ElementSpacing", fields.get("ElementSize", "")).split()] \
+              or [1.0]*len(sizes)
+
+    compressed = fields.get("CompressedData", "False").lower() == "true"
+
+    return get_header(sizes[::-1], spacing[::-1], dtype, data_file, offset,
+                      compression = "zlib" if compressed else None)
+
+## --------------------------------
+
+def read_nifti_header(path_to_file):
+
+    """
+    Reads the header of a NIfTI-1 file (compressed or not) (see `read_header`).
+    """
+
+    import numpy as np
+
+    open_fn = gzip.open if path_to_file.endswith(".gz") else open
+
+    with open_fn(path_to_file, "rb") as f:
+        header = f.read(348)
+
+    # the byte order is found from the size of the header
+    if struct.unpack("<i", header[:4])[0] == 348:
+        endian = "<"
+    elif struct.unpack(">i", header[:4])[0] == 348:
+        endian = ">"
+    else:
+        return None
+
+    dims = struct.unpack(endian + "8h", header[40:56])
+    datatype = struct.unpack(endian + "h", header[70:72])[0]
+    pixdims = struct.unpack(endian + "8f", header[76:108])
+    vox_offset = struct.unpack(endian + "f", header[108:112])[0]
+    scl_slope, scl_inter = struct.unpack(endian + "2f", header[112:120])
+
+    ndims = dims[0]
+
+    # a single volume (the dimensions past the third one, if any, must be of size 1)
+    if ndims < 2 or ndims > 7 or any([d != 1 for d in dims[4:ndims + 1]]) or datatype not in nifti_types:
+        return None
+
+    ndims = min(ndims, 3)
+
+    dtype = np.dtype(nifti_types[datatype])
+    if dtype.itemsize > 1:
+        dtype = dtype.newbyteorder(endian)
+
+    scaling = None
+    if scl_slope not in [0.0, 1.0] or (scl_slope != 0.0 and scl_inter != 0.0):
+        scaling = (scl_slope, scl_inter)
+
+    return get_header(dims[1:ndims + 1][::-1], pixdims[1:ndims + 1][::-1], dtype, path_to_file,
+                      max(int(vox_offset), 352), compression = "gzip" if path_to_file.endswith(".gz") else None,
+                      scaling = scaling)
+
+## --------------------------------
+
+# the number of voxels the confusion matrix is accumulated for at a time (see `get_confusion_matrix` in `test/utils.py`),
+# and the memory taken by the indices computed for them (the index of every pair of labels, and its copy as `np.intp`)
+confusion_chunk_size = 1 << 20
+confusion_chunk_memory = confusion_chunk_size*(4 + 8 + 8)
+
+def get_slice_count(header, memory_budget):
+
+    """
+    Returns the number of slices to read at a time, so that comparing two slabs stays within `memory_budget` bytes.
+
+    Every voxel of a slab needs its value in both volumes (plus a copy, while decoding or scaling), and the
+    confusion matrix of the slabs is accumulated in chunks taking `confusion_chunk_memory` bytes.
+    """
+
+    nz, ny, nx = header["shape"]
+
+    bytes_per_slice = ny*nx*4*header["dtype"].itemsize
+
+    return int(min(max((memory_budget - confusion_chunk_memory) // max(bytes_per_slice, 1), 1), max(nz, 1)))
+
+def get_decoded_size(header):
+
+    """
+    Returns the memory (in bytes) needed to compare two volumes of this size at once (as `get_slice_count`).
+    """
+
+    nz, ny, nx = header["shape"]
+
+    return nz*ny*nx*4*header["dtype"].itemsize + confusion_chunk_memory
+
+## --------------------------------
+
+def iter_slabs(header, nslices):
+
+    """
+    Yields the voxel data of a volume, `nslices` slices (along z) at a time.
+
+    Uncompressed voxel data is memory mapped one slab at a time (the mapping of every slab is released before the
+    next one is mapped), and compressed voxel data is decompressed one slab at a time.
+
+    Args:
+        header (dict): The header of the volume (see `read_header`).
+        nslices (int): The number of slices of every slab (see `get_slice_count`).
+
+    Yields:
+        np.ndarray: The slabs of the volume, indexed as (z, y, x).
+    """
+
+    import numpy as np
+
+    nz, ny, nx = header["shape"]
+    dtype = header["dtype"]
+    slice_bytes = ny*nx*dtype.itemsize
+
+    def scale(slab):
+        if header["scaling"] is None:
+            return slab
+        return slab*np.float32(header["scaling"][0]) + np.float32(header["scaling"][1])
+
+    if header["compression"] is None:
+        for z in range(0, nz, nslices):
+            nz_slab = min(nslices, nz - z)
+            slab = np.memmap(header["data_file"], dtype=dtype, mode="r", offset=header["offset"] + z*slice_bytes,
+                             shape=(nz_slab, ny, nx))
+            yield scale(slab)
+            del slab
+        return
+
+    with open(header["data_file"], "rb") as f:
+        if header["compression"] == "gzip":
+            stream = gzip.GzipFile(fileobj=f, mode="rb")
+
+            # the offset of NIfTI files is within the compressed stream, that of NRRD files is not
+            if header["data_file"].endswith(".gz"):
+                stream.read(header["offset"])
+            else:
+                f.seek(header["offset"])
+                stream = gzip.GzipFile(fileobj=f, mode="rb")
+
+            read_fn = stream.read
+        else:
+            f.seek(header["offset"])
+            read_fn = get_zlib_reader(f)
+
+        for z in range(0, nz, nslices):
+            nz_slab = min(nslices, nz - z)
+            data = read_fn(nz_slab*slice_bytes)
+
+            if len(data) != nz_slab*slice_bytes:
+                raise ValueError("The voxel data of %s is truncated"%header["data_file"])
+
+            yield scale(np.frombuffer(data, dtype=dtype).reshape(nz_slab, ny, nx))
+
+## --------------------------------
+
+def get_zlib_reader(file_obj, chunk_size=1 << 20):
+
+    """
+    Returns a function reading a number of bytes from a zlib stream (e.g., the voxel data of a compressed MHA file),
+    decompressing only as much of the stream as needed.
+    """
+
+    decompressor = zlib.decompressobj()
+
+    def read(nbytes):
+        chunks = list()
+        nread = 0
+
+        while nread < nbytes:
+            if decompressor.unconsumed_tail:
+                compressed = decompressor.unconsumed_tail
+            else:
+                compressed = file_obj.read(chunk_size)
+                if compressed == b"":
+                    break
+
+            chunk = decompressor.decompress(compressed, nbytes - nread)
+            chunks.append(chunk)
+            nread += len(chunk)
+
+        return b"".join(chunks)
+
+    return read
+
+## --------------------------------
+
+def get_confusion_matrix(header1, header2, memory_budget, confusion_fn):
+
+    """
+    Returns the confusion matrix between two label volumes, accumulated one slab at a time.
+
+    Args:
+        header1 (dict): The header of the first volume (see `read_header`).
+        header2 (dict): The header of the second volume (same shape as the first one).
+        memory_budget (int): The memory (in bytes) the slabs compared at the same time can take.
+        confusion_fn (callable): The function returning the (labels, confusion) tuple of two label arrays
+                                 (e.g., `get_confusion_matrix` in `test/utils.py`).
+
+    Returns:
+        tuple: A (labels, confusion) tuple over the whole volumes (as returned by `confusion_fn`).
+    """
+
+    import numpy as np
+
+    if header1["shape"] != header2["shape"]:
+        raise ValueError("The label volumes have a different shape (%s/%s)"%(header1["shape"], header2["shape"]))
+
+    nslices = min(get_slice_count(header1, memory_budget), get_slice_count(header2, memory_budget))
+
+    labels = np.zeros(0, dtype=np.int64)
+    confusion = np.zeros((0, 0), dtype=np.int64)
+
+    for slab1, slab2 in zip(iter_slabs(header1, nslices), iter_slabs(header2, nslices)):
+        slab_labels, slab_confusion = confusion_fn(slab1, slab2)
+
+        # merge the labels found in the slab with the labels found so far
+        merged_labels = np.union1d(labels, slab_labels)
+
+        if len(merged_labels) != len(labels):
+            index = np.searchsorted(merged_labels, labels)
+            merged_confusion = np.zeros((len(merged_labels), len(merged_labels)), dtype=np.int64)
+            merged_confusion[np.ix_(index, index)] = confusion
+            labels, confusion = merged_labels, merged_confusion
+
+        slab_index = np.searchsorted(labels, slab_labels)
+        confusion[np.ix_(slab_index, slab_index)] += slab_confusion
+
+    return labels, confusion
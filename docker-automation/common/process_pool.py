@@ -0,0 +1,97 @@
+"""
+-------------------------------------------------
+MHub - process pools that are safe to start from the threads running the tests
+-------------------------------------------------
+"""
+
+import os
+import sys
+import multiprocessing
+import importlib.util
+import concurrent.futures
+
+from common import tracing
+
+## --------------------------------
+
+def get_mp_context():
+
+    """
+    Returns the multiprocessing context the worker processes are started with.
+
+    Forking a process running several threads (e.g., the test slots) can leave a lock held by another thread
+    in the child, so the workers are started from a fork server instead (or spawned, where it is not available).
+    """
+
+    start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+    return multiprocessing.get_context(start_method)
+
+## --------------------------------
+
+def _init_worker(module_name, path_to_module, trace_state):
+
+    """
+    Prepares a worker process: the module the tasks are defined in is loaded under the name it has in the parent
+    process (as the stage modules are loaded from their path, e.g., `test_utils` in the pipeline), and the trace
+    of the parent process is resumed.
+    """
+
+    if module_name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(module_name, path_to_module)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[module_name] = module
+        spec.loader.exec_module(module)
+
+    tracing.resume_trace(trace_state)
+
+## --------------------------------
+
+def get_process_pool(nworkers, module):
+
+    """
+    Returns a pool of worker processes, running the functions of `module`.
+
+    Args:
+        nworkers (int): The number of worker processes.
+        module (module): The module defining the functions submitted to the pool.
+
+    Returns:
+        concurrent.futures.ProcessPoolExecutor: The pool of worker processes (see `terminate_process_pool`).
+
+    Example:
+        >>> executor = get_process_pool(4, sys.modules[__name__])
+        >>> future = executor.submit(compare_file_pair, "/out/seg.nii.gz", "/ref/seg.nii.gz")
+    """
+
+    return concurrent.futures.ProcessPoolExecutor(max_workers=nworkers, mp_context=get_mp_context(),
+                                                  initializer=_init_worker,
+                                                  initargs=(module.__name__, os.path.abspath(module.__file__),
+                                                            tracing.get_state()))
+
+## --------------------------------
+
+def terminate_process_pool(executor):
+
+    """
+    Terminates the worker processes without waiting for the tasks to complete: the tasks still running, as well as
+    the ones that have not started yet, are done with a `BrokenProcessPool` error.
+
+    Args:
+        executor (concurrent.futures.ProcessPoolExecutor): The pool of worker processes.
+    """
+
+    # NOTE: the futures are not cancelled first, as the pool may then try to set the error of a cancelled future
+    # (raising InvalidStateError in its management thread, before Python 3.12)
+
+    # the pool does not expose its worker processes
+    processes = list((getattr(executor, "_processes", None) or dict()).values())
+
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+
+    executor.shutdown(wait=True)
+
+    for process in processes:
+        process.join()
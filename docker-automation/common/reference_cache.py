@@ -0,0 +1,229 @@
+"""
+-------------------------------------------------
+MHub - persistent cache of the decoded reference data
+-------------------------------------------------
+"""
+
+import os
+import shutil
+import hashlib
+import tempfile
+
+# NOTE: numpy is imported by the functions using it, as it takes a while to import
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "mhubai", "reference_cache")
+
+# the size of the cache on disk (in bytes), past which the least recently used entries are deleted
+DEFAULT_MAX_SIZE = 10*1024**3
+
+## --------------------------------
+
+def get_file_hash(path_to_file):
+
+    """
+    Returns the SHA256 digest of the content of a file (read in chunks, so that large files are not loaded at once).
+    """
+
+    hash_obj = hashlib.sha256()
+
+    with open(path_to_file, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            hash_obj.update(chunk)
+
+    return hash_obj.hexdigest()
+
+## --------------------------------
+
+def get_array_hash(array):
+
+    """
+    Returns the SHA256 digest of the content of an array (voxel data, shape and data type).
+    """
+
+    import numpy as np
+
+    array = np.ascontiguousarray(array)
+
+    hash_obj = hashlib.sha256()
+    hash_obj.update(("%s|%s|"%(array.dtype.str, array.shape)).encode())
+    hash_obj.update(array.data)
+
+    return hash_obj.hexdigest()
+
+## --------------------------------
+
+def get_entry_path(path_to_file, cache_dir=DEFAULT_CACHE_DIR):
+
+    """
+    Returns the path to the cache entry of a file (a folder), named after the path, modification time and size of
+    the file.
+    """
+
+    stat = os.stat(path_to_file)
+    entry_key = "%s|%s|%s"%(os.path.abspath(path_to_file), stat.st_mtime_ns, stat.st_size)
+
+    return os.path.join(cache_dir, hashlib.sha256(entry_key.encode()).hexdigest())
+
+## --------------------------------
+
+def load_reference(path_to_file, read_fn, cache_dir=DEFAULT_CACHE_DIR, max_size=DEFAULT_MAX_SIZE):
+
+    """
+    Returns the decoded content of a reference file, from the cache if possible.
+
+    Entries are keyed by the path, modification time and size of the file, and store the content hash of the file
+    along with the decoded arrays (so that the file is not read at all when the entry is used). Otherwise, the
+    file is decoded using `read_fn`, and the result is stored in the cache - deleting the least recently used
+    entries if the cache grows too large. The arrays are stored uncompressed (one .npy file each), and memory
+    mapped (read-only) when loaded from the cache.
+
+    Args:
+        path_to_file (str): The path to the reference file.
+        read_fn (callable): The function decoding the file. Called as `read_fn(path_to_file)`, returns a dictionary
+                            of numpy arrays (the decoded voxel data under "array", if any).
+        cache_dir (str, optional): The folder storing the cache. Defaults to DEFAULT_CACHE_DIR.
+        max_size (int, optional): The maximum size of the cache on disk, in bytes. Defaults to DEFAULT_MAX_SIZE.
+
+    Returns:
+        dict: The dictionary returned by `read_fn`, plus the content hash of the file under "file_hash"
+              and the content hash of the decoded voxel data (see `get_array_hash`) under "array_hash".
+
+    Example:
+        >>> reference_data = load_reference("/path/to/reference.nii.gz", read_itk_labels)
+        >>> reference_data["array_hash"] == get_array_hash(output_data["array"])
+        True
+    """
+
+    entry_path = get_entry_path(path_to_file, cache_dir=cache_dir)
+
+    if os.path.isdir(entry_path):
+        try:
+            data = load_entry(entry_path)
+
+            # mark the entry as recently used
+            os.utime(entry_path)
+
+            data["file_hash"] = str(data["file_hash"])
+            data["array_hash"] = str(data["array_hash"])
+            return data
+
+        except Exception as e:
+            print("WARNING: Could not load the cache entry for %s (%s)"%(path_to_file, e))
+            shutil.rmtree(entry_path, ignore_errors=True)
+
+    data = read_fn(path_to_file)
+    data["file_hash"] = get_file_hash(path_to_file)
+    data["array_hash"] = get_array_hash(data["array"]) if data.get("array") is not None else ""
+
+    save_entry(entry_path, {key: value for key, value in data.items() if value is not None})
+    evict_entries(cache_dir, max_size=max_size)
+
+    return data
+
+## --------------------------------
+
+def load_entry(entry_path):
+
+    """
+    Returns the dictionary of arrays stored in a cache entry, memory mapped (read-only).
+    """
+
+    import numpy as np
+
+    data = dict()
+
+    with os.scandir(entry_path) as it:
+        for entry in it:
+            if entry.name.endswith(".npy"):
+                data[entry.name[:-len(".npy")]] = np.load(entry.path, mmap_mode="r", allow_pickle=False)
+
+    # e.g., the entry is being deleted by another process
+    if "file_hash" not in data or "array_hash" not in data:
+        raise ValueError("incomplete cache entry")
+
+    return data
+
+def save_entry(entry_path, data):
+
+    """
+    Stores a dictionary of arrays in the cache (uncompressed, one .npy file per array), creating the entry atomically.
+    """
+
+    import numpy as np
+
+    os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+
+    # the entries can be written by several processes at the same time
+    tmp_path = tempfile.mkdtemp(dir=os.path.dirname(entry_path), suffix=".tmp")
+
+    try:
+        for key, value in data.items():
+            np.save(os.path.join(tmp_path, key + ".npy"), np.asarray(value), allow_pickle=False)
+
+        os.rename(tmp_path, entry_path)
+
+    except OSError:
+        # another process just wrote the same entry
+        if not os.path.isdir(entry_path):
+            raise
+
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+## --------------------------------
+
+def get_entry_size(entry_path):
+
+    """
+    Returns the size on disk (in bytes) of a cache entry.
+    """
+
+    if not os.path.isdir(entry_path):
+        return os.path.getsize(entry_path)
+
+    with os.scandir(entry_path) as it:
+        return sum([entry.stat().st_size for entry in it if entry.is_file()])
+
+def evict_entries(cache_dir=DEFAULT_CACHE_DIR, max_size=DEFAULT_MAX_SIZE):
+
+    """
+    Deletes the least recently used entries of the cache, until its size on disk is at most `max_size` bytes.
+
+    The arrays of an entry memory mapped by another process stay readable once the entry is deleted.
+
+    Returns:
+        int: The number of entries deleted.
+    """
+
+    entry_list = list()
+
+    with os.scandir(cache_dir) as it:
+        for entry in it:
+            # (the entries written by previous versions are single .npz files)
+            if (entry.is_dir() and not entry.name.endswith(".tmp")) or entry.name.endswith(".npz"):
+                try:
+                    entry_list.append((entry.stat().st_mtime_ns, get_entry_size(entry.path), entry.path))
+                except FileNotFoundError:
+                    # deleted by another process
+                    pass
+
+    total_size = sum([size for _, size, _ in entry_list])
+    ndeleted = 0
+
+    for _, size, path in sorted(entry_list):
+        if total_size <= max_size:
+            break
+
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # already deleted by another process
+                pass
+
+        total_size -= size
+        ndeleted += 1
+
+    return ndeleted
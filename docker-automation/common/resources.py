@@ -0,0 +1,338 @@
+"""
+-------------------------------------------------
+MHub - resource-aware admission of concurrent builds
+-------------------------------------------------
+"""
+
+import os
+import re
+import threading
+import contextlib
+
+from common import tracing
+
+# the folder the Docker daemon stores the images (and the build cache) in
+DEFAULT_DOCKER_ROOT = "/var/lib/docker"
+
+# the resources a build is assumed to need, unless the image dictionary says otherwise (see `get_build_request`)
+DEFAULT_BUILD_REQUEST = {"memory": 4*1024**3, "cpus": 1, "disk": 10*1024**3}
+
+size_units = {"": 1, "k": 1024, "m": 1024**2, "g": 1024**3, "t": 1024**4}
+
+## --------------------------------
+
+def parse_size(size, default_unit="g"):
+
+    """
+    Returns a size (e.g., of memory) in bytes.
+
+    Args:
+        size (int, float or str): The size, either as a number (in `default_unit`) or as a string with a binary unit
+                                  (e.g., "512M", "8G", "1.5TiB").
+        default_unit (str, optional): The unit of the sizes without one ("", "k", "m", "g" or "t"). Defaults to "g".
+
+    Returns:
+        int: The size in bytes.
+
+    Example:
+        >>> parse_size("512M"), parse_size(8)
+        (536870912, 8589934592)
+    """
+
+    if isinstance(size, (int, float)):
+        return int(size*size_units[default_unit])
+
+    match = re.fullmatch(r"\s*([0-9.]+)\s*([kmgt]?)(i?b)?\s*", str(size).lower())
+
+    if match is None:
+        raise ValueError("Could not parse the size %s"%size)
+
+    value, unit, suffix = match.groups()
+
+    if unit == "" and suffix is None:
+        unit = default_unit
+
+    return int(float(value)*size_units[unit])
+
+## --------------------------------
+
+def get_allowed_cpus():
+
+    """
+    Returns the sorted list of the CPUs this process is allowed to run on (e.g., restricted by a cgroup cpuset,
+    `taskset` or the CPU affinity of a CI runner), which are not always the first `os.cpu_count()` CPUs.
+    """
+
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+
+    return list(range(os.cpu_count()))
+
+def format_cpuset(cpus):
+
+    """
+    Returns a list of CPUs formatted as expected by `docker run --cpuset-cpus`, with consecutive CPUs as ranges.
+
+    Example:
+        >>> format_cpuset([0, 1, 2, 3, 8, 10, 11])
+        '0-3,8,10-11'
+    """
+
+    ranges = list()
+
+    for cpu in sorted(cpus):
+        if len(ranges) > 0 and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+
+    return ",".join(["%d"%first if first == last else "%d-%d"%(first, last) for first, last in ranges])
+
+## --------------------------------
+
+def get_memory_info():
+
+    """
+    Returns the total and available memory of the node (in bytes), as found in /proc/meminfo.
+
+    Returns:
+        dict: The total memory under "total" and the memory available to new processes (without swapping)
+              under "available". Both are None if /proc/meminfo can not be read (e.g., not on Linux).
+    """
+
+    meminfo = dict()
+
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                key, value = line.split(":", 1)
+                meminfo[key] = int(value.split()[0])*1024
+    except (OSError, ValueError):
+        return {"total": None, "available": None}
+
+    return {"total": meminfo.get("MemTotal"), "available": meminfo.get("MemAvailable", meminfo.get("MemFree"))}
+
+## --------------------------------
+
+def get_load_average():
+
+    """
+    Returns the number of processes running or waiting for a CPU, averaged over the last minute (None if unknown).
+    """
+
+    try:
+        return os.getloadavg()[0]
+    except OSError:
+        return None
+
+## --------------------------------
+
+def get_free_disk(path_to_folder=DEFAULT_DOCKER_ROOT):
+
+    """
+    Returns the disk space available (in bytes) on the filesystem storing a folder.
+
+    If the folder does not exist (or can not be accessed, e.g., /var/lib/docker without root privileges),
+    the closest parent folder found is used instead.
+    """
+
+    path_to_folder = os.path.abspath(path_to_folder)
+
+    while True:
+        try:
+            stat = os.statvfs(path_to_folder)
+            return stat.f_bavail*stat.f_frsize
+        except OSError:
+            if path_to_folder == os.path.dirname(path_to_folder):
+                return None
+            path_to_folder = os.path.dirname(path_to_folder)
+
+## --------------------------------
+
+def get_build_request(image_dict, default_request=DEFAULT_BUILD_REQUEST):
+
+    """
+    Returns the resources needed to build an image: the `resources` hints of the image in the build config if any,
+    and `default_request` otherwise.
+
+    Args:
+        image_dict (dict): The image dictionary, with an optional `resources` dictionary storing the memory, CPUs
+                           and disk space needed to build the image (the sizes in GB, or as strings with a unit).
+        default_request (dict, optional): The resources needed by the images without hints (with the "memory" and
+                                          "disk" sizes in bytes). Defaults to DEFAULT_BUILD_REQUEST.
+
+    Returns:
+        dict: The memory (bytes) under "memory", the number of CPUs under "cpus" and the disk space (bytes)
+              under "disk".
+
+    Example:
+        >>> get_build_request({"name": "totalsegmentator", "resources": {"memory": "16G", "disk": 40}})
+        {'memory': 17179869184, 'cpus': 1, 'disk': 42949672960}
+    """
+
+    request = dict(default_request)
+    hints = image_dict.get("resources") or dict()
+
+    if "memory" in hints:
+        request["memory"] = parse_size(hints["memory"])
+    if "cpus" in hints:
+        request["cpus"] = float(hints["cpus"])
+    if "disk" in hints:
+        request["disk"] = parse_size(hints["disk"])
+
+    return request
+
+## --------------------------------
+
+class BuildAdmission:
+
+    """
+    Admits the builds to run based on the resources they need and on the live resources of the node.
+
+    A build is admitted if, on top of the builds already running:
+        - the memory reserved by the running builds plus the memory it needs fits in the total memory of the node,
+          and it needs no more than the memory currently available (both minus `memory_reserve`);
+        - the CPUs reserved by the running builds plus the CPUs it needs are at most the CPUs this process is
+          allowed to run on (see `get_allowed_cpus`), and the load average is below `max_load` (per CPU);
+        - the disk space it needs, plus the space reserved by the running builds and not written yet, is currently
+          free on the filesystem storing the Docker images (minus `disk_reserve`).
+
+    The disk space the running builds write as they go is already missing from the free disk space: every drop of
+    the free disk space is taken from their reservations (in proportion), so that it is not counted twice.
+
+    The load average already counts the running builds (and, in the pipeline, the test containers), and lags a
+    minute behind: `max_load` defaults to 2 per CPU, so that it only holds the builds back when the node is
+    oversubscribed (e.g., by other jobs), while the CPU reservations pace the builds themselves.
+
+    Otherwise, the build waits until a running build is done (or the live resources change). A build is always
+    admitted if nothing else is running, so that a build needing more than the node has still runs (alone).
+    The resources that can not be read (e.g., /proc/meminfo outside of Linux) are not checked.
+
+    Example:
+        >>> admission = BuildAdmission(max_load=3.0)
+        >>> with admission.admit(image_tag, admission.get_request(image_dict)):
+        ...     build_docker_image(image_dict)
+    """
+
+    def __init__(self, default_request=DEFAULT_BUILD_REQUEST, path_to_docker_root=DEFAULT_DOCKER_ROOT,
+                 memory_reserve=1024**3, disk_reserve=5*1024**3, max_load=2.0, poll_interval=5.0):
+
+        self.default_request = default_request
+        self.path_to_docker_root = path_to_docker_root
+        self.memory_reserve = memory_reserve
+        self.disk_reserve = disk_reserve
+        self.max_load = max_load
+        self.poll_interval = poll_interval
+
+        self.ncpus = len(get_allowed_cpus())
+
+        self.condition = threading.Condition()
+        self.running = dict()
+
+        # the disk space reserved by every running build and not written yet (see `update_disk_reservations`)
+        self.disk_reservations = dict()
+        self.last_free_disk = None
+
+    ## --------------------------------
+
+    def get_request(self, image_dict):
+
+        """
+        Returns the resources needed to build an image (see `get_build_request`).
+        """
+
+        return get_build_request(image_dict, default_request=self.default_request)
+
+    ## --------------------------------
+
+    def update_disk_reservations(self, free_disk):
+
+        """
+        Takes the disk space used since the last check (i.e., written by the running builds) from the disk space
+        reserved by the running builds, in proportion to what is left of their reservations.
+        """
+
+        if self.last_free_disk is not None and free_disk < self.last_free_disk:
+            used_disk = self.last_free_disk - free_disk
+            reserved_disk = sum(self.disk_reservations.values())
+
+            if reserved_disk > 0:
+                for image_tag, reservation in self.disk_reservations.items():
+                    self.disk_reservations[image_tag] = max(reservation - used_disk*reservation/reserved_disk, 0)
+
+        self.last_free_disk = free_disk
+
+    ## --------------------------------
+
+    def check_request(self, request):
+
+        """
+        Returns None if a build needing `request` can be admitted now, and the reason why not otherwise.
+        """
+
+        free_disk = get_free_disk(self.path_to_docker_root)
+
+        if free_disk is not None:
+            self.update_disk_reservations(free_disk)
+
+        if len(self.running) == 0:
+            return None
+
+        reserved = {key: sum([running_request[key] for running_request in self.running.values()])
+                    for key in ["memory", "cpus"]}
+
+        memory_info = get_memory_info()
+
+        if memory_info["total"] is not None:
+            if reserved["memory"] + request["memory"] > memory_info["total"] - self.memory_reserve:
+                return "memory reserved by the running builds"
+            if request["memory"] > memory_info["available"] - self.memory_reserve:
+                return "memory available"
+
+        if reserved["cpus"] + min(request["cpus"], self.ncpus) > self.ncpus:
+            return "CPUs reserved by the running builds"
+
+        load_average = get_load_average()
+
+        if load_average is not None and load_average >= self.max_load*self.ncpus:
+            return "load average"
+
+        if free_disk is not None and \
+           sum(self.disk_reservations.values()) + request["disk"] > free_disk - self.disk_reserve:
+            return "disk space"
+
+        return None
+
+    ## --------------------------------
+
+    @contextlib.contextmanager
+    def admit(self, image_tag, request):
+
+        """
+        Waits until a build needing `request` (see `get_build_request`) can run, and reserves the resources
+        it needs until the end of the block.
+        """
+
+        with self.condition:
+            reason = self.check_request(request)
+
+            if reason is not None:
+                print("Queueing the build of %s (not enough %s)"%(image_tag, reason))
+
+                with tracing.span(image_tag, "build queue") as span_args:
+                    span_args["reason"] = reason
+
+                    while reason is not None:
+                        self.condition.wait(timeout=self.poll_interval)
+                        reason = self.check_request(request)
+
+            self.running[image_tag] = request
+            self.disk_reservations[image_tag] = request["disk"]
+
+        try:
+            yield
+        finally:
+            with self.condition:
+                del self.running[image_tag]
+                del self.disk_reservations[image_tag]
+                self.condition.notify_all()
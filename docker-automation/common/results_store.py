@@ -0,0 +1,239 @@
+"""
+-------------------------------------------------
+MHub - store of the automated testing results
+-------------------------------------------------
+"""
+
+import os
+import json
+import time
+import sqlite3
+
+# the name of the store, found in the folder storing the test reports
+store_file_name = "results.db"
+
+# the store of the tests passed so far, shared by all of the runs (see `get_memo`)
+DEFAULT_MEMO_PATH = os.path.join(os.path.expanduser("~"), ".cache", "mhubai", "test_memo.db")
+
+# the results of the tests run using every config (see `add_test_result`)
+results_schema = """
+CREATE TABLE IF NOT EXISTS tests (
+    id INTEGER PRIMARY KEY,
+    config TEXT NOT NULL,
+    image TEXT NOT NULL,
+    workflow TEXT NOT NULL,
+    data_sample TEXT NOT NULL,
+    dirtree_match INTEGER NOT NULL,
+    output_match INTEGER NOT NULL,
+    error TEXT,
+    run_time REAL,
+    compare_time REAL,
+    created REAL NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS tests_image ON tests (image);
+CREATE INDEX IF NOT EXISTS tests_config ON tests (config);
+
+CREATE TABLE IF NOT EXISTS files (
+    test_id INTEGER NOT NULL REFERENCES tests (id) ON DELETE CASCADE,
+    path TEXT NOT NULL,
+    match INTEGER,
+    dice REAL,
+    time REAL,
+    error TEXT
+);
+
+CREATE INDEX IF NOT EXISTS files_test_id ON files (test_id);
+"""
+
+# the tests passed so far (see `add_memo`)
+memo_schema = """
+CREATE TABLE IF NOT EXISTS memo (
+    key TEXT PRIMARY KEY,
+    image TEXT NOT NULL,
+    workflow TEXT NOT NULL,
+    data_sample TEXT NOT NULL,
+    result TEXT NOT NULL,
+    created REAL NOT NULL
+);
+"""
+
+## --------------------------------
+
+def get_store_path(path_to_folder):
+
+    """
+    Returns the path to the store found in a folder (e.g., the folder storing the test reports).
+    """
+
+    return os.path.join(path_to_folder, store_file_name)
+
+## --------------------------------
+
+def connect(path_to_store, schema=results_schema):
+
+    """
+    Opens a connection to the store (created if needed, with the tables of `schema`).
+
+    The store is a SQLite database in WAL mode: the tests running at the same time (in different threads or
+    processes) can write their results concurrently, while the results are read.
+
+    Args:
+        path_to_store (str): The path to the store.
+        schema (str, optional): The tables of the store (`results_schema` or `memo_schema`).
+                                Defaults to `results_schema`.
+
+    Returns:
+        sqlite3.Connection: The connection to the store (to be closed by the caller).
+    """
+
+    os.makedirs(os.path.dirname(os.path.abspath(path_to_store)), exist_ok=True)
+
+    connection = sqlite3.connect(path_to_store, timeout=60)
+
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA foreign_keys=ON")
+    connection.executescript(schema)
+
+    return connection
+
+## --------------------------------
+
+def delete_results(path_to_store, config):
+
+    """
+    Deletes the results of the tests run using a config (e.g., before running the tests again).
+    """
+
+    connection = connect(path_to_store)
+
+    try:
+        with connection:
+            connection.execute("DELETE FROM tests WHERE config = ?", (config,))
+    finally:
+        connection.close()
+
+## --------------------------------
+
+def add_test_result(path_to_store, test_result, file_report_list=None):
+
+    """
+    Stores the result of a test, along with the report of every file compared (if any).
+
+    Args:
+        path_to_store (str): The path to the store.
+        test_result (dict): The result of the test, with the "config", "image", "workflow", "data_sample",
+                            "dirtree_match" and "output_match" keys, and optionally the "error", "run_time"
+                            and "compare_time" (in seconds) keys.
+        file_report_list (list, optional): The report of every file compared (with the "output_file", "match",
+                                           "time", "error" and, optionally, "dice" keys). Defaults to None.
+
+    Returns:
+        int: The ID of the test in the store.
+
+    Example:
+        >>> add_test_result("/path/to/reports/results.db",
+        ...                 {"config": "dev", "image": "mhubai/lungmask:latest", "workflow": "dicom",
+        ...                  "data_sample": "chest_ct", "dirtree_match": True, "output_match": True})
+        1
+    """
+
+    connection = connect(path_to_store)
+
+    try:
+        with connection:
+            cursor = connection.execute(
+                "INSERT INTO tests (config, image, workflow, data_sample, dirtree_match, output_match, error, "
+                "run_time, compare_time, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (test_result["config"], test_result["image"], test_result["workflow"], test_result["data_sample"],
+                 bool(test_result["dirtree_match"]), bool(test_result["output_match"]), test_result.get("error"),
+                 test_result.get("run_time"), test_result.get("compare_time"), time.time()))
+
+            test_id = cursor.lastrowid
+
+            connection.executemany(
+                "INSERT INTO files (test_id, path, match, dice, time, error) VALUES (?, ?, ?, ?, ?, ?)",
+                [(test_id, file_report["output_file"], file_report["match"], file_report.get("dice"),
+                  file_report["time"], file_report["error"]) for file_report in file_report_list or list()])
+    finally:
+        connection.close()
+
+    return test_id
+
+## --------------------------------
+
+def get_image_results(path_to_store):
+
+    """
+    Returns, for every image tested, whether it passed all of its tests (both the directory tree and the output
+    matching the reference, for every workflow and data sample).
+
+    Returns:
+        dict: A dictionary mapping every image (repo/image:tag) to True if it passed all of its tests.
+    """
+
+    connection = connect(path_to_store)
+
+    try:
+        rows = connection.execute(
+            "SELECT image, MIN(dirtree_match AND output_match) FROM tests GROUP BY image ORDER BY MIN(id)").fetchall()
+    finally:
+        connection.close()
+
+    return {image: bool(passed) for image, passed in rows}
+
+## --------------------------------
+
+def get_memo(path_to_store, key):
+
+    """
+    Returns the result of a test that passed with the same key (see `test/utils.get_memo_key`), if any.
+
+    Returns:
+        dict: The result of the test (as passed to `add_memo`), with the report of every file compared under
+              "file_report_list" - or None if no test passed with this key.
+    """
+
+    connection = connect(path_to_store, schema=memo_schema)
+
+    try:
+        row = connection.execute("SELECT result FROM memo WHERE key = ?", (key,)).fetchone()
+    finally:
+        connection.close()
+
+    return json.loads(row[0]) if row is not None else None
+
+## --------------------------------
+
+def add_memo(path_to_store, key, test_result, file_report_list=None):
+
+    """
+    Stores the result of a test that passed, so that the next tests with the same key can be skipped.
+
+    Args:
+        path_to_store (str): The path to the store (e.g., DEFAULT_MEMO_PATH).
+        key (str): The key of the test (see `test/utils.get_memo_key`).
+        test_result (dict): The result of the test (see `add_test_result`).
+        file_report_list (list, optional): The report of every file compared. Defaults to None.
+
+    Example:
+        >>> add_memo(DEFAULT_MEMO_PATH, key, {"config": "dev", "image": "mhubai/lungmask:latest", ...})
+        >>> get_memo(DEFAULT_MEMO_PATH, key)["output_match"]
+        True
+    """
+
+    result = dict(test_result, file_report_list=[{k: file_report.get(k) for k in
+                                                  ["output_file", "match", "dice", "time", "error"]}
+                                                 for file_report in file_report_list or list()])
+
+    connection = connect(path_to_store, schema=memo_schema)
+
+    try:
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO memo (key, image, workflow, data_sample, result, created) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, test_result["image"], test_result["workflow"], test_result["data_sample"],
+                 json.dumps(result), time.time()))
+    finally:
+        connection.close()
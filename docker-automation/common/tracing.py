@@ -0,0 +1,235 @@
+"""
+-------------------------------------------------
+MHub - timing instrumentation of the build, test and push stages
+-------------------------------------------------
+"""
+
+import os
+import json
+import time
+import secrets
+import datetime
+import threading
+import contextlib
+
+# the spans recorded by this process (and, once merged, by the worker processes it started)
+_spans = list()
+_spans_lock = threading.Lock()
+
+_trace = {"enabled": False, "run_id": None, "pid": None}
+
+## --------------------------------
+
+def get_run_id():
+
+    """
+    Returns a new run ID (formatted as in the `scripts` folder, e.g., "17102026120000_0a1b2c3d4e5f6a7b").
+    """
+
+    return "%s_%s"%(datetime.datetime.now().strftime("%d%m%Y%H%M%S"), secrets.token_hex(8))
+
+## --------------------------------
+
+def start_trace(run_id=None):
+
+    """
+    Starts recording the spans of this run (until then, `span` does nothing).
+
+    Returns:
+        str: The ID of the run (a new one, if not provided).
+    """
+
+    _trace["enabled"] = True
+    _trace["run_id"] = run_id if run_id is not None else get_run_id()
+    _trace["pid"] = os.getpid()
+
+    return _trace["run_id"]
+
+## --------------------------------
+
+def is_enabled():
+    return _trace["enabled"]
+
+def is_worker():
+
+    """
+    Returns True if running in a worker process (e.g., of a process pool) started after `start_trace`.
+    """
+
+    return _trace["enabled"] and os.getpid() != _trace["pid"]
+
+def get_state():
+
+    """
+    Returns the state of the trace, to resume it in a worker process that does not inherit it (see `resume_trace`).
+    """
+
+    return dict(_trace)
+
+def resume_trace(state):
+
+    """
+    Resumes the trace of the process that started this one (from its `get_state`), e.g., in a spawned worker process.
+    """
+
+    _trace.update(state)
+
+## --------------------------------
+
+@contextlib.contextmanager
+def span(name, category="", **kwargs):
+
+    """
+    Records the time spent in a block of code, as a span of the trace (if the trace was started).
+
+    Args:
+        name (str): The name of the span (e.g., the tag of the image being built).
+        category (str, optional): The category of the span (e.g., "build"). Defaults to "".
+        **kwargs: Details stored along with the span.
+
+    Yields:
+        dict: The details of the span, which can be updated from within the block (e.g., with its outcome).
+
+    Example:
+        >>> with span("mhubai/lungmask:latest", "build", no_cache=True) as span_args:
+        ...     span_args["result"] = build_docker_image(image_dict)
+    """
+
+    span_args = dict(kwargs)
+
+    if not _trace["enabled"]:
+        yield span_args
+        return
+
+    start_time = time.time()
+    start_counter = time.perf_counter()
+
+    try:
+        yield span_args
+    except BaseException as e:
+        span_args["error"] = repr(e)
+        raise
+    finally:
+        _record_span(name, category, start_time, time.perf_counter() - start_counter, span_args)
+
+## --------------------------------
+
+def add_span(name, category, start_time, duration, **kwargs):
+
+    """
+    Records a span whose timing is already known (e.g., a step reported by a build), if the trace was started.
+
+    Args:
+        name (str): The name of the span.
+        category (str): The category of the span (e.g., "build step").
+        start_time (float): The time the span started at (seconds since the epoch).
+        duration (float): The duration of the span (seconds).
+        **kwargs: Details stored along with the span.
+    """
+
+    if not _trace["enabled"]:
+        return
+
+    _record_span(name, category, start_time, duration, kwargs)
+
+def _record_span(name, category, start_time, duration, span_args):
+
+    """
+    Records a span of the current thread, as a Chrome trace "complete" event (timestamps and durations in
+    microseconds). The details that can not be stored in JSON as they are are stored as strings.
+    """
+
+    thread = threading.current_thread()
+
+    event = {"name": name, "cat": category, "ph": "X",
+             "ts": int(start_time*1e6), "dur": int(duration*1e6),
+             "pid": os.getpid(), "tid": thread.native_id,
+             "args": {key: value if isinstance(value, (str, int, float, bool, type(None))) else str(value)
+                      for key, value in span_args.items()},
+             "thread_name": thread.name}
+
+    with _spans_lock:
+        _spans.append(event)
+
+## --------------------------------
+
+def pop_spans():
+
+    """
+    Returns (and forgets) the spans recorded by this process - e.g., to send them back from a worker process.
+    """
+
+    with _spans_lock:
+        spans = list(_spans)
+        del _spans[:]
+
+    return spans
+
+def add_spans(spans):
+
+    """
+    Adds spans recorded elsewhere (e.g., returned by a worker process, see `pop_spans`) to the trace.
+    """
+
+    with _spans_lock:
+        _spans.extend(spans)
+
+## --------------------------------
+
+def get_trace_path(trace_dir, run_id=None):
+
+    """
+    Returns the path to the trace of a run (one file per run ID, shared by all of the stages of the run).
+    """
+
+    return os.path.join(trace_dir, "%s.trace.json"%(run_id if run_id is not None else _trace["run_id"]))
+
+## --------------------------------
+
+def write_trace(path_to_trace, stage=None):
+
+    """
+    Exports the spans recorded so far as a trace in the Chrome trace event format (which can be opened with
+    chrome://tracing or https://ui.perfetto.dev).
+
+    If the file exists (e.g., written by a previous stage of the same run), the spans are added to it.
+
+    Args:
+        path_to_trace (str): The path to the trace file.
+        stage (str, optional): The name of the stage, used to label the process in the trace. Defaults to None.
+
+    Returns:
+        int: The number of spans written.
+    """
+
+    spans = pop_spans()
+
+    trace = {"traceEvents": list(), "displayTimeUnit": "ms", "otherData": {"run_id": _trace["run_id"]}}
+
+    if os.path.isfile(path_to_trace):
+        with open(path_to_trace, "r") as f:
+            trace = json.load(f)
+
+    # name the processes and threads, as shown in the trace viewer
+    thread_names = dict()
+    for event in spans:
+        thread_names[(event["pid"], event["tid"])] = event.pop("thread_name")
+
+    for (pid, tid), thread_name in thread_names.items():
+        trace["traceEvents"].append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                                     "args": {"name": thread_name}})
+
+    if stage is not None:
+        trace["traceEvents"].append({"name": "process_name", "ph": "M", "pid": os.getpid(),
+                                     "args": {"name": stage}})
+
+    trace["traceEvents"] += spans
+
+    os.makedirs(os.path.dirname(os.path.abspath(path_to_trace)), exist_ok=True)
+
+    tmp_path = path_to_trace + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(trace, f)
+    os.replace(tmp_path, path_to_trace)
+
+    return len(spans)
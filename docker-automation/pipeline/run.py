@@ -0,0 +1,448 @@
+"""
+-------------------------------------------------
+MHub - local automation for the build, test and push pipeline
+-------------------------------------------------
+"""
+
+import os
+import sys
+import copy
+import time
+
+import argparse
+import functools
+import contextlib
+
+import yaml
+import pprint
+
+pp = pprint.PrettyPrinter(indent=2)
+
+import utils
+
+max_cores = os.cpu_count()
+
+# the run.py modules of the three stages (each with its own utils module, found under `.utils`)
+build = utils.load_stage("build")
+test = utils.load_stage("test")
+push = utils.load_stage("push")
+
+# shared by the three stages (found once the stages are loaded)
+from common import tracing
+
+## --------------------------------
+
+def is_test_passed(result):
+    return result is not None and result["dirtree_match"] is True and result["output_match"] is True
+
+## --------------------------------
+
+def dryrun_build(image_dict):
+    return build.dryrun_core(image_dict)
+
+def dryrun_test(test_dict, slot_dict, warm=False):
+    test.dryrun_core(test_dict, warm = warm)
+    return {"dirtree_match": True, "output_match": True}
+
+def dryrun_push(image_tag):
+    return push.dryrun_core({"name": image_tag})
+
+## --------------------------------
+
+def run_push(image_tag, use_api=False):
+    return push.run_core({"name": image_tag}, use_api = use_api)
+
+## --------------------------------
+
+def run_once(args, config_dict, commit_hash, build_index=None, run_id=None, status=None):
+
+    """
+    Runs the pipeline once, on the images of the build config (or, with `--changed_only`, on the images affected
+    by the changes since the last commit built successfully, according to `build_index`).
+
+    Returns:
+        dict: The number of images built under "built", and the lists of images that failed to build and that
+              were pushed under "failed" and "pushed".
+    """
+
+    image_list = build.get_image_list(config_dict, branch = args.branch)
+    build_graph = build.utils.get_build_graph(image_list)
+
+    if args.changed_only:
+        image_list, build_graph = build.get_affected_image_list(image_list, build_graph, build_index, config_dict,
+                                                                branch = args.branch, commit_hash = commit_hash)
+
+    if args.dryrun:
+        build_fn = dryrun_build
+    elif args.incremental:
+        build_fn = functools.partial(build.run_core, build_index = build_index, path_to_index = args.build_index,
+                                     commit_hash = commit_hash, force_rebuild = args.force_rebuild,
+                                     use_api = args.docker_api, buildkit = build.get_buildkit_options(args))
+    else:
+        build_fn = functools.partial(build.run_core, force_rebuild = args.force_rebuild, use_api = args.docker_api,
+                                     buildkit = build.get_buildkit_options(args))
+
+    # the builds only start if the node has the memory, CPUs and disk space they need
+    admission = None
+    if not args.no_admission and not args.dryrun:
+        default_request = {"memory": build.utils.resources.parse_size(args.build_memory),
+                           "cpus": 1,
+                           "disk": build.utils.resources.parse_size(args.build_disk)}
+
+        admission = build.utils.resources.BuildAdmission(default_request = default_request,
+                                                         path_to_docker_root = args.docker_root)
+
+    # -- TEST SETUP --
+
+    # test only the images built in this run
+    image_tags = [build.utils.get_image_tag(image_dict) for image_dict in image_list]
+
+    tests_dict = dict()
+    for config_path in args.test_config:
+        with open(config_path, 'r') as f:
+            test_config_dict = yaml.safe_load(f)
+
+        csv_path = test.init_output_file(config_path = config_path, outpath = args.outpath,
+                                         use_store = not args.dryrun)
+
+        for test_dict in test.get_test_list(test_config_dict, csv_path = csv_path, use_gpu = args.gpu,
+                                            images_to_test = image_tags):
+            tests_dict.setdefault(test_dict["image_to_test"], list()).append(test_dict)
+
+    slot_list = test.utils.get_test_slots(nslots = args.test_slots, gpu_devices = args.gpu_devices)
+
+    # the output files of the tests running at the same time are compared sharing the CPUs
+    # with warm containers, the workflows of an image are run one after the other, in the same container
+    warm_containers = None
+    if args.warm_containers and not args.dryrun:
+        warm_containers = test.utils.WarmContainers([test_dict for test_list in tests_dict.values()
+                                                     for test_dict in test_list], verbose = args.verbose)
+
+    ncpus = len(build.utils.resources.get_allowed_cpus())
+
+    test_fn = functools.partial(test.run_core, use_api = args.docker_api,
+                                compare_workers = max(ncpus//len(slot_list), 1),
+                                reference_cache_dir = None if args.no_reference_cache else args.reference_cache,
+                                warm_containers = warm_containers,
+                                memo_path = None if args.no_memo else args.memo_store,
+                                compare_memory = None if args.compare_memory is None
+                                                 else build.utils.resources.parse_size(args.compare_memory),
+                                surface_metrics = args.surface_metrics)
+
+    if args.verbose:
+        print("Found %g image(s) to build, %g of which with tests (%g tests in total)\n"%(
+            len(image_list), len(tests_dict), sum([len(v) for v in tests_dict.values()])))
+
+    push_fn = dryrun_push if args.dryrun else functools.partial(run_push, use_api = args.docker_api)
+    test_fn = functools.partial(dryrun_test, warm = args.warm_containers) if args.dryrun else test_fn
+
+    # in watch mode, report the jobs in flight
+    if status is not None:
+        status.start_run(run_id = run_id, commit_hash = commit_hash, nbuilds = len(image_list),
+                         ntests = sum([len(v) for v in tests_dict.values()]))
+
+        build_fn = status.track("build", build_fn, get_key = build.utils.get_image_tag)
+        test_fn = status.track("test", test_fn, get_key = utils.get_test_key)
+        push_fn = status.track("push", push_fn, get_key = lambda image_tag: image_tag)
+
+    # -- PIPELINE --
+
+    print("Running the pipeline (build: %g, test: %g, push: %g at the same time)\n"%(
+        args.build_slots, len(slot_list), args.push_slots))
+
+    failed_list = list()
+    pushed_list = list()
+
+    # the warm containers are removed once done, whatever happens
+    with warm_containers if warm_containers is not None else contextlib.nullcontext():
+        for image_tag, stage, item, result in utils.run_pipeline(
+                image_list, build_graph, tests_dict,
+                build_fn = build_fn,
+                test_fn = test_fn,
+                push_fn = push_fn,
+                get_image_tag = build.utils.get_image_tag,
+                get_downstream_images = build.utils.get_downstream_images,
+                nbuild = args.build_slots,
+                slot_list = slot_list,
+                npush = args.push_slots,
+                is_test_passed = is_test_passed,
+                admission = admission,
+                sequential_tests = args.warm_containers):
+
+            if status is not None:
+                status.set_done(stage)
+
+            if stage == "build":
+                print(">>> [build] %s: %s"%(image_tag, "done" if result is not None else "FAILED"))
+                if result is None:
+                    failed_list.append(image_tag)
+
+            elif stage == "test":
+                print(">>> [test] %s - %s: %s"%(image_tag, item["workflow_name"],
+                                                "passed" if is_test_passed(result) else "FAILED"))
+
+            elif stage == "push":
+                print(">>> [push] %s: %s"%(image_tag, result["status"] if result is not None else "FAILED"))
+                if result is not None:
+                    pushed_list.append(image_tag)
+
+    print("\nPushed %g image(s): %s"%(len(pushed_list), ", ".join(pushed_list)))
+
+    if len(failed_list) > 0:
+        print("The following images were not built: %s\n"%", ".join(failed_list))
+
+    # if everything was built, the changes up to this commit do not need to be built again
+    elif build_index is not None and not args.dryrun:
+        build_index["commits"][args.branch] = commit_hash
+        build.utils.save_build_index(build_index, args.build_index)
+
+    if args.prune and not args.dryrun:
+        print("Deleting all of the dangling Docker images...")
+        build.utils.prune_docker_images(use_api = args.docker_api, verbose = args.verbose)
+
+    return {"built": len(image_list) - len(failed_list), "failed": failed_list, "pushed": pushed_list}
+
+## --------------------------------
+
+def watch(args):
+
+    """
+    Runs the pipeline every time the models repository (or the branch to build) changes, until interrupted.
+
+    The remote is checked every `--interval` seconds (a single `git ls-remote`), and the pipeline only runs
+    on the images affected by the new commits (as with `--incremental --changed_only`). The configs, the build
+    index, the Docker API connections and the registry tokens are kept in memory
+    between the runs (the configs are read again only if their files change). If the check or the run fail,
+    the next check is delayed (doubling the interval, up to `--max_interval` seconds) - and a commit whose run
+    failed is run again at the next check, until a run on it succeeds.
+
+    The reports of every run are stored in a subfolder of `--outpath` named after the run ID. With
+    `--status_port`, the status of the pipeline (state, queue depth and jobs in flight) is served as JSON
+    at http://localhost:<port>/status.
+    """
+
+    args.incremental = True
+    args.changed_only = True
+
+    status = utils.PipelineStatus()
+
+    if args.status_port is not None:
+        utils.start_status_server(status, args.status_port)
+        print("Serving the status of the pipeline at http://localhost:%g/status"%args.status_port)
+
+    build_index = build.utils.load_build_index(args.build_index)
+
+    config_dict = None
+    config_mtimes = None
+
+    # the last commit the pipeline ran on successfully (run again at every check until then)
+    last_hash = build_index["commits"].get(args.branch)
+    interval = args.interval
+
+    print("Watching %s (branch: %s, every %gs)\n"%(args.build_config, args.branch, args.interval))
+
+    while True:
+        status.set(state = "checking", next_check = None)
+
+        try:
+            mtimes = [os.path.getmtime(config_path) for config_path in args.build_config + args.test_config]
+
+            if mtimes != config_mtimes:
+                config_dict = build.load_config(args.build_config)
+                config_mtimes = mtimes
+
+                if last_hash is not None:
+                    print("The config files changed - running the pipeline on the last commit again")
+                    last_hash = None
+
+            result = build.utils.git_sync.sync_repository(path_to_repo = config_dict["github"]["repository_folder"],
+                                                          repo_url = config_dict["github"]["repository_url"],
+                                                          branches = [args.branch],
+                                                          dryrun = args.dryrun,
+                                                          ttl = 0)
+
+            # every run points the config to the worktree of the branch (if any), leaving the original untouched
+            run_config_dict = copy.deepcopy(config_dict)
+            commit_hash = result.commit_hash
+
+            if args.branch != "main":
+                commit_hash = build.checkout_branch(run_config_dict, branch = args.branch,
+                                                    worktree_dir = args.worktree_dir, dryrun = args.dryrun)
+
+        except Exception as e:
+            interval = min(interval*2, args.max_interval)
+
+            print("ERROR: could not check the models repository for changes - retrying in %gs"%interval)
+            print(e, "\n")
+
+            status.set(state = "backoff", error = str(e), next_check = time.time() + interval)
+            time.sleep(interval)
+            continue
+
+        if commit_hash == last_hash:
+            interval = args.interval
+
+            status.set(state = "idle", commit_hash = commit_hash, next_check = time.time() + interval)
+            time.sleep(interval)
+            continue
+
+        run_id = tracing.get_run_id()
+        print("\n[%s] New commit %s - starting run %s\n"%(time.strftime("%Y-%m-%d %H:%M:%S"), commit_hash, run_id))
+
+        # the reports of every run are stored separately (as done by the scripts)
+        run_args = argparse.Namespace(**vars(args))
+        run_args.outpath = os.path.join(args.outpath, run_id)
+        os.makedirs(run_args.outpath, exist_ok=True)
+
+        if args.trace_dir is not None:
+            tracing.start_trace(run_id = run_id)
+
+        try:
+            summary = run_once(run_args, run_config_dict, commit_hash, build_index = build_index,
+                               run_id = run_id, status = status)
+
+            status.end_run(summary)
+            status.set(state = "idle")
+
+            last_hash = commit_hash
+            interval = args.interval
+
+        except Exception as e:
+            # e.g., the registry or the network is down: the same commit is run again at the next check
+            interval = min(interval*2, args.max_interval)
+
+            print("ERROR: run %s failed - running commit %s again in %gs"%(run_id, commit_hash, interval))
+            print(e, "\n")
+
+            status.end_run({"error": str(e)})
+            status.set(state = "backoff", error = str(e))
+
+        if args.trace_dir is not None:
+            tracing.write_trace(tracing.get_trace_path(args.trace_dir, run_id), stage = "pipeline")
+
+        status.set(next_check = time.time() + interval)
+        time.sleep(interval)
+
+## --------------------------------
+
+def main(argv=None):
+
+    # parse command line arguments
+    parser = argparse.ArgumentParser(description='MHub - local automation for the build, test and push pipeline')
+    parser.add_argument('--verbose', action='store_true', help='enable verbose mode')
+    parser.add_argument('--dryrun', action='store_true', help='execute in dry run mode')
+    parser.add_argument('--build_config', action='store', nargs='+', required=True,
+                        help='path to the build config file(s)')
+    parser.add_argument('--test_config', action='store', nargs='+', required=True,
+                        help='path to the test config file(s)')
+    parser.add_argument('--outpath', action='store', help='path to the folder storing the test reports', required=True)
+    parser.add_argument('--branch', action='store', help='name of the branch to build the images from',
+                        type=str, default="main")
+    parser.add_argument('--git_cache_ttl', action='store', type=float, default=build.utils.git_sync.DEFAULT_CACHE_TTL,
+                        help='seconds the commits of the remote branches are cached for (0 to check the remote every time)')
+    parser.add_argument('--worktree_dir', action='store', type=str, default=build.utils.default_worktree_dir,
+                        help='folder storing the worktrees the branches other than main are built from')
+    parser.add_argument('--incremental', action='store_true',
+                        help='skip the images whose Dockerfile, build context, parent images and image folder did not change')
+    parser.add_argument('--force_rebuild', action='store_true',
+                        help='rebuild every image from scratch, without the layer cache (and regardless of the build index)')
+    parser.add_argument('--changed_only', action='store_true',
+                        help='only build, test and push the images affected by the changes since the last successful build')
+    parser.add_argument('--build_index', action='store', help='path to the build index (incremental/changed-only mode)',
+                        type=str, default=build.default_build_index)
+    parser.add_argument('--build_slots', action='store', type=int, default=4,
+                        help='number of images to build at the same time (max is %g)'%max_cores)
+    parser.add_argument('--buildkit', action='store_true',
+                        help='build the images with BuildKit (docker buildx), importing and exporting their layer cache')
+    parser.add_argument('--buildkit_builder', action='store', type=str, default=None,
+                        help='name of the buildx builder to use (default: the current one)')
+    parser.add_argument('--buildkit_cache_dir', action='store', type=str, default=build.utils.default_buildkit_cache_dir,
+                        help='folder storing the BuildKit layer cache of every image')
+    parser.add_argument('--buildkit_cache_registry', action='store', type=str, default=None,
+                        help='registry storing the BuildKit layer cache instead of --buildkit_cache_dir (e.g., localhost:5000/mhubai)')
+    parser.add_argument('--build_memory', action='store', type=str, default="4G",
+                        help='memory needed by the builds of the images without resource hints in the config (e.g., 8G)')
+    parser.add_argument('--build_disk', action='store', type=str, default="10G",
+                        help='disk space needed by the builds of the images without resource hints in the config')
+    parser.add_argument('--docker_root', action='store', type=str, default=build.utils.resources.DEFAULT_DOCKER_ROOT,
+                        help='folder storing the Docker images, whose free disk space is checked before every build')
+    parser.add_argument('--no_admission', action='store_true',
+                        help='start the builds regardless of the memory, CPUs and disk space available')
+    parser.add_argument('--gpu', action='store_true', help='run the test containers using a GPU (device 0, see --gpu_devices)')
+    parser.add_argument('--gpu_devices', action='store', nargs='+', type=str, default=None,
+                        help='GPU devices to run the tests on (one test per device at a time) - implies --gpu')
+    parser.add_argument('--test_slots', action='store', type=int, default=1,
+                        help='number of tests to run at the same time when running on CPU')
+    parser.add_argument('--reference_cache', action='store', type=str,
+                        default=test.utils.reference_cache.DEFAULT_CACHE_DIR,
+                        help='path to the folder caching the decoded reference files')
+    parser.add_argument('--no_reference_cache', action='store_true', help='decode the reference files at every run')
+    parser.add_argument('--surface_metrics', action='store_true',
+                        help='compute and print the Hausdorff (max and 95th percentile) and mean surface distance of every label')
+    parser.add_argument('--compare_memory', action='store', type=str, default=None,
+                        help='memory every comparison can take (e.g., 2G) - larger images are compared one slab at a time')
+    parser.add_argument('--memo_store', action='store', type=str, default=test.utils.results_store.DEFAULT_MEMO_PATH,
+                        help='path to the store of the tests passed so far (skipped while the image and data do not change)')
+    parser.add_argument('--no-memo', action='store_true', help='run every test, even if it passed before with the same image and data')
+    parser.add_argument('--warm_containers', action='store_true',
+                        help='run all the workflows of an image in the same container, instead of a new container per workflow')
+    parser.add_argument('--push_slots', action='store', type=int, default=4,
+                        help='number of images to push at the same time')
+    parser.add_argument('--docker_api', action='store_true',
+                        help='talk to the Docker Engine API (/var/run/docker.sock) instead of running the docker CLI')
+    parser.add_argument('--prune', action='store_true', help='delete the dangling Docker images once done')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running, and run the pipeline on the images affected by every new commit')
+    parser.add_argument('--interval', action='store', type=float, default=30,
+                        help='watch mode: seconds between two checks of the models repository')
+    parser.add_argument('--max_interval', action='store', type=float, default=600,
+                        help='watch mode: maximum seconds between two checks after errors (the interval doubles)')
+    parser.add_argument('--status_port', action='store', type=int, default=None,
+                        help='watch mode: serve the status of the pipeline at http://localhost:<port>/status')
+    parser.add_argument('--trace_dir', action='store', type=str, default=None,
+                        help='folder to export the timing of every step to (as <run_id>.trace.json)')
+    parser.add_argument('--run_id', action='store', type=str, default=None,
+                        help='ID of the run, shared by the stages writing to the same trace (default: a new one)')
+
+    args = parser.parse_args(argv)
+
+    # the warm containers are run (and the workflows executed in them) with the docker CLI only
+    if args.docker_api and args.warm_containers:
+        parser.error("--docker_api can not be used with --warm_containers (warm containers are run with the docker CLI)")
+
+    if args.gpu_devices is not None:
+        args.gpu = True
+    elif args.gpu:
+        args.gpu_devices = ["0"]
+
+    if args.watch:
+        watch(args)
+        return
+
+    if args.trace_dir is not None:
+        tracing.start_trace(run_id = args.run_id)
+
+    config_dict = build.load_config(args.build_config)
+    commit_hash = build.sync_repository(config_dict, branch = args.branch, dryrun = args.dryrun,
+                                        verbose = args.verbose, ttl = args.git_cache_ttl)
+
+    # the branches other than main are built from their own worktree
+    if args.branch != "main":
+        with tracing.span("git worktree", "git", branch = args.branch):
+            commit_hash = build.checkout_branch(config_dict, branch = args.branch, worktree_dir = args.worktree_dir,
+                                                dryrun = args.dryrun, verbose = args.verbose) or commit_hash
+
+    build_index = None
+    if args.incremental or args.changed_only:
+        build_index = build.utils.load_build_index(args.build_index)
+
+    run_once(args, config_dict, commit_hash, build_index = build_index)
+
+    if args.trace_dir is not None:
+        path_to_trace = tracing.get_trace_path(args.trace_dir)
+        nspans = tracing.write_trace(path_to_trace, stage = "pipeline")
+
+        print("Timing of %g steps exported to %s"%(nspans, path_to_trace))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,474 @@
+"""
+-------------------------------------------------
+MHub - utils for the build, test and push pipeline
+-------------------------------------------------
+"""
+
+import os
+import sys
+import time
+
+import json
+import queue
+import threading
+import http.server
+import importlib.util
+import concurrent.futures
+
+import pprint
+
+pp = pprint.PrettyPrinter(indent=2)
+
+# the folder storing the build, test and push stages
+base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+## --------------------------------
+
+def load_module(module_name, path_to_module):
+
+    """
+    Loads a Python module from its path, under the provided name.
+
+    Args:
+        module_name (str): The name to register the module under (in `sys.modules`).
+        path_to_module (str): The path to the Python file.
+
+    Returns:
+        module: The loaded module.
+    """
+
+    spec = importlib.util.spec_from_file_location(module_name, path_to_module)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+
+    return module
+
+## --------------------------------
+
+def load_stage(stage):
+
+    """
+    Loads the `run.py` module of one of the stages (build, test or push), along with its own `utils.py` module.
+
+    Every stage imports its helpers with `import utils`: while the `run.py` module of the stage is loaded,
+    `utils` is temporarily bound to the `utils.py` module of the stage (registered as `<stage>_utils`).
+
+    Args:
+        stage (str): The name of the stage (i.e., of its folder).
+
+    Returns:
+        module: The `run.py` module of the stage (registered as `<stage>_run`). Its helpers are found under `.utils`.
+
+    Example:
+        >>> build = load_stage("build")
+        >>> image_list = build.get_image_list(build.load_config(["build/config/base.yml"]))
+        >>> build_graph = build.utils.get_build_graph(image_list)
+    """
+
+    path_to_stage = os.path.join(base_dir, stage)
+
+    stage_utils = load_module("%s_utils"%stage, os.path.join(path_to_stage, "utils.py"))
+
+    previous_utils = sys.modules.get("utils")
+    sys.modules["utils"] = stage_utils
+
+    try:
+        stage_run = load_module("%s_run"%stage, os.path.join(path_to_stage, "run.py"))
+    finally:
+        if previous_utils is None:
+            del sys.modules["utils"]
+        else:
+            sys.modules["utils"] = previous_utils
+
+    return stage_run
+
+## --------------------------------
+
+def run_pipeline(image_list, build_graph, tests_dict, build_fn, test_fn, push_fn,
+                 get_image_tag, get_downstream_images, nbuild, slot_list, npush, is_test_passed, admission=None,
+                 sequential_tests=False):
+
+    """
+    Streams every image through the build, test and push stages, independently from the other images.
+
+    Every image is built as soon as the images it is built from are built, tested as soon as it is built,
+    and pushed as soon as its tests pass (e.g., an image can be tested while another is still building,
+    and pushed while the others are still being tested). The number of images in each stage at the same time
+    is bounded by `nbuild` (build), the number of slots in `slot_list` (test) and `npush` (push).
+    If `admission` is provided, the builds also wait for the resources they need (see `common/resources.py`).
+    If `sequential_tests` is set, the tests of an image are run one after the other on the same slot (e.g., in the
+    same warm container, see `test/utils.WarmContainers`) instead of on all the free slots.
+
+    Images without tests (e.g., the base image) are pushed as soon as one of the images built from them
+    passes its tests, and the images built from them are only pushed once they are (so that the shared layers
+    are uploaded once). Images that fail to build (or depend on an image that failed) are neither tested nor pushed.
+
+    Args:
+        image_list (list): A list of image dictionaries (as passed to `build_fn`).
+        build_graph (dict): The dependency graph of the images (see `build/utils.get_build_graph`).
+        tests_dict (dict): A dictionary mapping image tags to the list of their test dictionaries.
+        build_fn (callable): The function building an image. Called as `build_fn(image_dict)`, returns None on failure.
+        test_fn (callable): The function running a test. Called as `test_fn(test_dict, slot_dict)`.
+        push_fn (callable): The function pushing an image. Called as `push_fn(image_tag)`.
+        get_image_tag (callable): The function returning the tag of an image dictionary.
+        get_downstream_images (callable): The function returning the tags of the images built (directly or not)
+                                          from a list of images (see `build/utils.get_downstream_images`).
+        nbuild (int): The maximum number of images to build at the same time.
+        slot_list (list): The slots to run the tests on (see `test/utils.get_test_slots`).
+        npush (int): The maximum number of images to push at the same time.
+        is_test_passed (callable): The function telling whether a test passed, given the result of `test_fn`.
+        admission (BuildAdmission, optional): The admission control of the builds. Defaults to None.
+        sequential_tests (bool, optional): Whether to run the tests of an image on a single slot. Defaults to False.
+
+    Yields:
+        tuple: A (image_tag, stage, item, result) tuple every time a stage is done for an image, where `stage` is
+               one of "build", "test" and "push", `item` is the test dictionary for the "test" stage (None otherwise)
+               and `result` is the value returned by the corresponding function (None on failure, or if skipped).
+    """
+
+    build_semaphore = threading.Semaphore(nbuild)
+    push_semaphore = threading.Semaphore(npush)
+
+    free_slots = queue.Queue()
+    for slot_dict in slot_list:
+        free_slots.put(slot_dict)
+
+    def run_on_slot(test_dict):
+        slot_dict = free_slots.get()
+        try:
+            return test_fn(test_dict, slot_dict)
+        finally:
+            free_slots.put(slot_dict)
+
+    # the state of every image, shared between the threads processing the images
+    state_lock = threading.Condition()
+    state = {get_image_tag(image_dict): {"built": threading.Event(), "build_ok": False,
+                                         "tested": threading.Event(), "test_ok": False,
+                                         "pushed": threading.Event()}
+             for image_dict in image_list}
+
+    events = queue.Queue()
+
+    def set_tested(image_tag, test_ok):
+        with state_lock:
+            state[image_tag]["test_ok"] = test_ok
+            state[image_tag]["tested"].set()
+            state_lock.notify_all()
+
+    def process_image(image_dict):
+
+        image_tag = get_image_tag(image_dict)
+        image_state = state[image_tag]
+
+        try:
+            # -- BUILD --
+            for parent_tag in build_graph[image_tag]:
+                state[parent_tag]["built"].wait()
+
+            if not all([state[parent_tag]["build_ok"] for parent_tag in build_graph[image_tag]]):
+                print("Skipping image %s (depends on an image that was not built)"%image_tag)
+                events.put((image_tag, "build", None, None))
+                return
+
+            with build_semaphore:
+                if admission is None:
+                    result = build_fn(image_dict)
+                else:
+                    with admission.admit(image_tag, admission.get_request(image_dict)):
+                        result = build_fn(image_dict)
+
+            image_state["build_ok"] = result is not None
+            image_state["built"].set()
+            events.put((image_tag, "build", None, result))
+
+            if result is None:
+                return
+
+            # -- TEST --
+            test_list = tests_dict.get(image_tag, list())
+
+            if len(test_list) > 0 and sequential_tests:
+                test_ok = True
+                slot_dict = free_slots.get()
+
+                try:
+                    for test_dict in test_list:
+                        result = test_fn(test_dict, slot_dict)
+                        test_ok = test_ok and is_test_passed(result)
+                        events.put((image_tag, "test", test_dict, result))
+                finally:
+                    free_slots.put(slot_dict)
+
+            elif len(test_list) > 0:
+                test_ok = True
+                futures = {test_executor.submit(run_on_slot, test_dict): test_dict for test_dict in test_list}
+
+                for future in concurrent.futures.as_completed(futures):
+                    result = future.result()
+                    test_ok = test_ok and is_test_passed(result)
+                    events.put((image_tag, "test", futures[future], result))
+
+            else:
+                # images without tests are pushed as soon as one of the images built from them passes the tests
+                children_tags = [t for t in get_downstream_images(build_graph, [image_tag]) if t in state]
+
+                with state_lock:
+                    state_lock.wait_for(lambda: any([state[t]["test_ok"] for t in children_tags]) or
+                                                all([state[t]["tested"].is_set() for t in children_tags]))
+                    test_ok = any([state[t]["test_ok"] for t in children_tags])
+
+            set_tested(image_tag, test_ok)
+
+            # -- PUSH --
+            if test_ok:
+                # wait for the images this one is built from to be pushed (if they are to be pushed at all)
+                for parent_tag in build_graph[image_tag]:
+                    state[parent_tag]["tested"].wait()
+                    if state[parent_tag]["test_ok"]:
+                        state[parent_tag]["pushed"].wait()
+
+                with push_semaphore:
+                    result = push_fn(image_tag)
+
+                events.put((image_tag, "push", None, result))
+
+        finally:
+            # never leave the images depending on this one (or waiting for its tests) hanging
+            image_state["built"].set()
+            if not image_state["tested"].is_set():
+                set_tested(image_tag, False)
+            image_state["pushed"].set()
+
+            events.put((image_tag, None, None, None))
+
+    # the threads processing the images are mostly waiting (on the stages semaphores or on the test slots)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(slot_list), 1)) as test_executor, \
+         concurrent.futures.ThreadPoolExecutor(max_workers=max(len(image_list), 1)) as image_executor:
+
+        futures = [image_executor.submit(process_image, image_dict) for image_dict in image_list]
+
+        nprocessed = 0
+        while nprocessed < len(image_list):
+            image_tag, stage, item, result = events.get()
+
+            if stage is None:
+                nprocessed += 1
+            else:
+                yield image_tag, stage, item, result
+
+        # raise any unexpected error from the threads
+        for future in futures:
+            future.result()
+
+## --------------------------------
+
+def get_test_key(test_dict, slot_dict=None):
+
+    """
+    Returns the name of a test, as reported by the status endpoint (the same workflow can be run on several
+    data samples, e.g., by different test configs).
+
+    Example:
+        >>> get_test_key({"image_to_test": "mhubai/lungmask:latest", "workflow_name": "default",
+        ...               "data_sample": "chest_ct"})
+        'mhubai/lungmask:latest - default - chest_ct'
+    """
+
+    return "%s - %s - %s"%(test_dict["image_to_test"], test_dict["workflow_name"], test_dict["data_sample"])
+
+## --------------------------------
+
+class PipelineStatus:
+
+    """
+    The status of the pipeline in watch mode (see `pipeline/run.py`), shared between the threads running it
+    and the status endpoint (see `start_status_server`).
+
+    The functions running the stages are wrapped with `track`, so that the jobs in flight are known at any time,
+    while the images (and tests) done are counted from the events of `run_pipeline` (see `set_done`).
+
+    Example:
+        >>> status = PipelineStatus()
+        >>> build_fn = status.track("build", build_fn, get_key = get_image_tag)
+        >>> status.to_dict()["in_flight"]
+        {'build': [], 'test': [], 'push': []}
+    """
+
+    stage_list = ["build", "test", "push"]
+
+    def __init__(self):
+
+        self.lock = threading.Lock()
+
+        self.state = "starting"
+        self.commit_hash = None
+        self.run_id = None
+        self.error = None
+        self.next_check = None
+        self.last_run = None
+        self.nruns = 0
+
+        self.total = {stage: 0 for stage in self.stage_list}
+        self.done = {stage: 0 for stage in self.stage_list}
+        self.in_flight = {stage: dict() for stage in self.stage_list}
+
+    ## --------------------------------
+
+    def set(self, **kwargs):
+
+        """
+        Updates the status (e.g., `status.set(state = "idle", next_check = time.time() + 60)`).
+        """
+
+        with self.lock:
+            for key, value in kwargs.items():
+                setattr(self, key, value)
+
+    ## --------------------------------
+
+    def start_run(self, run_id, commit_hash, nbuilds, ntests):
+
+        """
+        Resets the counters at the start of a run of the pipeline.
+        """
+
+        with self.lock:
+            self.state = "running"
+            self.run_id = run_id
+            self.commit_hash = commit_hash
+            self.error = None
+
+            self.total = {"build": nbuilds, "test": ntests, "push": 0}
+            self.done = {stage: 0 for stage in self.stage_list}
+
+    def end_run(self, summary):
+
+        """
+        Records the outcome of a run of the pipeline (e.g., the images built, tested and pushed).
+        """
+
+        with self.lock:
+            self.nruns += 1
+            self.last_run = dict(summary, run_id = self.run_id, commit_hash = self.commit_hash, end_time = time.time())
+
+    ## --------------------------------
+
+    def set_done(self, stage):
+
+        """
+        Counts an item done (or skipped) in a stage.
+        """
+
+        with self.lock:
+            self.done[stage] += 1
+
+            # the images are only known to be pushed once their tests pass
+            if stage == "push":
+                self.total[stage] += 1
+
+    ## --------------------------------
+
+    def track(self, stage, fn, get_key):
+
+        """
+        Returns `fn` wrapped so that its calls are reported as in flight in `stage` while they run.
+
+        Args:
+            stage (str): The stage the function runs ("build", "test" or "push").
+            fn (callable): The function running the stage.
+            get_key (callable): The function returning the name of the job, called with the arguments of `fn`.
+        """
+
+        def tracked_fn(*args, **kwargs):
+            key = get_key(*args, **kwargs)
+
+            with self.lock:
+                self.in_flight[stage][key] = time.time()
+
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.in_flight[stage].pop(key, None)
+
+        return tracked_fn
+
+    ## --------------------------------
+
+    def to_dict(self):
+
+        """
+        Returns the status as a JSON-serializable dictionary.
+
+        The queue depth of every stage is the number of items not started yet (for the push stage, only the images
+        whose tests passed are known to be pushed at all, so only the jobs in flight are reported).
+        """
+
+        with self.lock:
+            now = time.time()
+
+            in_flight = {stage: [{"name": key, "running_for": round(now - start_time, 1)}
+                                 for key, start_time in jobs.items()]
+                         for stage, jobs in self.in_flight.items()}
+
+            queued = {stage: max(self.total[stage] - self.done[stage] - len(self.in_flight[stage]), 0)
+                      for stage in ["build", "test"]}
+
+            return {"state": self.state,
+                    "commit_hash": self.commit_hash,
+                    "run_id": self.run_id,
+                    "error": self.error,
+                    "next_check": self.next_check,
+                    "queued": queued,
+                    "in_flight": in_flight,
+                    "done": dict(self.done),
+                    "nruns": self.nruns,
+                    "last_run": self.last_run}
+
+## --------------------------------
+
+def start_status_server(status, port, host="127.0.0.1"):
+
+    """
+    Serves the status of the pipeline (see `PipelineStatus`) as JSON over HTTP, from a background thread.
+
+    Args:
+        status (PipelineStatus): The status to serve.
+        port (int): The port to listen on.
+        host (str, optional): The address to listen on. Defaults to "127.0.0.1" (i.e., only from the node).
+
+    Returns:
+        http.server.ThreadingHTTPServer: The server (running until the process exits, or `.shutdown()` is called).
+
+    Example:
+        >>> start_status_server(status, 8765)
+        $ curl http://localhost:8765/status
+        {"state": "idle", "commit_hash": "b45e63a...", "queued": {"build": 0, "test": 0}, ...}
+    """
+
+    class StatusHandler(http.server.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.split("?")[0] not in ["/", "/status"]:
+                self.send_error(404)
+                return
+
+            body = json.dumps(status.to_dict(), indent=2).encode("utf-8")
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # do not print every request
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), StatusHandler)
+    server.daemon_threads = True
+
+    threading.Thread(target=server.serve_forever, name="status-server", daemon=True).start()
+
+    return server
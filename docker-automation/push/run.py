@@ -14,31 +14,50 @@ import time
 import tqdm
 
 import argparse
+import functools
 import subprocess
-import multiprocessing
 
 import yaml
 import pprint
-import pandas as pd
 
 pp = pprint.PrettyPrinter(indent=2)
 
 import utils
 
+from common import tracing
+
 max_cores = os.cpu_count()
 
 ## --------------------------------
 
-# for now, build only
-def run_core(image_dict):
+def run_core(image_dict, use_api=False, force_push=False):
+
+    """
+    Pushes an image to its registry, unless the registry already stores the same image under the same tag
+    (see `utils.is_image_up_to_date`).
+
+    Returns a dictionary with the image tag under "name" and the outcome ("pushed" or "up to date") under "status",
+    or None on failure.
+    """
 
     try:
-        image_tag = utils.push_docker_image(image_tag = image_dict["name"])    
+        if not force_push:
+            with tracing.span(image_dict["name"], "push check") as span_args:
+                span_args["up_to_date"] = utils.is_image_up_to_date(image_dict["name"], use_api = use_api)
+
+            if span_args["up_to_date"]:
+                print("Image %s is up to date"%image_dict["name"])
+                return {"name": image_dict["name"], "status": "up to date"}
+
+        with tracing.span(image_dict["name"], "push"):
+            utils.push_docker_image(image_tag = image_dict["name"], use_api = use_api)
     except Exception as e:
         print("Error pushing image %s"%image_dict["name"])
         print(e)
         return None
 
+    return {"name": image_dict["name"], "status": "pushed"}
+
 ## --------------------------------
 
 def dryrun_core(image_dict):
@@ -46,32 +65,22 @@ def dryrun_core(image_dict):
     pp.pprint(image_dict["name"])
     print("")
 
+    return {"name": image_dict["name"], "status": "dry run"}
+
 ## --------------------------------
 
-def main():
+def load_csv_results(path_to_logs_folder):
 
-    # FIXME: for now, assume the log-in to the correct dockerhub account was already set up on the system
+    """
+    Returns, for every image tested, whether it passed all of its tests, according to the CSV reports found
+    in the folder (for the reports written before the results store was introduced).
+    """
 
-    # parse command line arguments
-    parser = argparse.ArgumentParser(description='MHub - local automation for docker builds')
-    #parser.add_argument('-l', '--logging', action='store_true', help='enable logging')
-    parser.add_argument('--verbose', action='store_true', help='enable verbose mode')
-    parser.add_argument('--dryrun', action='store_true', help='execute in dry run mode')
-    parser.add_argument('--ncores', action='store', help='number of cores to execute on (max is %g)'%max_cores, 
-                        type=int, default=4)
-    parser.add_argument('--path_to_logs_folder', action='store', help='path to the folder storing the automated testing reports', required=True)
-
-    args = parser.parse_args()
-    
-    use_multiprocessing = True if args.ncores > 1 else False
+    # only needed for the CSV reports
+    import pandas as pd
 
     # load all of the CSV files storing the automated testing reports
-    csv_files = [os.path.join(args.path_to_logs_folder, f) for f in os.listdir(args.path_to_logs_folder) if f.endswith(".csv")]
-    
-    # check that there is at least one CSV file
-    if len(csv_files) == 0:
-        print("WARNING: no CSV files found in %s"%args.path_to_logs_folder)
-        sys.exit(1)
+    csv_files = [os.path.join(path_to_logs_folder, f) for f in os.listdir(path_to_logs_folder) if f.endswith(".csv")]
 
     # load the CSV files using pandas
     df_list = []
@@ -94,62 +103,110 @@ def main():
         df_list.append(tmp)
     
     if len(df_list) == 0:
-        print("WARNING: no CSV files correctly formatted found in %s"%args.path_to_logs_folder)
-        sys.exit(1)
+        return dict()
 
-    # concatenate the dataframes
     df = pd.concat(df_list)
-    df.reset_index(inplace=True, drop=True)
+
+    # a single pass over the rows (instead of filtering the dataframe for every image)
+    df["passed"] = df["dirtree_match"].astype(bool) & df["output_match"].astype(bool)
+
+    return {image: bool(passed) for image, passed in df.groupby("image", sort=False)["passed"].all().items()}
+
+## --------------------------------
+
+def main(argv=None):
+
+    # FIXME: for now, assume the log-in to the correct dockerhub account was already set up on the system
+
+    # parse command line arguments
+    parser = argparse.ArgumentParser(description='MHub - local automation for docker builds')
+    #parser.add_argument('-l', '--logging', action='store_true', help='enable logging')
+    parser.add_argument('--verbose', action='store_true', help='enable verbose mode')
+    parser.add_argument('--dryrun', action='store_true', help='execute in dry run mode')
+    parser.add_argument('--ncores', action='store', help='number of cores to execute on (max is %g)'%max_cores, 
+                        type=int, default=4)
+    parser.add_argument('--registry_slots', action='store', type=int, default=None,
+                        help='number of images to push to the same registry at the same time (default: same as --ncores)')
+    parser.add_argument('--force_push', action='store_true',
+                        help='push every image, even if the registry already stores the same image under the same tag')
+    parser.add_argument('--docker_api', action='store_true',
+                        help='talk to the Docker Engine API (/var/run/docker.sock) instead of running the docker CLI')
+    parser.add_argument('--path_to_logs_folder', action='store', help='path to the folder storing the automated testing reports', required=True)
+    parser.add_argument('--trace_dir', action='store', type=str, default=None,
+                        help='folder to export the timing of every step to (as <run_id>.trace.json)')
+    parser.add_argument('--run_id', action='store', type=str, default=None,
+                        help='ID of the run, shared by the stages writing to the same trace (default: a new one)')
+
+    args = parser.parse_args(argv)
+
+    if args.trace_dir is not None:
+        tracing.start_trace(run_id = args.run_id)
 
     # check which images passed the automated testing (both dirtree and output, for all the workflows and data samples)
-    image_list = list()
-    tags_list = list()
+    path_to_store = utils.results_store.get_store_path(args.path_to_logs_folder)
 
-    for image in df["image"].unique():
-        
-        image_dict = dict() 
+    if os.path.isfile(path_to_store):
+        image_results = utils.results_store.get_image_results(path_to_store)
+    else:
+        image_results = load_csv_results(args.path_to_logs_folder)
 
-        # collect all the tags of the images that passed the test for later use
-        tags_list.append(image.split(":")[-1])
+    if len(image_results) == 0:
+        print("WARNING: no test results found in %s"%args.path_to_logs_folder)
+        sys.exit(1)
 
-        tmp = df[df["image"] == image]
-        val = tmp["dirtree_match"].all() and tmp["output_match"].all()
+    image_list = [{"name": image} for image, passed in image_results.items() if passed]
+
+    # collect the base images of all the images tested (same tag and registry) for later use
+    base_tags_list = list(dict.fromkeys([utils.get_base_tag(image) for image in image_results]))
 
-        if val:
-            image_dict["name"] = image
-            image_list.append(image_dict)
-    
     # if more than one model passed the checks (i.e., image_list is not empty)
     # add the base image to the list
+    if len(image_list) > 0:
+        for base_tag in base_tags_list:
+            if {"name": base_tag} not in image_list:
+                image_list.append({"name": base_tag})
 
-    tags_list = list(set(tags_list))
+    # push the base images first, then the model images built from them (sharing their layers)
+    push_graph = utils.get_push_graph(image_list)
 
-    if len(image_list) > 0:
-        for tag in tags_list:
-            image_list.append({"name": "mhubai/base:%s"%tag})
+    if args.verbose:
+        print("Push order:")
+        pp.pprint(push_graph)
 
     # for every image that passed the test, push the docker image to the registry
     if args.dryrun:
-        pool = multiprocessing.Pool(processes = 1)
-
-        if use_multiprocessing:
-            print("This will run in parallel, on %g cores.\n"%(args.ncores))
-        else:
-            print("This will run on a single core.\n")
+        core_fn = dryrun_core
+    else:
+        core_fn = functools.partial(run_core, use_api = args.docker_api, force_push = args.force_push)
 
-        for _ in tqdm.tqdm(pool.imap_unordered(dryrun_core, image_list), total = len(image_list)):
-            pass
+    if args.ncores > 1:
+        print("\nRunning in parallel on %g cores.\n"%(args.ncores))
     else:
-        if use_multiprocessing:
-            pool = multiprocessing.Pool(processes = args.ncores)
-
-            print("\nRunning in parallel on %g cores.\n"%(args.ncores))
-            for _ in tqdm.tqdm(pool.imap_unordered(run_core, image_list), total = len(image_list)):
-                pass
-        else:
-            print("Running on a single core.\n")
-            for image_dict in image_list:
-                run_core(image_dict)
+        print("Running on a single core.\n")
+
+    failed_list = list()
+    up_to_date_list = list()
+
+    for image_tag, result in tqdm.tqdm(utils.run_push_graph(image_list, push_graph, core_fn,
+                                                            ncores = 1 if args.dryrun else args.ncores,
+                                                            nper_registry = args.registry_slots),
+                                       total = len(image_list)):
+        if result is None:
+            failed_list.append(image_tag)
+        elif result["status"] == "up to date":
+            up_to_date_list.append(image_tag)
+
+    if len(up_to_date_list) > 0:
+        print("The following images are up to date (not pushed): %s"%", ".join(up_to_date_list))
+
+    if len(failed_list) > 0:
+        print("The following images were not pushed: %s"%", ".join(failed_list))
+
+    if args.trace_dir is not None:
+        path_to_trace = tracing.get_trace_path(args.trace_dir)
+        nspans = tracing.write_trace(path_to_trace, stage = "push")
+
+        print("Timing of %g steps exported to %s"%(nspans, path_to_trace))
 
 if __name__ == '__main__':
     main()
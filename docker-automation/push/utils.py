@@ -11,17 +11,48 @@ Email:  dbontempi@bwh.harvard.edu
 import os
 import sys
 import time
-import requests
 
+import re
 import json
+import base64
+import threading
 import subprocess
+import concurrent.futures
 
 import yaml
 import pprint
 
 pp = pprint.PrettyPrinter(indent=2)
 
-def push_docker_image(image_tag, verbose=False):
+# NOTE: requests is imported by the functions talking to the registry, as it takes a while to import
+
+# modules shared by the build, test and push stages
+base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if base_dir not in sys.path:
+    sys.path.append(base_dir)
+
+from common import docker_api
+from common import results_store
+
+# every model image is built from (and shares the layers of) the base image
+base_repository = "mhubai/base"
+
+# the HTTP API of the DockerHub registry (as opposed to the index the credentials are stored for)
+DOCKERHUB_REGISTRY_URL = "https://registry-1.docker.io"
+
+# the manifest formats we can parse (the registry converts the manifest to the first format it supports)
+manifest_media_types = ["application/vnd.docker.distribution.manifest.v2+json",
+                        "application/vnd.oci.image.manifest.v1+json",
+                        "application/vnd.docker.distribution.manifest.list.v2+json",
+                        "application/vnd.oci.image.index.v1+json"]
+
+# the registry tokens, cached per repository for the whole run
+registry_tokens = dict()
+registry_tokens_lock = threading.Lock()
+
+## --------------------------------
+
+def push_docker_image(image_tag, verbose=False, use_api=False):
 
     """
     Pushes a Docker image to the dockerhub registry.
@@ -29,18 +60,34 @@ def push_docker_image(image_tag, verbose=False):
     Args:
         image_tag (str): The tag of the Docker image to push.
         verbose (bool, optional): Controls the verbosity of the output. Defaults to False.
+        use_api (bool, optional): Whether to push the image through the Docker Engine API (instead of
+                                  the docker CLI). Defaults to False.
 
     Returns:
         None
 
     Raises:
         CalledProcessError: If the Docker push command fails.
+        DockerAPIError: If the push fails (Docker Engine API only).
 
     Example:
         >>> image_tag = "my-docker-image:latest"
         >>> push_docker_image(image_tag, verbose=True)
     """
 
+    if use_api:
+        # the credentials stored on the node by `docker login`
+        auth = docker_api.get_registry_auth(docker_api.get_registry(image_tag))
+
+        def print_event(event):
+            if "status" in event:
+                print("%s %s"%(event.get("id", ""), event["status"]))
+
+        push_events = docker_api.get_client().push_image(image_tag, auth=auth)
+        docker_api.run_sync(docker_api.collect_events(push_events, callback=print_event if verbose else None))
+
+        return
+
     # push the docker image to the registry
     # TO-DO: add checks on the docker push
     bash_command = ["docker", "push", "%s"%(image_tag)]
@@ -48,3 +95,378 @@ def push_docker_image(image_tag, verbose=False):
     output = subprocess.run(bash_command, check=True, text=True,
                             stdout=None if verbose else subprocess.DEVNULL,
                             stderr=None if verbose else subprocess.DEVNULL)
+
+## --------------------------------
+
+def get_local_digest(image_tag, use_api=False):
+
+    """
+    Returns the digest of the manifest the local image was last pushed (or pulled) with, if any.
+
+    Args:
+        image_tag (str): The tag of the Docker image (repo/image:tag).
+        use_api (bool, optional): Whether to use the Docker Engine API (instead of the docker CLI). Defaults to False.
+
+    Returns:
+        str: The digest of the manifest (e.g., 'sha256:0a1b...'), or None if the image was never pushed
+             (e.g., it was just built) or is not found locally.
+    """
+
+    if use_api:
+        image_details = docker_api.run_sync(docker_api.get_client().inspect_image(image_tag))
+        repo_digests = image_details["RepoDigests"] if image_details is not None else None
+    else:
+        bash_command = ["docker", "image", "inspect",
+                        "--format", "{{json .RepoDigests}}",
+                        "%s"%image_tag]
+
+        try:
+            output = subprocess.run(bash_command, check=True, text=True,
+                                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except (subprocess.CalledProcessError, FileNotFoundError):
+            return None
+
+        repo_digests = json.loads(output.stdout)
+
+    repository, _ = docker_api.split_image_tag(image_tag)
+
+    # the repository digests are formatted as "repo/image@sha256:..."
+    for repo_digest in repo_digests or list():
+        digest_repository, _, digest = repo_digest.partition("@")
+        if digest_repository == repository:
+            return digest
+
+    return None
+
+## --------------------------------
+
+def get_registry_location(image_tag):
+
+    """
+    Returns the URL of the HTTP API of the registry an image is pushed to, and the path of the repository in it.
+
+    Example:
+        >>> get_registry_location("mhubai/base:latest")
+        ('https://registry-1.docker.io', 'mhubai/base')
+        >>> get_registry_location("localhost:5000/mhubai/base:latest")
+        ('http://localhost:5000', 'mhubai/base')
+    """
+
+    registry = docker_api.get_registry(image_tag)
+    repository, _ = docker_api.split_image_tag(image_tag)
+
+    if registry == docker_api.DOCKERHUB_REGISTRY:
+        # the official images are found under "library/"
+        return DOCKERHUB_REGISTRY_URL, repository if "/" in repository else "library/" + repository
+
+    # as for the Docker daemon, local registries are accessed over plain HTTP
+    scheme = "http" if registry.split(":")[0] in ["localhost", "127.0.0.1"] else "https"
+
+    return "%s://%s"%(scheme, registry), repository[len(registry) + 1:]
+
+## --------------------------------
+
+def get_registry_credentials(image_tag):
+
+    """
+    Returns the (username, password) credentials stored by `docker login` for the registry of an image, if any.
+    """
+
+    auth = docker_api.get_registry_auth(docker_api.get_registry(image_tag))
+
+    if auth is None:
+        return None
+
+    auth = json.loads(base64.urlsafe_b64decode(auth))
+
+    return auth["username"], auth["password"]
+
+## --------------------------------
+
+def get_registry_token(image_tag, challenge, timeout=30):
+
+    """
+    Returns the credentials to read the repository of an image, as requested by the registry.
+
+    Args:
+        image_tag (str): The tag of the Docker image (repo/image:tag).
+        challenge (str): The `WWW-Authenticate` header returned by the registry with the 401 response.
+        timeout (int, optional): The timeout of the request to the authentication server, in seconds. Defaults to 30.
+
+    Returns:
+        str: The value of the `Authorization` header to send to the registry.
+
+    Raises:
+        ValueError: If the registry asks for credentials and none are stored.
+        HTTPError: If the authentication server refuses to issue a token.
+    """
+
+    import requests
+
+    registry_url, repository = get_registry_location(image_tag)
+    credentials = get_registry_credentials(image_tag)
+
+    scheme, _, params = challenge.partition(" ")
+
+    if scheme.lower() == "basic":
+        if credentials is None:
+            raise ValueError("No credentials found for %s"%registry_url)
+        return "Basic " + base64.b64encode(("%s:%s"%credentials).encode("utf-8")).decode("ascii")
+
+    # e.g., Bearer realm="https://auth.docker.io/token",service="registry.docker.io",scope="repository:mhubai/base:pull"
+    params = dict(re.findall(r'(\w+)="([^"]*)"', params))
+    query = {"service": params.get("service"), "scope": params.get("scope", "repository:%s:pull"%repository)}
+
+    response = requests.get(params["realm"], params=query, auth=credentials, timeout=timeout)
+    response.raise_for_status()
+
+    token_dict = response.json()
+
+    return "Bearer " + token_dict.get("token", token_dict.get("access_token"))
+
+## --------------------------------
+
+def request_manifest(image_tag, method="GET", timeout=30):
+
+    """
+    Sends a request for the manifest of an image to its registry, authenticating if needed.
+
+    The token used to authenticate is cached for the repository, and only requested again once it expires.
+
+    Returns:
+        requests.Response: The response of the registry.
+    """
+
+    import requests
+
+    registry_url, repository = get_registry_location(image_tag)
+    _, tag = docker_api.split_image_tag(image_tag)
+
+    url = "%s/v2/%s/manifests/%s"%(registry_url, repository, tag)
+    headers = {"Accept": ", ".join(manifest_media_types)}
+
+    with registry_tokens_lock:
+        token = registry_tokens.get((registry_url, repository))
+
+    if token is not None:
+        headers["Authorization"] = token
+
+    response = requests.request(method, url, headers=headers, timeout=timeout)
+
+    # no token yet (or an expired one)
+    if response.status_code == 401 and "www-authenticate" in response.headers:
+        token = get_registry_token(image_tag, response.headers["www-authenticate"], timeout=timeout)
+
+        with registry_tokens_lock:
+            registry_tokens[(registry_url, repository)] = token
+
+        headers["Authorization"] = token
+        response = requests.request(method, url, headers=headers, timeout=timeout)
+
+    return response
+
+## --------------------------------
+
+def get_remote_digest(image_tag):
+
+    """
+    Returns the digest of the manifest the tag points to in the registry, or None if the tag is not found.
+
+    This is a HEAD request, which does not count as a pull for the registries enforcing rate limits (e.g., DockerHub).
+    """
+
+    response = request_manifest(image_tag, method="HEAD")
+
+    if response.status_code == 404:
+        return None
+
+    response.raise_for_status()
+
+    return response.headers.get("docker-content-digest")
+
+## --------------------------------
+
+def get_remote_config_digest(image_tag):
+
+    """
+    Returns the digest of the config of the image the tag points to in the registry (i.e., the ID of the image
+    once pulled), or None if the tag is not found (or points to a multi-platform image, which has no config).
+    """
+
+    response = request_manifest(image_tag, method="GET")
+
+    if response.status_code == 404:
+        return None
+
+    response.raise_for_status()
+
+    return response.json().get("config", dict()).get("digest")
+
+## --------------------------------
+
+def is_image_up_to_date(image_tag, use_api=False):
+
+    """
+    Returns True if the registry already stores the local image under the same tag.
+
+    The digest of the remote manifest is compared with the one the local image was last pushed (or pulled) with
+    first; if they differ (e.g., the image was just built), the digest of the remote config is compared with
+    the ID of the local image (the same if the image was built again from the same content).
+
+    Args:
+        image_tag (str): The tag of the Docker image (repo/image:tag).
+        use_api (bool, optional): Whether to inspect the local image through the Docker Engine API (instead of
+                                  the docker CLI). Defaults to False.
+
+    Returns:
+        bool: True if the image does not need to be pushed, False otherwise (or if the registry can not be reached).
+
+    Example:
+        >>> is_image_up_to_date("mhubai/base:latest")
+        True
+    """
+
+    import requests
+
+    try:
+        remote_digest = get_remote_digest(image_tag)
+
+        if remote_digest is None:
+            return False
+
+        if remote_digest == get_local_digest(image_tag, use_api=use_api):
+            return True
+
+        remote_config_digest = get_remote_config_digest(image_tag)
+
+    except (requests.RequestException, ValueError) as e:
+        print("WARNING: Could not check whether %s is up to date (%s)"%(image_tag, e))
+        return False
+
+    return remote_config_digest is not None and \
+           remote_config_digest == docker_api.get_image_id(image_tag, use_api=use_api)
+
+## --------------------------------
+
+def get_push_graph(image_list):
+
+    """
+    Returns the order the images should be pushed in, as a dependency graph.
+
+    Every model image shares the layers of the base image with the same tag (in the same registry, see
+    `get_base_tag`): pushing the base image first uploads the shared layers once, instead of having every model
+    image race to upload them.
+
+    Args:
+        image_list (list): A list of image dictionaries (with the image tag under "name").
+
+    Returns:
+        dict: A dictionary mapping every image tag to the list of the tags of the images to push before it.
+
+    Example:
+        >>> get_push_graph([{"name": "mhubai/lungmask:latest"}, {"name": "mhubai/base:latest"}])
+        {'mhubai/lungmask:latest': ['mhubai/base:latest'], 'mhubai/base:latest': []}
+    """
+
+    image_tags = [image_dict["name"] for image_dict in image_list]
+
+    push_graph = dict()
+
+    for image_tag in image_tags:
+        base_tag = get_base_tag(image_tag)
+
+        if base_tag != image_tag and base_tag in image_tags:
+            push_graph[image_tag] = [base_tag]
+        else:
+            push_graph[image_tag] = list()
+
+    return push_graph
+
+## --------------------------------
+
+def get_base_tag(image_tag):
+
+    """
+    Returns the tag of the base image a model image is built from, in the same registry (layers are only shared
+    within the same registry).
+
+    Example:
+        >>> get_base_tag("mhubai/lungmask:latest")
+        'mhubai/base:latest'
+        >>> get_base_tag("localhost:5000/mhubai/lungmask:v1")
+        'localhost:5000/mhubai/base:v1'
+    """
+
+    registry = docker_api.get_registry(image_tag)
+    _, tag = docker_api.split_image_tag(image_tag)
+
+    if registry == docker_api.DOCKERHUB_REGISTRY:
+        return "%s:%s"%(base_repository, tag)
+
+    return "%s/%s:%s"%(registry, base_repository, tag)
+
+## --------------------------------
+
+def run_push_graph(image_list, push_graph, core_fn, ncores=1, nper_registry=None):
+
+    """
+    Runs `core_fn` on every image of the list, pushing every image only after the images it depends on.
+
+    Unlike the build, the images are pushed even if an image they depend on failed to push (the shared layers
+    are then uploaded along with the image). At most `ncores` images are pushed at the same time, and at most
+    `nper_registry` to the same registry.
+
+    Args:
+        image_list (list): A list of image dictionaries (with the image tag under "name").
+        push_graph (dict): The dependency graph returned by `get_push_graph`.
+        core_fn (callable): The function to run on each image dictionary. Should return None on failure.
+        ncores (int, optional): The maximum number of images to push at the same time. Defaults to 1.
+        nper_registry (int, optional): The maximum number of images to push to the same registry at the same time.
+                                       Defaults to None (same as `ncores`).
+
+    Yields:
+        tuple: A (image_tag, result) tuple for every image, as soon as the image is done.
+               `result` is the value returned by `core_fn`.
+    """
+
+    image_dicts = {image_dict["name"]: image_dict for image_dict in image_list}
+
+    if nper_registry is None:
+        nper_registry = ncores
+
+    registry_semaphores = dict()
+    registry_lock = threading.Lock()
+
+    def push_image(image_dict):
+        registry = docker_api.get_registry(image_dict["name"])
+
+        with registry_lock:
+            semaphore = registry_semaphores.setdefault(registry, threading.Semaphore(nper_registry))
+
+        with semaphore:
+            return core_fn(image_dict)
+
+    pending = {image_tag: set(parents) for image_tag, parents in push_graph.items()}
+
+    ready = [image_tag for image_tag in image_dicts if len(pending[image_tag]) == 0]
+    futures = dict()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=ncores) as executor:
+        while len(ready) > 0 or len(futures) > 0:
+
+            for image_tag in ready:
+                futures[executor.submit(push_image, image_dicts[image_tag])] = image_tag
+            ready = list()
+
+            done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+
+            for future in done:
+                image_tag = futures.pop(future)
+
+                yield image_tag, future.result()
+
+                for child_tag, parents in pending.items():
+                    if image_tag in parents:
+                        parents.discard(image_tag)
+                        if len(parents) == 0:
+                            ready.append(child_tag)
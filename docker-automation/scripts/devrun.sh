@@ -17,11 +17,8 @@ echo -e "Run ID: ${RUN_ID}\n"
 
 # -- BUILD --
 
-echo "Building the base Docker image (using ${BUILD_BASE_CONF})"
-python ../build/run.py --config ${BUILD_BASE_CONF} --ncores 1
-
-echo "Building the model Docker images (using ${BUILD_MODEL_CONF})"
-python ../build/run.py --config ${BUILD_MODEL_CONF} --ncores 1
+echo "Building the base and model Docker images (using ${BUILD_BASE_CONF} and ${BUILD_MODEL_CONF})"
+python ../build/run.py --config ${BUILD_BASE_CONF} ${BUILD_MODEL_CONF} --ncores 1
 
 # -- DOCKER INSPECT --
 
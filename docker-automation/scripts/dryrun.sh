@@ -10,11 +10,8 @@ PUSH_CONF="/home/mhubai/mhubai_testing/logs"
 
 # -- BUILD --
 
-echo "Building the base Docker image (using $BUILD_BASE_CONF)"
-python ../build/run.py --config $BUILD_BASE_CONF --ncores 1 --dryrun
-
-echo "Building the model Docker images (using $BUILD_MODEL_CONF)"
-python ../build/run.py --config $BUILD_MODEL_CONF --ncores 1 --dryrun
+echo "Building the base and model Docker images (using $BUILD_BASE_CONF and $BUILD_MODEL_CONF)"
+python ../build/run.py --config $BUILD_BASE_CONF $BUILD_MODEL_CONF --ncores 1 --dryrun
 
 # -- PRUNE --
 
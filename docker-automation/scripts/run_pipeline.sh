@@ -10,6 +10,7 @@ RUN_ID=${DATE_TIME}_$(cat /dev/urandom | tr -cd 'a-f0-9' | head -c 16)
 
 TEST_LOG_DIR="/home/mhubai/mhubai_testing/logs/${RUN_ID}"
 IMAGE_LOG_DIR="${TEST_LOG_DIR}/inspect/"
+AFFECTED_LIST="${TEST_LOG_DIR}/affected_images.json"
 
 mkdir -p ${TEST_LOG_DIR}
 mkdir -p ${IMAGE_LOG_DIR}
@@ -18,11 +19,8 @@ echo -e "Run ID: ${RUN_ID}\n"
 
 # -- BUILD --
 
-echo "Building the base Docker image (using ${BUILD_BASE_CONF})"
-python ../build/run.py --config ${BUILD_BASE_CONF} --ncores 1
-
-echo "Building the model Docker images (using ${BUILD_MODEL_CONF})"
-python ../build/run.py --config ${BUILD_MODEL_CONF} --ncores 8
+echo "Building the base and model Docker images (using ${BUILD_BASE_CONF} and ${BUILD_MODEL_CONF})"
+python ../build/run.py --config ${BUILD_BASE_CONF} ${BUILD_MODEL_CONF} --ncores 8 --incremental --changed_only --affected_list ${AFFECTED_LIST}
 
 # -- DOCKER INSPECT --
 
@@ -42,10 +40,10 @@ docker image prune -f
 
 echo -e "\n-----------------\n"
 echo "Running the testing routine for CHEST CT images (using ${TEST_CT_CHEST_CONF})"
-python ../test/run.py --config ${TEST_CT_CHEST_CONF} --verbose --outpath ${TEST_LOG_DIR}
+python ../test/run.py --config ${TEST_CT_CHEST_CONF} --verbose --outpath ${TEST_LOG_DIR} --images_list ${AFFECTED_LIST}
 
 echo "Running the testing routine for ABDOMEN CT images (using ${TEST_CT_ABDOMEN_CONF})"
-python ../test/run.py --config ${TEST_CT_ABDOMEN_CONF} --verbose --outpath ${TEST_LOG_DIR}
+python ../test/run.py --config ${TEST_CT_ABDOMEN_CONF} --verbose --outpath ${TEST_LOG_DIR} --images_list ${AFFECTED_LIST}
 
 # -- PUSH --
 
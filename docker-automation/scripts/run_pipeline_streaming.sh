@@ -0,0 +1,23 @@
+#!/bin/bash
+BUILD_BASE_CONF="../build/config/base.yml"
+BUILD_MODEL_CONF="../build/config/models.yml"
+
+TEST_CT_CHEST_CONF="../test/config/latest_chest.yml"
+TEST_CT_ABDOMEN_CONF="../test/config/latest_abdomen.yml"
+
+DATE_TIME=$(date +"%d%m%Y%H%M%S")
+RUN_ID=${DATE_TIME}_$(cat /dev/urandom | tr -cd 'a-f0-9' | head -c 16)
+
+TEST_LOG_DIR="/home/mhubai/mhubai_testing/logs/${RUN_ID}"
+
+mkdir -p ${TEST_LOG_DIR}
+
+echo -e "Run ID: ${RUN_ID}\n"
+
+# -- BUILD, TEST AND PUSH --
+
+echo "Running the pipeline (using ${BUILD_BASE_CONF}, ${BUILD_MODEL_CONF}, ${TEST_CT_CHEST_CONF} and ${TEST_CT_ABDOMEN_CONF})"
+python ../pipeline/run.py --build_config ${BUILD_BASE_CONF} ${BUILD_MODEL_CONF} \
+                          --test_config ${TEST_CT_CHEST_CONF} ${TEST_CT_ABDOMEN_CONF} \
+                          --outpath ${TEST_LOG_DIR} --incremental --changed_only \
+                          --build_slots 8 --push_slots 8 --docker_api --prune --verbose
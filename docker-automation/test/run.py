@@ -11,52 +11,114 @@ Email:  dbontempi@bwh.harvard.edu
 import os
 import sys
 import time
-import tqdm
 
 import argparse
+import functools
+import contextlib
+import threading
 import subprocess
 
 #import logging
 #import logging.config
 
 import yaml
+import json
 import pprint
 
 pp = pprint.PrettyPrinter(indent=2)
 
 import utils
 
+from common import resources
+from common import tracing
+
 # constants definition
 INPUT_BASE_DIR = "/home/mhubai/mhubai_testing/input_data"
 OUTPUT_BASE_DIR = "/home/mhubai/mhubai_testing/output_data"
 REFERENCE_BASE_DIR = "/home/mhubai/mhubai_testing/reference_data"
 
+max_cores = len(resources.get_allowed_cpus())
+
+# tests running at the same time append to the same output file
+output_file_lock = threading.Lock()
+
 ## --------------------------------
 
-def run_core(test_dict):
+def run_core(test_dict, slot_dict=None, use_api=False, fail_fast=True, compare_workers=None,
+             reference_cache_dir=None, warm_containers=None, memo_path=None, compare_memory=None,
+             surface_metrics=False):
     """
      The core function should run the following operations:
         - run the processing using the MHub container
         - run some basic checks on the output
         - compare the output to the expected output
+
+     If a slot is provided (see `utils.get_test_slots`), the container is pinned to its GPU device and CPUs.
+     The output files are compared by `compare_workers` processes, stopping at the first mismatch if `fail_fast`.
+     If `reference_cache_dir` is provided, the decoded reference files are cached there (see `common/reference_cache.py`).
+     If `compare_memory` is provided, the images too large to be compared within this many bytes are compared
+     one slab at a time (see `utils.compare_results_itk`).
+     If `surface_metrics` is set, the surface distances of every label of the segmentations are computed and printed.
+     If `warm_containers` is provided (see `utils.WarmContainers`), the workflow is run in the warm container of the image.
+     If `memo_path` is provided, a test that already passed with the same image, workflow, input and reference data
+     (see `utils.get_memo_key`) is skipped, and its result stored again.
     """
 
+    memo_key = None
+    if memo_path is not None:
+        memo_key = utils.get_memo_key(test_dict, use_api = use_api)
+        memo_result = utils.results_store.get_memo(memo_path, memo_key) if memo_key is not None else None
+
+        if memo_result is not None:
+            if warm_containers is not None:
+                warm_containers.release(test_dict["image_to_test"])
+
+            return store_memo_result(test_dict, memo_result)
+
     # Run the processing using the MHub container
+    start_time = time.time()
+
     try:
-        docker_command = test_dict["docker_command"]
-        utils.run_mhub_model(docker_command)    
+        if slot_dict is None:
+            slot_dict = {"gpu_device": None, "cpuset": None}
+
+        with tracing.span(test_dict["image_to_test"], "run", workflow = test_dict["workflow_name"],
+                          data_sample = test_dict["data_sample"], gpu_device = slot_dict["gpu_device"]):
+            if warm_containers is not None:
+                warm_containers.run_workflow(test_dict["docker_args"], slot_dict)
+            elif use_api:
+                container_config = utils.get_container_config(**test_dict["docker_args"],
+                                                              gpu_device = slot_dict["gpu_device"],
+                                                              cpuset = slot_dict["cpuset"])
+                utils.run_mhub_model_api(container_config)
+            else:
+                docker_command = utils.get_docker_command(**test_dict["docker_args"],
+                                                          gpu_device = slot_dict["gpu_device"],
+                                                          cpuset = slot_dict["cpuset"])
+                utils.run_mhub_model(docker_command)
     except Exception as e:
         print("Error running image %s"%test_dict["image_to_test"])
         print(e)
+        store_result(test_dict, error = "Error running the image: %s"%e, run_time = time.time() - start_time)
         return None
+    finally:
+        # the container is not needed to compare the results
+        if warm_containers is not None:
+            warm_containers.release(test_dict["image_to_test"])
+
+    run_time = time.time() - start_time
+    start_time = time.time()
 
     # compare the tree of the output directory to the reference
-    try:       
-        same_tree = utils.compare_results_dir(test_dict)    
+    try:
+        # the manifest of the output directory is shared by the directory tree and the file comparisons
+        with tracing.span(test_dict["image_to_test"], "compare dir", workflow = test_dict["workflow_name"]):
+            output_manifest = utils.get_dir_manifest(test_dict["pipeline_output"])
+            same_tree = utils.compare_results_dir(test_dict, output_manifest = output_manifest)
     except Exception as e:
         print("Error comparing directory trees for image %s"%test_dict["image_to_test"])
         print(e)
-        same_tree = False
+        store_result(test_dict, error = "Error comparing the directory trees: %s"%e, run_time = run_time)
         return None
 
     if same_tree:
@@ -65,28 +127,107 @@ def run_core(test_dict):
         print("WARNING: The directory tree of the output DOES NOT match the expected output")
 
     try:
-        are_files_equal = utils.compare_results_file(test_dict)
+        with tracing.span(test_dict["image_to_test"], "compare files", workflow = test_dict["workflow_name"]):
+            are_files_equal, file_report_list = utils.compare_results_file(test_dict, fail_fast = fail_fast,
+                                                                           nworkers = compare_workers,
+                                                                           cache_dir = reference_cache_dir,
+                                                                           output_manifest = output_manifest,
+                                                                           return_report = True,
+                                                                           memory_budget = compare_memory,
+                                                                           surface_metrics = surface_metrics)
     except Exception as e:
         print("Error comparing results for image %s"%test_dict["image_to_test"])
         print(e)
-        are_files_equal = False
+        store_result(test_dict, same_tree = same_tree, error = "Error comparing the results: %s"%e,
+                     run_time = run_time)
         return None
 
-    with open(test_dict["output_file"], "a") as f:
-        f.write("%s,%s,%s,%s,%s\n"%(
-            test_dict["image_to_test"],
-            test_dict["workflow_name"],
-            test_dict["data_sample"],
-            same_tree,
-            are_files_equal
-            ))
-    
+    test_result = store_result(test_dict, same_tree = same_tree, are_files_equal = are_files_equal,
+                               run_time = run_time, compare_time = time.time() - start_time,
+                               file_report_list = file_report_list)
+
+    # the tests that passed are not run again, until the image or the data change
+    if memo_key is not None and same_tree and are_files_equal:
+        utils.results_store.add_memo(memo_path, memo_key, test_result, file_report_list)
+
+    write_csv_result(test_dict, same_tree, are_files_equal)
+
+    return {"dirtree_match": same_tree, "output_match": are_files_equal}
+
 ## --------------------------------
 
-def dryrun_core(test_dict):
+def store_memo_result(test_dict, memo_result):
+
+    """
+    Stores (and reports) the result of a test that passed in a previous run (see `run_core`).
+    """
+
+    print(">>> %s - %s: passed in a previous run with the same image and data - skipping"%(
+        test_dict["image_to_test"], test_dict["workflow_name"]))
+
+    store_result(test_dict, same_tree = memo_result["dirtree_match"], are_files_equal = memo_result["output_match"],
+                 run_time = 0.0, compare_time = 0.0, file_report_list = memo_result["file_report_list"])
+
+    write_csv_result(test_dict, memo_result["dirtree_match"], memo_result["output_match"])
+
+    return {"dirtree_match": memo_result["dirtree_match"], "output_match": memo_result["output_match"],
+            "memoized": True}
+
+## --------------------------------
+
+def write_csv_result(test_dict, same_tree, are_files_equal):
+
+    # the CSV report is kept for humans (the push stage reads the results store)
+    with output_file_lock:
+        with open(test_dict["output_file"], "a") as f:
+            f.write("%s,%s,%s,%s,%s\n"%(
+                test_dict["image_to_test"],
+                test_dict["workflow_name"],
+                test_dict["data_sample"],
+                same_tree,
+                are_files_equal
+                ))
+
+## --------------------------------
+
+def store_result(test_dict, same_tree=False, are_files_equal=False, error=None, run_time=None, compare_time=None,
+                 file_report_list=None):
+
+    """
+    Stores the result of a test (failed, if an error is provided) in the results store of the test.
+
+    Returns:
+        dict: The result of the test, as stored.
+    """
+
+    test_result = {
+        "config": test_dict["config_name"],
+        "image": test_dict["image_to_test"],
+        "workflow": test_dict["workflow_name"],
+        "data_sample": test_dict["data_sample"],
+        "dirtree_match": same_tree,
+        "output_match": are_files_equal,
+        "error": error,
+        "run_time": run_time,
+        "compare_time": compare_time
+        }
+
+    utils.results_store.add_test_result(test_dict["results_store"], test_result, file_report_list)
+
+    return test_result
+
+## --------------------------------
+
+def dryrun_core(test_dict, warm=False):
     print("")
-    print("- Docker command to be executed:")
-    print(" ".join(test_dict["docker_command"]))
+
+    if warm:
+        print("- Docker command to be executed (in the warm container of the image):")
+        print(" ".join(utils.get_exec_command("<container>", ["<entrypoint>"], test_dict["workflow_name"],
+                                              test_dict["docker_args"]["workflow_dict"])))
+    else:
+        print("- Docker command to be executed:")
+        print(" ".join(test_dict["docker_command"]))
 
     print("- Output dir to be generated:")
     print(test_dict["pipeline_output"])
@@ -96,52 +237,55 @@ def dryrun_core(test_dict):
 
 ## --------------------------------
 
-def main():
+def init_output_file(config_path, outpath, use_store=True):
 
-    # TO-DO: implement ands set up logging
-    # https://stackoverflow.com/questions/7507825/where-is-a-complete-example-of-logging-config-dictconfig
-    #logging.config.dictConfig(config['logging'])
-    #logger = logging.getLogger(__name__)
-
-    # parse command line arguments
-    parser = argparse.ArgumentParser(description='MHub - automated testing for MHub containers')
-    #parser.add_argument('-l', '--logging', action='store_true', help='enable logging')
-    parser.add_argument('--verbose', action='store_true', help='enable verbose mode')
-    # FIXME: past this directly in the docker command?
-    parser.add_argument('--gpu', action='store_true', help='enable verbose mode')
-    parser.add_argument('--dryrun', action='store_true', help='execute in dry run mode')
-    parser.add_argument('--config', action='store', help='path to config file', required=True)
-    parser.add_argument('--outpath', action='store', help='path to the folder storing the output file', required=True)
+    """
+    Initializes the CSV file storing the results of the tests run using the provided config file
+    (and clears the results of the previous run with the same config from the results store).
 
+    If `use_store` is not set (e.g., in dry run mode), the results store is left untouched (and not created).
+    """
 
-    args = parser.parse_args()
-    
     # split the config file name from the path
-    config_name = os.path.basename(args.config).split(".yml")[0]
+    config_name = os.path.basename(config_path).split(".yml")[0]
     csv_fn = config_name + ".csv"
-    csv_path = os.path.join(args.outpath, csv_fn)
+    csv_path = os.path.join(outpath, csv_fn)
 
-    # parse yaml config file
-    with open(args.config, 'r') as f:
-        config_dict = yaml.safe_load(f)
-    
     # if the output file is already found, delete it
     if os.path.isfile(csv_path):
         os.remove(csv_path)
 
+    # same for the results of the previous run with this config found in the results store
+    if use_store:
+        utils.results_store.delete_results(utils.results_store.get_store_path(outpath), config_name)
+
     # initialize the output file
     with open(csv_path, "a") as f:
         f.write("image,workflow,data_sample,dirtree_match,output_match\n")
 
+    return csv_path
+
+## --------------------------------
+
+def get_test_list(config_dict, csv_path, use_gpu=False, images_to_test=None):
+
+    """
+    Returns the list of tests to run (formatted in dictionaries), i.e., every image x workflow pair of the config.
+
+    If `images_to_test` is provided, only the images (repo/image:tag) found in the list are tested.
+    """
+
     # dict of versions of the MHub image to test
     mhub_images_dict = config_dict["images"]
 
+    if images_to_test is not None:
+        mhub_images_dict = {k: v for k, v in mhub_images_dict.items()
+                            if "mhubai/" + v["name"] + ":" + v["version"] in images_to_test}
+
     workflows_list = list(config_dict["workflows"].keys())
 
     test_list = list()
-    image_name_list = list()
 
-    # FIXME: handle all of the following in a dedicated function?
     for mhub_image in mhub_images_dict.keys():
 
         image_dict = config_dict["images"][mhub_image]
@@ -151,11 +295,10 @@ def main():
             test_dict = dict()
 
             test_dict["output_file"] = csv_path
+            test_dict["config_name"] = os.path.splitext(os.path.basename(csv_path))[0]
+            test_dict["results_store"] = utils.results_store.get_store_path(os.path.dirname(csv_path))
             test_dict["image_to_test"] = "mhubai/" + image_dict["name"] + ":" + image_dict["version"]
 
-            if test_dict["image_to_test"] not in image_name_list:
-                image_name_list.append(test_dict["image_to_test"])        
-
             workflow_dict = config_dict["workflows"][workflow_name]
 
             test_dict["workflow_name"] = workflow_name
@@ -163,14 +306,16 @@ def main():
             test_dict["config"] = workflow_dict["config"]
 
             # build the docker command to run
-            test_dict["docker_command"] = utils.get_docker_command(
+            # (the GPU device and the CPUs are only known once the test is assigned to a slot)
+            test_dict["docker_args"] = dict(
                 image_to_test = test_dict["image_to_test"],
                 workflow_name = workflow_name,
                 workflow_dict = workflow_dict,
                 input_base_dir = INPUT_BASE_DIR,
                 output_base_dir = OUTPUT_BASE_DIR,
-                use_gpu = args.gpu
+                use_gpu = use_gpu
                 )
+            test_dict["docker_command"] = utils.get_docker_command(**test_dict["docker_args"])
 
             test_dict["pipeline_output"] = os.path.join(
                 OUTPUT_BASE_DIR,
@@ -184,28 +329,165 @@ def main():
                 workflow_dict["data_sample"],
                 workflow_name)
 
-            # append to the list of task to run (single proc.)
+            # append to the list of task to run
             test_list.append(test_dict)
 
+    return test_list
+
+## --------------------------------
+
+def main(argv=None):
+
+    # TO-DO: implement ands set up logging
+    # https://stackoverflow.com/questions/7507825/where-is-a-complete-example-of-logging-config-dictconfig
+    #logging.config.dictConfig(config['logging'])
+    #logger = logging.getLogger(__name__)
+
+    # parse command line arguments
+    parser = argparse.ArgumentParser(description='MHub - automated testing for MHub containers')
+    #parser.add_argument('-l', '--logging', action='store_true', help='enable logging')
+    parser.add_argument('--verbose', action='store_true', help='enable verbose mode')
+    # FIXME: past this directly in the docker command?
+    parser.add_argument('--gpu', action='store_true', help='run the containers using a GPU (device 0, see --gpu_devices)')
+    parser.add_argument('--gpu_devices', action='store', nargs='+', type=str, default=None,
+                        help='GPU devices to run the tests on (one test per device at a time) - implies --gpu')
+    parser.add_argument('--nslots', action='store', type=int, default=1,
+                        help='number of tests to run at the same time when running on CPU (max is %g)'%max_cores)
+    parser.add_argument('--dryrun', action='store_true', help='execute in dry run mode')
+    parser.add_argument('--docker_api', action='store_true',
+                        help='talk to the Docker Engine API (/var/run/docker.sock) instead of running the docker CLI')
+    parser.add_argument('--warm_containers', action='store_true',
+                        help='run all the workflows of an image in the same container (one per slot), instead of a new container per workflow')
+    parser.add_argument('--config', action='store', help='path to config file', required=True)
+    parser.add_argument('--outpath', action='store', help='path to the folder storing the output file', required=True)
+    parser.add_argument('--images_list', action='store', type=str, default=None,
+                        help='path to a JSON list of images (repo/image:tag) to test - others are skipped (e.g., build --affected_list)')
+    parser.add_argument('--full_report', action='store_true',
+                        help='compare every output file, instead of stopping at the first mismatch')
+    parser.add_argument('--compare_workers', action='store', type=int, default=None,
+                        help='number of processes comparing the output files of a test (default: CPUs/slots)')
+    parser.add_argument('--surface_metrics', action='store_true',
+                        help='compute and print the Hausdorff (max and 95th percentile) and mean surface distance of every label')
+    parser.add_argument('--compare_memory', action='store', type=str, default=None,
+                        help='memory every comparison can take (e.g., 2G) - larger images are compared one slab at a time')
+    parser.add_argument('--reference_cache', action='store', type=str, default=utils.reference_cache.DEFAULT_CACHE_DIR,
+                        help='path to the folder caching the decoded reference files')
+    parser.add_argument('--no_reference_cache', action='store_true', help='decode the reference files at every run')
+    parser.add_argument('--memo_store', action='store', type=str, default=utils.results_store.DEFAULT_MEMO_PATH,
+                        help='path to the store of the tests passed so far (skipped while the image and data do not change)')
+    parser.add_argument('--no-memo', action='store_true', help='run every test, even if it passed before with the same image and data')
+    parser.add_argument('--write_manifests', action='store_true',
+                        help='precompute the manifests of the reference directories of the tests, then exit')
+    parser.add_argument('--trace_dir', action='store', type=str, default=None,
+                        help='folder to export the timing of every step to (as <run_id>.trace.json)')
+    parser.add_argument('--run_id', action='store', type=str, default=None,
+                        help='ID of the run, shared by the stages writing to the same trace (default: a new one)')
+
+    args = parser.parse_args(argv)
+
+    # the warm containers are run (and the workflows executed in them) with the docker CLI only
+    if args.docker_api and args.warm_containers:
+        parser.error("--docker_api can not be used with --warm_containers (warm containers are run with the docker CLI)")
+
+    if args.trace_dir is not None:
+        tracing.start_trace(run_id = args.run_id)
+
+    if args.gpu_devices is not None:
+        args.gpu = True
+    elif args.gpu:
+        args.gpu_devices = ["0"]
+    
+    # parse yaml config file
+    with open(args.config, 'r') as f:
+        config_dict = yaml.safe_load(f)
+
+    # no test is run in dry run mode (or when writing the manifests): the results store is left untouched
+    csv_path = init_output_file(config_path = args.config, outpath = args.outpath,
+                                use_store = not (args.dryrun or args.write_manifests))
+
+    # if a list of images is provided (e.g., the images affected by the last changes), test only those
+    images_to_test = None
+    if args.images_list is not None:
+        with open(args.images_list, "r") as f:
+            images_to_test = json.load(f)
+
+    test_list = get_test_list(config_dict, csv_path = csv_path, use_gpu = args.gpu, images_to_test = images_to_test)
+
+    workflows_list = list(config_dict["workflows"].keys())
+    image_name_list = list(dict.fromkeys([test_dict["image_to_test"] for test_dict in test_list]))
+
     if args.verbose:
         print("Found %g image(s) to test running %g workflow(s)"%(len(image_name_list), len(workflows_list)))
         
         for test_dict in test_list:
             print("- %s - %s"%(test_dict["image_to_test"], test_dict["workflow_name"]))
 
-    for idx, test_dict in  enumerate(test_list):
+    # the manifests stored in the reference directories are used until the directory trees change
+    if args.write_manifests:
+        for reference_dir in dict.fromkeys([test_dict["pipeline_reference"] for test_dict in test_list]):
+            manifest = utils.write_dir_manifest(reference_dir)
+            print("Wrote the manifest of %s (%g entries)"%(reference_dir, len(manifest)))
 
-        if args.verbose:
-            print("\nRunning test %g/%g"%(idx+1, len(test_list)))
-            print("MHub image: %s"%test_dict["image_to_test"])
-            print("Workflow: %s"%test_dict["workflow_name"])
-            print("Sample data: %s"%test_dict["data_sample"])
-            print("Using GPU") if args.gpu else print("Using CPU")
+        return
 
-        if args.dryrun:
-            dryrun_core(test_dict)
-        else:
-            run_core(test_dict)
+    if args.dryrun:
+        for idx, test_dict in  enumerate(test_list):
+
+            if args.verbose:
+                print("\nRunning test %g/%g"%(idx+1, len(test_list)))
+                print("MHub image: %s"%test_dict["image_to_test"])
+                print("Workflow: %s"%test_dict["workflow_name"])
+                print("Sample data: %s"%test_dict["data_sample"])
+                print("Using GPU") if args.gpu else print("Using CPU")
+
+            dryrun_core(test_dict, warm = args.warm_containers)
+
+        return
+
+    # run the tests on the available slots (one test per GPU device, or --nslots tests on CPU)
+    slot_list = utils.get_test_slots(nslots = args.nslots, gpu_devices = args.gpu_devices)
+
+    if args.verbose:
+        print("\nRunning %g test(s) on %g slot(s):"%(len(test_list), len(slot_list)))
+        for slot_dict in slot_list:
+            print("- GPU device: %s, CPUs: %s"%(slot_dict["gpu_device"], slot_dict["cpuset"]))
+
+    # the CPUs are shared by the tests running at the same time
+    if args.compare_workers is None:
+        args.compare_workers = max(max_cores//len(slot_list), 1)
+
+    # with warm containers, the workflows of an image are run one after the other, in the same container
+    with contextlib.ExitStack() as stack:
+        warm_containers = None
+        if args.warm_containers:
+            warm_containers = stack.enter_context(utils.WarmContainers(test_list, verbose = args.verbose))
+
+        core_fn = functools.partial(run_core, use_api = args.docker_api, fail_fast = not args.full_report,
+                                    compare_workers = args.compare_workers,
+                                    reference_cache_dir = None if args.no_reference_cache else args.reference_cache,
+                                    warm_containers = warm_containers,
+                                    memo_path = None if args.no_memo else args.memo_store,
+                                    compare_memory = None if args.compare_memory is None
+                                                     else resources.parse_size(args.compare_memory),
+                                    surface_metrics = args.surface_metrics)
+
+        get_group = (lambda test_dict: test_dict["image_to_test"]) if args.warm_containers else None
+
+        for idx, (test_dict, result) in enumerate(utils.run_tests(test_list, core_fn, slot_list,
+                                                                  get_group = get_group)):
+
+            if args.verbose:
+                print("\nTest done %g/%g"%(idx+1, len(test_list)))
+                print("MHub image: %s"%test_dict["image_to_test"])
+                print("Workflow: %s"%test_dict["workflow_name"])
+                print("Sample data: %s"%test_dict["data_sample"])
+                print("Result: %s"%("ERROR" if result is None else result))
+
+    if args.trace_dir is not None:
+        path_to_trace = tracing.get_trace_path(args.trace_dir)
+        nspans = tracing.write_trace(path_to_trace, stage = "test")
+
+        print("Timing of %g steps exported to %s"%(nspans, path_to_trace))
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
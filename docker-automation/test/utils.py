@@ -12,10 +12,14 @@ import os
 import sys
 import time
 
-import filecmp
-
+import queue
+import hashlib
+import signal
 import argparse
+import threading
+import functools
 import subprocess
+import concurrent.futures
 
 # TO-DO: add logging
 #import logging
@@ -25,15 +29,29 @@ import yaml
 import json
 import pprint
 
-import pydicom
-import pydicom_seg
-import SimpleITK as sitk
+# NOTE: numpy, pydicom and SimpleITK take a while to import, and are only needed to compare the
+# results: they are imported by the functions using them (see `python cli.py bench`)
 
 pp = pprint.PrettyPrinter(indent=2)
 
+# modules shared by the build, test and push stages
+base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if base_dir not in sys.path:
+    sys.path.append(base_dir)
+
+from common import dicom_seg
+from common import docker_api
+from common import label_streams
+from common import process_pool
+from common import reference_cache
+from common import resources
+from common import results_store
+from common import tracing
 
 
-def get_docker_command(image_to_test, workflow_name, workflow_dict, input_base_dir, output_base_dir, use_gpu, rm_container=True):
+
+def get_docker_command(image_to_test, workflow_name, workflow_dict, input_base_dir, output_base_dir, use_gpu, rm_container=True,
+                       gpu_device=None, cpuset=None):
 
     """
     Generate a Docker command for running a container via subprocess.
@@ -45,6 +63,9 @@ def get_docker_command(image_to_test, workflow_name, workflow_dict, input_base_d
         input_base_dir (str):
         output_base_dir (str): 
         use_gpu (bool): Flag indicating whether to run the docker containers using a GPU.
+        rm_container (bool, optional): Flag indicating whether to remove the container once done. Defaults to True.
+        gpu_device (str, optional): The GPU device to run the container on (if `use_gpu` is set). Defaults to "0".
+        cpuset (str, optional): The CPUs the container is allowed to run on (e.g., "0-7"). Defaults to None (all).
 
     Returns:
         list: A list representing the Docker command (subprocess runnable).
@@ -77,7 +98,10 @@ def get_docker_command(image_to_test, workflow_name, workflow_dict, input_base_d
         docker_command += ["--rm"]
 
     if use_gpu:
-        docker_command += ["--gpus", "device=0"]
+        docker_command += ["--gpus", "device=%s"%(gpu_device if gpu_device is not None else "0")]
+
+    if cpuset is not None:
+        docker_command += ["--cpuset-cpus", cpuset]
     
     docker_command += [image_to_test]
 
@@ -89,281 +113,1672 @@ def get_docker_command(image_to_test, workflow_name, workflow_dict, input_base_d
         
 ## --------------------------------
 
-def run_mhub_model(docker_command, verbose=False):
+def get_container_config(image_to_test, workflow_name, workflow_dict, input_base_dir, output_base_dir, use_gpu,
+                         gpu_device=None, cpuset=None):
 
-    # run the docker command
+    """
+    Generate the configuration of a container for running it via the Docker Engine API.
 
-    print("Data processing - running subprocess...")
-    output = subprocess.run(docker_command, check=True, text=True,
-                            stdout=None if verbose else subprocess.DEVNULL,
-                            stderr=None if verbose else subprocess.DEVNULL)
+    This is the Docker Engine API counterpart of `get_docker_command` (same arguments, same container).
 
-    print("... Done.")
+    Returns:
+        dict: The configuration of the container, as expected by the `/containers/create` endpoint.
+    """
 
-    if verbose:
-        print("Subprocess output:", output)
+    model_name = image_to_test.split("/")[-1].split(":")[0]
 
-## --------------------------------
+    path_to_input_data = os.path.join(input_base_dir, workflow_dict["data_sample"], workflow_name)
+    path_to_output_data = os.path.join(output_base_dir, model_name, workflow_dict["data_sample"], workflow_name)
 
-def compare_results_file(test_dict, verbose=False):
+    host_config = dict()
+    host_config["Binds"] = [path_to_input_data + ":/app/data/input_data",
+                            path_to_output_data + ":/app/data/output_data"]
 
-    output_dir = test_dict["pipeline_output"]
+    if use_gpu:
+        host_config["DeviceRequests"] = [{"Driver": "",
+                                          "DeviceIDs": [gpu_device if gpu_device is not None else "0"],
+                                          "Capabilities": [["gpu"]]}]
 
-    output_file_list = list()
-    reference_file_list = list()
+    if cpuset is not None:
+        host_config["CpusetCpus"] = cpuset
 
-    # use os.walk to iterate over the files in the output directory and create a list of paths to the files
-    for root, dirs, files in os.walk(output_dir):
-        for file in files:
-            output_file_list.append(os.path.join(root, file))
+    # get the name of the file without the extension
+    config_name = os.path.splitext(workflow_dict["config"])[0]
 
-    # at this stage, we should already have checked the directory trees are equal, so we can safely assume
-    # any file found under "reference_data" will have a counterpart in the "output_data" directory
-    # we can therefore create a list of paths to the files in the reference directory by replacing the
-    # "output_data" part of the path with "reference_data", and loop on both lists together
-    reference_file_list = [f.replace("output_data", "reference_data") for f in output_file_list]
+    return {"Image": image_to_test,
+            "Cmd": ["--workflow", config_name],
+            "HostConfig": host_config}
 
-    itk_image_formats = tuple([".nii.gz", ".nrrd", ".mha", ".mhd"])
+## --------------------------------
 
-    if verbose:
-        print("output_file_list:", output_file_list)
-        print("reference_file_list:", reference_file_list)
+def get_test_slots(nslots, gpu_devices=None):
 
-    # depending on the file extension, we will use different functions to compare the files
-    # DICOM SEG
-    for output_file, reference_file in zip(output_file_list, reference_file_list):
+    """
+    Returns the slots the tests can be run on at the same time.
 
-        if output_file.endswith(".seg.dcm"):
-            same_content = compare_results_dicomseg(output_file, reference_file, verbose=verbose)
+    If GPU devices are provided, a slot is created for every device; otherwise, `nslots` CPU-only slots are created.
+    In both cases, the CPUs this process is allowed to run on are split evenly between the slots (so that tests
+    running at the same time do not compete for the same cores).
 
-            if not same_content:
-                print("DICOM SEG files %s and %s are not equal"%(output_file, reference_file))
-                return False
-        
-        elif output_file.endswith(itk_image_formats):
-            same_content = compare_results_itk(output_file, reference_file, verbose=verbose)
+    Args:
+        nslots (int): The number of slots to create when running on CPU.
+        gpu_devices (list, optional): The list of GPU devices to run the tests on (e.g., ["0", "1"]). Defaults to None.
+
+    Returns:
+        list: A list of slot dictionaries, storing the "gpu_device" (None if CPU-only) and "cpuset" of each slot.
+
+    Example:
+        >>> get_test_slots(2)
+        [{'gpu_device': None, 'cpuset': '0-3'}, {'gpu_device': None, 'cpuset': '4-7'}]
+        >>> get_test_slots(2, gpu_devices=["0", "1"])
+        [{'gpu_device': '0', 'cpuset': '0-3'}, {'gpu_device': '1', 'cpuset': '4-7'}]
+    """
 
-            if not same_content:
-                print("ITK image files %s and %s are not equal"%(output_file, reference_file))
-                return False
+    if gpu_devices is not None and len(gpu_devices) > 0:
+        slot_gpus = list(gpu_devices)
+    else:
+        slot_gpus = [None]*max(nslots, 1)
 
-        elif output_file.endswith(".json"):
-            same_content = compare_results_json(output_file, reference_file, verbose=verbose)
+    allowed_cpus = resources.get_allowed_cpus()
+    cpus_per_slot = len(allowed_cpus) // len(slot_gpus)
 
-            if not same_content:
-                print("JSON files %s and %s are not equal"%(output_file, reference_file))
-                return False
+    slot_list = list()
+    for idx, gpu_device in enumerate(slot_gpus):
 
+        # if there are more slots than CPUs, let docker schedule the containers on all the cores
+        if cpus_per_slot == 0:
+            cpuset = None
         else:
-            print("File %s has an unsupported format; moving on..."%output_file)
-            continue
-        
-    return True
-    
+            cpuset = resources.format_cpuset(allowed_cpus[idx*cpus_per_slot:(idx + 1)*cpus_per_slot])
+
+        slot_list.append({"gpu_device": gpu_device, "cpuset": cpuset})
+
+    return slot_list
+
 ## --------------------------------
 
-def compare_results_itk(output_file, reference_file, dc_thresh=0.99, verbose=False):
-    
-    if verbose:
-        print("\nComparing ITK image files...")
+def run_tests(test_list, core_fn, slot_list, get_group=None):
 
-        print("Output file:", output_file)
-        print("Reference file:", reference_file)
+    """
+    Runs `core_fn` on every test of the list, on the provided slots (one test per slot at a time).
 
-    # FIXME: swap this block out for whatever we decide to stick with
-    output_seg = sitk.ReadImage(output_file)
-    reference_seg = sitk.ReadImage(reference_file)
+    Args:
+        test_list (list): A list of test dictionaries.
+        core_fn (callable): The function to run on each test. Called as `core_fn(test_dict, slot_dict)`, where
+                            `slot_dict` is the slot (see `get_test_slots`) the test was assigned to.
+        slot_list (list): A list of slot dictionaries, as returned by `get_test_slots`.
+        get_group (callable, optional): If provided, the tests with the same `get_group(test_dict)` are run one
+                                        after the other on the same slot (e.g., the workflows of an image, in the
+                                        same warm container). Defaults to None (every test on the first free slot).
+
+    Yields:
+        tuple: A (test_dict, result) tuple for every test, as soon as the test is done.
+    """
 
-    dc = compute_overlap(output_seg, reference_seg)
-    
-    # FIXME: we can bend this rule as much as we want
-    if dc > dc_thresh:
-        print(">>> The ITK image files are equal (DC/DC threshold: %g/%g)"%(dc, dc_thresh))
-        return True
-    else:
-        print(">>> The ITK image files are NOT equal (DC/DC threshold: %g/%g)"%(dc, dc_thresh))
-        return False
+    free_slots = queue.Queue()
+    for slot_dict in slot_list:
+        free_slots.put(slot_dict)
 
-## --------------------------------
+    group_dict = dict()
+    for idx, test_dict in enumerate(test_list):
+        group_dict.setdefault(idx if get_group is None else get_group(test_dict), list()).append(test_dict)
 
-def compute_overlap(itksegimage1, itksegimage2):
-    # Load segmentation volumes
+    done_queue = queue.Queue()
+
+    def run_on_slot(test_group):
+        slot_dict = free_slots.get()
+        try:
+            for test_dict in test_group:
+                done_queue.put((test_dict, core_fn(test_dict, slot_dict), None))
+        except Exception as e:
+            done_queue.put((None, None, e))
+        finally:
+            free_slots.put(slot_dict)
 
-    # Compute the overlap between the segmentations
-    overlap_filter = sitk.LabelOverlapMeasuresImageFilter()
-    overlap_filter.Execute(itksegimage1, itksegimage2)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(slot_list)) as executor:
+        for test_group in group_dict.values():
+            executor.submit(run_on_slot, test_group)
 
-    # Get the overlap measures
-    dice_coefficient = overlap_filter.GetDiceCoefficient()
+        for _ in range(len(test_list)):
+            test_dict, result, error = done_queue.get()
 
-    return dice_coefficient
+            if error is not None:
+                raise error
+
+            yield test_dict, result
 
 ## --------------------------------
 
-def compare_results_dicomseg(output_file, reference_file, dc_thresh=0.99, verbose=False):
+# the label of the warm containers, storing the PID of the process that started them
+warm_container_label = "mhubai.warm_container"
 
-    if verbose:
-        print("\nComparing DICOM SEG files...")
+# where the input and output folders of the image are mounted in its warm container
+warm_input_dir = "/mnt/mhub/input_data"
+warm_output_dir = "/mnt/mhub/output_data"
 
-        print("Output file:", output_file)
-        print("Reference file:", reference_file)
+def get_warm_docker_command(image_to_test, input_base_dir, output_base_dir, use_gpu, container_name,
+                            gpu_device=None, cpuset=None):
 
-    dcm = pydicom.dcmread(output_file)
-    reader = pydicom_seg.SegmentReader()
-    output_seg = reader.read(dcm)
+    """
+    Generate the Docker command starting the warm container of an image (see `WarmContainers`).
 
-    dcm = pydicom.dcmread(reference_file)
-    reader = pydicom_seg.SegmentReader()
-    reference_seg = reader.read(dcm)
+    The container only sleeps until removed: the workflows are run in it with `get_exec_command`. The input folder
+    and the output folder of the image (all the data samples and workflows) are mounted in it.
 
-    if len(output_seg.available_segments) != len(reference_seg.available_segments):
-        print(">>> The DICOM SEG files store a different number of segments")
-        return False
+    Args:
+        image_to_test (str): The name of the Docker image to test in the usual format (repo/image:tag).
+        input_base_dir (str): The folder storing the input data of every data sample and workflow.
+        output_base_dir (str): The folder storing the output data of every image, data sample and workflow.
+        use_gpu (bool): Flag indicating whether to run the docker container using a GPU.
+        container_name (str): The name of the container.
+        gpu_device (str, optional): The GPU device to run the container on (if `use_gpu` is set). Defaults to "0".
+        cpuset (str, optional): The CPUs the container is allowed to run on (e.g., "0-7"). Defaults to None (all).
 
-    for segment_number in output_seg.available_segments:
-        output_segment = output_seg.segment_image(segment_number)
-        reference_segment = reference_seg.segment_image(segment_number)
+    Returns:
+        list: A list representing the Docker command (subprocess runnable).
+    """
 
-        dc = compute_overlap(output_segment, reference_segment)
+    model_name = image_to_test.split("/")[-1].split(":")[0]
 
-        # FIXME: how do we aggregate the DCs for each segment?
-        if dc < dc_thresh:
-            print(">>> DICOM SEG segments #%g are not equal (DC/DC threshold: %g/%g)"%(segment_number, dc, dc_thresh))
-            return False
-    
+    docker_command = list()
+    docker_command += ["docker", "run", "--detach", "--init"]
+    docker_command += ["--name", container_name]
+    docker_command += ["--label", "%s=%s"%(warm_container_label, os.getpid())]
+    docker_command += ["-v", input_base_dir + ":" + warm_input_dir]
+    docker_command += ["-v", os.path.join(output_base_dir, model_name) + ":" + warm_output_dir]
 
-    print(">>> The DICOM SEG files are equal (DC threshold: %g)"%dc_thresh)
-    return True
+    if use_gpu:
+        docker_command += ["--gpus", "device=%s"%(gpu_device if gpu_device is not None else "0")]
+
+    if cpuset is not None:
+        docker_command += ["--cpuset-cpus", cpuset]
+
+    docker_command += ["--entrypoint", "sleep", image_to_test, "infinity"]
+
+    return docker_command
 
 ## --------------------------------
 
-def compare_results_json(output_file, reference_file, verbose=False):
+def get_exec_command(container_name, entrypoint, workflow_name, workflow_dict):
 
-    if verbose:
-        print("\nComparing JSON files...")
+    """
+    Generate the Docker command running a workflow in the warm container of an image.
 
-        print("Output file:", output_file)
-        print("Reference file:", reference_file)
+    Every workflow starts from an empty /app/data folder, whose input_data and output_data folders point to the
+    input and output folders of the workflow (the same folders mounted by `get_docker_command`), so that nothing
+    is left over from the workflows run before in the same container.
 
-    # load the json files
-    with open(output_file, "r") as f:
-        json1 = json.load(f)
+    Args:
+        container_name (str): The name of the warm container (see `get_warm_docker_command`).
+        entrypoint (list): The entrypoint of the image (run with the workflow arguments, as `docker run` would).
+        workflow_name (str): The name of the workflow.
+        workflow_dict (dict): The workflow dictionary (data sample and config) from the test config.
 
-    with open(reference_file, "r") as f:
-        json2 = json.load(f)
+    Returns:
+        list: A list representing the Docker command (subprocess runnable).
 
-    # NOTE: this compares every (key;value) pair in the json files and should not raise any errors
-    # provided nothing strange is in the json (i.e., everything needs to be comparable with "==")
-    # therefore, it should be good for now, but we might want to change it in the future
-    if json1 == json2:
-        print(">>> The JSON files are equal")
-        return True
+    Example:
+        Example of command returned by this function (once unpacked from list)):
+        ```
+        docker exec mhub_warm_totalsegmentator_3f2a1c sh -c '...' sh \
+            /mnt/mhub/input_data/chest_ct/dicom /mnt/mhub/output_data/chest_ct/dicom \
+            mhub.run --workflow default
+        ```
+    """
+
+    path_to_input_data = "/".join([warm_input_dir, workflow_dict["data_sample"], workflow_name])
+    path_to_output_data = "/".join([warm_output_dir, workflow_dict["data_sample"], workflow_name])
+
+    # the paths are passed as arguments, so that they do not need to be quoted
+    setup_script = ('rm -rf /app/data && mkdir -p /app/data "$2" && '
+                    'ln -s "$1" /app/data/input_data && ln -s "$2" /app/data/output_data && '
+                    'shift 2 && exec "$@"')
+
+    # get the name of the file without the extension
+    config_name = os.path.splitext(workflow_dict["config"])[0]
 
+    docker_command = ["docker", "exec", container_name, "sh", "-c", setup_script, "sh",
+                      path_to_input_data, path_to_output_data]
+    docker_command += list(entrypoint) + ["--workflow", config_name]
+
+    return docker_command
 
 ## --------------------------------
 
-def compare_results_dir(test_dict, verbose=False, check_files=False):
+class WarmContainers:
 
-    output_dir = test_dict["pipeline_output"]
-    reference_dir = test_dict["pipeline_reference"]
+    """
+    Runs the workflows of every image in a long-lived container, instead of a new container per workflow.
 
-    print("\nOutput directory:", output_dir)
-    print("Reference directory:", reference_dir)
-    
-    print("Comparing the results with the reference...")
+    The first workflow of an image run on a slot starts a container pinned to the GPU device and CPUs of the slot
+    (see `get_warm_docker_command`), and every workflow of the image is then run in it (see `get_exec_command`),
+    so that the container start, GPU setup and loading of the model weights from disk are only paid once.
+    The tests of an image should be run one after the other on the same slot (see `run_tests`).
 
-    # check that the directories exist (they should, since they were created by the docker container)
-    assert os.path.exists(output_dir), "Output directory %s does not exist"%output_dir
-    assert os.path.exists(output_dir), "Reference directory %s does not exist"%output_dir
+    The containers of an image are removed as soon as all of its tests are done, and all of them are removed when
+    exiting the `with` block - on errors and on SIGTERM too. The containers left over by runs that were killed
+    (whose PID is not running anymore) are removed when entering it. If a workflow fails, its container is
+    removed, and the next workflow of the image starts a new one.
 
-    # check that the directories trees are equal
-    same_tree = are_dir_trees_equal(output_dir, reference_dir, check_files=check_files, verbose=verbose)
+    Example:
+        >>> with WarmContainers(test_list) as warm_containers:
+        ...     for test_dict in test_list:
+        ...         warm_containers.run_workflow(test_dict["docker_args"], slot_dict)
+        ...         warm_containers.release(test_dict["docker_args"]["image_to_test"])
+    """
+
+    def __init__(self, test_list, verbose=False):
+
+        self.verbose = verbose
+
+        # the number of tests of every image not done yet
+        self.pending = dict()
+        for test_dict in test_list:
+            self.pending[test_dict["image_to_test"]] = self.pending.get(test_dict["image_to_test"], 0) + 1
+
+        self.lock = threading.Lock()
+        self.containers = dict()
+        self.entrypoints = dict()
+
+        self.sigterm_handler = None
+
+    ## --------------------------------
+
+    def __enter__(self):
+
+        self.remove_stale_containers()
+
+        # turn SIGTERM into an exception, so that the containers are removed when the run is stopped
+        if threading.current_thread() is threading.main_thread():
+            self.sigterm_handler = signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        if self.sigterm_handler is not None:
+            signal.signal(signal.SIGTERM, self.sigterm_handler)
+            self.sigterm_handler = None
+
+        self.close()
+
+    ## --------------------------------
+
+    def get_entrypoint(self, image_to_test):
+
+        """
+        Returns the entrypoint of an image (the command `docker run` would run the workflow arguments with).
+        """
+
+        with self.lock:
+            if image_to_test not in self.entrypoints:
+                output = subprocess.run(["docker", "image", "inspect", "--format", "{{json .Config.Entrypoint}}",
+                                         image_to_test], check=True, text=True, stdout=subprocess.PIPE)
+                entrypoint = json.loads(output.stdout)
+
+                if not entrypoint:
+                    raise RuntimeError("Image %s has no entrypoint to run the workflows with"%image_to_test)
+
+                self.entrypoints[image_to_test] = entrypoint
+
+            return self.entrypoints[image_to_test]
+
+    ## --------------------------------
+
+    def get_container(self, docker_args, slot_dict):
+
+        """
+        Returns the name of the warm container of an image on a slot, starting it if needed.
+        """
+
+        image_to_test = docker_args["image_to_test"]
+        container_key = (image_to_test, slot_dict["gpu_device"], slot_dict["cpuset"])
+
+        with self.lock:
+            if container_key in self.containers:
+                return self.containers[container_key]
+
+        model_name = image_to_test.split("/")[-1].split(":")[0]
+        container_name = "mhub_warm_%s_%s"%(model_name, os.urandom(4).hex())
+
+        docker_command = get_warm_docker_command(image_to_test = image_to_test,
+                                                 input_base_dir = docker_args["input_base_dir"],
+                                                 output_base_dir = docker_args["output_base_dir"],
+                                                 use_gpu = docker_args["use_gpu"],
+                                                 container_name = container_name,
+                                                 gpu_device = slot_dict["gpu_device"],
+                                                 cpuset = slot_dict["cpuset"])
+
+        print("Starting the warm container of %s..."%image_to_test)
+
+        # registered before starting it, so that it is removed even if the start is interrupted
+        with self.lock:
+            self.containers[container_key] = container_name
+
+        subprocess.run(docker_command, check=True, text=True, stdout=subprocess.DEVNULL,
+                       stderr=None if self.verbose else subprocess.DEVNULL)
+
+        return container_name
+
+    ## --------------------------------
+
+    def run_workflow(self, docker_args, slot_dict):
+
+        """
+        Runs a workflow (see `get_docker_command` for the arguments) in the warm container of its image.
+
+        Raises:
+            subprocess.CalledProcessError: If the workflow fails (its container is removed).
+        """
+
+        container_name = self.get_container(docker_args, slot_dict)
+        entrypoint = self.get_entrypoint(docker_args["image_to_test"])
+
+        docker_command = get_exec_command(container_name, entrypoint, docker_args["workflow_name"],
+                                          docker_args["workflow_dict"])
+
+        try:
+            run_mhub_model(docker_command, verbose = self.verbose)
+        except Exception:
+            # the next workflow of the image starts from a new container
+            self.remove_containers(lambda container_key: container_key[0] == docker_args["image_to_test"]
+                                   and container_key[1:] == (slot_dict["gpu_device"], slot_dict["cpuset"]))
+            raise
+
+    ## --------------------------------
+
+    def release(self, image_to_test):
+
+        """
+        Marks a test of an image as done, removing the containers of the image once all of its tests are done.
+        """
+
+        with self.lock:
+            self.pending[image_to_test] = self.pending.get(image_to_test, 1) - 1
+            done = self.pending[image_to_test] <= 0
+
+        if done:
+            self.remove_containers(lambda container_key: container_key[0] == image_to_test)
+
+    ## --------------------------------
+
+    def remove_containers(self, select_fn):
+
+        """
+        Removes the warm containers whose (image, GPU device, CPUs) key is selected by `select_fn`.
+        """
+
+        with self.lock:
+            container_keys = [container_key for container_key in self.containers if select_fn(container_key)]
+            container_names = [self.containers.pop(container_key) for container_key in container_keys]
+
+        if len(container_names) > 0:
+            subprocess.run(["docker", "rm", "--force"] + container_names, text=True,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    ## --------------------------------
+
+    def close(self):
+
+        """
+        Removes all of the warm containers.
+        """
+
+        self.remove_containers(lambda container_key: True)
+
+    ## --------------------------------
+
+    def remove_stale_containers(self):
+
+        """
+        Removes the warm containers started by processes that are not running anymore (e.g., killed runs).
+        """
+
+        output = subprocess.run(["docker", "ps", "--all", "--filter", "label=%s"%warm_container_label,
+                                 "--format", '{{.ID}} {{.Label "%s"}}'%warm_container_label],
+                                text=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+        stale_list = list()
+        for line in output.stdout.splitlines():
+            container_id, pid = (line.split() + [""])[:2]
+
+            try:
+                os.kill(int(pid), 0)
+            except (ValueError, ProcessLookupError):
+                stale_list.append(container_id)
+            except PermissionError:
+                pass
+
+        if len(stale_list) > 0:
+            print("Removing %g warm container(s) left over by previous runs"%len(stale_list))
+            subprocess.run(["docker", "rm", "--force"] + stale_list, text=True,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+## --------------------------------
+
+def run_mhub_model(docker_command, verbose=False):
+
+    # run the docker command
+
+    print("Data processing - running subprocess...")
+    output = subprocess.run(docker_command, check=True, text=True,
+                            stdout=None if verbose else subprocess.DEVNULL,
+                            stderr=None if verbose else subprocess.DEVNULL)
 
     print("... Done.")
 
-    return same_tree
+    if verbose:
+        print("Subprocess output:", output)
 
 ## --------------------------------
-    
-def are_dir_trees_equal(dir1, dir2, check_files=False, verbose=False):
+
+def run_mhub_model_api(container_config, verbose=False):
 
     """
-    Compare two directory trees.
+    Runs an MHub container through the Docker Engine API (see `get_container_config`), and waits for it to exit.
+
+    Raises:
+        RuntimeError: If the container exits with a non-zero exit code.
+    """
+
+    print("Data processing - running container...")
+
+    exit_code = docker_api.run_sync(docker_api.get_client().run_container(container_config))
+
+    if exit_code != 0:
+        raise RuntimeError("Container %s exited with code %g"%(container_config["Image"], exit_code))
+
+    print("... Done.")
+
+## --------------------------------
+
+def compare_results_file(test_dict, verbose=False, fail_fast=True, nworkers=None, cache_dir=None,
+                         output_manifest=None, return_report=False, memory_budget=None, surface_metrics=False):
+
+    """
+    Compares every file in the output directory with its counterpart in the reference directory.
 
     Args:
-        dir1 (str): Path to the first directory.
-        dir2 (str): Path to the second directory.
-        check_files (bool): Flag indicating whether to check the files in the directories or just the directoy trees.
-                            Defaults to False (as binary files in Linux can be different even if the content the same).
-        verbose (bool): Flag indicating whether to print a bunch of text that might help with debug. Defaults to False.
+        test_dict (dict): The test dictionary (see `run.get_test_list`).
+        verbose (bool, optional): Whether to print the details (and timing) of every comparison. Defaults to False.
+        fail_fast (bool, optional): Whether to stop at the first mismatch, or to compare every file anyway
+                                    (full report). Defaults to True.
+        nworkers (int, optional): The number of processes comparing the files at the same time.
+                                  Defaults to None (as many as the CPUs allowed).
+        cache_dir (str, optional): The folder storing the decoded reference files (see `common/reference_cache.py`).
+                                   Defaults to None (no cache).
+        output_manifest (list, optional): The manifest of the output directory (see `get_dir_manifest`),
+                                          if already computed. Defaults to None.
+        return_report (bool, optional): Whether to return the report of every comparison too. Defaults to False.
+        memory_budget (int, optional): The memory (in bytes) a comparison can take, past which the ITK images are
+                                       compared one slab at a time (see `compare_results_itk`) and the frames
+                                       of the DICOM SEGs unpacked in chunks (see `common/dicom_seg.py`).
+                                       Defaults to None (no limit).
+        surface_metrics (bool, optional): Whether to compute (and print) the surface distances of every label of the
+                                          segmentations too (see `compute_label_metrics`). Defaults to False.
 
     Returns:
-        bool: True if the directory trees are equal, False otherwise.
+        bool: True if the content of every (supported) file matches the reference, False otherwise.
+              If `return_report` is set, a (bool, list) tuple with the report of every comparison
+              (see `compare_file_list`).
     """
 
-    # construct a new directory comparison object, to compare the directories a and b
-    # The dircmp class compares files by doing shallow comparisons
-    dirs_cmp = filecmp.dircmp(dir1, dir2)
+    output_dir = test_dict["pipeline_output"]
+    reference_dir = test_dict["pipeline_reference"]
+
+    if output_manifest is None:
+        output_manifest = get_dir_manifest(output_dir)
 
-    # left_only: list of files and subdirectories that are in dir1 but not in dir2
-    # right_only: list of files and subdirectories that are in dir2 but not in dir1
-    # funny_files: list of files that are in both directories, but could not be compared
-    # if some of these lists are not empty, the directories are definitely not equal
-    if len(dirs_cmp.left_only)>0 or len(dirs_cmp.right_only)>0 or len(dirs_cmp.funny_files)>0:
-        if verbose: 
-            print("left_only:", dirs_cmp.left_only)
-            print("right_only:", dirs_cmp.right_only)
-            print("funny_files:", dirs_cmp.funny_files)
-        return False
+    # at this stage, we should already have checked the directory trees are equal, so we can safely assume
+    # any file found in the output directory will have a counterpart in the reference directory
+    relpath_list = [relpath for relpath, entry_type, _, _ in output_manifest if entry_type == "file"]
 
-    # common_files: list of files that are common to both directories
-    # if the check above is passed, compare each file in common_files
-    # if the directories do not have files (e.g., are only nested subdirectories), this will be an empty list
-    # and this step will simply be skipped, if this is not the case
-    # filecmp.cmpfiles will compare the files in the two directories and return a tuple of lists:
-    #   - match: list of files that match
-    #   - mismatch: list of files that do not match
-    #   - errors: list of files that could not be compared (including those that don’t exist in one of the directories)
-    match, mismatch, errors =  filecmp.cmpfiles(dir1, dir2, dirs_cmp.common_files, shallow=False)
+    output_file_list = [os.path.join(output_dir, relpath) for relpath in relpath_list]
+    reference_file_list = [os.path.join(reference_dir, relpath) for relpath in relpath_list]
 
     if verbose:
-        print("match:", match)
-
-    # if some of the files in common_files do not match, the directories are not equal
-    # however, we know binary files in Linux can be different even if the content the same
-    # (which is why we are also going to check the segmentation/classifications results in other ways)
-    #   - if the check_files flag is set to False, we will ignore "mismatch" and focus on "errors" alone
-    #   - if the check_files flag is set to True, we will check both "mismatch" and "errors"
-    if check_files:
-        if len(mismatch)>0 or len(errors)>0:
-            if verbose:
-                print("mismatch:", mismatch)
-                print("errors:", errors)
-            return False
-    else:
-        if len(errors)>0:
-            if verbose:
-                print("errors:", errors)
-            return False
+        print("output_file_list:", output_file_list)
+        print("reference_file_list:", reference_file_list)
 
-    # common_dirs: list of subdirectories that are common to both directories
-    # assuming the tree is identical, this should be a list of subdirectories
-    # if there are commons directories, run the same function recursively on each of them (always in pairs)
-    for common_dir in dirs_cmp.common_dirs:
-        new_dir1 = os.path.join(dir1, common_dir)
-        new_dir2 = os.path.join(dir2, common_dir)
+    file_report_list = compare_file_list(output_file_list, reference_file_list, fail_fast=fail_fast,
+                                         nworkers=nworkers, cache_dir=cache_dir, verbose=verbose,
+                                         memory_budget=memory_budget, surface_metrics=surface_metrics)
 
-        if verbose:
-            print("new_dir1:", new_dir1)
-            print("new_dir2:", new_dir2)
+    if verbose:
+        print_file_report(file_report_list)
 
-        if not are_dir_trees_equal(new_dir1, new_dir2, verbose=verbose):
-            if verbose:
-                print("subdirectories %s and %s are not equal"%(new_dir1, new_dir2))
-            return False
+    are_files_equal = all([file_report["match"] is not False for file_report in file_report_list])
 
-    # if all of the checks above are passed, the directories are equal
-    if verbose:
-        print("Directories %s and %s are equal"%(dir1, dir2))
+    if return_report:
+        return are_files_equal, file_report_list
+
+    return are_files_equal
+
+## --------------------------------
+
+def get_file_comparator(output_file):
+
+    """
+    Returns the function comparing the content of the file (depending on the file extension), or None if unsupported.
+    """
+
+    itk_image_formats = tuple([".nii.gz", ".nii", ".nrrd", ".mha", ".mhd"])
+
+    if output_file.endswith(".seg.dcm"):
+        return compare_results_dicomseg
+    elif output_file.endswith(itk_image_formats):
+        return compare_results_itk
+    elif output_file.endswith(".json"):
+        return compare_results_json
+
+    return None
+
+## --------------------------------
+
+def compare_file_pair(output_file, reference_file, cache_dir=None, verbose=False, memory_budget=None,
+                      surface_metrics=False):
+
+    """
+    Compares an output file with its reference (runs in the worker processes, see `compare_file_list`).
+
+    Returns:
+        dict: The report of the comparison, with the paths of the files, the outcome of the comparison under "match"
+              (None if the file format is not supported, or if the comparison was cancelled), the time it took
+              (in seconds) under "time", the error raised while comparing the files (if any) under "error"
+              and the Dice coefficient (segmentations only) under "dice".
+    """
+
+    file_report = {"output_file": output_file, "reference_file": reference_file,
+                   "match": None, "time": 0.0, "error": None, "dice": None}
+
+    compare_fn = get_file_comparator(output_file)
+
+    if compare_fn is None:
+        print("File %s has an unsupported format; moving on..."%output_file)
+        return file_report
+
+    # the spans a worker process inherited from the parent process are not its own
+    if tracing.is_worker():
+        tracing.pop_spans()
+
+    start_time = time.time()
+
+    with tracing.span(os.path.basename(output_file), "compare", path = output_file) as span_args:
+        try:
+            if compare_fn is compare_results_json:
+                file_report["match"] = compare_fn(output_file, reference_file, verbose=verbose) is True
+            else:
+                metrics = dict()
+                file_report["match"] = compare_fn(output_file, reference_file, verbose=verbose, cache_dir=cache_dir,
+                                                  metrics=metrics, memory_budget=memory_budget,
+                                                  surface_metrics=surface_metrics) is True
+                file_report["dice"] = metrics.get("dice")
+        except Exception as e:
+            file_report["match"] = False
+            file_report["error"] = str(e)
+
+        span_args["match"] = file_report["match"]
+
+    file_report["time"] = time.time() - start_time
+
+    # the spans recorded in a worker process are sent back with the report (see `compare_file_list`)
+    if tracing.is_worker():
+        file_report["spans"] = tracing.pop_spans()
+
+    if file_report["match"] is False:
+        print("Files %s and %s are not equal"%(output_file, reference_file))
+
+    return file_report
+
+## --------------------------------
+
+def compare_file_list(output_file_list, reference_file_list, fail_fast=True, nworkers=None, cache_dir=None,
+                      verbose=False, memory_budget=None, surface_metrics=False):
+
+    """
+    Compares every output file with its reference, dispatching the comparisons to a pool of processes.
+
+    Decoding the images (and computing the metrics) is CPU and I/O bound and independent for every file,
+    so the files are compared at the same time - largest first, so that the slowest comparisons start early.
+    In fail-fast mode, the comparisons that have not started yet are cancelled at the first mismatch, and the
+    workers still comparing files are terminated.
+
+    Args:
+        output_file_list (list): The list of paths to the output files.
+        reference_file_list (list): The list of paths to the reference files (same order as `output_file_list`).
+        fail_fast (bool, optional): Whether to stop at the first mismatch. Defaults to True.
+        nworkers (int, optional): The number of worker processes. Defaults to None (as many as the CPUs allowed).
+        cache_dir (str, optional): The folder storing the reference cache. Defaults to None (no cache).
+        verbose (bool, optional): Whether to print the details of every comparison. Defaults to False.
+        memory_budget (int, optional): The memory (in bytes) every comparison can take (see `compare_results_file`).
+                                       Defaults to None (no limit).
+        surface_metrics (bool, optional): Whether to compute the surface distances too. Defaults to False.
+
+    Returns:
+        list: The report of every comparison (see `compare_file_pair`), in the order of `output_file_list`
+              (the comparisons cancelled in fail-fast mode have "match" set to None).
+
+    Example:
+        >>> file_report_list = compare_file_list(["/out/seg.nii.gz"], ["/ref/seg.nii.gz"])
+        >>> file_report_list[0]["match"], file_report_list[0]["time"]
+        (True, 1.52)
+    """
+
+    file_pair_list = [(output_file, reference_file) for output_file, reference_file
+                      in zip(output_file_list, reference_file_list) if get_file_comparator(output_file) is not None]
+
+    # the files with an unsupported format are not sent to the workers
+    file_report_dict = {output_file: compare_file_pair(output_file, reference_file) for output_file, reference_file
+                        in zip(output_file_list, reference_file_list) if get_file_comparator(output_file) is None}
+
+    if nworkers is None:
+        nworkers = len(resources.get_allowed_cpus())
+
+    nworkers = max(min(nworkers, len(file_pair_list)), 1)
+
+    if nworkers == 1:
+        for output_file, reference_file in file_pair_list:
+            file_report_dict[output_file] = compare_file_pair(output_file, reference_file, cache_dir=cache_dir,
+                                                              verbose=verbose, memory_budget=memory_budget,
+                                                              surface_metrics=surface_metrics)
+
+            if fail_fast and file_report_dict[output_file]["match"] is False:
+                break
+
+    else:
+        file_pair_list = sorted(file_pair_list, key=lambda file_pair: os.path.getsize(file_pair[0]), reverse=True)
+
+        executor = process_pool.get_process_pool(nworkers, sys.modules[__name__])
+        futures = list()
+
+        try:
+            futures = [executor.submit(compare_file_pair, output_file, reference_file, cache_dir, verbose,
+                                       memory_budget, surface_metrics)
+                       for output_file, reference_file in file_pair_list]
+
+            for future in concurrent.futures.as_completed(futures):
+                file_report = future.result()
+                file_report_dict[file_report["output_file"]] = file_report
+
+                tracing.add_spans(file_report.pop("spans", list()))
+
+                if fail_fast and file_report["match"] is False:
+                    break
+
+        finally:
+            # after a mismatch in fail-fast mode (or if interrupted), do not wait for the comparisons still running
+            if not all([future.done() for future in futures]):
+                process_pool.terminate_process_pool(executor)
+            else:
+                executor.shutdown(wait=True)
+
+    # the comparisons cancelled in fail-fast mode
+    for output_file, reference_file in zip(output_file_list, reference_file_list):
+        if output_file not in file_report_dict:
+            file_report_dict[output_file] = {"output_file": output_file, "reference_file": reference_file,
+                                             "match": None, "time": 0.0, "error": None, "dice": None}
+
+    return [file_report_dict[output_file] for output_file in output_file_list]
+
+## --------------------------------
+
+def print_file_report(file_report_list):
+
+    """
+    Prints the outcome and timing of every comparison returned by `compare_file_list`.
+    """
+
+    for file_report in file_report_list:
+        if file_report["match"] is None:
+            outcome = "skipped"
+        else:
+            outcome = "equal" if file_report["match"] else "NOT equal"
+
+        print("- %s: %s (%.2fs)%s"%(file_report["output_file"], outcome, file_report["time"],
+                                    "" if file_report["error"] is None else " - error: %s"%file_report["error"]))
+
+    print("Total comparison time: %.2fs"%sum([file_report["time"] for file_report in file_report_list]))
+
+## --------------------------------
+
+def compare_results_itk(output_file, reference_file, dc_thresh=0.99, verbose=False, cache_dir=None, metrics=None,
+                        memory_budget=None, surface_metrics=False):
+
+    # if provided, `metrics` is filled with the Dice coefficient (over all of the labels)
+    if metrics is None:
+        metrics = dict()
+
+    if verbose:
+        print("\nComparing ITK image files...")
+
+        print("Output file:", output_file)
+        print("Reference file:", reference_file)
+
+    # the images too large to be compared within the memory budget are compared one slab at a time
+    if memory_budget is not None:
+        output_header = label_streams.read_header(output_file)
+        reference_header = label_streams.read_header(reference_file)
+
+        if output_header is not None and reference_header is not None and \
+           max(label_streams.get_decoded_size(output_header),
+               label_streams.get_decoded_size(reference_header)) > memory_budget:
+            if surface_metrics:
+                print("NOTE: the surface distances are not computed for images compared one slab at a time")
+
+            return compare_results_itk_streaming(output_file, reference_file, output_header, reference_header,
+                                                 memory_budget, dc_thresh=dc_thresh, verbose=verbose, metrics=metrics)
+
+    with tracing.span("decode", "compare", path = output_file):
+        output_data, reference_data = read_label_files(output_file, reference_file, read_itk_labels,
+                                                       cache_dir=cache_dir)
+
+    if output_data is None:
+        print(">>> The ITK image files are equal (same voxel data)")
+        metrics["dice"] = 1.0
+        return True
+
+    if output_data["array"].shape != reference_data["array"].shape:
+        print(">>> The ITK image files have a different size (%s/%s)"%(output_data["array"].shape[::-1],
+                                                                     reference_data["array"].shape[::-1]))
+        return False
+
+    with tracing.span("metrics", "compare", path = output_file):
+        report = compute_label_metrics(output_data["array"], reference_data["array"],
+                                       spacing = output_data["spacing"], surface_metrics = surface_metrics)
+    dc = report["dice"]
+    metrics["dice"] = dc
+
+    if verbose or surface_metrics:
+        print_label_metrics(report)
+    
+    # FIXME: we can bend this rule as much as we want
+    if dc > dc_thresh:
+        print(">>> The ITK image files are equal (DC/DC threshold: %g/%g)"%(dc, dc_thresh))
+        return True
+    else:
+        print(">>> The ITK image files are NOT equal (DC/DC threshold: %g/%g)"%(dc, dc_thresh))
+        return False
+
+## --------------------------------
+
+def compare_results_itk_streaming(output_file, reference_file, output_header, reference_header, memory_budget,
+                                  dc_thresh=0.99, verbose=False, metrics=None):
+
+    """
+    Compares two ITK images one slab (along z) at a time, so that the comparison takes at most `memory_budget` bytes.
+
+    The voxel data is read straight from the files (memory mapped if uncompressed, decompressed one slab at a time
+    otherwise, see `common/label_streams.py`) and the confusion matrix of the images is accumulated slab by slab,
+    so neither image is ever held in memory as a whole. The reference cache is not used for these images.
+
+    Args:
+        output_file (str): The path to the output file.
+        reference_file (str): The path to the reference file.
+        output_header (dict): The header of the output file (see `label_streams.read_header`).
+        reference_header (dict): The header of the reference file.
+        memory_budget (int): The memory (in bytes) the comparison can take.
+        dc_thresh (float, optional): The Dice coefficient past which the images are equal. Defaults to 0.99.
+        verbose (bool, optional): Whether to print the metrics of every label. Defaults to False.
+        metrics (dict, optional): If provided, filled with the Dice coefficient (over all of the labels).
+
+    Returns:
+        bool: True if the images are equal (Dice coefficient above `dc_thresh`), False otherwise.
+    """
+
+    if metrics is None:
+        metrics = dict()
+
+    if output_header["shape"] != reference_header["shape"]:
+        print(">>> The ITK image files have a different size (%s/%s)"%(output_header["shape"][::-1],
+                                                                     reference_header["shape"][::-1]))
+        return False
+
+    if reference_cache.get_file_hash(output_file) == reference_cache.get_file_hash(reference_file):
+        print(">>> The ITK image files are equal (same content)")
+        metrics["dice"] = 1.0
+        return True
+
+    if verbose:
+        print("Comparing %d slices at a time (memory budget: %d MB)"%(
+              label_streams.get_slice_count(output_header, memory_budget), memory_budget // 1024**2))
+
+    with tracing.span("metrics", "compare", path = output_file, streaming = True):
+        labels, confusion = label_streams.get_confusion_matrix(output_header, reference_header, memory_budget,
+                                                               get_confusion_matrix)
+        report = get_confusion_metrics(labels, confusion, spacing = output_header["spacing"])
+
+    dc = report["dice"]
+    metrics["dice"] = dc
+
+    if verbose:
+        print_label_metrics(report)
+
+    if dc > dc_thresh:
+        print(">>> The ITK image files are equal (DC/DC threshold: %g/%g)"%(dc, dc_thresh))
+        return True
+    else:
+        print(">>> The ITK image files are NOT equal (DC/DC threshold: %g/%g)"%(dc, dc_thresh))
+        return False
+
+## --------------------------------
+
+def read_itk_labels(path_to_file):
+
+    """
+    Reads an ITK image, returning its voxel data under "array" (indexed as z, y, x) and its spacing under "spacing"
+    (in the same order as the axes of the array).
+    """
+
+    import numpy as np
+    import SimpleITK as sitk
+
+    itk_image = sitk.ReadImage(path_to_file)
+
+    return {"array": sitk.GetArrayFromImage(itk_image), "spacing": np.array(itk_image.GetSpacing()[::-1])}
+
+## --------------------------------
+
+def read_label_files(output_file, reference_file, read_fn, cache_dir=None):
+
+    """
+    Reads an output file and its reference, the latter from the reference cache if `cache_dir` is provided.
+
+    With the cache, the output is not decoded at all if the content of the files is the same, and its voxel data
+    is compared with the (cached) content hash of the voxel data of the reference before computing any metric.
+
+    Args:
+        output_file (str): The path to the output file.
+        reference_file (str): The path to the reference file.
+        read_fn (callable): The function decoding the files (e.g., `read_itk_labels`).
+        cache_dir (str, optional): The folder storing the reference cache. Defaults to None (no cache).
+
+    Returns:
+        tuple: The (output_data, reference_data) tuple of decoded files (as returned by `read_fn`),
+               where `output_data` is None if the voxel data of the files is the same.
+    """
+
+    if cache_dir is None:
+        return read_fn(output_file), read_fn(reference_file)
+
+    reference_data = reference_cache.load_reference(reference_file, read_fn, cache_dir=cache_dir)
+
+    if reference_cache.get_file_hash(output_file) == reference_data["file_hash"]:
+        return None, reference_data
+
+    output_data = read_fn(output_file)
+
+    if output_data.get("array") is not None and \
+       reference_cache.get_array_hash(output_data["array"]) == reference_data["array_hash"]:
+        return None, reference_data
+
+    return output_data, reference_data
+
+## --------------------------------
+
+def compute_overlap(itksegimage1, itksegimage2):
+
+    """
+    Returns the Dice coefficient between two label images (over all of the labels, background excluded).
+    """
+
+    import SimpleITK as sitk
+
+    report = compute_label_metrics(sitk.GetArrayViewFromImage(itksegimage1),
+                                   sitk.GetArrayViewFromImage(itksegimage2))
+
+    return report["dice"]
+
+## --------------------------------
+
+def get_confusion_matrix(array1, array2, chunk_size=label_streams.confusion_chunk_size):
+
+    """
+    Returns the confusion matrix between two label arrays, computed in a single pass over the arrays.
+
+    The matrix is accumulated `chunk_size` voxels at a time, with the index of every pair of labels stored in the
+    smallest integer type holding them: beyond the arrays themselves, the memory needed does not grow with their size.
+
+    Args:
+        array1 (np.ndarray): The first label array.
+        array2 (np.ndarray): The second label array (same shape as `array1`).
+        chunk_size (int, optional): The number of voxels accumulated at a time. Defaults to
+                                    label_streams.confusion_chunk_size.
+
+    Returns:
+        tuple: A (labels, confusion) tuple, where `labels` is the array of the label values found in either array
+               and `confusion[i, j]` is the number of voxels labelled `labels[i]` in `array1` and `labels[j]` in `array2`.
+
+    Raises:
+        ValueError: If one of the arrays stores non-integer (floating point) values.
+    """
+
+    import numpy as np
+
+    array1 = np.asarray(array1).ravel()
+    array2 = np.asarray(array2).ravel()
+
+    chunks = [slice(start, start + chunk_size) for start in range(0, array1.size, chunk_size)]
+
+    # label maps stored as floating point values are only accepted if their values are integers
+    # (casting them to indices would truncate the values, silently merging labels)
+    for array in [array1, array2]:
+        if np.issubdtype(array.dtype, np.floating):
+            for chunk in chunks:
+                if not np.array_equal(array[chunk], np.round(array[chunk])):
+                    raise ValueError("The label arrays store non-integer values (e.g., a probability map)")
+
+    min_label = min(array1.min(), array2.min()) if array1.size > 0 else 0
+    max_label = max(array1.max(), array2.max()) if array1.size > 0 else 0
+
+    # small non-negative labels (the usual case) can be used as indices directly,
+    # otherwise the labels are mapped to consecutive indices first
+    if min_label >= 0 and max_label < 1024:
+        labels = np.arange(int(max_label) + 1)
+        get_index = lambda values: values
+    else:
+        labels = np.unique(np.concatenate([np.unique(array[chunk]) for array in [array1, array2] for chunk in chunks]))
+        get_index = lambda values: np.searchsorted(labels, values)
+
+    nlabels = len(labels)
+    index_dtype = np.min_scalar_type(max(nlabels*nlabels - 1, 0))
+
+    confusion = np.zeros(nlabels*nlabels, dtype=np.int64)
+
+    for chunk in chunks:
+        index = get_index(array1[chunk]).astype(index_dtype)
+        index *= index_dtype.type(nlabels)
+        index += get_index(array2[chunk]).astype(index_dtype)
+
+        confusion += np.bincount(index, minlength=nlabels*nlabels)
+
+    confusion = confusion.reshape(nlabels, nlabels)
+
+    # only keep the labels found in (at least) one of the arrays
+    found = (confusion.sum(axis=0) + confusion.sum(axis=1)) > 0
+
+    return labels[found], confusion[found][:, found]
+
+## --------------------------------
+
+def get_surface(mask):
+
+    """
+    Returns the voxels of a binary mask that have at least one (face-connected) neighbour outside of the mask.
+    """
+
+    import numpy as np
+
+    # the padding makes sure the voxels on the border of the array are part of the surface
+    padded = np.pad(mask, 1, mode="constant", constant_values=False)
+    eroded = padded.copy()
+
+    for axis in range(mask.ndim):
+        eroded &= np.roll(padded, 1, axis=axis) & np.roll(padded, -1, axis=axis)
+
+    crop = tuple([slice(1, -1)]*mask.ndim)
+
+    return mask & ~eroded[crop]
+
+## --------------------------------
+
+def compute_surface_distances(mask1, mask2, spacing):
+
+    """
+    Returns the Hausdorff distance, the 95th percentile Hausdorff distance and the average symmetric surface distance
+    between two binary masks (in the units of `spacing`), or NaNs if one of the masks is empty.
+    """
+
+    import numpy as np
+    import SimpleITK as sitk
+
+    if not mask1.any() or not mask2.any():
+        return float("nan"), float("nan"), float("nan")
+
+    surface1 = get_surface(mask1)
+    surface2 = get_surface(mask2)
+
+    # distance from every voxel to the surface of each mask
+    distances = list()
+    for mask, surface in [(mask2, surface1), (mask1, surface2)]:
+        mask_image = sitk.GetImageFromArray(mask.astype(np.uint8))
+        mask_image.SetSpacing([float(v) for v in spacing[::-1]])
+
+        distance_map = sitk.SignedMaurerDistanceMap(mask_image, insideIsPositive=False,
+                                                    squaredDistance=False, useImageSpacing=True)
+        distances.append(np.abs(sitk.GetArrayViewFromImage(distance_map)[surface]))
+
+    distances = np.concatenate(distances)
+
+    return float(distances.max()), float(np.percentile(distances, 95)), float(distances.mean())
+
+## --------------------------------
+
+def compute_label_metrics(array1, array2, spacing=None, surface_metrics=False, background=0):
+
+    """
+    Computes the overlap metrics between two label arrays, for all of the labels at once.
+
+    The Dice coefficient and the volume of every label are computed from the confusion matrix of the two arrays,
+    which is accumulated in a single pass over the arrays (see `get_confusion_matrix`). Surface metrics are optional,
+    and computed for each label within the bounding box of the label only.
+
+    Args:
+        array1 (np.ndarray): The first label array (e.g., the output of the pipeline).
+        array2 (np.ndarray): The second label array (e.g., the reference), same shape as `array1`.
+        spacing (tuple, optional): The spacing of the voxels, in the same order as the axes of the arrays.
+                                   Defaults to None (unit spacing).
+        surface_metrics (bool, optional): Whether to compute the surface distances. Defaults to False.
+        background (int, optional): The label of the background, excluded from the metrics. Defaults to 0.
+
+    Returns:
+        dict: A report with:
+              - "dice": the Dice coefficient over all of the labels (as `sitk.LabelOverlapMeasuresImageFilter`);
+              - "labels": a dictionary mapping every label found in either array to its metrics ("dice",
+                "voxels1", "voxels2", "volume1", "volume2", "volume_difference", and "hausdorff", "hausdorff95"
+                and "mean_surface_distance" if `surface_metrics` is set).
+
+    Example:
+        >>> report = compute_label_metrics(output_array, reference_array, spacing=(3.0, 0.8, 0.8))
+        >>> report["dice"]
+        0.9934
+        >>> report["labels"][1]["dice"]
+        0.9971
+    """
+
+    import numpy as np
+
+    array1 = np.asarray(array1)
+    array2 = np.asarray(array2)
+
+    if array1.shape != array2.shape:
+        raise ValueError("The label arrays have a different shape (%s/%s)"%(array1.shape, array2.shape))
+
+    if spacing is None:
+        spacing = (1.0,)*array1.ndim
+
+    labels, confusion = get_confusion_matrix(array1, array2)
+
+    report = get_confusion_metrics(labels, confusion, spacing=spacing, background=background)
+
+    if surface_metrics:
+        bounding_boxes = get_bounding_boxes(array1, array2, labels)
+
+        for label in report["labels"]:
+            bounding_box = bounding_boxes[label]
+            mask1 = array1[bounding_box] == label
+            mask2 = array2[bounding_box] == label
+
+            hausdorff, hausdorff95, mean_distance = compute_surface_distances(mask1, mask2, spacing)
+
+            report["labels"][label]["hausdorff"] = hausdorff
+            report["labels"][label]["hausdorff95"] = hausdorff95
+            report["labels"][label]["mean_surface_distance"] = mean_distance
+
+    return report
+
+## --------------------------------
+
+def get_confusion_metrics(labels, confusion, spacing, background=0):
+
+    """
+    Returns the Dice coefficient and the volume of every label from the confusion matrix of two label arrays
+    (see `get_confusion_matrix`), as reported by `compute_label_metrics` (without the surface metrics).
+    """
+
+    import numpy as np
+
+    voxel_volume = float(np.prod(spacing))
+
+    intersection = np.diag(confusion)
+    voxels1 = confusion.sum(axis=1)
+    voxels2 = confusion.sum(axis=0)
+
+    foreground = labels != background
+
+    # Dice over all of the labels (1 if both arrays are background only)
+    total = voxels1[foreground].sum() + voxels2[foreground].sum()
+    dice = 2.0*intersection[foreground].sum()/total if total > 0 else 1.0
+
+    report = {"dice": float(dice), "labels": dict()}
+
+    for idx in np.flatnonzero(foreground):
+        label = labels[idx].item()
+
+        report["labels"][label] = {
+            "dice": float(2.0*intersection[idx]/(voxels1[idx] + voxels2[idx])),
+            "voxels1": int(voxels1[idx]),
+            "voxels2": int(voxels2[idx]),
+            "volume1": float(voxels1[idx]*voxel_volume),
+            "volume2": float(voxels2[idx]*voxel_volume),
+            "volume_difference": float((int(voxels1[idx]) - int(voxels2[idx]))*voxel_volume),
+        }
+
+    return report
+
+## --------------------------------
+
+def get_bounding_boxes(array1, array2, labels):
+
+    """
+    Returns the bounding box of every label (over both arrays, padded by one voxel), with a single pass per axis.
+
+    Args:
+        array1 (np.ndarray): The first label array.
+        array2 (np.ndarray): The second label array (same shape as `array1`).
+        labels (np.ndarray): The sorted array of every label found in either array (see `get_confusion_matrix`).
+
+    Returns:
+        dict: A dictionary mapping every label to its bounding box (a tuple of slices, to index the arrays with).
+    """
+
+    import numpy as np
+
+    nlabels = len(labels)
+    index1 = np.searchsorted(labels, array1)
+    index2 = np.searchsorted(labels, array2)
+
+    bounding_boxes = {label.item(): list() for label in labels}
+
+    for axis in range(array1.ndim):
+        size = array1.shape[axis]
+        coordinates = np.arange(size).reshape([-1 if a == axis else 1 for a in range(array1.ndim)])
+
+        # how many voxels of each label are found at each coordinate along the axis
+        counts = np.bincount((coordinates*nlabels + index1).ravel(), minlength=size*nlabels)
+        counts += np.bincount((coordinates*nlabels + index2).ravel(), minlength=size*nlabels)
+        present = counts.reshape(size, nlabels) > 0
+
+        for idx, label in enumerate(labels):
+            found = np.flatnonzero(present[:, idx])
+            bounding_boxes[label.item()].append(slice(max(int(found[0]) - 1, 0), int(found[-1]) + 2))
+
+    return {label: tuple(slices) for label, slices in bounding_boxes.items()}
+
+## --------------------------------
+
+def print_label_metrics(report):
+
+    """
+    Prints the per-label metrics of a report returned by `compute_label_metrics` (worst Dice first), including
+    the surface distances if they were computed.
+    """
+
+    surface_metrics = any(["hausdorff" in metrics for metrics in report["labels"].values()])
+
+    if surface_metrics:
+        print("Label | Dice | Voxels (output/reference) | Hausdorff | Hausdorff 95 | Mean surface distance")
+    else:
+        print("Label | Dice | Voxels (output/reference)")
+
+    for label, metrics in sorted(report["labels"].items(), key=lambda item: item[1]["dice"]):
+        line = "%5s | %.4f | %g/%g"%(label, metrics["dice"], metrics["voxels1"], metrics["voxels2"])
+
+        if surface_metrics:
+            line += " | %.3f | %.3f | %.3f"%(metrics.get("hausdorff", float("nan")),
+                                             metrics.get("hausdorff95", float("nan")),
+                                             metrics.get("mean_surface_distance", float("nan")))
+
+        print(line)
+
+## --------------------------------
+
+def compare_results_dicomseg(output_file, reference_file, dc_thresh=0.99, verbose=False, cache_dir=None,
+                             metrics=None, memory_budget=None, surface_metrics=False):
+
+    # if provided, `metrics` is filled with the Dice coefficient (over all of the segments)
+    if metrics is None:
+        metrics = dict()
+
+    if verbose:
+        print("\nComparing DICOM SEG files...")
+
+        print("Output file:", output_file)
+        print("Reference file:", reference_file)
+
+    with tracing.span("decode", "compare", path = output_file):
+        read_fn = functools.partial(read_dicomseg_labels, memory_budget=memory_budget)
+        output_data, reference_data = read_label_files(output_file, reference_file, read_fn, cache_dir=cache_dir)
+
+    if output_data is None:
+        print(">>> The DICOM SEG files are equal (same voxel data)")
+        metrics["dice"] = 1.0
+        return True
+
+    if len(output_data["segments"]) != len(reference_data["segments"]):
+        print(">>> The DICOM SEG files store a different number of segments")
+        return False
+
+    with tracing.span("metrics", "compare", path = output_file):
+        report = compute_segment_metrics(output_data, reference_data, surface_metrics = surface_metrics)
+    metrics["dice"] = report["dice"]
+
+    if verbose or surface_metrics:
+        print_label_metrics(report)
+
+    # FIXME: how do we aggregate the DCs for each segment?
+    for segment_number, segment_metrics in report["labels"].items():
+        if segment_metrics["dice"] < dc_thresh:
+            print(">>> DICOM SEG segments #%g are not equal (DC/DC threshold: %g/%g)"%(segment_number,
+                                                                                     segment_metrics["dice"], dc_thresh))
+            return False
+
+    print(">>> The DICOM SEG files are equal (DC threshold: %g)"%dc_thresh)
+    return True
+
+## --------------------------------
+
+def read_dicomseg_labels(path_to_file, memory_budget=None):
+
+    """
+    Reads a DICOM SEG, returning the segment numbers under "segments" and the voxel data of the segments, either
+    merged in a single label array under "array" or, if some of the segments overlap, stacked in an array of binary
+    masks (one per segment) under "masks" (see `common/dicom_seg.py`).
+
+    If `memory_budget` is provided, the pixel data is memory mapped and its frames unpacked in chunks fitting in it.
+    """
+
+    return dicom_seg.read_labels(path_to_file, memory_budget=memory_budget)
+
+## --------------------------------
+
+def get_segment_mask(seg_data, segment_number):
+
+    """
+    Returns the binary mask of a segment, given a DICOM SEG decoded with `read_dicomseg_labels`.
+    """
+
+    if seg_data.get("array") is not None:
+        return seg_data["array"] == segment_number
+
+    return seg_data["masks"][list(seg_data["segments"]).index(segment_number)]
+
+## --------------------------------
+
+def compute_segment_metrics(output_data, reference_data, surface_metrics=False):
+
+    """
+    Computes the overlap metrics between the segments of two DICOM SEGs (decoded with `read_dicomseg_labels`).
+
+    Non-overlapping segments (the usual case) are merged in a label array, and the metrics for all of the segments
+    are computed at once (see `compute_label_metrics`); otherwise, the segments are compared one by one.
+    The surface distances (if `surface_metrics` is set) use the spacing of the output DICOM SEG.
+
+    Returns:
+        dict: A report with the same structure as the one returned by `compute_label_metrics` (labels are the
+              segment numbers, and segments that are empty in both DICOM SEGs have a Dice of 1).
+    """
+
+    output_array = output_data.get("array")
+    reference_array = reference_data.get("array")
+    segments = [int(segment_number) for segment_number in output_data["segments"]]
+    spacing = output_data.get("spacing")
+
+    if output_array is not None and reference_array is not None and output_array.shape == reference_array.shape:
+        report = compute_label_metrics(output_array, reference_array, spacing=spacing,
+                                       surface_metrics=surface_metrics)
+
+    else:
+        report = {"dice": None, "labels": dict()}
+        intersection, total = 0, 0
+
+        for segment_number in segments:
+            segment_report = compute_label_metrics(get_segment_mask(output_data, segment_number),
+                                                   get_segment_mask(reference_data, segment_number),
+                                                   spacing=spacing, surface_metrics=surface_metrics)
+
+            if 1 in segment_report["labels"]:
+                metrics = segment_report["labels"][1]
+                report["labels"][segment_number] = metrics
+                intersection += metrics["dice"]*(metrics["voxels1"] + metrics["voxels2"])/2.0
+                total += metrics["voxels1"] + metrics["voxels2"]
+
+        report["dice"] = 2.0*intersection/total if total > 0 else 1.0
+
+    # segments missing from both files are identical
+    for segment_number in segments:
+        if segment_number not in report["labels"]:
+            report["labels"][segment_number] = {"dice": 1.0, "voxels1": 0, "voxels2": 0,
+                                                "volume1": 0.0, "volume2": 0.0, "volume_difference": 0.0}
+
+    return report
+
+## --------------------------------
+
+def compare_results_json(output_file, reference_file, verbose=False):
+
+    if verbose:
+        print("\nComparing JSON files...")
+
+        print("Output file:", output_file)
+        print("Reference file:", reference_file)
+
+    # load the json files
+    with open(output_file, "r") as f:
+        json1 = json.load(f)
+
+    with open(reference_file, "r") as f:
+        json2 = json.load(f)
+
+    # NOTE: this compares every (key;value) pair in the json files and should not raise any errors
+    # provided nothing strange is in the json (i.e., everything needs to be comparable with "==")
+    # therefore, it should be good for now, but we might want to change it in the future
+    if json1 == json2:
+        print(">>> The JSON files are equal")
+        return True
+    else:
+        print(">>> The JSON files are NOT equal")
+        return False
+
+## --------------------------------
+
+def compare_results_dir(test_dict, verbose=False, check_files=False, output_manifest=None):
+
+    output_dir = test_dict["pipeline_output"]
+    reference_dir = test_dict["pipeline_reference"]
+
+    print("\nOutput directory:", output_dir)
+    print("Reference directory:", reference_dir)
+    
+    print("Comparing the results with the reference...")
+
+    # check that the directories exist (they should, since they were created by the docker container)
+    assert os.path.exists(output_dir), "Output directory %s does not exist"%output_dir
+    assert os.path.exists(reference_dir), "Reference directory %s does not exist"%reference_dir
+
+    if output_manifest is None:
+        output_manifest = get_dir_manifest(output_dir, hash_files=check_files)
+
+    reference_manifest = load_dir_manifest(reference_dir, hash_files=check_files)
+
+    # check that the directories trees are equal
+    diff_dict = diff_manifests(output_manifest, reference_manifest, check_files=check_files)
+    same_tree = all([len(entry_list) == 0 for entry_list in diff_dict.values()])
+
+    if verbose and not same_tree:
+        print("output only:", diff_dict["left_only"])
+        print("reference only:", diff_dict["right_only"])
+        print("mismatch:", diff_dict["mismatch"])
+
+    print("... Done.")
+
+    return same_tree
+
+## --------------------------------
+
+# the name of the (optional) precomputed manifest stored in the reference directories
+manifest_file_name = ".mhub_manifest.json"
+
+def get_dir_manifest(path_to_dir, hash_files=False):
+
+    """
+    Returns the manifest of a directory tree, built with a single pass (one `os.scandir` per directory).
+
+    Args:
+        path_to_dir (str): The path to the directory.
+        hash_files (bool, optional): Whether to store the SHA256 digest of the content of every file. Defaults to False.
+
+    Returns:
+        list: The (relpath, type, size, hash) tuples of every entry in the tree, sorted by relative path.
+              The type is one of "dir", "file" and "other"; the size is 0 and the hash None for anything but files
+              (the hash is also None if `hash_files` is not set).
+
+    Example:
+        >>> get_dir_manifest("/path/to/output_data")
+        [('seg', 'dir', 0, None), ('seg/lungs.nii.gz', 'file', 52311, None), ('report.json', 'file', 733, None)]
+    """
+
+    manifest = list()
+    to_visit = [""]
+
+    while len(to_visit) > 0:
+        relpath = to_visit.pop()
+
+        with os.scandir(os.path.join(path_to_dir, relpath)) as it:
+            for entry in it:
+                entry_relpath = os.path.join(relpath, entry.name)
+
+                if entry.is_dir():
+                    manifest.append((entry_relpath, "dir", 0, None))
+                    to_visit.append(entry_relpath)
+
+                elif entry.is_file():
+                    # the manifests stored in the tree (at any depth) are not part of the data
+                    if entry.name == manifest_file_name:
+                        continue
+
+                    file_hash = reference_cache.get_file_hash(entry.path) if hash_files else None
+                    manifest.append((entry_relpath, "file", entry.stat().st_size, file_hash))
+
+                else:
+                    manifest.append((entry_relpath, "other", 0, None))
+
+    return sorted(manifest)
+
+## --------------------------------
+
+def get_dir_mtimes(path_to_dir, manifest):
+
+    """
+    Returns the modification time (in ns) of the directory and of every subdirectory found in its manifest,
+    or None if one of them is gone. An entry added to, removed from or renamed in a directory changes its mtime.
+    """
+
+    dir_mtimes = dict()
+
+    for relpath in [""] + [entry[0] for entry in manifest if entry[1] == "dir"]:
+        try:
+            dir_mtimes[relpath] = os.stat(os.path.join(path_to_dir, relpath)).st_mtime_ns
+        except OSError:
+            return None
+
+    return dir_mtimes
+
+## --------------------------------
+
+def load_dir_manifest(path_to_dir, hash_files=False):
+
+    """
+    Returns the manifest of a directory tree (see `get_dir_manifest`), using the precomputed manifest stored in the
+    directory if any (see `write_dir_manifest`) - unless the file hashes are needed and the manifest has none, or the
+    tree changed since the manifest was written (i.e., the mtime of one of its directories changed).
+    """
+
+    path_to_manifest = os.path.join(path_to_dir, manifest_file_name)
+
+    if os.path.isfile(path_to_manifest):
+        with open(path_to_manifest, "r") as f:
+            manifest_dict = json.load(f)
+
+        # the manifests written before the mtimes were stored cannot be checked, and are ignored
+        if isinstance(manifest_dict, dict):
+            manifest = [tuple(entry) for entry in manifest_dict["entries"]]
+
+            if get_dir_mtimes(path_to_dir, manifest) != manifest_dict["dir_mtimes"]:
+                print("The manifest of %s is out of date; walking the directory tree..."%path_to_dir)
+
+            elif not hash_files or all([entry[3] is not None for entry in manifest if entry[1] == "file"]):
+                return manifest
+
+    return get_dir_manifest(path_to_dir, hash_files=hash_files)
+
+## --------------------------------
+
+def write_dir_manifest(path_to_dir, hash_files=True):
+
+    """
+    Precomputes the manifest of a directory tree (e.g., of the reference data) and stores it in the directory.
+
+    The manifest is stored along with the mtime of every directory of the tree: `load_dir_manifest` walks the tree
+    again if one of them changed (the content of a file rewritten in place is not checked, though).
+    """
+
+    path_to_manifest = os.path.join(path_to_dir, manifest_file_name)
+
+    # the manifest file is created first, as adding it to the directory changes the mtime of the directory
+    with open(path_to_manifest, "a"):
+        pass
+
+    manifest = get_dir_manifest(path_to_dir, hash_files=hash_files)
+    dir_mtimes = get_dir_mtimes(path_to_dir, manifest)
+
+    with open(path_to_manifest, "w") as f:
+        json.dump({"dir_mtimes": dir_mtimes, "entries": manifest}, f, indent=1)
+
+    return manifest
+
+## --------------------------------
+
+def diff_manifests(manifest1, manifest2, check_files=False):
+
+    """
+    Compares two manifests (see `get_dir_manifest`) by merging them in a single pass.
+
+    Args:
+        manifest1 (list): The first manifest.
+        manifest2 (list): The second manifest.
+        check_files (bool): Flag indicating whether to compare the size (and hash, if found in both manifests) of the
+                            files too, or just the directory trees. Defaults to False (as binary files in Linux
+                            can be different even if the content the same).
+
+    Returns:
+        dict: The relative paths of the entries found in `manifest1` only (under "left_only"), in `manifest2` only
+              (under "right_only"), and in both but with a different type (or content, see `check_files`)
+              (under "mismatch").
+    """
+
+    diff_dict = {"left_only": list(), "right_only": list(), "mismatch": list()}
+
+    idx1, idx2 = 0, 0
+
+    while idx1 < len(manifest1) and idx2 < len(manifest2):
+        relpath1, type1, size1, hash1 = manifest1[idx1]
+        relpath2, type2, size2, hash2 = manifest2[idx2]
+
+        if relpath1 < relpath2:
+            diff_dict["left_only"].append(relpath1)
+            idx1 += 1
+
+        elif relpath1 > relpath2:
+            diff_dict["right_only"].append(relpath2)
+            idx2 += 1
+
+        else:
+            if type1 != type2:
+                diff_dict["mismatch"].append(relpath1)
+            elif check_files and type1 == "file":
+                if size1 != size2 or (hash1 is not None and hash2 is not None and hash1 != hash2):
+                    diff_dict["mismatch"].append(relpath1)
+
+            idx1 += 1
+            idx2 += 1
+
+    diff_dict["left_only"] += [entry[0] for entry in manifest1[idx1:]]
+    diff_dict["right_only"] += [entry[0] for entry in manifest2[idx2:]]
+
+    return diff_dict
+
+## --------------------------------
+    
+def are_dir_trees_equal(dir1, dir2, check_files=False, verbose=False):
+
+    """
+    Compare two directory trees.
+
+    Args:
+        dir1 (str): Path to the first directory.
+        dir2 (str): Path to the second directory.
+        check_files (bool): Flag indicating whether to check the files in the directories or just the directoy trees.
+                            Defaults to False (as binary files in Linux can be different even if the content the same).
+        verbose (bool): Flag indicating whether to print a bunch of text that might help with debug. Defaults to False.
+
+    Returns:
+        bool: True if the directory trees are equal, False otherwise.
+    """
+
+    diff_dict = diff_manifests(get_dir_manifest(dir1, hash_files=check_files),
+                               load_dir_manifest(dir2, hash_files=check_files),
+                               check_files=check_files)
+
+    if verbose:
+        print("left_only:", diff_dict["left_only"])
+        print("right_only:", diff_dict["right_only"])
+        print("mismatch:", diff_dict["mismatch"])
+
+    return all([len(entry_list) == 0 for entry_list in diff_dict.values()])
+
+## --------------------------------
+
+# changed whenever the way the results are compared changes, so that the tests passed before are run again
+memo_version = 1
+
+def get_dir_fingerprint(path_to_dir):
+
+    """
+    Returns a fingerprint of a directory tree: the hash of the relative path, type, size and modification time of
+    every entry (so that the content of the files does not need to be read). None if the directory is not found.
+    """
+
+    if not os.path.isdir(path_to_dir):
+        return None
+
+    sha = hashlib.sha256()
+    to_visit = [""]
+    entry_list = list()
+
+    while len(to_visit) > 0:
+        relpath = to_visit.pop()
+
+        with os.scandir(os.path.join(path_to_dir, relpath)) as it:
+            for entry in it:
+                entry_relpath = os.path.join(relpath, entry.name)
+                stat = entry.stat()
+
+                if entry.is_dir():
+                    entry_list.append((entry_relpath, "dir", 0, 0))
+                    to_visit.append(entry_relpath)
+                else:
+                    entry_list.append((entry_relpath, "file", stat.st_size, stat.st_mtime_ns))
+
+    for entry in sorted(entry_list):
+        sha.update(("%s|%s|%d|%d\n"%entry).encode("utf-8"))
+
+    return sha.hexdigest()
+
+## --------------------------------
+
+def get_memo_key(test_dict, use_api=False):
+
+    """
+    Returns the key a test is memoized under (see `common/results_store.get_memo`).
+
+    The key is the hash of the ID of the image tested, of the workflow (name, config and data sample), and of the
+    fingerprints (see `get_dir_fingerprint`) of the input data and of the reference data of the test. A test
+    with the same key as a test that passed is expected to pass.
+
+    Args:
+        test_dict (dict): The test dictionary.
+        use_api (bool, optional): Whether to use the Docker Engine API to inspect the image. Defaults to False.
+
+    Returns:
+        str: The key (a hex digest), or None if the image or the data are not found.
+    """
+
+    docker_args = test_dict["docker_args"]
+
+    image_id = docker_api.get_image_id(test_dict["image_to_test"], use_api=use_api)
+    input_fingerprint = get_dir_fingerprint(os.path.join(docker_args["input_base_dir"], test_dict["data_sample"],
+                                                         test_dict["workflow_name"]))
+    reference_fingerprint = get_dir_fingerprint(test_dict["pipeline_reference"])
+
+    if image_id is None or input_fingerprint is None or reference_fingerprint is None:
+        return None
+
+    key_dict = {"version": memo_version,
+                "image_id": image_id,
+                "workflow": test_dict["workflow_name"],
+                "config": test_dict["config"],
+                "data_sample": test_dict["data_sample"],
+                "input": input_fingerprint,
+                "reference": reference_fingerprint}
 
-    return True
\ No newline at end of file
+    return hashlib.sha256(json.dumps(key_dict, sort_keys=True).encode("utf-8")).hexdigest()
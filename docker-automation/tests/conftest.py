@@ -0,0 +1,98 @@
+"""
+-------------------------------------------------
+MHub - shared fixtures of the tests of the build, test and push automation
+-------------------------------------------------
+"""
+
+import os
+import sys
+import time
+import shutil
+import subprocess
+import urllib.request
+import importlib.util
+
+import pytest
+
+# the modules shared by the stages (`from common import ...`)
+base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if base_dir not in sys.path:
+    sys.path.insert(0, base_dir)
+
+## --------------------------------
+
+def load_stage_utils(stage):
+
+    """
+    Imports the `utils.py` of a stage (build, test, push or pipeline) under the name `<stage>_utils`,
+    as every stage has its own module named `utils`.
+    """
+
+    module_name = "%s_utils"%stage
+
+    if module_name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(module_name, os.path.join(base_dir, stage, "utils.py"))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[module_name] = module
+        spec.loader.exec_module(module)
+
+    return sys.modules[module_name]
+
+## --------------------------------
+
+@pytest.fixture
+def git_env(monkeypatch, tmp_path):
+
+    """
+    Runs git with a throwaway identity and configuration (commits made by the tests need an author).
+    """
+
+    monkeypatch.setenv("GIT_AUTHOR_NAME", "test")
+    monkeypatch.setenv("GIT_AUTHOR_EMAIL", "test@example.com")
+    monkeypatch.setenv("GIT_COMMITTER_NAME", "test")
+    monkeypatch.setenv("GIT_COMMITTER_EMAIL", "test@example.com")
+    monkeypatch.setenv("GIT_CONFIG_GLOBAL", str(tmp_path / "gitconfig"))
+    monkeypatch.setenv("GIT_CONFIG_NOSYSTEM", "1")
+
+## --------------------------------
+
+def docker(*docker_args, **kwargs):
+    return subprocess.run(["docker"] + list(docker_args), check=True, text=True,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs).stdout.strip()
+
+def is_docker_available():
+
+    if shutil.which("docker") is None:
+        return False
+
+    return subprocess.run(["docker", "info"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+
+requires_docker = pytest.mark.skipif(not is_docker_available(), reason="Docker is not available")
+
+@pytest.fixture
+def local_registry():
+
+    """
+    Runs a local registry (`registry:2`, on a free port) for the duration of the test, and returns its host.
+    """
+
+    try:
+        container_id = docker("run", "-d", "-p", "127.0.0.1::5000", "registry:2")
+    except subprocess.CalledProcessError as e:
+        pytest.skip("Cannot run the registry:2 image (%s)"%e.stderr.strip())
+
+    try:
+        host = docker("port", container_id, "5000/tcp").splitlines()[0]
+
+        # the registry takes a moment to accept connections
+        for _ in range(50):
+            try:
+                urllib.request.urlopen("http://%s/v2/"%host, timeout=1)
+                break
+            except OSError:
+                time.sleep(0.2)
+
+        yield host
+
+    finally:
+        subprocess.run(["docker", "rm", "-f", "-v", container_id], stdout=subprocess.DEVNULL)
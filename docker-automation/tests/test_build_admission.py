@@ -0,0 +1,103 @@
+"""
+-------------------------------------------------
+MHub - tests of the admission of concurrent builds
+-------------------------------------------------
+"""
+
+import pytest
+
+from common import resources
+
+GB = 1024**3
+
+## --------------------------------
+
+@pytest.fixture
+def node(monkeypatch):
+
+    """
+    A node with plenty of memory and CPUs, whose free disk space is set by the test (under "free_disk").
+    """
+
+    node = {"free_disk": 100*GB}
+
+    monkeypatch.setattr(resources, "get_memory_info", lambda: {"total": 256*GB, "available": 256*GB})
+    monkeypatch.setattr(resources, "get_load_average", lambda: 0.0)
+    monkeypatch.setattr(resources, "get_free_disk", lambda path_to_folder=None: node["free_disk"])
+
+    return node
+
+def get_request(disk):
+    return {"memory": GB, "cpus": 1, "disk": disk*GB}
+
+## --------------------------------
+
+def test_disk_written_by_running_builds_not_counted_twice(node):
+
+    admission = resources.BuildAdmission(disk_reserve=5*GB)
+    admission.ncpus = 8
+
+    with admission.admit("mhubai/base:latest", get_request(60)):
+
+        # nothing written yet: 60 GB reserved, 95 GB usable
+        assert admission.check_request(get_request(40)) == "disk space"
+
+        # the running build wrote 50 GB of its 60 GB: only 10 GB are still reserved
+        node["free_disk"] = 50*GB
+        assert admission.check_request(get_request(30)) is None
+        assert admission.check_request(get_request(36)) == "disk space"
+
+    # once done, the build reserves nothing (what it wrote stays missing from the free space)
+    assert admission.disk_reservations == dict()
+
+def test_disk_used_taken_from_reservations_in_proportion(node):
+
+    admission = resources.BuildAdmission(disk_reserve=0)
+    admission.ncpus = 8
+
+    with admission.admit("mhubai/base:latest", get_request(30)):
+        with admission.admit("mhubai/lungmask:latest", get_request(10)):
+            node["free_disk"] = 80*GB
+            admission.check_request(get_request(1))
+
+            assert admission.disk_reservations == {"mhubai/base:latest": 15*GB, "mhubai/lungmask:latest": 5*GB}
+
+            # freeing disk space (e.g., pruning images) gives nothing back to the reservations
+            node["free_disk"] = 90*GB
+            admission.check_request(get_request(1))
+            assert sum(admission.disk_reservations.values()) == 20*GB
+
+def test_build_admitted_when_nothing_runs(node):
+
+    node["free_disk"] = GB
+    admission = resources.BuildAdmission()
+
+    assert admission.check_request(get_request(500)) is None
+
+def test_cpus_limited_to_the_cpu_affinity(node, monkeypatch):
+
+    # e.g., `taskset -c 0-1` on a node with more CPUs
+    monkeypatch.setattr(resources, "get_allowed_cpus", lambda: [0, 1])
+
+    admission = resources.BuildAdmission()
+
+    with admission.admit("mhubai/base:latest", get_request(1)):
+        assert admission.check_request(get_request(1)) is None
+
+        with admission.admit("mhubai/lungmask:latest", get_request(1)):
+            assert admission.check_request(get_request(1)) == "CPUs reserved by the running builds"
+
+def test_load_of_the_running_builds_does_not_serialize_them(node, monkeypatch):
+
+    admission = resources.BuildAdmission()
+    admission.ncpus = 4
+
+    with admission.admit("mhubai/base:latest", get_request(1)):
+
+        # the running build (and the test containers) keep the CPUs busy
+        monkeypatch.setattr(resources, "get_load_average", lambda: 4.5)
+        assert admission.check_request(get_request(1)) is None
+
+        # the node is oversubscribed
+        monkeypatch.setattr(resources, "get_load_average", lambda: 8.0)
+        assert admission.check_request(get_request(1)) == "load average"
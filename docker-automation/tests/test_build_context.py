@@ -0,0 +1,113 @@
+"""
+-------------------------------------------------
+MHub - tests of the build contexts sent to the builder
+-------------------------------------------------
+"""
+
+import os
+import fcntl
+import tarfile
+
+import pytest
+
+from conftest import load_stage_utils
+
+## --------------------------------
+
+@pytest.fixture
+def build_utils():
+    return load_stage_utils("build")
+
+@pytest.fixture
+def context_dir(tmp_path, monkeypatch):
+
+    # the build context is the folder the build is run from
+    path_to_context = tmp_path / "models"
+
+    for path in ["models/lungmask/config/default.yml", "models/lungmask/.env", "models/lungmask/.hidden/weights",
+                 "models/lungmask/dockerfiles/Dockerfile", ".dockerignore"]:
+        os.makedirs(os.path.dirname(str(path_to_context / path)), exist_ok=True)
+        (path_to_context / path).write_text(path)
+
+    monkeypatch.chdir(path_to_context)
+
+    return path_to_context
+
+def get_image_dict(context_dir, name="lungmask"):
+    return {"name": name, "version": "latest", "repository_folder": str(context_dir),
+            "dockerfile": "models/lungmask/dockerfiles/Dockerfile"}
+
+## --------------------------------
+
+def test_glob_context_matches_hidden_files(build_utils, context_dir):
+
+    relpaths = lambda paths: [os.path.relpath(path, str(context_dir)) for path in paths]
+
+    assert relpaths(build_utils.glob_context(str(context_dir), "models/lungmask/*")) == \
+        ["models/lungmask/.env", "models/lungmask/.hidden", "models/lungmask/config", "models/lungmask/dockerfiles"]
+    assert relpaths(build_utils.glob_context(str(context_dir), "./models/*/.env")) == ["models/lungmask/.env"]
+    assert relpaths(build_utils.glob_context(str(context_dir), "/.docker*")) == [".dockerignore"]
+    assert build_utils.glob_context(str(context_dir), "models/missing/*") == []
+
+def test_context_files_include_hidden_files(build_utils, context_dir):
+
+    dockerfile = "FROM mhubai/base:latest\nCOPY models/lungmask/* /app/models/lungmask/\n"
+
+    assert build_utils.get_context_files(get_image_dict(context_dir), dockerfile) == \
+        ["models/lungmask/.env", "models/lungmask/.hidden/weights", "models/lungmask/config/default.yml",
+         "models/lungmask/dockerfiles/Dockerfile"]
+
+def test_context_tar(build_utils, context_dir, tmp_path):
+
+    dockerfile = "FROM mhubai/base:latest\nCOPY models/lungmask/config /app/models/lungmask/config\n"
+    cache_dir = str(tmp_path / "contexts")
+
+    with build_utils.use_context_tar(get_image_dict(context_dir), dockerfile, cache_dir=cache_dir) as path_to_tar:
+        with tarfile.open(path_to_tar) as tar:
+            names = tar.getnames()
+
+    assert build_utils.context_dockerfile_name in names
+    assert "models/lungmask/config/default.yml" in names
+
+    # the same content is not archived again
+    assert build_utils.create_context_tar(get_image_dict(context_dir), dockerfile, cache_dir=cache_dir) == path_to_tar
+
+def test_context_tars_not_evicted_while_in_use(build_utils, context_dir, tmp_path, monkeypatch):
+
+    monkeypatch.setattr(build_utils, "max_cached_contexts", 1)
+
+    cache_dir = str(tmp_path / "contexts")
+    get_dockerfile = lambda i: "FROM mhubai/base:latest\nCOPY models/lungmask/config /app/config%d\n"%i
+
+    with build_utils.use_context_tar(get_image_dict(context_dir), get_dockerfile(0), cache_dir=cache_dir) as first:
+
+        # another build done meanwhile (e.g., by another thread or run) does not delete the archive being read
+        with build_utils.use_context_tar(get_image_dict(context_dir), get_dockerfile(1), cache_dir=cache_dir):
+            pass
+
+        assert os.path.isfile(first)
+
+    # once no build is reading an archive, only the most recently used one is kept
+    with build_utils.use_context_tar(get_image_dict(context_dir), get_dockerfile(2), cache_dir=cache_dir) as last:
+        pass
+
+    assert sorted(os.listdir(cache_dir)) == sorted([".lock", os.path.basename(last)])
+
+def test_context_tars_not_evicted_while_locked_by_another_process(build_utils, context_dir, tmp_path, monkeypatch):
+
+    monkeypatch.setattr(build_utils, "max_cached_contexts", 0)
+
+    cache_dir = str(tmp_path / "contexts")
+    dockerfile = "FROM mhubai/base:latest\nCOPY models/lungmask/config /app/config\n"
+
+    path_to_tar = build_utils.create_context_tar(get_image_dict(context_dir), dockerfile, cache_dir=cache_dir)
+
+    # a separate open file description, as another process (e.g., a concurrent run of the build stage) would have
+    with open(os.path.join(cache_dir, ".lock"), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_SH)
+
+        build_utils.evict_context_tars(cache_dir)
+        assert os.path.isfile(path_to_tar)
+
+    build_utils.evict_context_tars(cache_dir)
+    assert not os.path.isfile(path_to_tar)
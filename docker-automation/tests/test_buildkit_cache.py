@@ -0,0 +1,210 @@
+"""
+-------------------------------------------------
+MHub - tests of the build keys and of the layer cache, and of the BuildKit cache in a local registry (needs Docker)
+-------------------------------------------------
+"""
+
+import uuid
+import subprocess
+
+import pytest
+
+from conftest import load_stage_utils, docker, requires_docker
+
+## --------------------------------
+
+def init_models_repository(path_to_repo, dockerfiles):
+
+    """
+    Creates a models repository with an image per Dockerfile of `dockerfiles` ({name: content}), stored in
+    `models/<name>/dockerfiles/Dockerfile` along with a `models/<name>/config/default.yml`.
+    """
+
+    for name, dockerfile in dockerfiles.items():
+        (path_to_repo / "models" / name / "dockerfiles").mkdir(parents=True)
+        (path_to_repo / "models" / name / "dockerfiles" / "Dockerfile").write_text(dockerfile)
+        (path_to_repo / "models" / name / "config").mkdir()
+        (path_to_repo / "models" / name / "config" / "default.yml").write_text("name: %s\n"%name)
+
+    commit(path_to_repo, "Add the models", init=True)
+
+def commit(path_to_repo, message, init=False):
+
+    if init:
+        subprocess.run(["git", "init", "-q", str(path_to_repo)], check=True)
+
+    subprocess.run(["git", "-C", str(path_to_repo), "add", "-A"], check=True)
+    subprocess.run(["git", "-C", str(path_to_repo), "commit", "-q", "--allow-empty", "-m", message], check=True)
+
+def get_image_dict(path_to_repo, name, folder=None):
+    return {"name": name, "version": "latest", "dockerhub_username": "mhubai", "repository_folder": str(path_to_repo),
+            "dockerfile": "models/%s/dockerfiles/Dockerfile"%(folder if folder is not None else name)}
+
+fetch_dockerfile = "FROM mhubai/base:latest\nRUN pip install torch\nRUN git init && \\\n" \
+                   "    git fetch https://github.com/MHubAI/models.git main\nCMD [\"echo\"]\n"
+
+## --------------------------------
+
+def test_models_tree_arg():
+
+    build_utils = load_stage_utils("build")
+
+    assert build_utils.fetches_models_repository(fetch_dockerfile)
+    assert build_utils.add_models_tree_arg(fetch_dockerfile).splitlines() == \
+        ["FROM mhubai/base:latest", "RUN pip install torch", "ARG MHUB_MODELS_TREE", "RUN git init && \\",
+         "    git fetch https://github.com/MHubAI/models.git main", "CMD [\"echo\"]"]
+
+    dockerfile = "FROM mhubai/base:latest\nRUN git clone https://github.com/MHubAI/models.git /app/models\n"
+
+    assert not build_utils.fetches_models_repository(dockerfile)
+    assert build_utils.add_models_tree_arg(dockerfile) == dockerfile
+
+def test_build_key_only_changes_with_the_image_folder(git_env, tmp_path, monkeypatch):
+
+    build_utils = load_stage_utils("build")
+
+    # the parent image was not rebuilt in between
+    monkeypatch.setattr(build_utils.docker_api, "get_image_id", lambda image_tag, use_api=False: "sha256:base")
+
+    path_to_repo = tmp_path / "models"
+    init_models_repository(path_to_repo, {"lungmask": fetch_dockerfile, "platipy": fetch_dockerfile})
+    monkeypatch.chdir(path_to_repo)
+
+    image_dicts = {name: get_image_dict(path_to_repo, name) for name in ["lungmask", "platipy"]}
+    get_keys = lambda: {name: build_utils.get_build_key(image_dict) for name, image_dict in image_dicts.items()}
+    get_tree_args = lambda: {name: build_utils.get_models_tree_arg(image_dict)[1]["MHUB_MODELS_TREE"]
+                             for name, image_dict in image_dicts.items()}
+
+    first_keys, first_tree_args = get_keys(), get_tree_args()
+
+    # a commit to another folder (or to the folder of another model) changes neither the keys nor the build arguments
+    (path_to_repo / "README.md").write_text("MHub models\n")
+    commit(path_to_repo, "Add a README")
+
+    (path_to_repo / "models" / "platipy" / "config" / "default.yml").write_text("name: platipy\nmodality: CT\n")
+    commit(path_to_repo, "Update platipy")
+
+    last_keys, last_tree_args = get_keys(), get_tree_args()
+
+    assert last_keys["lungmask"] == first_keys["lungmask"]
+    assert last_tree_args["lungmask"] == first_tree_args["lungmask"]
+    assert last_keys["platipy"] != first_keys["platipy"]
+    assert last_tree_args["platipy"] != first_tree_args["platipy"]
+
+def test_layer_cache_used_on_key_miss(git_env, tmp_path, monkeypatch):
+
+    pytest.importorskip("tqdm")
+
+    build = load_stage_utils("pipeline").load_stage("build")
+
+    builds = dict()
+    monkeypatch.setattr(build.utils, "build_docker_image",
+                        lambda image_dict, no_cache, use_api, buildkit: builds.setdefault(image_dict["name"], no_cache))
+    monkeypatch.setattr(build.docker_api, "get_image_id", lambda image_tag, use_api=False: "sha256:image")
+
+    dockerfiles = {"fetch": "FROM mhubai/base:latest\nRUN git fetch https://github.com/MHubAI/models.git main\n",
+                   "clone": "FROM mhubai/base:latest\nRUN git clone https://github.com/MHubAI/models.git /app/models\n"}
+
+    path_to_repo = tmp_path / "models"
+    init_models_repository(path_to_repo, dockerfiles)
+    monkeypatch.chdir(path_to_repo)
+
+    build_index = {"images": dict(), "commits": dict()}
+    path_to_index = str(tmp_path / "build_index.json")
+
+    for name in dockerfiles:
+        image_dict = get_image_dict(path_to_repo, name)
+
+        # without index: from scratch, unless built with BuildKit
+        build.run_core(dict(image_dict, name=name + "-classic"))
+        build.run_core(dict(image_dict, name=name + "-buildkit"), buildkit={})
+        build.run_core(dict(image_dict, name=name + "-forced"), force_rebuild=True, buildkit={})
+
+        # incremental: the image was never built (key miss), the layer cache is still used
+        build.run_core(dict(image_dict, name=name + "-indexed"), build_index=build_index, path_to_index=path_to_index)
+
+    # the models cloned by another command could be those of another commit: the cache is never used
+    assert builds == {"fetch-classic": True, "fetch-buildkit": False, "fetch-forced": True, "fetch-indexed": False,
+                      "clone-classic": True, "clone-buildkit": True, "clone-forced": True, "clone-indexed": True}
+
+## --------------------------------
+
+@pytest.fixture
+def buildx_builder():
+
+    """
+    Creates a `docker-container` buildx builder for the duration of the test (a new one has an empty layer cache,
+    and reaches the local registry through the network of the host), and returns a function creating another one.
+    """
+
+    builders = list()
+
+    def create_builder():
+        name = "mhub-test-%s"%uuid.uuid4().hex[:12]
+
+        try:
+            docker("buildx", "create", "--name", name, "--driver", "docker-container",
+                   "--driver-opt", "network=host")
+        except subprocess.CalledProcessError as e:
+            pytest.skip("Cannot create a buildx builder (%s)"%e.stderr.strip())
+
+        builders.append(name)
+        return name
+
+    yield create_builder
+
+    for name in builders:
+        subprocess.run(["docker", "buildx", "rm", "-f", name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+@requires_docker
+def test_buildkit_cache_in_local_registry(local_registry, buildx_builder, git_env, tmp_path, monkeypatch):
+
+    build_utils = load_stage_utils("build")
+
+    # every layer writes a random value, which only stays the same if the layer comes from the cache
+    dockerfile = "FROM busybox:latest\n" \
+                 "RUN cat /proc/sys/kernel/random/uuid > /dependencies\n" \
+                 "RUN echo git fetch https://github.com/MHubAI/models.git main > /models && " \
+                 "cat /proc/sys/kernel/random/uuid >> /models\n"
+
+    path_to_repo = tmp_path / "models"
+    init_models_repository(path_to_repo, {"buildkit-test": dockerfile})
+
+    # the build context is the folder the build is run from
+    monkeypatch.chdir(path_to_repo)
+
+    image_dict = get_image_dict(path_to_repo, name="buildkit-test-%s"%uuid.uuid4().hex[:12], folder="buildkit-test")
+    image_tag = build_utils.get_image_tag(image_dict)
+
+    get_files = lambda: docker("run", "--rm", image_tag, "cat", "/dependencies", "/models")
+
+    def build_image():
+
+        # every build runs on a new builder: the layers can only come from the cache exported to the registry
+        build_utils.build_docker_image_buildkit(image_dict, builder=buildx_builder(),
+                                                cache_registry="%s/mhubai"%local_registry)
+        return get_files()
+
+    try:
+        first_files = build_image()
+
+        # nothing changed: every layer is imported from the registry
+        assert build_image() == first_files
+
+        # a commit to the folder of another model: every layer is still imported from the registry
+        (path_to_repo / "models" / "other").mkdir()
+        (path_to_repo / "models" / "other" / "README.md").write_text("other\n")
+        commit(path_to_repo, "Add another model")
+
+        assert build_image() == first_files
+
+        # the image folder changed: the layers from the one fetching the models repository onwards are built again
+        (path_to_repo / "models" / "buildkit-test" / "config" / "default.yml").write_text("name: changed\n")
+        commit(path_to_repo, "Update the model")
+        last_files = build_image()
+
+        assert last_files.splitlines()[0] == first_files.splitlines()[0]
+        assert last_files.splitlines()[1:] != first_files.splitlines()[1:]
+
+    finally:
+        subprocess.run(["docker", "rmi", "-f", image_tag], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
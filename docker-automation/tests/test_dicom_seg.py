@@ -0,0 +1,152 @@
+"""
+-------------------------------------------------
+MHub - tests of the decoding of DICOM SEG files
+-------------------------------------------------
+"""
+
+import pytest
+
+from common import dicom_seg
+
+np = pytest.importorskip("numpy")
+sitk = pytest.importorskip("SimpleITK")
+pydicom = pytest.importorskip("pydicom")
+pydicom_seg = pytest.importorskip("pydicom_seg")
+
+# the frames are 13x11 pixels: they do not start on a byte boundary in the bit-packed pixel data
+shape = (6, 13, 11)
+
+## --------------------------------
+
+def get_template(segments):
+
+    """
+    Returns the DICOM SEG template of `pydicom_seg` declaring the segments `segments`.
+    """
+
+    code = lambda value, meaning: {"CodeValue": value, "CodingSchemeDesignator": "SCT", "CodeMeaning": meaning}
+
+    segment_attributes = [{"labelID": segment, "SegmentDescription": "Segment %d"%segment,
+                           "SegmentAlgorithmType": "AUTOMATIC", "SegmentAlgorithmName": "MHub",
+                           "SegmentedPropertyCategoryCodeSequence": code("123037004", "Anatomical Structure"),
+                           "SegmentedPropertyTypeCodeSequence": code("10200004", "Liver"),
+                           "recommendedDisplayRGBValue": [255, 0, 0]} for segment in segments]
+
+    return pydicom_seg.template.from_dcmqi_metainfo({"ContentCreatorName": "MHub", "ClinicalTrialSeriesID": "1",
+                                                     "ClinicalTrialTimePointID": "1", "SeriesDescription": "Test",
+                                                     "SeriesNumber": "300", "InstanceNumber": "1",
+                                                     "segmentAttributes": [segment_attributes]})
+
+def write_seg(labels, path_to_file):
+
+    """
+    Writes a label array (z, y, x) as a multi-segment DICOM SEG (one segment per label), referencing a made up
+    CT series.
+    """
+
+    image = sitk.GetImageFromArray(labels)
+    image.SetSpacing((0.7, 0.8, 2.5))
+    image.SetOrigin((-10.0, 5.0, 30.0))
+
+    study_uid, series_uid, frame_uid = [pydicom.uid.generate_uid() for _ in range(3)]
+    source_images = list()
+
+    for z in range(labels.shape[0]):
+        source_image = pydicom.Dataset()
+        source_image.SOPClassUID = "1.2.840.10008.5.1.4.1.1.2"
+        source_image.SOPInstanceUID = pydicom.uid.generate_uid()
+        source_image.StudyInstanceUID, source_image.SeriesInstanceUID = study_uid, series_uid
+        source_image.FrameOfReferenceUID = frame_uid
+        source_image.ImagePositionPatient = list(image.TransformIndexToPhysicalPoint((0, 0, z)))
+        source_image.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        source_images.append(source_image)
+
+    segments = sorted(set(np.unique(labels).tolist()) - {0})
+    dcm = pydicom_seg.MultiClassWriter(get_template(segments)).write(image, source_images)
+    dcm.save_as(str(path_to_file))
+
+    return dcm
+
+def get_labels(seed=0):
+
+    # the first and last slices are empty (and not stored in the DICOM SEG)
+    labels = np.zeros(shape, dtype=np.uint8)
+    labels[1:-1] = np.random.default_rng(seed).integers(0, 4, (shape[0] - 2,) + shape[1:])
+
+    return labels
+
+def get_segment_masks(path_to_file):
+
+    """
+    Returns the binary mask of every segment of a DICOM SEG ({segment number: mask}), decoded by `pydicom_seg`.
+    """
+
+    result = pydicom_seg.SegmentReader().read(pydicom.dcmread(str(path_to_file)))
+
+    return {segment: sitk.GetArrayFromImage(result.segment_image(segment)) > 0
+            for segment in sorted(result.available_segments)}
+
+## --------------------------------
+
+def test_unpack_frames_across_byte_boundaries():
+
+    rows, columns = shape[1:]
+    frames = np.random.default_rng(0).integers(0, 2, (7, rows, columns)).astype(bool)
+    buffer = np.packbits(frames.ravel(), bitorder="little")
+
+    for start, stop in [(0, 7), (1, 4), (3, 7), (5, 6)]:
+        assert np.array_equal(dicom_seg.unpack_frames(buffer, start, stop, rows, columns, 1), frames[start:stop])
+
+    # fractional DICOM SEGs store a byte per pixel
+    fractional = frames.astype(np.uint8)*255
+    assert np.array_equal(dicom_seg.unpack_frames(fractional.ravel(), 2, 5, rows, columns, 8), frames[2:5])
+
+@pytest.mark.parametrize("memory_budget", [None, 4*shape[1]*shape[2]*2, 1])
+def test_read_labels_matches_pydicom_seg(tmp_path, memory_budget):
+
+    path_to_file = tmp_path / "labels.seg.dcm"
+    write_seg(get_labels(), path_to_file)
+
+    # memory budgets of all of the frames at once, 4 frames (not dividing the number of frames) and a single frame
+    seg_data = dicom_seg.read_labels(str(path_to_file), memory_budget=memory_budget)
+    segment_masks = get_segment_masks(path_to_file)
+
+    assert list(seg_data["segments"]) == list(segment_masks) == [1, 2, 3]
+    assert seg_data["spacing"] == pytest.approx([2.5, 0.8, 0.7])
+    assert seg_data["masks"] is None
+
+    for segment, mask in segment_masks.items():
+        assert np.array_equal(seg_data["array"] == segment, mask)
+
+@pytest.mark.parametrize("memory_budget", [None, 4*shape[1]*shape[2]*2])
+def test_overlapping_segments_read_as_masks(tmp_path, memory_budget):
+
+    path_to_file = tmp_path / "labels.seg.dcm"
+    dcm = write_seg(get_labels(), path_to_file)
+
+    # the frames of segment 2 also cover segment 1 (in the same slice)
+    frame_info = dicom_seg.read_frame_info(dcm)
+    nframes, frame_size = len(frame_info["frame_segments"]), shape[1]*shape[2]
+
+    frames = np.unpackbits(np.frombuffer(dcm.PixelData, dtype=np.uint8), bitorder="little")[:nframes*frame_size]
+    frames = frames.astype(bool).reshape((nframes,) + shape[1:])
+
+    for frame_idx in np.flatnonzero(frame_info["frame_segments"] == 2):
+        slice_idx = frame_info["frame_slices"][frame_idx]
+        frame_idx1 = np.flatnonzero((frame_info["frame_segments"] == 1) & (frame_info["frame_slices"] == slice_idx))
+        frames[frame_idx] |= frames[frame_idx1].any(axis=0)
+
+    pixel_data = np.packbits(frames.ravel(), bitorder="little").tobytes()
+    dcm.PixelData = pixel_data + b"\x00"*(len(pixel_data) % 2)
+    dcm.SegmentsOverlap = "YES"
+    dcm.save_as(str(path_to_file))
+
+    seg_data = dicom_seg.read_labels(str(path_to_file), memory_budget=memory_budget)
+    segment_masks = get_segment_masks(path_to_file)
+
+    assert seg_data["array"] is None
+    assert list(seg_data["segments"]) == list(segment_masks) == [1, 2, 3]
+    assert (segment_masks[1] & segment_masks[2]).any()
+
+    for idx, (segment, mask) in enumerate(segment_masks.items()):
+        assert np.array_equal(seg_data["masks"][idx], mask)
@@ -0,0 +1,75 @@
+"""
+-------------------------------------------------
+MHub - tests of the manifests of the output and reference directory trees
+-------------------------------------------------
+"""
+
+import os
+import json
+
+import pytest
+
+from conftest import load_stage_utils
+
+## --------------------------------
+
+@pytest.fixture(scope="module")
+def test_utils():
+    return load_stage_utils("test")
+
+@pytest.fixture
+def reference_dir(tmp_path):
+
+    path_to_dir = tmp_path / "reference"
+    (path_to_dir / "seg").mkdir(parents=True)
+    (path_to_dir / "seg" / "lungs.nii.gz").write_bytes(b"lungs")
+    (path_to_dir / "report.json").write_text("{}")
+
+    return str(path_to_dir)
+
+## --------------------------------
+
+def test_stored_manifest_is_used(test_utils, reference_dir):
+
+    manifest = test_utils.write_dir_manifest(reference_dir)
+    assert [entry[0] for entry in manifest] == ["report.json", "seg", "seg/lungs.nii.gz"]
+
+    # the stored manifest is used as is while the tree does not change (a made-up size shows it)
+    path_to_manifest = os.path.join(reference_dir, test_utils.manifest_file_name)
+    with open(path_to_manifest) as f:
+        manifest_dict = json.load(f)
+    manifest_dict["entries"][0][2] = 1234
+    with open(path_to_manifest, "w") as f:
+        json.dump(manifest_dict, f)
+
+    assert test_utils.load_dir_manifest(reference_dir)[0] == ("report.json", "file", 1234, manifest[0][3])
+
+def test_stale_manifest_is_ignored(test_utils, reference_dir):
+
+    test_utils.write_dir_manifest(reference_dir)
+
+    # a file added to a subdirectory changes the mtime of the subdirectory only
+    path_to_file = os.path.join(reference_dir, "seg", "heart.nii.gz")
+    with open(path_to_file, "wb") as f:
+        f.write(b"heart")
+    os.utime(os.path.join(reference_dir, "seg"), ns=(0, 12345))
+
+    relpath_list = [entry[0] for entry in test_utils.load_dir_manifest(reference_dir)]
+    assert relpath_list == ["report.json", "seg", "seg/heart.nii.gz", "seg/lungs.nii.gz"]
+
+def test_legacy_manifest_is_ignored(test_utils, reference_dir):
+
+    with open(os.path.join(reference_dir, test_utils.manifest_file_name), "w") as f:
+        json.dump([["made-up.json", "file", 1, None]], f)
+
+    assert [entry[0] for entry in test_utils.load_dir_manifest(reference_dir)] == \
+        ["report.json", "seg", "seg/lungs.nii.gz"]
+
+def test_nested_manifests_are_excluded(test_utils, reference_dir):
+
+    with open(os.path.join(reference_dir, "seg", test_utils.manifest_file_name), "w") as f:
+        f.write("[]")
+
+    manifest = test_utils.get_dir_manifest(reference_dir)
+
+    assert [entry[0] for entry in manifest] == ["report.json", "seg", "seg/lungs.nii.gz"]
@@ -0,0 +1,329 @@
+"""
+-------------------------------------------------
+MHub - tests of the Docker Engine API client, against a stub daemon listening on a Unix socket
+-------------------------------------------------
+"""
+
+import os
+import json
+import shutil
+import asyncio
+import tempfile
+import urllib.parse
+
+import pytest
+
+from common import docker_api
+
+## --------------------------------
+
+class StubDaemon:
+
+    """
+    A minimal HTTP/1.1 server on a Unix socket, answering the requests with the handler registered for their route.
+
+    Handlers are called as `handler(method, path, query, body)` and return a (status, headers, body) tuple, where
+    `body` is either bytes or a list of chunks (sent with chunked transfer encoding). With `drop_reused`, the stub
+    closes a connection without answering when a second request is sent on it (as when the daemon closes an idle
+    connection while the client reuses it).
+    """
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.routes = dict()
+        self.requests = list()
+        self.connections = 0
+        self.drop_reused = False
+        self.server = None
+        self.handlers = set()
+
+    def route(self, method, path, handler):
+        self.routes[(method, path)] = handler
+
+    async def start(self):
+        self.server = await asyncio.start_unix_server(self.handle, path=self.socket_path)
+
+    async def stop(self):
+        self.server.close()
+
+        # the connections still open (e.g., kept alive by the client) are closed too
+        for handler in list(self.handlers):
+            handler.cancel()
+        await asyncio.gather(*self.handlers, return_exceptions=True)
+
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        self.handlers.add(asyncio.current_task())
+        nrequests = 0
+
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+
+                method, url, _ = request_line.decode("latin-1").split(" ")
+
+                headers = dict()
+                while True:
+                    line = await reader.readline()
+                    if line in [b"\r\n", b""]:
+                        break
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                parsed_url = urllib.parse.urlparse(url)
+                path = urllib.parse.unquote(parsed_url.path)[len("/" + docker_api.DEFAULT_API_VERSION):]
+                query = dict(urllib.parse.parse_qsl(parsed_url.query))
+                self.requests.append({"method": method, "path": path, "query": query, "headers": headers,
+                                      "body": body})
+
+                if self.drop_reused and nrequests > 0:
+                    break
+                nrequests += 1
+
+                handler = self.routes.get((method, path))
+                if handler is None:
+                    status, response_headers, response_body = 404, dict(), json.dumps({"message": "not found"}).encode()
+                else:
+                    status, response_headers, response_body = handler(method, path, query, body)
+
+                head = "HTTP/1.1 %d Stub\r\n"%status
+                head += "".join(["%s: %s\r\n"%(k, v) for k, v in response_headers.items()])
+
+                if isinstance(response_body, list):
+                    head += "Transfer-Encoding: chunked\r\n\r\n"
+                    writer.write(head.encode("latin-1"))
+                    for chunk in response_body:
+                        writer.write(b"%x\r\n"%len(chunk) + chunk + b"\r\n")
+                        await writer.drain()
+                    writer.write(b"0\r\n\r\n")
+                else:
+                    if status not in [204, 304]:
+                        head += "Content-Length: %d\r\n"%len(response_body)
+                    writer.write((head + "\r\n").encode("latin-1") + response_body)
+
+                await writer.drain()
+
+        finally:
+            writer.close()
+            self.handlers.discard(asyncio.current_task())
+
+def json_response(obj, status=200):
+    return status, {"Content-Type": "application/json"}, json.dumps(obj).encode()
+
+@pytest.fixture
+def socket_path():
+
+    # the path to a Unix socket is limited to ~100 characters, which pytest's tmp_path can exceed
+    socket_dir = tempfile.mkdtemp(prefix="mhub-docker-", dir="/tmp")
+    yield os.path.join(socket_dir, "docker.sock")
+    shutil.rmtree(socket_dir, ignore_errors=True)
+
+def run_with_daemon(socket_path, setup_fn, test_fn):
+
+    """
+    Starts a stub daemon (set up by `setup_fn`), runs `test_fn(client, daemon)` against it, then stops both.
+    """
+
+    async def main():
+        daemon = StubDaemon(socket_path)
+        setup_fn(daemon)
+        await daemon.start()
+
+        client = docker_api.DockerClient(socket_path=socket_path)
+
+        try:
+            return await test_fn(client, daemon)
+        finally:
+            await client.close()
+            await daemon.stop()
+
+    return asyncio.run(main())
+
+## --------------------------------
+
+def test_build_streams_events(socket_path, tmp_path):
+
+    context_path = tmp_path / "context.tar"
+    context_path.write_bytes(b"tar" * 1000)
+
+    events = [{"stream": "Step 1/2 : FROM ubuntu\n"}, {"stream": "Successfully tagged mhubai/base:latest\n"}]
+    payload = b"".join([json.dumps(event).encode() + b"\r\n" for event in events])
+
+    def setup(daemon):
+        # the events are split in arbitrary chunks (an object across chunks, several objects in a chunk)
+        daemon.route("POST", "/build", lambda *args: (200, {"Content-Type": "application/json"},
+                                                       [payload[:7], payload[7:60], payload[60:]]))
+
+    async def test(client, daemon):
+        received = await docker_api.collect_events(client.build(str(context_path), tag="mhubai/base:latest",
+                                                                nocache=True, buildargs={"A": "1"}))
+        request = daemon.requests[0]
+        return received, request
+
+    received, request = run_with_daemon(socket_path, setup, test)
+
+    assert received == events
+    assert request["body"] == b"tar" * 1000
+    assert request["headers"]["content-type"] == "application/x-tar"
+    assert request["query"]["t"] == "mhubai/base:latest"
+    assert request["query"]["nocache"] == "1"
+    assert json.loads(request["query"]["buildargs"]) == {"A": "1"}
+
+def test_build_error_in_stream(socket_path):
+
+    payload = json.dumps({"stream": "Step 1/1"}).encode() + json.dumps({"error": "no space left"}).encode()
+
+    def setup(daemon):
+        daemon.route("POST", "/build", lambda *args: (200, dict(), [payload]))
+
+    async def test(client, daemon):
+        with pytest.raises(docker_api.DockerAPIError, match="no space left"):
+            await docker_api.collect_events(client.build(b"tar", tag="mhubai/base:latest"))
+
+    run_with_daemon(socket_path, setup, test)
+
+def test_stream_keeps_multibyte_characters_split_across_chunks(socket_path):
+
+    payload = json.dumps({"stream": "Modèle ✓ 模型\n"}, ensure_ascii=False).encode("utf-8")
+
+    # split every few bytes, so that multi-byte characters end up across chunks
+    chunks = [payload[idx:idx + 3] for idx in range(0, len(payload), 3)]
+
+    def setup(daemon):
+        daemon.route("POST", "/build", lambda *args: (200, dict(), chunks))
+
+    async def test(client, daemon):
+        return await docker_api.collect_events(client.build(b"tar", tag="mhubai/base:latest"))
+
+    assert run_with_daemon(socket_path, setup, test) == [{"stream": "Modèle ✓ 模型\n"}]
+
+def test_inspect_image(socket_path):
+
+    def setup(daemon):
+        daemon.route("GET", "/images/mhubai/base:latest/json", lambda *args: json_response({"Id": "sha256:abc"}))
+
+    async def test(client, daemon):
+        found = await client.inspect_image("mhubai/base:latest")
+        missing = await client.inspect_image("mhubai/missing:latest")
+        return found, missing, daemon
+
+    found, missing, daemon = run_with_daemon(socket_path, setup, test)
+
+    assert found == {"Id": "sha256:abc"}
+    assert missing is None
+    # the connection is kept alive between requests
+    assert daemon.connections == 1
+
+def test_push_image(socket_path):
+
+    def setup(daemon):
+        daemon.route("POST", "/images/localhost:5000/mhubai/base/push",
+                     lambda *args: (200, dict(), [b'{"status": "Pushing"}', b'{"status": "latest: digest: sha256:1"}']))
+
+    async def test(client, daemon):
+        events = await docker_api.collect_events(client.push_image("localhost:5000/mhubai/base:v1", auth="abc"))
+        return events, daemon.requests[0]
+
+    events, request = run_with_daemon(socket_path, setup, test)
+
+    assert [event["status"] for event in events] == ["Pushing", "latest: digest: sha256:1"]
+    assert request["query"]["tag"] == "v1"
+    assert request["headers"]["x-registry-auth"] == "abc"
+
+def test_run_wait_remove_container(socket_path):
+
+    def setup(daemon):
+        daemon.route("POST", "/containers/create", lambda *args: json_response({"Id": "c0ffee"}, status=201))
+        daemon.route("POST", "/containers/c0ffee/start", lambda *args: (204, dict(), b""))
+        daemon.route("POST", "/containers/c0ffee/wait", lambda *args: json_response({"StatusCode": 3}))
+        daemon.route("DELETE", "/containers/c0ffee", lambda *args: (204, dict(), b""))
+
+    async def test(client, daemon):
+        exit_code = await client.run_container({"Image": "mhubai/base:latest", "Cmd": ["true"]}, name="test")
+        return exit_code, daemon.requests
+
+    exit_code, requests = run_with_daemon(socket_path, setup, test)
+
+    assert exit_code == 3
+    assert [(request["method"], request["path"]) for request in requests] == [
+        ("POST", "/containers/create"), ("POST", "/containers/c0ffee/start"),
+        ("POST", "/containers/c0ffee/wait"), ("DELETE", "/containers/c0ffee")]
+    assert json.loads(requests[0]["body"]) == {"Image": "mhubai/base:latest", "Cmd": ["true"]}
+    assert requests[0]["query"]["name"] == "test"
+    assert requests[3]["query"]["force"] == "1"
+
+def test_run_container_removed_when_start_fails(socket_path):
+
+    def setup(daemon):
+        daemon.route("POST", "/containers/create", lambda *args: json_response({"Id": "c0ffee"}, status=201))
+        daemon.route("POST", "/containers/c0ffee/start", lambda *args: json_response({"message": "no GPU"}, 500))
+        daemon.route("DELETE", "/containers/c0ffee", lambda *args: (204, dict(), b""))
+
+    async def test(client, daemon):
+        with pytest.raises(docker_api.DockerAPIError, match="no GPU"):
+            await client.run_container({"Image": "mhubai/base:latest"})
+        return daemon.requests[-1]
+
+    assert run_with_daemon(socket_path, setup, test)["method"] == "DELETE"
+
+def test_prune_images(socket_path):
+
+    def setup(daemon):
+        daemon.route("POST", "/images/prune", lambda *args: json_response({"ImagesDeleted": None,
+                                                                           "SpaceReclaimed": 1024}))
+
+    async def test(client, daemon):
+        return await client.prune_images(), daemon.requests[0]
+
+    result, request = run_with_daemon(socket_path, setup, test)
+
+    assert result["SpaceReclaimed"] == 1024
+    assert json.loads(request["query"]["filters"]) == {"dangling": ["true"]}
+
+def test_reconnects_when_pooled_connection_was_closed(socket_path):
+
+    def setup(daemon):
+        daemon.route("GET", "/_ping", lambda *args: (200, {"Content-Type": "text/plain"}, b"OK"))
+
+    async def test(client, daemon):
+        # the connection is kept alive, but the daemon drops it when it is reused
+        daemon.drop_reused = True
+
+        results = list()
+        for _ in range(3):
+            results.append(await client.ping())
+
+        return results, daemon.connections, [request["path"] for request in daemon.requests]
+
+    results, connections, paths = run_with_daemon(socket_path, setup, test)
+
+    # every request is sent again (once) on a new connection
+    assert results == [True, True, True]
+    assert connections == 3
+    assert paths == ["/_ping"]*5
+
+def test_run_sync_from_threads(socket_path):
+
+    loop = asyncio.new_event_loop()
+    daemon = StubDaemon(socket_path)
+    daemon.route("GET", "/images/mhubai/base:latest/json", lambda *args: json_response({"Id": "sha256:abc"}))
+    loop.run_until_complete(daemon.start())
+
+    import threading
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    try:
+        client = docker_api.get_client(socket_path=socket_path)
+        assert docker_api.run_sync(client.inspect_image("mhubai/base:latest")) == {"Id": "sha256:abc"}
+        docker_api.run_sync(client.close())
+    finally:
+        asyncio.run_coroutine_threadsafe(daemon.stop(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
@@ -0,0 +1,130 @@
+"""
+-------------------------------------------------
+MHub - tests of the sync of the models repository (a local bare repository stands for the remote)
+-------------------------------------------------
+"""
+
+import os
+import subprocess
+
+import pytest
+
+from conftest import load_stage_utils
+from common import git_sync
+
+## --------------------------------
+
+def git(path_to_repo, *git_args):
+    return subprocess.run(["git", "-C", str(path_to_repo)] + list(git_args), check=True, text=True,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout.strip()
+
+def commit_file(path_to_clone, relpath, content, branch="main"):
+    git(path_to_clone, "checkout", "--quiet", "-B", branch)
+    with open(os.path.join(str(path_to_clone), relpath), "w") as f:
+        f.write(content)
+    git(path_to_clone, "add", relpath)
+    git(path_to_clone, "commit", "--quiet", "-m", "update %s"%relpath)
+    git(path_to_clone, "push", "--quiet", "origin", branch)
+    return git(path_to_clone, "rev-parse", "HEAD")
+
+@pytest.fixture
+def repos(git_env, tmp_path):
+
+    """
+    Returns a (remote, upstream clone, local repository) tuple, with a first commit on main.
+    """
+
+    remote = tmp_path / "remote.git"
+    upstream = tmp_path / "upstream"
+    local = tmp_path / "models"
+
+    subprocess.run(["git", "init", "--quiet", "--bare", "-b", "main", str(remote)], check=True)
+    subprocess.run(["git", "clone", "--quiet", str(remote), str(upstream)], check=True, stderr=subprocess.DEVNULL)
+    commit_file(upstream, "README.md", "first")
+    subprocess.run(["git", "clone", "--quiet", str(remote), str(local)], check=True)
+
+    return remote, upstream, local
+
+## --------------------------------
+
+def test_cache_hit_does_not_contact_the_remote(repos, tmp_path):
+
+    remote, upstream, local = repos
+    cache_path = str(tmp_path / "remote_refs.json")
+
+    result = git_sync.sync_repository(str(local), str(remote), cache_path=cache_path, ttl=300)
+    assert result.from_cache is False
+    assert result.fetched == ["main"]
+
+    # the remote is gone, the cached commits are used anyway (and nothing needs to be fetched)
+    os.rename(str(remote), str(tmp_path / "moved.git"))
+
+    result = git_sync.sync_repository(str(local), str(remote), cache_path=cache_path, ttl=300)
+    assert result.from_cache is True
+    assert result.fetched == list()
+    assert result.updated is False
+
+def test_fetch_new_commit(repos, tmp_path):
+
+    remote, upstream, local = repos
+    cache_path = str(tmp_path / "remote_refs.json")
+
+    git_sync.sync_repository(str(local), str(remote), cache_path=cache_path, ttl=0)
+
+    new_hash = commit_file(upstream, "model.py", "second")
+    commit_file(upstream, "branch.py", "branch", branch="patch-models")
+
+    result = git_sync.sync_repository(str(local), str(remote), branches=["patch-models"], cache_path=cache_path,
+                                      ttl=0)
+
+    assert result.from_cache is False
+    assert sorted(result.fetched) == ["main", "patch-models"]
+    assert result.updated is True
+    assert result.commit_hash == new_hash
+    assert git(local, "rev-parse", "HEAD") == new_hash
+
+    # nothing changed on the remote: nothing is fetched
+    result = git_sync.sync_repository(str(local), str(remote), branches=["patch-models"], cache_path=cache_path,
+                                      ttl=0)
+    assert result.fetched == list()
+    assert result.updated is False
+
+def test_missing_branch_raises(repos, tmp_path):
+
+    remote, upstream, local = repos
+
+    with pytest.raises(git_sync.GitSyncError):
+        git_sync.sync_repository(str(local), str(remote), branches=["no-such-branch"],
+                                 cache_path=str(tmp_path / "remote_refs.json"), ttl=0)
+
+def test_worktree_checkout(repos, tmp_path):
+
+    remote, upstream, local = repos
+    build_utils = load_stage_utils("build")
+
+    commit_file(upstream, "model.py", "v1", branch="patch-models")
+    git_sync.sync_repository(str(local), str(remote), branches=["patch-models"],
+                             cache_path=str(tmp_path / "remote_refs.json"), ttl=0)
+
+    worktree_dir = str(tmp_path / "worktrees")
+    path_to_worktree = build_utils.get_branch_worktree(str(local), "patch-models", worktree_dir=worktree_dir)
+
+    with open(os.path.join(path_to_worktree, "model.py")) as f:
+        assert f.read() == "v1"
+
+    # the checkout of the repository itself is left on main
+    assert not os.path.exists(os.path.join(str(local), "model.py"))
+
+    # a new commit of the branch is checked out in the same worktree (leftover files are cleaned)
+    commit_file(upstream, "model.py", "v2", branch="patch-models")
+    git_sync.sync_repository(str(local), str(remote), branches=["patch-models"],
+                             cache_path=str(tmp_path / "remote_refs.json"), ttl=0)
+
+    with open(os.path.join(path_to_worktree, "leftover.txt"), "w") as f:
+        f.write("leftover")
+
+    assert build_utils.get_branch_worktree(str(local), "patch-models", worktree_dir=worktree_dir) == path_to_worktree
+
+    with open(os.path.join(path_to_worktree, "model.py")) as f:
+        assert f.read() == "v2"
+    assert not os.path.exists(os.path.join(path_to_worktree, "leftover.txt"))
@@ -0,0 +1,94 @@
+"""
+-------------------------------------------------
+MHub - tests of the label metrics computed when comparing the segmentations
+-------------------------------------------------
+"""
+
+import pytest
+
+from conftest import load_stage_utils
+
+np = pytest.importorskip("numpy")
+
+## --------------------------------
+
+@pytest.fixture(scope="module")
+def test_utils():
+    return load_stage_utils("test")
+
+def get_cube(shape, start, stop, label=1):
+    array = np.zeros(shape, dtype=np.uint8)
+    array[start[0]:stop[0], start[1]:stop[1], start[2]:stop[2]] = label
+    return array
+
+## --------------------------------
+
+def test_dice_and_volumes(test_utils):
+
+    array1 = get_cube((10, 10, 10), (2, 2, 2), (6, 6, 6))
+    array2 = get_cube((10, 10, 10), (2, 2, 2), (6, 6, 4))
+
+    report = test_utils.compute_label_metrics(array1, array2, spacing=(2.0, 1.0, 1.0))
+
+    assert report["labels"][1]["voxels1"] == 64
+    assert report["labels"][1]["voxels2"] == 32
+    assert report["labels"][1]["dice"] == pytest.approx(2*32/96)
+    assert report["labels"][1]["volume_difference"] == pytest.approx(64.0)
+    assert "hausdorff" not in report["labels"][1]
+
+@pytest.mark.parametrize("offset", [0, -5, 2000])
+def test_confusion_matrix_accumulated_in_chunks(test_utils, offset):
+
+    rng = np.random.default_rng(0)
+
+    # labels used as indices directly, negative labels and large labels (mapped to consecutive indices first)
+    array1 = rng.integers(0, 5, (13, 17, 11)).astype(np.int32) + offset
+    array2 = rng.integers(2, 9, (13, 17, 11)).astype(np.int32) + offset
+
+    labels, confusion = test_utils.get_confusion_matrix(array1, array2, chunk_size=1000)
+
+    assert list(labels) == list(range(offset, offset + 9))
+    for i, label1 in enumerate(labels):
+        for j, label2 in enumerate(labels):
+            assert confusion[i, j] == np.count_nonzero((array1 == label1) & (array2 == label2))
+
+    # the chunks do not change the matrix
+    assert np.array_equal(test_utils.get_confusion_matrix(array1, array2)[1], confusion)
+
+def test_integer_float_labels_are_accepted(test_utils):
+
+    array1 = get_cube((8, 8, 8), (1, 1, 1), (4, 4, 4), label=3).astype(np.float32)
+    array2 = get_cube((8, 8, 8), (1, 1, 1), (4, 4, 4), label=3)
+
+    report = test_utils.compute_label_metrics(array1, array2)
+
+    assert list(report["labels"]) == [3]
+    assert report["dice"] == 1.0
+
+def test_non_integer_float_labels_are_rejected(test_utils):
+
+    # a probability map would be truncated to (mostly) background
+    array1 = np.full((4, 4, 4), 0.9, dtype=np.float32)
+    array2 = np.ones((4, 4, 4), dtype=np.uint8)
+
+    with pytest.raises(ValueError, match="non-integer"):
+        test_utils.compute_label_metrics(array1, array2)
+
+def test_surface_metrics_are_printed(test_utils, capsys):
+
+    pytest.importorskip("SimpleITK")
+
+    array1 = get_cube((12, 12, 12), (2, 2, 2), (8, 8, 8))
+    array2 = get_cube((12, 12, 12), (2, 2, 2), (8, 8, 10))
+
+    report = test_utils.compute_label_metrics(array1, array2, spacing=(1.0, 1.0, 1.0), surface_metrics=True)
+
+    assert report["labels"][1]["hausdorff"] == pytest.approx(2.0)
+    assert report["labels"][1]["hausdorff95"] <= report["labels"][1]["hausdorff"]
+    assert report["labels"][1]["mean_surface_distance"] > 0
+
+    test_utils.print_label_metrics(report)
+    printed = capsys.readouterr().out
+
+    assert "Hausdorff 95" in printed
+    assert "2.000" in printed
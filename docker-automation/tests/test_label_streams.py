@@ -0,0 +1,142 @@
+"""
+-------------------------------------------------
+MHub - tests of the bounded-memory reading of large label volumes
+-------------------------------------------------
+"""
+
+import io
+import zlib
+
+import pytest
+
+from conftest import load_stage_utils
+from common import label_streams
+
+np = pytest.importorskip("numpy")
+sitk = pytest.importorskip("SimpleITK")
+
+# the formats read by `label_streams.read_header`, raw and compressed (NIfTI files are compressed as .nii.gz)
+file_formats = [(".nrrd", False), (".nrrd", True), (".mha", False), (".mha", True), (".mhd", False), (".mhd", True),
+                (".nii", False), (".nii.gz", True)]
+
+## --------------------------------
+
+@pytest.fixture(scope="module")
+def test_utils():
+    return load_stage_utils("test")
+
+def get_labels(shape, dtype, seed=0):
+
+    """
+    Returns a label volume whose labels change along z (so that some labels are only found in the last slices).
+    """
+
+    rng = np.random.default_rng(seed)
+    labels = rng.integers(0, 3, shape)
+
+    labels[-2:][labels[-2:] == 2] = 7
+
+    return labels.astype(dtype)
+
+def write_image(array, path_to_file, compressed, spacing=(0.8, 0.7, 2.5)):
+
+    image = sitk.GetImageFromArray(array)
+    image.SetSpacing(spacing[:array.ndim])
+    sitk.WriteImage(image, str(path_to_file), useCompression=compressed)
+
+    return str(path_to_file)
+
+def read_slabs(header, nslices):
+    return [np.array(slab) for slab in label_streams.iter_slabs(header, nslices)]
+
+## --------------------------------
+
+@pytest.mark.parametrize("extension, compressed", file_formats)
+@pytest.mark.parametrize("dtype", [np.uint8, np.int16, np.uint32])
+def test_iter_slabs_matches_simpleitk(tmp_path, extension, compressed, dtype):
+
+    # odd sizes, and slabs of 3 slices not dividing the 7 slices of the volume
+    array = get_labels((7, 5, 9), dtype)
+    path_to_file = write_image(array, tmp_path / ("labels" + extension), compressed)
+
+    header = label_streams.read_header(path_to_file)
+
+    assert header["shape"] == (7, 5, 9)
+    assert header["spacing"] == pytest.approx((2.5, 0.7, 0.8))
+    assert header["dtype"] == np.dtype(dtype)
+    assert (header["compression"] is not None) == compressed
+
+    slabs = read_slabs(header, 3)
+
+    assert [slab.shape[0] for slab in slabs] == [3, 3, 1]
+    assert np.array_equal(np.concatenate(slabs), sitk.GetArrayFromImage(sitk.ReadImage(path_to_file)))
+
+    # a single slab
+    assert np.array_equal(read_slabs(header, 7)[0], array)
+
+def test_2d_image_read_as_a_single_slice(tmp_path):
+
+    array = get_labels((5, 9), np.uint8)
+    header = label_streams.read_header(write_image(array, tmp_path / "labels.nrrd", False))
+
+    assert header["shape"] == (1, 5, 9)
+    assert np.array_equal(read_slabs(header, 4)[0][0], array)
+
+def test_unsupported_files(tmp_path):
+
+    # a vector image (e.g., RGB) is not a label volume
+    path_to_file = tmp_path / "rgb.nrrd"
+    sitk.WriteImage(sitk.Image([4, 4, 4], sitk.sitkVectorUInt8, 3), str(path_to_file))
+
+    assert label_streams.read_header(str(path_to_file)) is None
+    assert label_streams.read_header(str(tmp_path / "labels.png")) is None
+
+    # a truncated file
+    path_to_file = tmp_path / "truncated.nii.gz"
+    write_image(get_labels((7, 5, 9), np.uint8), path_to_file, True)
+    path_to_file.write_bytes(path_to_file.read_bytes()[:-40])
+
+    with pytest.raises((ValueError, EOFError, zlib.error)):
+        read_slabs(label_streams.read_header(str(path_to_file)), 3)
+
+def test_zlib_reader():
+
+    data = bytes(np.random.default_rng(0).integers(0, 4, 100000, dtype=np.uint8))
+    read = label_streams.get_zlib_reader(io.BytesIO(zlib.compress(data)), chunk_size=1000)
+
+    # reads of any size, crossing the compressed chunks
+    assert read(1) + read(33333) + read(66666) == data
+    assert read(10) == b""
+
+## --------------------------------
+
+@pytest.mark.parametrize("extension, compressed", file_formats)
+def test_confusion_matrix_accumulated_per_slab(tmp_path, test_utils, extension, compressed):
+
+    output_array = get_labels((7, 5, 9), np.uint8, seed=1)
+    reference_array = get_labels((7, 5, 9), np.int16, seed=2)
+
+    output_header = label_streams.read_header(write_image(output_array, tmp_path / ("output" + extension), compressed))
+    reference_header = label_streams.read_header(write_image(reference_array, tmp_path / ("reference" + extension),
+                                                             compressed))
+
+    # slabs of 3 slices (the labels found in every slab are merged with the labels found so far)
+    memory_budget = label_streams.confusion_chunk_memory + 3*5*9*4*2
+
+    assert min(label_streams.get_slice_count(output_header, memory_budget),
+               label_streams.get_slice_count(reference_header, memory_budget)) == 3
+
+    labels, confusion = label_streams.get_confusion_matrix(output_header, reference_header, memory_budget,
+                                                           test_utils.get_confusion_matrix)
+    expected_labels, expected_confusion = test_utils.get_confusion_matrix(output_array, reference_array)
+
+    assert list(labels) == list(expected_labels) == [0, 1, 2, 7]
+    assert np.array_equal(confusion, expected_confusion)
+
+def test_confusion_matrix_of_volumes_of_different_shapes(tmp_path, test_utils):
+
+    header1 = label_streams.read_header(write_image(get_labels((7, 5, 9), np.uint8), tmp_path / "a.nrrd", False))
+    header2 = label_streams.read_header(write_image(get_labels((7, 5, 8), np.uint8), tmp_path / "b.nrrd", False))
+
+    with pytest.raises(ValueError, match="different shape"):
+        label_streams.get_confusion_matrix(header1, header2, 1024**3, test_utils.get_confusion_matrix)
@@ -0,0 +1,69 @@
+"""
+-------------------------------------------------
+MHub - tests of the streaming build, test and push pipeline
+-------------------------------------------------
+"""
+
+import threading
+
+import pytest
+
+from conftest import load_stage_utils
+
+## --------------------------------
+
+@pytest.mark.parametrize("sequential_tests", [False, True])
+def test_run_pipeline_pushes_parents_first_and_skips_failed_images(sequential_tests):
+
+    pipeline_utils = load_stage_utils("pipeline")
+    build_utils = load_stage_utils("build")
+
+    # the base images have no tests: "base" is pushed once "lungmask" passes its tests, "other-base" is never pushed
+    build_graph = {"base": [], "lungmask": ["base"], "platipy": ["base"], "platipy-gpu": ["platipy"],
+                   "totalsegmentator": ["base"], "other-base": [], "casust": ["other-base"]}
+    tests_dict = {image_tag: [{"image_to_test": image_tag, "workflow_name": workflow_name}
+                              for workflow_name in ["default", "fast"]]
+                  for image_tag in ["lungmask", "platipy", "platipy-gpu", "totalsegmentator", "casust"]}
+
+    lock = threading.Lock()
+    calls = {"build": list(), "test": list(), "push": list()}
+
+    def build_fn(image_dict):
+        with lock:
+            calls["build"].append(image_dict["name"])
+        return None if image_dict["name"] == "platipy" else "sha256:%s"%image_dict["name"]
+
+    def test_fn(test_dict, slot_dict):
+        with lock:
+            calls["test"].append(test_dict["image_to_test"])
+        return {"passed": test_dict["image_to_test"] not in ["totalsegmentator", "casust"]}
+
+    def push_fn(image_tag):
+        with lock:
+            calls["push"].append(image_tag)
+        return {"status": "pushed"}
+
+    events = list(pipeline_utils.run_pipeline(
+        [{"name": image_tag} for image_tag in build_graph], build_graph, tests_dict,
+        build_fn = build_fn,
+        test_fn = test_fn,
+        push_fn = push_fn,
+        get_image_tag = lambda image_dict: image_dict["name"],
+        get_downstream_images = build_utils.get_downstream_images,
+        nbuild = 2,
+        slot_list = [{"slot": 0}, {"slot": 1}],
+        npush = 2,
+        is_test_passed = lambda result: result["passed"],
+        sequential_tests = sequential_tests))
+
+    # the images depending on an image that failed to build are neither built nor tested
+    assert sorted(calls["build"]) == ["base", "casust", "lungmask", "other-base", "platipy", "totalsegmentator"]
+    assert sorted(set(calls["test"])) == ["casust", "lungmask", "totalsegmentator"]
+    assert ("platipy-gpu", "build", None, None) in events
+
+    # only the images whose tests passed (or, without tests, those of an image built from them) are pushed
+    assert calls["push"] == ["base", "lungmask"]
+    assert sorted([image_tag for image_tag, stage, _, _ in events if stage == "push"]) == ["base", "lungmask"]
+
+    assert len([event for event in events if event[1] == "test"]) == 6
+    assert len([event for event in events if event[1] == "build"]) == len(build_graph)
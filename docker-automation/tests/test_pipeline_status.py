@@ -0,0 +1,98 @@
+"""
+-------------------------------------------------
+MHub - tests of the status of the pipeline in watch mode
+-------------------------------------------------
+"""
+
+import types
+import argparse
+import threading
+
+import pytest
+
+from conftest import load_stage_utils
+
+## --------------------------------
+
+def test_tests_of_the_same_workflow_tracked_per_data_sample():
+
+    pipeline_utils = load_stage_utils("pipeline")
+    status = pipeline_utils.PipelineStatus()
+
+    started = threading.Barrier(3)
+    release = threading.Event()
+
+    def test_fn(test_dict, slot_dict):
+        started.wait()
+        release.wait()
+
+    test_fn = status.track("test", test_fn, get_key = pipeline_utils.get_test_key)
+
+    test_list = [{"image_to_test": "mhubai/lungmask:latest", "workflow_name": "default", "data_sample": data_sample}
+                 for data_sample in ["chest_ct", "lidc_idri"]]
+    threads = [threading.Thread(target=test_fn, args=(test_dict, None)) for test_dict in test_list]
+
+    for thread in threads:
+        thread.start()
+
+    try:
+        started.wait()
+        assert sorted([job["name"] for job in status.to_dict()["in_flight"]["test"]]) == [
+            "mhubai/lungmask:latest - default - chest_ct", "mhubai/lungmask:latest - default - lidc_idri"]
+    finally:
+        release.set()
+        for thread in threads:
+            thread.join()
+
+    assert status.to_dict()["in_flight"]["test"] == list()
+
+## --------------------------------
+
+class StopWatching(Exception):
+    pass
+
+def test_watch_runs_a_failed_commit_again(tmp_path, monkeypatch):
+
+    pytest.importorskip("tqdm")
+
+    pipeline = load_stage_utils("pipeline").load_stage("pipeline")
+
+    for config_name in ["build.yml", "test.yml"]:
+        (tmp_path / config_name).write_text("")
+
+    monkeypatch.setattr(pipeline.build, "load_config", lambda config_paths: {"github": {"repository_folder": "models",
+                                                                                        "repository_url": "url"}})
+    monkeypatch.setattr(pipeline.build.utils, "load_build_index", lambda path: {"images": dict(), "commits": dict()})
+    monkeypatch.setattr(pipeline.build.utils.git_sync, "sync_repository",
+                        lambda **kwargs: types.SimpleNamespace(commit_hash="a"*40))
+
+    # the first run fails (e.g., the registry is down), the next ones succeed
+    runs = list()
+
+    def run_once(args, config_dict, commit_hash, build_index=None, run_id=None, status=None):
+        runs.append(commit_hash)
+        if len(runs) == 1:
+            raise ConnectionError("registry unreachable")
+        return {"built": 1, "failed": list(), "pushed": list()}
+
+    monkeypatch.setattr(pipeline, "run_once", run_once)
+
+    sleeps = list()
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        if len(sleeps) == 4:
+            raise StopWatching()
+
+    monkeypatch.setattr(pipeline.time, "sleep", sleep)
+
+    args = argparse.Namespace(build_config=[str(tmp_path / "build.yml")], test_config=[str(tmp_path / "test.yml")],
+                              outpath=str(tmp_path / "reports"), branch="main", build_index=None, dryrun=False,
+                              worktree_dir=None, status_port=None, interval=30, max_interval=120, trace_dir=None)
+
+    with pytest.raises(StopWatching):
+        pipeline.watch(args)
+
+    # the failed commit is run again after the backoff, and not run again once a run on it succeeded
+    assert runs == ["a"*40]*2
+    assert sleeps == [60, 30, 30, 30]
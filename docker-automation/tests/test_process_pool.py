@@ -0,0 +1,74 @@
+"""
+-------------------------------------------------
+MHub - tests of the worker processes comparing the output files
+-------------------------------------------------
+"""
+
+import sys
+import json
+import time
+
+import pytest
+
+from concurrent.futures.process import BrokenProcessPool
+
+from conftest import load_stage_utils
+from common import process_pool
+from common import tracing
+
+## --------------------------------
+
+def sleep(seconds):
+    time.sleep(seconds)
+    return seconds
+
+def write_json(path, obj):
+    with open(str(path), "w") as f:
+        json.dump(obj, f)
+    return str(path)
+
+@pytest.fixture
+def trace(monkeypatch):
+
+    # the state of the trace is restored once the test is done
+    for key, value in tracing.get_state().items():
+        monkeypatch.setitem(tracing._trace, key, value)
+
+    tracing.start_trace()
+    yield
+    tracing.pop_spans()
+
+## --------------------------------
+
+def test_workers_load_the_stage_module(tmp_path, trace):
+
+    # the test stage helpers are loaded from their path (as `test_utils`), which a spawned worker cannot import
+    test_utils = load_stage_utils("test")
+
+    output_file_list = [write_json(tmp_path / ("out%d.json"%idx), {"idx": idx}) for idx in range(3)]
+    reference_file_list = [write_json(tmp_path / ("ref%d.json"%idx), {"idx": idx if idx != 1 else -1})
+                           for idx in range(3)]
+
+    file_report_list = test_utils.compare_file_list(output_file_list, reference_file_list, fail_fast=False,
+                                                    nworkers=2)
+
+    assert [file_report["match"] for file_report in file_report_list] == [True, False, True]
+
+    # the spans of the comparisons are recorded in the workers, and sent back
+    spans = tracing.pop_spans()
+    assert sorted([span["args"]["path"] for span in spans]) == sorted(output_file_list)
+
+def test_terminate_does_not_wait_for_running_tasks():
+
+    executor = process_pool.get_process_pool(2, sys.modules[__name__])
+    futures = [executor.submit(sleep, 60) for _ in range(6)]
+
+    # the first two tasks are running, the last ones have not started (or even been sent to the workers)
+    time.sleep(2.0)
+
+    start_time = time.time()
+    process_pool.terminate_process_pool(executor)
+
+    assert time.time() - start_time < 10
+    assert all([future.done() for future in futures])
+    assert all([future.cancelled() or isinstance(future.exception(), BrokenProcessPool) for future in futures])
@@ -0,0 +1,95 @@
+"""
+-------------------------------------------------
+MHub - tests of the push order, and of the push to a local registry (needs Docker)
+-------------------------------------------------
+"""
+
+import uuid
+import threading
+import subprocess
+
+import pytest
+
+from conftest import load_stage_utils, docker, requires_docker
+
+## --------------------------------
+
+def build_image(path_to_context, image_tag, dockerfile, content):
+
+    path_to_context.mkdir()
+    (path_to_context / "Dockerfile").write_text(dockerfile)
+    (path_to_context / "layer.txt").write_text(content)
+
+    docker("build", "--quiet", "-t", image_tag, str(path_to_context))
+
+## --------------------------------
+
+def test_push_graph_in_local_registry():
+
+    push_utils = load_stage_utils("push")
+
+    image_list = [{"name": "localhost:5000/mhubai/lungmask:v1"}, {"name": "mhubai/lungmask:v1"},
+                  {"name": "localhost:5000/mhubai/base:v1"}, {"name": "mhubai/base:v1"},
+                  {"name": "localhost:5000/mhubai/totalsegmentator:v2"}]
+
+    # the base image is only pushed first to its own registry (with the same tag)
+    assert push_utils.get_push_graph(image_list) == {
+        "localhost:5000/mhubai/lungmask:v1": ["localhost:5000/mhubai/base:v1"],
+        "mhubai/lungmask:v1": ["mhubai/base:v1"],
+        "localhost:5000/mhubai/base:v1": [],
+        "mhubai/base:v1": [],
+        "localhost:5000/mhubai/totalsegmentator:v2": [],
+    }
+
+@requires_docker
+def test_push_images_sharing_a_base(local_registry, tmp_path):
+
+    pytest.importorskip("tqdm")
+    push = load_stage_utils("pipeline").load_stage("push")
+
+    # new content at every run, so that the layers are not in the registry yet
+    tag = uuid.uuid4().hex[:12]
+    base_tag = "%s/mhubai/base:%s"%(local_registry, tag)
+    model_tags = ["%s/mhubai/%s:%s"%(local_registry, model, tag) for model in ["lungmask", "totalsegmentator"]]
+
+    build_image(tmp_path / "base", base_tag, "FROM scratch\nCOPY layer.txt /base.txt\n", tag)
+    for model_tag in model_tags:
+        build_image(tmp_path / model_tag.split("/")[-1].split(":")[0], model_tag,
+                    "FROM %s\nCOPY layer.txt /model.txt\n"%base_tag, model_tag)
+
+    image_list = [{"name": model_tag} for model_tag in model_tags] + [{"name": base_tag}]
+    push_graph = push.utils.get_push_graph(image_list)
+
+    pushing = {"now": 0, "max": 0, "started": list()}
+    lock = threading.Lock()
+
+    def core_fn(image_dict):
+        with lock:
+            pushing["now"] += 1
+            pushing["max"] = max(pushing["max"], pushing["now"])
+            pushing["started"].append(image_dict["name"])
+        try:
+            return push.run_core(image_dict)
+        finally:
+            with lock:
+                pushing["now"] -= 1
+
+    try:
+        results = dict(push.utils.run_push_graph(image_list, push_graph, core_fn, ncores=3, nper_registry=1))
+
+        assert {image_tag: result["status"] for image_tag, result in results.items()} == \
+            {image_tag: "pushed" for image_tag in [base_tag] + model_tags}
+
+        # one image at a time in the registry, the base image first
+        assert pushing["max"] == 1
+        assert pushing["started"][0] == base_tag
+
+        # the registry now stores the same images: nothing is pushed again
+        results = dict(push.utils.run_push_graph(image_list, push_graph, push.run_core, ncores=3, nper_registry=1))
+
+        assert {image_tag: result["status"] for image_tag, result in results.items()} == \
+            {image_tag: "up to date" for image_tag in [base_tag] + model_tags}
+
+    finally:
+        subprocess.run(["docker", "rmi", "-f"] + model_tags + [base_tag], stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
@@ -0,0 +1,107 @@
+"""
+-------------------------------------------------
+MHub - tests of the cache of the decoded reference files
+-------------------------------------------------
+"""
+
+import os
+import hashlib
+
+import pytest
+
+from common import reference_cache
+
+np = pytest.importorskip("numpy")
+
+## --------------------------------
+
+def test_file_hash_matches_sha256(tmp_path):
+
+    path_to_file = tmp_path / "reference.nrrd"
+    content = bytes(range(256))*10000
+    path_to_file.write_bytes(content)
+
+    assert reference_cache.get_file_hash(str(path_to_file)) == hashlib.sha256(content).hexdigest()
+
+def test_load_reference_decodes_once(tmp_path):
+
+    path_to_file = tmp_path / "reference.nrrd"
+    path_to_file.write_bytes(b"voxel data")
+    cache_dir = str(tmp_path / "cache")
+
+    calls = list()
+    def read_fn(path):
+        calls.append(path)
+        return {"array": np.arange(10, dtype=np.uint8)}
+
+    first = reference_cache.load_reference(str(path_to_file), read_fn, cache_dir=cache_dir)
+    second = reference_cache.load_reference(str(path_to_file), read_fn, cache_dir=cache_dir)
+
+    assert len(calls) == 1
+    assert second["file_hash"] == first["file_hash"] == reference_cache.get_file_hash(str(path_to_file))
+    assert second["array_hash"] == reference_cache.get_array_hash(np.arange(10, dtype=np.uint8))
+    assert (second["array"] == first["array"]).all()
+
+def test_cached_reference_memory_mapped_without_hashing_the_file(tmp_path, monkeypatch):
+
+    path_to_file = tmp_path / "reference.nrrd"
+    path_to_file.write_bytes(b"voxel data")
+    cache_dir = str(tmp_path / "cache")
+
+    read_fn = lambda path: {"array": np.arange(24, dtype=np.int16).reshape(2, 3, 4), "segments": np.array([1, 2])}
+    first = reference_cache.load_reference(str(path_to_file), read_fn, cache_dir=cache_dir)
+
+    # the entry is trusted as long as the path, modification time and size of the file did not change
+    monkeypatch.setattr(reference_cache, "get_file_hash", lambda path: pytest.fail("the file was hashed again"))
+    second = reference_cache.load_reference(str(path_to_file), read_fn, cache_dir=cache_dir)
+
+    assert isinstance(second["array"], np.memmap)
+    assert not second["array"].flags.writeable
+    assert np.array_equal(second["array"], first["array"]) and list(second["segments"]) == [1, 2]
+    assert second["file_hash"] == first["file_hash"] and second["array_hash"] == first["array_hash"]
+
+def test_changed_or_corrupt_entries_decoded_again(tmp_path):
+
+    path_to_file = tmp_path / "reference.nrrd"
+    path_to_file.write_bytes(b"voxel data")
+    cache_dir = str(tmp_path / "cache")
+
+    calls = list()
+    def read_fn(path):
+        calls.append(path)
+        return {"array": np.full(4, len(calls), dtype=np.uint8)}
+
+    reference_cache.load_reference(str(path_to_file), read_fn, cache_dir=cache_dir)
+
+    # a new reference file has a new entry
+    path_to_file.write_bytes(b"new voxel data")
+    assert list(reference_cache.load_reference(str(path_to_file), read_fn, cache_dir=cache_dir)["array"]) == [2]*4
+
+    # a corrupt entry is replaced
+    entry_path = reference_cache.get_entry_path(str(path_to_file), cache_dir=cache_dir)
+    with open(os.path.join(entry_path, "array.npy"), "wb") as f:
+        f.write(b"garbage")
+
+    assert list(reference_cache.load_reference(str(path_to_file), read_fn, cache_dir=cache_dir)["array"]) == [3]*4
+    assert list(reference_cache.load_reference(str(path_to_file), read_fn, cache_dir=cache_dir)["array"]) == [3]*4
+    assert len(calls) == 3
+
+def test_least_recently_used_entries_evicted(tmp_path):
+
+    cache_dir = str(tmp_path / "cache")
+    read_fn = lambda path: {"array": np.zeros(1000, dtype=np.uint8)}
+
+    paths = [tmp_path / ("reference%d.nrrd"%idx) for idx in range(3)]
+    for idx, path in enumerate(paths):
+        path.write_bytes(b"voxel data %d"%idx)
+
+    reference_cache.load_reference(str(paths[0]), read_fn, cache_dir=cache_dir)
+    entry_size = reference_cache.get_entry_size(reference_cache.get_entry_path(str(paths[0]), cache_dir=cache_dir))
+
+    # only two entries fit
+    for path in paths[1:]:
+        reference_cache.load_reference(str(path), read_fn, cache_dir=cache_dir, max_size=int(2.5*entry_size))
+
+    entries = [os.path.isdir(reference_cache.get_entry_path(str(path), cache_dir=cache_dir)) for path in paths]
+
+    assert entries == [False, True, True]
@@ -0,0 +1,169 @@
+"""
+-------------------------------------------------
+MHub - tests of the registry HTTP API lookups of the push stage, against a stub registry
+-------------------------------------------------
+"""
+
+import json
+import threading
+import http.server
+
+import pytest
+
+from conftest import load_stage_utils
+from common import docker_api
+
+pytest.importorskip("requests")
+
+## --------------------------------
+
+class StubRegistry(http.server.ThreadingHTTPServer):
+
+    """
+    A registry storing the manifests of `images` ({"repository:tag": config digest}), only served with a bearer token
+    issued by its own token endpoint (as DockerHub does). Changing `token` expires the tokens issued so far.
+    """
+
+    def __init__(self, images):
+        super().__init__(("127.0.0.1", 0), StubRegistryHandler)
+        self.images = images
+        self.token = "token-1"
+        self.token_requests = list()
+        self.manifest_requests = list()
+
+    @property
+    def host(self):
+        return "127.0.0.1:%d"%self.server_address[1]
+
+class StubRegistryHandler(http.server.BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, status, headers=None, body=b""):
+        self.send_response(status)
+        for key, value in (headers or dict()).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        registry = self.server
+
+        if self.path.startswith("/token"):
+            registry.token_requests.append(self.path)
+            return self.send(200, {"Content-Type": "application/json"},
+                             json.dumps({"token": registry.token}).encode())
+
+        # e.g., /v2/mhubai/base/manifests/v1
+        repository, _, tag = self.path[len("/v2/"):].partition("/manifests/")
+        registry.manifest_requests.append((self.command, repository, tag))
+
+        if self.headers.get("Authorization") != "Bearer %s"%registry.token:
+            challenge = 'Bearer realm="http://%s/token",service="stub",scope="repository:%s:pull"'%(registry.host,
+                                                                                                repository)
+            return self.send(401, {"WWW-Authenticate": challenge})
+
+        config_digest = registry.images.get("%s:%s"%(repository, tag))
+
+        if config_digest is None:
+            return self.send(404)
+
+        manifest = json.dumps({"schemaVersion": 2, "config": {"digest": config_digest}}).encode()
+        self.send(200, {"Docker-Content-Digest": "sha256:manifest-of-%s"%tag,
+                        "Content-Type": "application/vnd.docker.distribution.manifest.v2+json"}, manifest)
+
+@pytest.fixture
+def push_utils(monkeypatch, tmp_path):
+
+    push_utils = load_stage_utils("push")
+
+    # no credentials stored by `docker login`, and no token cached by other tests
+    monkeypatch.setenv("HOME", str(tmp_path))
+    monkeypatch.setattr(push_utils, "registry_tokens", dict())
+
+    return push_utils
+
+@pytest.fixture
+def registry():
+
+    registry = StubRegistry({"mhubai/base:v1": "sha256:base", "mhubai/lungmask:v1": "sha256:lungmask"})
+    thread = threading.Thread(target=registry.serve_forever, daemon=True)
+    thread.start()
+
+    yield registry
+
+    registry.shutdown()
+    registry.server_close()
+
+## --------------------------------
+
+def test_registry_location():
+
+    push_utils = load_stage_utils("push")
+
+    assert push_utils.get_registry_location("mhubai/base:latest") == ("https://registry-1.docker.io", "mhubai/base")
+    assert push_utils.get_registry_location("ubuntu:20.04") == ("https://registry-1.docker.io", "library/ubuntu")
+    assert push_utils.get_registry_location("localhost:5000/mhubai/base") == ("http://localhost:5000", "mhubai/base")
+    assert push_utils.get_registry_location("ghcr.io/mhubai/base:v1") == ("https://ghcr.io", "mhubai/base")
+
+def test_remote_digests(push_utils, registry):
+
+    image_tag = "%s/mhubai/base:v1"%registry.host
+
+    assert push_utils.get_remote_digest(image_tag) == "sha256:manifest-of-v1"
+    assert push_utils.get_remote_config_digest(image_tag) == "sha256:base"
+    assert push_utils.get_remote_digest("%s/mhubai/base:v2"%registry.host) is None
+
+    # the digest is looked up with a HEAD request (not counted as a pull)
+    assert registry.manifest_requests[:2] == [("HEAD", "mhubai/base", "v1")]*2
+
+def test_token_cached_per_repository(push_utils, registry):
+
+    for _ in range(3):
+        push_utils.get_remote_digest("%s/mhubai/base:v1"%registry.host)
+
+    # a single token for the repository, sent along with every request after the first one
+    assert len(registry.token_requests) == 1
+    assert len(registry.manifest_requests) == 4
+
+    push_utils.get_remote_digest("%s/mhubai/lungmask:v1"%registry.host)
+    assert len(registry.token_requests) == 2
+    assert "scope=repository%3Amhubai%2Flungmask%3Apull" in registry.token_requests[1]
+
+def test_expired_token_requested_again(push_utils, registry):
+
+    image_tag = "%s/mhubai/base:v1"%registry.host
+
+    push_utils.get_remote_digest(image_tag)
+    registry.token = "token-2"
+
+    assert push_utils.get_remote_digest(image_tag) == "sha256:manifest-of-v1"
+    assert len(registry.token_requests) == 2
+    assert push_utils.registry_tokens[("http://%s"%registry.host, "mhubai/base")] == "Bearer token-2"
+
+def test_image_up_to_date(push_utils, registry, monkeypatch):
+
+    local_images = {"%s/mhubai/base:v1"%registry.host: "sha256:base",
+                    "%s/mhubai/lungmask:v1"%registry.host: "sha256:rebuilt",
+                    "%s/mhubai/base:v2"%registry.host: "sha256:base"}
+
+    # the images were just built (never pushed or pulled): only their IDs are known
+    monkeypatch.setattr(push_utils, "get_local_digest", lambda image_tag, use_api=False: None)
+    monkeypatch.setattr(docker_api, "get_image_id", lambda image_tag, use_api=False: local_images[image_tag])
+
+    up_to_date = {image_tag: push_utils.is_image_up_to_date(image_tag) for image_tag in local_images}
+
+    assert up_to_date == {"%s/mhubai/base:v1"%registry.host: True,
+                          "%s/mhubai/lungmask:v1"%registry.host: False,
+                          "%s/mhubai/base:v2"%registry.host: False}
+
+def test_image_up_to_date_unreachable_registry(push_utils):
+
+    # nothing listens on port 9 (discard): the image is pushed
+    assert push_utils.is_image_up_to_date("127.0.0.1:9/mhubai/base:v1") is False
@@ -0,0 +1,75 @@
+"""
+-------------------------------------------------
+MHub - tests of the store of the automated testing results
+-------------------------------------------------
+"""
+
+import os
+import sqlite3
+
+from conftest import base_dir, load_stage_utils
+from common import results_store
+
+## --------------------------------
+
+def get_tables(path_to_store):
+
+    connection = sqlite3.connect(path_to_store)
+
+    try:
+        rows = connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()
+    finally:
+        connection.close()
+
+    return sorted([row[0] for row in rows])
+
+def get_test_result(image, workflow, passed=True, config="dev"):
+    return {"config": config, "image": image, "workflow": workflow, "data_sample": "chest_ct",
+            "dirtree_match": True, "output_match": passed}
+
+## --------------------------------
+
+def test_image_results(tmp_path):
+
+    path_to_store = results_store.get_store_path(str(tmp_path))
+
+    results_store.add_test_result(path_to_store, get_test_result("mhubai/lungmask:latest", "dicom"),
+                                  [{"output_file": "/out/seg.dcm", "match": True, "time": 1.0, "error": None}])
+    results_store.add_test_result(path_to_store, get_test_result("mhubai/lungmask:latest", "nifti", passed=False))
+    results_store.add_test_result(path_to_store, get_test_result("mhubai/totalsegmentator:latest", "dicom"))
+
+    assert results_store.get_image_results(path_to_store) == {"mhubai/lungmask:latest": False,
+                                                              "mhubai/totalsegmentator:latest": True}
+
+    # running the tests of a config again replaces its results
+    results_store.delete_results(path_to_store, "dev")
+    assert results_store.get_image_results(path_to_store) == dict()
+
+def test_stores_only_create_their_tables(tmp_path):
+
+    path_to_results = str(tmp_path / "results.db")
+    path_to_memo = str(tmp_path / "memo.db")
+
+    results_store.add_test_result(path_to_results, get_test_result("mhubai/lungmask:latest", "dicom"))
+    results_store.add_memo(path_to_memo, "key", get_test_result("mhubai/lungmask:latest", "dicom"))
+
+    assert get_tables(path_to_results) == ["files", "tests"]
+    assert get_tables(path_to_memo) == ["memo"]
+
+    assert results_store.get_memo(path_to_memo, "key")["output_match"] is True
+    assert results_store.get_memo(path_to_memo, "other key") is None
+
+def test_dryrun_leaves_the_store_untouched(tmp_path, capsys):
+
+    test = load_stage_utils("pipeline").load_stage("test")
+    outpath = str(tmp_path)
+
+    test.main(["--config", os.path.join(base_dir, "test", "config", "dev.yml"), "--outpath", outpath, "--dryrun"])
+    assert not os.path.exists(results_store.get_store_path(outpath))
+
+    # the results of a previous run are kept too
+    path_to_store = results_store.get_store_path(outpath)
+    results_store.add_test_result(path_to_store, get_test_result("mhubai/lungmask:latest", "dicom"))
+
+    test.main(["--config", os.path.join(base_dir, "test", "config", "dev.yml"), "--outpath", outpath, "--dryrun"])
+    assert results_store.get_image_results(path_to_store) == {"mhubai/lungmask:latest": True}
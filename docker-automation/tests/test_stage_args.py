@@ -0,0 +1,40 @@
+"""
+-------------------------------------------------
+MHub - tests of the command line arguments of the stages
+-------------------------------------------------
+"""
+
+import os
+import sys
+import subprocess
+
+import pytest
+
+from conftest import base_dir
+
+## --------------------------------
+
+def run_stage(stage, *stage_args):
+    return subprocess.run([sys.executable, os.path.join(base_dir, stage, "run.py")] + list(stage_args),
+                          text=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=base_dir)
+
+## --------------------------------
+
+def test_test_stage_rejects_docker_api_with_warm_containers(tmp_path):
+
+    output = run_stage("test", "--config", os.path.join(base_dir, "test", "config", "dev.yml"),
+                       "--outpath", str(tmp_path), "--docker_api", "--warm_containers")
+
+    assert output.returncode == 2
+    assert "--docker_api can not be used with --warm_containers" in output.stderr
+
+def test_pipeline_rejects_docker_api_with_warm_containers(tmp_path):
+
+    # the push stage (loaded by the pipeline) needs tqdm
+    pytest.importorskip("tqdm")
+
+    output = run_stage("pipeline", "--build_config", "build.yml", "--test_config", "test.yml",
+                       "--outpath", str(tmp_path), "--docker_api", "--warm_containers")
+
+    assert output.returncode == 2
+    assert "--docker_api can not be used with --warm_containers" in output.stderr
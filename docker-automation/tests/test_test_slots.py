@@ -0,0 +1,41 @@
+"""
+-------------------------------------------------
+MHub - tests of the slots the tests are run on
+-------------------------------------------------
+"""
+
+import pytest
+
+from conftest import load_stage_utils
+from common import resources
+
+## --------------------------------
+
+def test_format_cpuset():
+
+    assert resources.format_cpuset([0, 1, 2, 3]) == "0-3"
+    assert resources.format_cpuset([11, 10, 8, 0, 1, 2, 3]) == "0-3,8,10-11"
+    assert resources.format_cpuset([5]) == "5"
+
+def test_slots_use_the_allowed_cpus(monkeypatch):
+
+    test_utils = load_stage_utils("test")
+
+    # e.g., a CI runner restricted to the CPUs 4-7 and 12-15 of the node
+    monkeypatch.setattr(resources, "get_allowed_cpus", lambda: [4, 5, 6, 7, 12, 13, 14, 15])
+
+    assert test_utils.get_test_slots(2) == [{"gpu_device": None, "cpuset": "4-7"},
+                                            {"gpu_device": None, "cpuset": "12-15"}]
+    assert test_utils.get_test_slots(4, gpu_devices=["0", "1", "2"]) == [
+        {"gpu_device": "0", "cpuset": "4-5"}, {"gpu_device": "1", "cpuset": "6-7"},
+        {"gpu_device": "2", "cpuset": "12-13"}]
+
+    # more slots than CPUs: the containers are scheduled on all of them
+    assert test_utils.get_test_slots(16)[0] == {"gpu_device": None, "cpuset": None}
+
+@pytest.mark.skipif(not hasattr(__import__("os"), "sched_getaffinity"), reason="no CPU affinity on this platform")
+def test_allowed_cpus_match_the_affinity():
+
+    import os
+
+    assert resources.get_allowed_cpus() == sorted(os.sched_getaffinity(0))